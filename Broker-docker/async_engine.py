@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⚡ Asyncio Engine สำหรับ MQTT Broker
+===================================
+
+Engine ทางเลือกที่ให้บริการทุก connection จาก event loop เดียว
+แทนการสร้าง thread ต่อ client หนึ่งตัว
+
+Broker เป็นคนเก็บ state และประมวลผลข้อความเหมือนเดิม
+Engine มีหน้าที่แค่:
+- รับ connection ใหม่แล้วแจ้ง broker ผ่าน on_connect
+- ตัดข้อมูลที่ได้รับเป็นบรรทัด (JSON-line) แล้วส่งให้ on_frames ทีละ batch
+  หรือถอดรหัส MQTT packet (binary) แล้วส่งให้ on_packet
+- ในโหมด 'auto' ดู byte แรกของแต่ละ connection แล้วเลือก protocol ให้เอง
+- แจ้ง on_disconnect เมื่อ connection ปิด
+- จับเวลา ingress ของข้อมูลแต่ละชุดให้ LatencyTracker (ถ้ามี) ก่อนถอดรหัส
+"""
+
+import asyncio
+import logging
+import threading
+from time import perf_counter_ns
+
+from client_writer import OutboundQueue, BackpressureStats
+from frame_decoder import LineFrameDecoder, FrameTooLargeError, DEFAULT_READ_SIZE
+from mqtt_codec import MQTTStreamDecoder, MQTTProtocolError, detect_protocol
+
+logger = logging.getLogger(__name__)
+
+
+class TransportConnection(OutboundQueue):
+    """
+    🔌 ตัวห่อ asyncio transport ให้หน้าตาเหมือน socket
+
+    broker เรียก send() / close() ได้เหมือน socket ปกติ
+    และเรียกจาก thread อื่นนอก event loop ได้อย่างปลอดภัย
+
+    send() ใส่ frame ลงคิวขาออก (OutboundQueue) แล้วนัดให้ loop เขียนทีเดียว
+    ทุก frame ที่เกิดในรอบเดียวกันของ loop จึงถูกส่งด้วย writelines() ครั้งเดียว
+    เมื่อ transport บอกว่า buffer ของตัวเองเต็ม (pause_writing) ข้อมูลจะค้างในคิวนี้
+    ซึ่งเป็นที่ที่ backpressure policy ทำงาน
+    """
+
+    def __init__(self, transport, loop, loop_thread, limits=None, stats=None):
+        super().__init__(limits, stats)
+        self.transport = transport
+        self.loop = loop
+        self.loop_thread = loop_thread
+        self.scheduled = False
+        self.writing_paused = False
+        self.pause_pending = 0      # จำนวนคิวของ subscriber ที่ยังรอให้ลดลง (policy pause)
+
+    def _call(self, callback):
+        """🔁 เรียก callback บน event loop (ทันทีถ้าอยู่บน loop อยู่แล้ว)"""
+        if threading.get_ident() == self.loop_thread:
+            callback()
+        else:
+            self.loop.call_soon_threadsafe(callback)
+
+    def _wake(self):
+        # เรียกขณะถือ lock: นัด flush ครั้งเดียวต่อรอบของ loop
+        if self.scheduled:
+            return
+        self.scheduled = True
+        if threading.get_ident() == self.loop_thread:
+            self.loop.call_soon(self._flush)
+        else:
+            self.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        """✍️ ส่งทุก frame ที่ค้างให้ transport (transport จัดการ short write ต่อเอง)"""
+        with self.condition:
+            self.scheduled = False
+            if self.writing_paused or self.transport.is_closing():
+                return
+            frames, waiters, traces = self._take()
+        if frames:
+            self.transport.writelines(frames)
+        if traces:
+            # transport เขียนลง socket ทันทีถ้าทำได้ ที่เหลืออยู่ใน buffer ของ transport
+            now = perf_counter_ns()
+            for trace in traces:
+                trace.written(now)
+        for callback in waiters:
+            callback()
+
+    def pause_writing(self):
+        """⏸️ buffer ของ transport เต็ม: เก็บข้อมูลไว้ในคิวก่อน"""
+        self.writing_paused = True
+
+    def resume_writing(self):
+        """▶️ transport ส่งข้อมูลออกไปแล้ว: ส่งข้อมูลที่ค้างในคิวต่อ"""
+        self.writing_paused = False
+        self._flush()
+
+    def _close(self):
+        self.writing_paused = False
+        self._flush()
+        self.transport.close()
+        # connection ที่หลุดไปแล้ว flush ไม่ได้: ข้อมูลที่เหลือไม่มีวันถูกส่ง
+        with self.condition:
+            self._discard_queue()
+
+    def close(self):
+        """🔒 ส่งข้อมูลที่ค้างแล้วปิด transport"""
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+        self._call(self._close)
+        self._release_waiters()
+
+    def _abort(self):
+        """💥 ปิดทันที ทิ้งข้อมูลที่ค้าง"""
+        with self.condition:
+            self.closing = True
+            self._discard_queue()
+        self._call(self.transport.abort)
+        self._release_waiters()
+
+    def pause_until_drained(self, queues):
+        """
+        ⏸️ หยุดอ่านจาก client นี้จนกว่าคิวที่ระบุทั้งหมดจะลดลงถึง low watermark
+
+        ไม่ block: หยุด transport ไว้แล้วให้คิวของ subscriber เรียกกลับมาเมื่อลดลง
+        """
+        with self.condition:
+            first = self.pause_pending == 0
+            self.pause_pending += len(queues)
+        if first:
+            self.stats.add('paused')
+            self._call(self.transport.pause_reading)
+
+        for queue in queues:
+            if not queue.add_drain_waiter(self._drained):
+                self._drained()
+
+    def _drained(self):
+        with self.condition:
+            self.pause_pending -= 1
+            done = self.pause_pending == 0
+        if done:
+            self._call(self._resume_reading)
+
+    def _resume_reading(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+
+class _BaseClientProtocol(asyncio.BufferedProtocol):
+    """🔌 ส่วนที่ใช้ร่วมกันของ protocol ทุกแบบ: อ่านลง buffer ของ decoder โดยตรง"""
+
+    protocol_name = None
+
+    def __init__(self, engine, decoder):
+        self.engine = engine
+        self.client_id = None
+        self.transport = None
+        self.connection = None
+        self.decoder = decoder
+
+    def connection_made(self, transport):
+        self.transport = transport
+        engine = self.engine
+        self.connection = TransportConnection(
+            transport, engine.loop, engine.loop_thread,
+            limits=engine.outbound_limits, stats=engine.backpressure_stats
+        )
+        address = transport.get_extra_info('peername')
+        self.client_id = engine.on_connect(self.connection, address, self.protocol_name)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def pause_writing(self):
+        self.connection.pause_writing()
+
+    def resume_writing(self):
+        self.connection.resume_writing()
+
+    def connection_lost(self, exc):
+        if self.connection is not None:
+            self.connection.close()
+        if self.client_id is not None:
+            self.engine.on_disconnect(self.client_id)
+
+
+class _ClientProtocol(_BaseClientProtocol):
+    """📨 Protocol ของ client หนึ่งตัว ส่งบรรทัด JSON ที่ครบแล้วให้ broker ทีละ batch"""
+
+    protocol_name = 'json'
+
+    def __init__(self, engine):
+        super().__init__(engine, LineFrameDecoder(engine.read_size))
+
+    def buffer_updated(self, nbytes):
+        self.engine.backpressure_stats.received_bytes.add(nbytes)
+        self.decoder.buffer_updated(nbytes)
+        latency = self.engine.latency
+        if latency is not None:
+            latency.received()
+        try:
+            frames = self.decoder.decode()
+        except FrameTooLargeError as e:
+            logger.warning(f"⚠️ {self.client_id} {e}")
+            self.engine.backpressure_stats.error('frame_too_large')
+            self.transport.close()
+            return
+        else:
+            if frames:
+                self.engine.on_frames(self.client_id, frames)
+        finally:
+            if latency is not None:
+                latency.finished()
+
+
+class _MQTTClientProtocol(_BaseClientProtocol):
+    """📦 Protocol ของ client ที่พูด MQTT binary"""
+
+    protocol_name = 'mqtt'
+
+    def __init__(self, engine):
+        super().__init__(engine, MQTTStreamDecoder(engine.read_size))
+
+    def buffer_updated(self, nbytes):
+        self.engine.backpressure_stats.received_bytes.add(nbytes)
+        self.decoder.buffer_updated(nbytes)
+        latency = self.engine.latency
+        if latency is not None:
+            latency.received()
+        try:
+            packets = self.decoder.decode()
+        except MQTTProtocolError as e:
+            logger.warning(f"⚠️ {self.client_id} ส่ง MQTT packet ไม่ถูกต้อง: {e}")
+            self.engine.backpressure_stats.error('protocol')
+            self.transport.close()
+            return
+        else:
+            for packet in packets:
+                # handler คืนค่า False เมื่อต้องปิด connection (เช่น DISCONNECT)
+                if self.engine.on_packet(self.client_id, packet) is False:
+                    self.transport.close()
+                    return
+        finally:
+            if latency is not None:
+                latency.finished()
+
+
+class _DetectingProtocol(asyncio.Protocol):
+    """🔎 รอ byte แรกของ connection แล้วสลับไปใช้ protocol ที่ตรงกัน"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.transport = None
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # connection ที่ไม่ส่งอะไรมาเลยยังไม่ได้ลงทะเบียนกับ broker จึงต้องหมดเวลาเองที่นี่
+        if self.engine.detect_timeout:
+            self.timer = self.engine.loop.call_later(self.engine.detect_timeout, transport.close)
+
+    def data_received(self, data):
+        if self.timer is not None:
+            self.timer.cancel()
+        if detect_protocol(data[0]) == 'mqtt':
+            protocol = _MQTTClientProtocol(self.engine)
+        else:
+            protocol = _ClientProtocol(self.engine)
+
+        # transport จะส่งข้อมูลครั้งต่อไปให้ protocol ใหม่โดยตรง
+        self.transport.set_protocol(protocol)
+        protocol.connection_made(self.transport)
+
+        # ส่งข้อมูลชุดแรกที่อ่านมาแล้วต่อให้ protocol ใหม่
+        buffer = protocol.get_buffer(len(data))
+        buffer[:len(data)] = data
+        protocol.buffer_updated(len(data))
+
+    def connection_lost(self, exc):
+        # ยังไม่เคยได้รับข้อมูล จึงยังไม่ได้ลงทะเบียนกับ broker
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+class AsyncioEngine:
+    """
+    ⚡ Event loop เดียวสำหรับทุก connection
+
+    Args:
+        host (str): ที่อยู่ IP ที่จะรอรับการเชื่อมต่อ
+        port (int): พอร์ตที่จะใช้
+        on_connect (Callable): เรียกเมื่อมี client ใหม่ (connection, address, protocol) -> client_id
+        on_frames (Callable): เรียกเมื่อได้รับบรรทัดที่ครบแล้ว (client_id, [line, ...])
+        on_disconnect (Callable): เรียกเมื่อ connection ปิด (client_id)
+        backlog (int): ขนาดคิวรอ accept
+        reuse_port (bool): bind ด้วย SO_REUSEPORT (หลาย process ใช้ port เดียวกัน)
+        protocol (str): 'json' (JSON-line), 'mqtt' (MQTT 3.1.1 binary) หรือ 'auto' (ดูจาก byte แรก)
+        on_packet (Callable): เรียกเมื่อได้รับ MQTT packet (client_id, packet) -> False เพื่อปิด
+        read_size (int): พื้นที่ว่างขั้นต่ำของ buffer รับข้อมูลต่อ connection
+        outbound_limits (OutboundLimits): ขีดจำกัดคิวขาออกและ backpressure policy
+        backpressure_stats (BackpressureStats): ตัวนับ backpressure และปริมาณข้อมูลที่ใช้ร่วมกัน
+        detect_timeout (float): วินาทีที่รอ byte แรกของ protocol 'auto' ก่อนปิด connection (None = รอตลอด)
+        latency (LatencyTracker): ตัววัด latency ที่ต้องรู้เวลา ingress ของข้อมูลแต่ละชุด (None = ไม่วัด)
+    """
+
+    def __init__(self, host, port, on_connect, on_frames, on_disconnect, backlog=100,
+                 reuse_port=False, protocol='json', on_packet=None, read_size=DEFAULT_READ_SIZE,
+                 outbound_limits=None, backpressure_stats=None, detect_timeout=None, latency=None):
+        self.host = host
+        self.port = port
+        self.on_connect = on_connect
+        self.on_frames = on_frames
+        self.on_disconnect = on_disconnect
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.protocol = protocol
+        self.on_packet = on_packet
+        self.read_size = read_size
+        self.outbound_limits = outbound_limits
+        self.backpressure_stats = backpressure_stats or BackpressureStats()
+        self.detect_timeout = detect_timeout
+        self.latency = latency
+
+        self.loop = None
+        self.loop_thread = None
+        self._stopped = None
+
+    def run(self, on_ready=None):
+        """
+        🚀 เริ่ม event loop และ block จนกว่าจะเรียก stop()
+
+        Args:
+            on_ready (Callable): เรียกหลัง bind port สำเร็จ
+        """
+        asyncio.run(self._serve(on_ready))
+
+    async def _serve(self, on_ready):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._stopped = self.loop.create_future()
+
+        protocol_class = {
+            'mqtt': _MQTTClientProtocol,
+            'auto': _DetectingProtocol
+        }.get(self.protocol, _ClientProtocol)
+        server = await self.loop.create_server(
+            lambda: protocol_class(self),
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            reuse_port=self.reuse_port or None
+        )
+
+        if on_ready:
+            on_ready()
+
+        async with server:
+            await self._stopped
+
+    def stop(self):
+        """🛑 หยุด event loop (เรียกจาก thread ไหนก็ได้)"""
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        def _finish():
+            if not self._stopped.done():
+                self._stopped.set_result(None)
+
+        try:
+            self.loop.call_soon_threadsafe(_finish)
+        except RuntimeError:
+            # loop ปิดไปแล้ว
+            pass
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📤 คิวขาออกของ Client
+====================
+
+เดิม broker เรียก socket.send() ตรงๆ จาก thread ของผู้ publish
+ถ้า subscriber ตัวไหนรับข้อมูลช้า ผู้ publish จะค้างรอ และ send() ที่เขียนได้ไม่ครบ
+(short write) ทำให้ข้อมูลส่วนที่เหลือหายไปเงียบๆ
+
+OutboundQueue คือคิวขาออกของ client หนึ่งตัว ใช้ร่วมกันทั้งสอง engine:
+- SocketWriter (engine threaded) มี thread เขียนของตัวเอง ดึงทุก frame ที่ค้าง
+  แล้วส่งด้วย sendmsg() ครั้งเดียว (writev) และส่งต่อจาก byte ที่ค้างเมื่อ kernel รับไม่หมด
+- TransportConnection (engine asyncio, อยู่ใน async_engine.py) ส่งต่อให้ transport ทีละ batch
+
+🚦 Backpressure: คิวมี high/low watermark ทั้งจำนวน byte และจำนวนข้อความ
+เมื่อเกิน high watermark จะทำตาม policy จนกว่าคิวจะลดลงต่ำกว่า low watermark
+- drop-oldest  ทิ้งข้อความเก่าสุดจนเหลือไม่เกิน low watermark
+- drop-newest  ทิ้งข้อความใหม่ที่เข้ามาจนกว่าคิวจะลดลง
+- conflate     เก็บเฉพาะค่าล่าสุดของแต่ละ topic (แทนที่ข้อความเดิมในคิว)
+- pause        หยุดอ่านข้อมูลจากผู้ publish จนกว่าคิวของ subscriber จะลดลง
+- disconnect   ตัดการเชื่อมต่อ subscriber ที่ตามไม่ทัน
+
+frame ที่ไม่มี topic (เช่น CONNACK, SUBACK, pong) ไม่ถูกทิ้งหรือรวม
+
+BackpressureStats ยังนับปริมาณข้อมูลเข้า-ออกและข้อมูลที่ค้างในคิวของทุก client รวมกัน
+(ปรับทีละนิดตอนใส่/ดึง frame จึงอ่านค่าได้โดยไม่ต้องเดินดูคิวของทุก client)
+
+⏱️ frame ที่ส่งมาพร้อม LatencyTrace (latency.py) ถูกบันทึกขั้น write หลังตัวเขียนส่ง batch นั้นเสร็จ
+"""
+
+import socket
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from time import perf_counter_ns
+
+from sharded_state import StatCounter
+
+# จำนวน frame สูงสุดต่อการเรียก sendmsg หนึ่งครั้ง (IOV_MAX ของ Linux คือ 1024)
+MAX_FRAMES_PER_WRITE = 1024
+
+# 🚦 policy ที่รองรับเมื่อคิวเกิน high watermark
+POLICIES = ('drop-oldest', 'drop-newest', 'conflate', 'pause', 'disconnect')
+
+
+class OutboundLimits:
+    """
+    📏 ขีดจำกัดของคิวขาออกและ policy เมื่อเกิน
+
+    Args:
+        policy (str): หนึ่งใน POLICIES
+        high_bytes (int): high watermark เป็น byte
+        low_bytes (int): low watermark เป็น byte (ค่าเริ่มต้น = ครึ่งหนึ่งของ high)
+        high_messages (int): high watermark เป็นจำนวนข้อความ
+        low_messages (int): low watermark เป็นจำนวนข้อความ (ค่าเริ่มต้น = ครึ่งหนึ่งของ high)
+    """
+
+    __slots__ = ('policy', 'high_bytes', 'low_bytes', 'high_messages', 'low_messages')
+
+    def __init__(self, policy='drop-oldest', high_bytes=8 * 1024 * 1024, low_bytes=None,
+                 high_messages=10000, low_messages=None):
+        if policy not in POLICIES:
+            raise ValueError(f"ไม่รู้จัก backpressure policy: {policy} (ใช้ได้: {', '.join(POLICIES)})")
+        self.policy = policy
+        self.high_bytes = high_bytes
+        self.low_bytes = high_bytes // 2 if low_bytes is None else min(low_bytes, high_bytes)
+        self.high_messages = high_messages
+        self.low_messages = high_messages // 2 if low_messages is None else min(low_messages, high_messages)
+
+    def with_policy(self, policy):
+        """🔁 ขีดจำกัดเดิมแต่เปลี่ยน policy (ใช้กับ policy เฉพาะ client)"""
+        return OutboundLimits(policy, self.high_bytes, self.low_bytes,
+                              self.high_messages, self.low_messages)
+
+
+class BackpressureStats:
+    """📊 ตัวนับการทำงานของ backpressure และปริมาณข้อมูลเข้า-ออก (ใช้ร่วมกันทุก client)"""
+
+    COUNTERS = ('high_watermark', 'dropped_oldest', 'dropped_newest', 'conflated',
+                'paused', 'disconnected')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.errors = {}                        # สาเหตุ -> จำนวน connection ที่มีปัญหา
+
+        # นับทุก frame จึงใช้ StatCounter (ไม่ใช้ lock)
+        self.received_bytes = StatCounter()     # byte ที่อ่านจาก client
+        self.sent_bytes = StatCounter()         # byte ที่ส่งต่อให้ socket / transport
+        self.queued_bytes = StatCounter()       # byte ที่ค้างในคิวขาออกของทุก client ตอนนี้
+        self.queued_frames = StatCounter()
+
+    def add(self, name, count=1):
+        """➕ เพิ่มตัวนับ (เกิดเฉพาะตอนคิวล้น จึงใช้ lock ได้โดยไม่กระทบ hot path)"""
+        with self.lock:
+            self.counters[name] += count
+
+    def error(self, reason):
+        """❌ นับ connection ที่มีปัญหา (เช่น 'protocol', 'frame_too_large', 'accept')"""
+        with self.lock:
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def snapshot(self):
+        """📸 ค่าปัจจุบันของทุกตัวนับ"""
+        with self.lock:
+            return dict(self.counters)
+
+    def error_snapshot(self):
+        """📸 จำนวน connection ที่มีปัญหาแยกตามสาเหตุ"""
+        with self.lock:
+            return dict(self.errors)
+
+
+class OutboundQueue(ABC):
+    """
+    📮 คิวขาออกของ client หนึ่งตัว หน้าตาเหมือน socket (send / close)
+
+    subclass ต้องมี:
+    - _wake(): แจ้งตัวเขียนว่ามีข้อมูลใหม่ (เรียกขณะถือ lock)
+    - _abort(): ปิด connection ทันทีโดยไม่ส่งข้อมูลที่ค้าง
+    - pause_until_drained(queues): หยุดอ่านข้อมูลจาก client นี้จนกว่าคิวที่ระบุจะลดลง
+
+    Args:
+        limits (OutboundLimits): ขีดจำกัดและ policy
+        stats (BackpressureStats): ตัวนับที่ใช้ร่วมกัน
+    """
+
+    def __init__(self, limits=None, stats=None):
+        self.limits = limits or OutboundLimits()
+        self.stats = stats or BackpressureStats()
+        self.queue = deque()        # แต่ละรายการคือ [data, topic, trace]
+        self.latest = {}            # topic -> รายการในคิว (ใช้กับ conflate)
+        self.queued_bytes = 0
+        self.congested = False      # เกิน high watermark และยังไม่ลดลงถึง low watermark
+        self.closing = False
+        self.drain_waiters = []
+        lock = threading.RLock()
+        self.condition = threading.Condition(lock)
+        self.room = threading.Condition(lock)   # ผู้ที่รอให้คิวลดลง (wait_for_room) แยกจากตัวเขียน
+        self.room_waiters = 0
+
+    def set_limits(self, limits):
+        """🔧 เปลี่ยนขีดจำกัด/policy ของ client นี้"""
+        with self.condition:
+            self.limits = limits
+            if limits.policy != 'conflate':
+                self.latest.clear()
+
+    def send(self, data, topic=None, trace=None):
+        """
+        📨 ใส่ frame ลงคิว (ไม่ block)
+
+        Args:
+            data (bytes): ข้อมูลที่จะส่ง
+            topic (str): topic ของข้อความ (None = frame ควบคุมที่ห้ามทิ้ง)
+            trace (LatencyTrace): บันทึก latency ขั้น write เมื่อเขียน frame นี้เสร็จ (None = ไม่วัด)
+
+        Returns:
+            int: จำนวน byte ที่รับไว้ (0 ถ้าถูกทิ้งหรือปิดแล้ว)
+        """
+        with self.condition:
+            if self.closing:
+                return 0
+            accepted = self._enqueue(data, topic, trace)
+            if accepted:
+                self._wake()
+            overflow = self.congested and self.limits.policy == 'disconnect'
+
+        if overflow:
+            self.stats.add('disconnected')
+            self._abort()
+            return 0
+        return len(data) if accepted else 0
+
+    def _enqueue(self, data, topic, trace=None):
+        """🚦 ใส่ข้อมูลลงคิวตาม policy (เรียกขณะถือ lock) คืนค่า False ถ้าทิ้ง"""
+        limits = self.limits
+        policy = limits.policy
+
+        if self.congested and topic is not None:
+            if policy == 'drop-newest':
+                self.stats.add('dropped_newest')
+                return False
+            if policy == 'conflate':
+                entry = self.latest.get(topic)
+                if entry is not None:
+                    # แทนที่ค่าเดิมของ topic นี้ในตำแหน่งเดิม (ลำดับของ topic ไม่เปลี่ยน)
+                    self.queued_bytes += len(data) - len(entry[0])
+                    self.stats.queued_bytes.add(len(data) - len(entry[0]))
+                    entry[0] = data
+                    entry[2] = trace
+                    self.stats.add('conflated')
+                    return True
+
+        entry = [data, topic, trace]
+        self.queue.append(entry)
+        self.queued_bytes += len(data)
+        self.stats.queued_bytes.add(len(data))
+        self.stats.queued_frames.add(1)
+        if topic is not None and policy == 'conflate':
+            self.latest[topic] = entry
+
+        if self.queued_bytes > limits.high_bytes or len(self.queue) > limits.high_messages:
+            if not self.congested:
+                self.congested = True
+                self.stats.add('high_watermark')
+            if policy == 'drop-oldest':
+                # ทิ้งรวดเดียวจนถึง low watermark (ไม่ต้องทิ้งทีละข้อความที่ขอบ)
+                self._drop_oldest(limits.low_bytes, limits.low_messages)
+                self.congested = False
+            elif policy == 'conflate':
+                # topic ใหม่ที่รวมกับของเดิมไม่ได้: คุมไม่ให้เกิน high watermark
+                self._drop_oldest(limits.high_bytes, limits.high_messages)
+        return True
+
+    def _drop_oldest(self, max_bytes, max_messages):
+        """🗑️ ทิ้งข้อความเก่าสุด (ข้าม frame ควบคุม) จนขนาดไม่เกินที่กำหนด"""
+        queue = self.queue
+        kept = []
+        dropped = 0
+        freed = 0
+        while queue and (self.queued_bytes - freed > max_bytes or len(queue) + len(kept) > max_messages):
+            entry = queue.popleft()
+            if entry[1] is None:
+                kept.append(entry)
+                continue
+            freed += len(entry[0])
+            if self.latest.get(entry[1]) is entry:
+                del self.latest[entry[1]]
+            dropped += 1
+        queue.extendleft(reversed(kept))
+        if dropped:
+            self.queued_bytes -= freed
+            self.stats.queued_bytes.add(-freed)
+            self.stats.queued_frames.add(-dropped)
+            self.stats.add('dropped_oldest', dropped)
+
+    def _take(self, max_frames=None):
+        """
+        📤 ดึง frame ออกจากคิวเพื่อเขียน (เรียกขณะถือ lock)
+
+        Returns:
+            tuple: (รายการ bytes, callback ที่ต้องเรียกเพราะคิวลดลงถึง low watermark,
+                    LatencyTrace ของ frame ที่วัด latency)
+        """
+        queue = self.queue
+        count = len(queue) if max_frames is None else min(len(queue), max_frames)
+        frames = []
+        traces = []
+        latest = self.latest
+        taken = 0
+        for _ in range(count):
+            entry = queue.popleft()
+            data = entry[0]
+            frames.append(data)
+            taken += len(data)
+            if entry[2] is not None:
+                traces.append(entry[2])
+            if latest and latest.get(entry[1]) is entry:
+                del latest[entry[1]]
+        if count:
+            self.queued_bytes -= taken
+            stats = self.stats
+            stats.queued_bytes.add(-taken)
+            stats.queued_frames.add(-count)
+            stats.sent_bytes.add(taken)
+
+        if self.room_waiters:
+            self.room.notify_all()
+
+        waiters = ()
+        if self.congested:
+            limits = self.limits
+            if self.queued_bytes <= limits.low_bytes and len(queue) <= limits.low_messages:
+                self.congested = False
+                waiters, self.drain_waiters = self.drain_waiters, []
+        return frames, waiters, traces
+
+    def add_drain_waiter(self, callback):
+        """
+        ⏳ ขอให้เรียก callback เมื่อคิวลดลงถึง low watermark (หรือปิด)
+
+        Returns:
+            bool: False ถ้าคิวไม่ได้ล้นอยู่แล้ว (callback จะไม่ถูกเรียก)
+        """
+        with self.condition:
+            if not self.congested or self.closing:
+                return False
+            self.drain_waiters.append(callback)
+            return True
+
+    def wait_for_room(self, timeout=None):
+        """
+        ⏳ รอจนคิวลดลงถึง low watermark (ทั้ง byte และจำนวนข้อความ)
+
+        ใช้กับผู้ส่งข้อมูลจำนวนมากที่รอได้ เช่น replay ที่ส่งทีละ chunk
+        คิวจึงไม่ล้นจนข้อความสดของ client ถูกทิ้งตาม policy
+
+        Returns:
+            bool: True ถ้าคิวมีที่ว่าง, False ถ้าหมดเวลาหรือคิวถูกปิดแล้ว
+        """
+        with self.condition:
+            self.room_waiters += 1
+            try:
+                self.room.wait_for(lambda: self.closing or self._has_room(), timeout)
+            finally:
+                self.room_waiters -= 1
+            return not self.closing and self._has_room()
+
+    def _has_room(self):
+        limits = self.limits
+        return self.queued_bytes <= limits.low_bytes and len(self.queue) <= limits.low_messages
+
+    def _discard_queue(self):
+        """🗑️ ทิ้งข้อมูลที่ค้างทั้งหมด (เรียกขณะถือ lock ตอนปิด connection)"""
+        self.stats.queued_bytes.add(-self.queued_bytes)
+        self.stats.queued_frames.add(-len(self.queue))
+        self.queue.clear()
+        self.latest.clear()
+        self.queued_bytes = 0
+
+    def _release_waiters(self):
+        """🔓 ปลดทุกคนที่รออยู่ (ใช้ตอนปิดคิว)"""
+        with self.condition:
+            waiters, self.drain_waiters = self.drain_waiters, []
+            self.room.notify_all()
+        for callback in waiters:
+            callback()
+
+    @abstractmethod
+    def _wake(self):
+        """🔔 แจ้งตัวเขียนว่ามีข้อมูลใหม่ (เรียกขณะถือ lock)"""
+
+    @abstractmethod
+    def _abort(self):
+        """💥 ปิด connection ทันทีโดยไม่ส่งข้อมูลที่ค้าง"""
+
+    @abstractmethod
+    def pause_until_drained(self, queues):
+        """⏸️ หยุดอ่านข้อมูลจาก client นี้จนกว่าคิวที่ระบุจะลดลงถึง low watermark"""
+
+
+class SocketWriter(OutboundQueue):
+    """
+    🧵 คิวขาออกของ engine threaded: thread เขียนหนึ่งตัวต่อ client
+
+    Args:
+        sock (socket): socket ของ client
+        name (str): ชื่อ thread เขียน (ใช้ตอน debug)
+        close_timeout (float): เวลาสูงสุดที่รอส่งข้อมูลที่ค้างอยู่ตอนปิด
+        limits (OutboundLimits): ขีดจำกัดและ policy
+        stats (BackpressureStats): ตัวนับที่ใช้ร่วมกัน
+    """
+
+    def __init__(self, sock, name=None, close_timeout=5.0, limits=None, stats=None):
+        super().__init__(limits, stats)
+        self.sock = sock
+        self.close_timeout = close_timeout
+        self.close_timer = None
+
+        # writer ถูกสร้างใน thread อ่านของ client นี้ (engine threaded)
+        self.reader = threading.get_ident()
+        self.pause_queues = []      # คิวที่ thread อ่านต้องรอให้ลดลงก่อนอ่านครั้งถัดไป
+
+        # sendmsg ไม่มีบน Windows ใช้ send ข้อมูลที่ต่อกันแล้วแทน
+        self._sendmsg = getattr(sock, 'sendmsg', None)
+
+        self.thread = threading.Thread(target=self._run, name=name or 'client-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _wake(self):
+        self.condition.notify()
+
+    def close(self):
+        """🔒 ส่งข้อมูลที่ค้างให้หมดแล้วปิด socket (ไม่ block ผู้เรียก)"""
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            self.condition.notify()
+
+        # subscriber ที่ไม่อ่านข้อมูลเลยจะทำให้ thread เขียนค้าง: บังคับปิดเมื่อครบเวลา
+        self.close_timer = threading.Timer(self.close_timeout, self._shutdown)
+        self.close_timer.daemon = True
+        self.close_timer.start()
+        self._release_waiters()
+
+    def _abort(self):
+        """💥 ปิดทันที ทิ้งข้อมูลที่ค้าง (thread อ่านของ client จะเห็น connection ปิดเอง)"""
+        with self.condition:
+            self.closing = True
+            self._discard_queue()
+            self.condition.notify()
+        self._shutdown()
+        self._release_waiters()
+
+    def pause_until_drained(self, queues):
+        """
+        ⏸️ หยุดอ่านจาก client นี้จนกว่าคิวที่ระบุจะลดลงถึง low watermark
+
+        ถ้าเรียกจาก thread อ่านของผู้ publish เอง จะรอตรงนี้ (เท่ากับหยุดอ่าน socket ของผู้ publish)
+        ถ้าเรียกจาก thread อื่น (เช่น thread fsync ของ durable log ที่ส่งข้อความของทุกคน)
+        การรอจะทำให้ทุกคนที่ใช้ thread นั้นค้างไปด้วย จึงแค่จดคิวไว้ให้ thread อ่านรอเองใน wait_if_paused()
+        """
+        self.stats.add('paused')
+        if threading.get_ident() != self.reader:
+            with self.condition:
+                self.pause_queues.extend(queues)
+            return
+        self._wait_drained(queues)
+
+    def wait_if_paused(self):
+        """⏸️ thread อ่านเรียกก่อนอ่านแต่ละครั้ง: รอคิวที่ถูกขอให้หยุดรอจาก thread อื่นให้ลดลงก่อน"""
+        if not self.pause_queues:
+            return
+        with self.condition:
+            queues, self.pause_queues = self.pause_queues, []
+        self._wait_drained(queues)
+
+    def _wait_drained(self, queues):
+        """⏳ รอจนทุกคิวลดลงถึง low watermark (หรือ connection นี้ปิด)"""
+        for queue in queues:
+            drained = threading.Event()
+            if not queue.add_drain_waiter(drained.set):
+                continue
+            while not drained.wait(1.0):
+                if self.closing:
+                    return
+
+    def _run(self):
+        """🧵 ดึง frame จากคิวแล้วเขียนลง socket จนกว่าจะปิด"""
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue and not self.closing:
+                        self.condition.wait()
+                    if not self.queue:
+                        break
+                    frames, waiters, traces = self._take(MAX_FRAMES_PER_WRITE)
+
+                for callback in waiters:
+                    callback()
+                self._write(frames)
+                if traces:
+                    now = perf_counter_ns()
+                    for trace in traces:
+                        trace.written(now)
+        except OSError:
+            # client หายไปแล้ว ข้อมูลที่เหลือส่งไม่ได้
+            pass
+        finally:
+            with self.condition:
+                self.closing = True
+                self._discard_queue()
+            if self.close_timer is not None:
+                self.close_timer.cancel()
+            self._shutdown()
+            self._release_waiters()
+
+    def _write(self, frames):
+        """✍️ เขียน frame ทั้งหมดให้ครบ (รองรับการเขียนได้ไม่ครบในครั้งเดียว)"""
+        while frames:
+            try:
+                if self._sendmsg is not None:
+                    sent = self._sendmsg(frames)
+                else:
+                    sent = self.sock.send(b''.join(frames))
+            except socket.timeout:
+                # socket ที่ตั้ง timeout ไว้ (ใช้ร่วมกับ thread อ่าน): ลองใหม่
+                continue
+
+            done = 0
+            while done < len(frames) and sent >= len(frames[done]):
+                sent -= len(frames[done])
+                done += 1
+            if sent:
+                # short write: frame ถัดไปถูกส่งไปแค่บางส่วน
+                frames = [memoryview(frames[done])[sent:]] + frames[done + 1:]
+            else:
+                frames = frames[done:]
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
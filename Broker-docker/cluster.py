@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🧩 Multi-process Broker (pre-fork + SO_REUSEPORT)
+================================================
+
+แบ่งงานของ broker ไปหลาย process เพื่อให้ใช้ได้หลาย core:
+- process แม่สร้าง worker N ตัว ทุกตัว bind port เดียวกันด้วย SO_REUSEPORT
+  (kernel จะกระจาย connection ใหม่ให้แต่ละ worker เอง)
+- worker แต่ละตัวคือ MQTTBroker ธรรมดาที่ดูแล client ของตัวเอง
+- process แม่เป็น hub กลางผ่าน Pipe:
+  * worker แจ้ง "interest" เมื่อ topic filter มี subscriber ตัวแรก/ตัวสุดท้ายใน worker นั้น
+  * hub บอก worker อื่นว่ามี worker อื่นสนใจ filter ไหนบ้าง (รองรับ + และ #)
+  * worker ส่ง publish ให้ hub เฉพาะ topic ที่ worker อื่นสนใจ (หรือเป็น retained)
+  * hub ส่งต่อ publish ไปยัง worker ที่สนใจเท่านั้น
+
+publish ที่ไม่มี worker อื่นสนใจจะไม่ผ่าน hub เลย จึง scale ตามจำนวน worker ได้
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from multiprocessing.connection import wait
+
+from topic_trie import TopicTrie
+from sharded_state import ShardedTopicTrie
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterLink:
+    """
+    🔗 ช่องทางสื่อสารฝั่ง worker
+
+    broker เรียก:
+    - add_interest(topic) / remove_interest(topic) เมื่อ filter มี subscriber ตัวแรก/หมด
+    - forward_publish(message, retain, qos) หลัง fan-out ในเครื่องเสร็จ
+
+    และส่ง callback on_remote_publish(message, retain, qos) ให้ start()
+    """
+
+    def __init__(self, conn, worker_index):
+        self.conn = conn
+        self.worker_index = worker_index
+        self.remote_filters = ShardedTopicTrie()  # filter ที่ worker อื่นมี subscriber (อ่านจากหลาย thread)
+        self.send_lock = threading.Lock()
+        self.on_remote_publish = None
+
+    def start(self, on_remote_publish):
+        """🚀 เริ่ม thread รับข้อความจาก hub"""
+        self.on_remote_publish = on_remote_publish
+        thread = threading.Thread(target=self._receive_loop, name='cluster-link')
+        thread.daemon = True
+        thread.start()
+
+    def _send(self, item):
+        with self.send_lock:
+            try:
+                self.conn.send(item)
+            except (OSError, EOFError):
+                pass
+
+    def add_interest(self, topic):
+        """📥 แจ้ง hub ว่า worker นี้มี subscriber ของ topic แล้ว"""
+        self._send(('interest', topic, True))
+
+    def remove_interest(self, topic):
+        """📤 แจ้ง hub ว่า worker นี้ไม่มี subscriber ของ topic แล้ว"""
+        self._send(('interest', topic, False))
+
+    def forward_publish(self, message, retain=False, qos=0):
+        """
+        📢 ส่ง publish ให้ worker อื่น (เฉพาะเมื่อจำเป็น)
+
+        Args:
+            message (dict): ข้อความที่ส่งต่อให้ subscriber
+            retain (bool): ถ้าเป็น retained ต้องส่งให้ทุก worker เก็บไว้
+            qos (int): QoS ของ publish (worker ปลายทางส่ง QoS 1 ให้ subscriber ที่ขอไว้)
+        """
+        if retain or self.remote_filters.match(message['topic']):
+            self._send(('publish', message, retain, qos))
+
+    def _receive_loop(self):
+        while True:
+            try:
+                item = self.conn.recv()
+            except (OSError, EOFError):
+                break
+
+            kind = item[0]
+            if kind == 'publish':
+                _, message, retain, qos = item
+                try:
+                    self.on_remote_publish(message, retain, qos)
+                except Exception as e:
+                    logger.error(f"💥 เกิดข้อผิดพลาดในการส่งต่อข้อความจาก worker อื่น: {e}")
+            elif kind == 'remote':
+                _, topic_filter, interested = item
+                if interested:
+                    self.remote_filters.subscribe(topic_filter, True)
+                else:
+                    self.remote_filters.unsubscribe(topic_filter, True)
+
+
+class ClusterHub:
+    """
+    🛰️ hub ฝั่ง process แม่: เก็บว่า worker ไหนสนใจ filter ไหน แล้วส่งต่อ publish
+    """
+
+    def __init__(self):
+        self.conns = {}                 # worker_index -> Connection
+        self.interest = TopicTrie()     # filter -> {worker_index}
+        self.worker_filters = {}        # worker_index -> {filter}
+
+    def add_worker(self, worker_index, conn):
+        """➕ ลงทะเบียน worker และส่ง filter ที่ worker อื่นสนใจอยู่แล้วให้"""
+        self.conns[worker_index] = conn
+        self.worker_filters.setdefault(worker_index, set())
+        known = set()
+        for filters in self.worker_filters.values():
+            known |= filters
+        for topic_filter in known:
+            if self.interest.subscribers(topic_filter) - {worker_index}:
+                self._send(worker_index, ('remote', topic_filter, True))
+
+    def remove_worker(self, worker_index):
+        """➖ ลบ worker (เช่น process ตาย) พร้อม interest ทั้งหมดของมัน"""
+        self.conns.pop(worker_index, None)
+        for topic_filter in list(self.worker_filters.get(worker_index, ())):
+            self._set_interest(worker_index, topic_filter, False)
+        self.worker_filters.pop(worker_index, None)
+
+    def _send(self, worker_index, item):
+        conn = self.conns.get(worker_index)
+        if conn is None:
+            return
+        try:
+            conn.send(item)
+        except (OSError, EOFError):
+            pass
+
+    def _set_interest(self, worker_index, topic_filter, interested):
+        before = self.interest.subscribers(topic_filter)
+        filters = self.worker_filters.setdefault(worker_index, set())
+        if interested:
+            self.interest.subscribe(topic_filter, worker_index)
+            filters.add(topic_filter)
+        else:
+            self.interest.unsubscribe(topic_filter, worker_index)
+            filters.discard(topic_filter)
+        workers = self.interest.subscribers(topic_filter)
+
+        # worker แต่ละตัวต้องรู้ว่า "worker อื่น" สนใจ filter นี้หรือไม่
+        for index in self.conns:
+            was = bool(before - {index})
+            now = bool(workers - {index})
+            if was != now:
+                self._send(index, ('remote', topic_filter, now))
+
+    def handle(self, worker_index, item):
+        """📨 จัดการข้อความจาก worker หนึ่งตัว"""
+        kind = item[0]
+        if kind == 'interest':
+            _, topic_filter, interested = item
+            self._set_interest(worker_index, topic_filter, interested)
+        elif kind == 'publish':
+            _, message, retain, _ = item
+            if retain:
+                targets = self.conns.keys()
+            else:
+                targets = self.interest.match(message['topic'])
+            for index in list(targets):
+                if index != worker_index:
+                    self._send(index, item)
+
+
+def _worker_entry(worker_main, conn, worker_index):
+    """🧵 จุดเริ่มของ process ลูก"""
+    # ให้ process แม่เป็นคนจัดการ Ctrl+C แล้วสั่ง terminate เอง
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # handler ส่งต่อ SIGUSR1/SIGUSR2 ของแม่ติดมากับ fork: ไม่สนใจจนกว่า broker จะตั้ง handler ของตัวเอง
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    worker_main(ClusterLink(conn, worker_index))
+
+
+def run_cluster(worker_main, workers):
+    """
+    🧩 สร้าง worker N ตัวและทำหน้าที่ hub จนกว่าจะได้รับสัญญาณหยุด
+
+    Args:
+        worker_main (Callable): ฟังก์ชันที่รันใน worker รับ ClusterLink เป็น argument
+        workers (int): จำนวน worker process
+    """
+    context = multiprocessing.get_context('fork')
+    hub = ClusterHub()
+    processes = {}
+    stopping = threading.Event()
+
+    def spawn(worker_index):
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=_worker_entry,
+            args=(worker_main, child_conn, worker_index),
+            name=f'broker-worker-{worker_index}'
+        )
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        processes[worker_index] = process
+        hub.add_worker(worker_index, parent_conn)
+        logger.info(f"🧩 เริ่ม worker #{worker_index} (pid {process.pid})")
+
+    def request_stop(signum, frame):
+        stopping.set()
+
+    def forward_signal(signum, frame):
+        # SIGUSR1 / SIGUSR2 (เปิด/ปิด profiler) ส่งต่อให้ทุก worker (docker kill -s USR1 ส่งถึงแม่เท่านั้น)
+        for process in list(processes.values()):
+            try:
+                os.kill(process.pid, signum)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGUSR1, forward_signal)
+    signal.signal(signal.SIGUSR2, forward_signal)
+
+    for worker_index in range(workers):
+        spawn(worker_index)
+
+    logger.info(f"🧩 Broker แบบ multi-process ทำงานด้วย {workers} worker (pid แม่ {os.getpid()})")
+
+    try:
+        while not stopping.is_set():
+            by_conn = {conn: index for index, conn in hub.conns.items()}
+            for conn in wait(list(by_conn), timeout=1.0):
+                index = by_conn[conn]
+                try:
+                    item = conn.recv()
+                except (OSError, EOFError):
+                    hub.remove_worker(index)
+                    continue
+                hub.handle(index, item)
+
+            # worker ที่ตายจะถูกสร้างใหม่
+            for index, process in list(processes.items()):
+                if not process.is_alive() and not stopping.is_set():
+                    logger.warning(f"⚠️ worker #{index} หยุดทำงาน (exit {process.exitcode}) กำลังเริ่มใหม่")
+                    hub.remove_worker(index)
+                    spawn(index)
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join(timeout=5)
+        logger.info("✅ หยุด worker ทั้งหมดเรียบร้อย")
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📬 ข้อความ QoS 1 ที่รอ PUBACK (In-flight Window)
+==============================================
+
+ข้อความ QoS 1 ต้องส่งซ้ำจนกว่า client จะตอบ PUBACK (at-least-once)
+แต่ละ client มี InflightWindow หนึ่งตัว:
+- ส่งข้อความที่ยังไม่ได้ PUBACK พร้อมกันได้ไม่เกิน size ข้อความ
+  ที่เหลือรอในคิว pending (จำกัดที่ max_pending ทิ้งข้อความเก่าสุดเมื่อเกิน)
+- packet id ไล่จาก 1 ถึง 65535 แล้ววนกลับ โดยข้าม id ที่ยังรอ PUBACK อยู่
+- ข้อความที่รอ PUBACK เรียงตามเวลาที่ส่งล่าสุด การหาข้อความที่ต้องส่งซ้ำจึงดูแค่หัวแถว
+- ทั้ง window ใช้ timer เดียวใน TimerQueue กลาง (นัดตามข้อความที่ส่งนานที่สุด)
+  PUBACK ไม่ต้องแตะ timer เลย
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+MAX_PACKET_ID = 65535
+
+
+class InflightWindow:
+    """
+    📬 ข้อความ QoS 1 ของ client หนึ่งตัว
+
+    Args:
+        size (int): จำนวนข้อความที่รอ PUBACK ได้พร้อมกัน
+        max_pending (int): จำนวนข้อความที่รอที่ว่างใน window ได้ (0 = ไม่จำกัด)
+    """
+
+    __slots__ = ('size', 'max_pending', 'lock', 'inflight', 'pending', 'next_id', 'timer',
+                 'closed', 'dropped', 'retransmitted')
+
+    def __init__(self, size=20, max_pending=1000):
+        self.size = max(1, size)
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.inflight = OrderedDict()   # packet_id -> [message, เวลาที่ส่งล่าสุด] เรียงตามเวลาที่ส่ง
+        self.pending = deque()
+        self.next_id = 0
+        self.timer = None               # TimerHandle ของการตรวจส่งซ้ำ (None = ยังไม่ได้นัด)
+        self.closed = False
+        self.dropped = 0
+        self.retransmitted = 0
+
+    def _next_packet_id(self):
+        while True:
+            self.next_id = self.next_id % MAX_PACKET_ID + 1
+            if self.next_id not in self.inflight:
+                return self.next_id
+
+    def _start(self, message, now):
+        packet_id = self._next_packet_id()
+        self.inflight[packet_id] = [message, now]
+        return packet_id
+
+    def submit(self, message):
+        """
+        ➕ เพิ่มข้อความที่จะส่ง
+
+        Returns:
+            int: packet id ถ้าส่งได้ทันที, None ถ้าต้องรอที่ว่างใน window (หรือ window ปิดแล้ว)
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            # มีข้อความรออยู่แล้ว: ต่อท้ายคิว ไม่แซงข้อความที่มาก่อน
+            if len(self.inflight) < self.size and not self.pending:
+                return self._start(message, time.monotonic())
+            self.pending.append(message)
+            if self.max_pending and len(self.pending) > self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            return None
+
+    def ack(self, packet_id):
+        """
+        ✅ client ตอบ PUBACK แล้ว
+
+        Returns:
+            tuple: (True ถ้า packet id นี้รออยู่จริง, [(packet_id, message), ...] ที่ได้ที่ว่างและต้องส่งต่อ)
+        """
+        with self.lock:
+            if self.inflight.pop(packet_id, None) is None:
+                return False, []
+            released = []
+            now = time.monotonic()
+            while self.pending and len(self.inflight) < self.size and not self.closed:
+                message = self.pending.popleft()
+                released.append((self._start(message, now), message))
+            return True, released
+
+    def due(self, retry_interval):
+        """
+        ⏰ ข้อความที่ส่งไปนานเกิน retry_interval วินาทีโดยยังไม่ได้ PUBACK (เรียกจาก timer)
+
+        ข้อความที่คืนไปถือว่าส่งซ้ำแล้ว (เวลาที่ส่งเป็นตอนนี้และย้ายไปท้ายแถว)
+
+        Returns:
+            tuple: ([(packet_id, message), ...], วินาทีจนถึงการตรวจครั้งถัดไป หรือ None ถ้าไม่มีข้อความรอ)
+        """
+        with self.lock:
+            self.timer = None
+            if self.closed:
+                return [], None
+            now = time.monotonic()
+            cutoff = now - retry_interval
+            expired = []
+            for packet_id, entry in self.inflight.items():
+                if entry[1] > cutoff:
+                    break
+                expired.append((packet_id, entry[0]))
+            for packet_id, _ in expired:
+                self.inflight[packet_id][1] = now
+                self.inflight.move_to_end(packet_id)
+            self.retransmitted += len(expired)
+            if not self.inflight:
+                return expired, None
+            oldest = next(iter(self.inflight.values()))[1]
+            return expired, max(0.0, oldest + retry_interval - now)
+
+    def arm(self, timers, delay, callback):
+        """⏲️ นัดตรวจส่งซ้ำใน TimerQueue (ถ้ามีข้อความรอ PUBACK และยังไม่ได้นัดไว้)"""
+        with self.lock:
+            if self.timer is None and self.inflight and not self.closed:
+                self.timer = timers.schedule(delay, callback)
+
+    def close(self):
+        """
+        🔒 เลิกใช้ window (client หลุด) ยกเลิก timer และเอาข้อความที่ค้างออกทั้งหมด
+
+        Returns:
+            list: ข้อความที่ยังไม่ได้ PUBACK ตามลำดับที่ส่ง ตามด้วยข้อความที่รอที่ว่าง
+                  (session ถาวรเก็บไว้ส่งใหม่ตอน client กลับมา)
+        """
+        with self.lock:
+            self.closed = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            unacked = [entry[0] for entry in self.inflight.values()]
+            unacked.extend(self.pending)
+            self.inflight.clear()
+            self.pending.clear()
+            return unacked
+
+    def __len__(self):
+        """📊 จำนวนข้อความที่รอ PUBACK"""
+        return len(self.inflight)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📦 MQTT 3.1.1 Packet Codec
+=========================
+
+แปลง packet ของ MQTT จริง (binary) ให้อยู่ในรูป dict แบบเดียวกับ JSON protocol
+ของ broker เช่น {'type': 'publish', 'topic': ..., 'payload': ...}
+เพื่อให้ handler เดิมของ broker ใช้ต่อได้ทันที
+
+รองรับ packet:
+- CONNECT / CONNACK
+- PUBLISH / PUBACK (และ PUBREC / PUBREL / PUBCOMP สำหรับ QoS 2 ขาเข้า)
+- SUBSCRIBE / SUBACK
+- UNSUBSCRIBE / UNSUBACK
+- PINGREQ / PINGRESP
+- DISCONNECT
+
+ตัวถอดรหัส (MQTTStreamDecoder) อ่านข้อมูลลง ReceiveBuffer ที่ใช้ซ้ำได้
+(recv_into / asyncio BufferedProtocol) แล้วอ่าน fixed header และ remaining length
+ผ่าน memoryview โดยตรง ไม่ต้อง copy ข้อมูลก่อน parse
+"""
+
+import struct
+
+from frame_decoder import ReceiveBuffer, DEFAULT_READ_SIZE, DEFAULT_MAX_FRAME_SIZE
+
+# 🏷️ ประเภทของ packet (4 bit บนของ byte แรก)
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# 🔢 return code ของ CONNACK
+CONNACK_ACCEPTED = 0
+CONNACK_BAD_PROTOCOL = 1
+CONNACK_IDENTIFIER_REJECTED = 2
+
+# ❌ return code ของ SUBACK เมื่อ subscribe ไม่สำเร็จ
+SUBACK_FAILURE = 0x80
+
+PINGRESP_PACKET = b'\xd0\x00'
+
+_UINT16 = struct.Struct('!H')
+
+
+class MQTTProtocolError(Exception):
+    """❌ ข้อมูลที่ได้รับไม่ใช่ MQTT packet ที่ถูกต้อง"""
+
+
+def detect_protocol(first_byte):
+    """
+    🔎 เดา protocol จาก byte แรกของ connection
+
+    client MQTT ต้องเริ่มด้วย CONNECT (0x10) เสมอ ส่วน JSON-line จะเริ่มด้วย '{'
+    หรือช่องว่าง จึงแยกกันได้ตั้งแต่ byte แรก
+
+    Args:
+        first_byte (int): byte แรกที่ได้รับ
+
+    Returns:
+        str: 'mqtt' หรือ 'json'
+    """
+    return 'mqtt' if first_byte == CONNECT << 4 else 'json'
+
+
+# ========================================
+# 📏 Remaining Length (variable byte integer)
+# ========================================
+
+def encode_remaining_length(length):
+    """📏 แปลงความยาวเป็น variable byte integer (1-4 byte)"""
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def decode_remaining_length(view, offset, end):
+    """
+    📏 อ่าน remaining length จาก memoryview
+
+    Returns:
+        tuple: (ความยาว, offset ถัดจาก field นี้) หรือ None ถ้าข้อมูลยังมาไม่ครบ
+    """
+    multiplier = 1
+    value = 0
+    for index in range(4):
+        if offset + index >= end:
+            return None
+        byte = view[offset + index]
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, offset + index + 1
+        multiplier *= 128
+    raise MQTTProtocolError("remaining length ยาวเกิน 4 byte")
+
+
+# ========================================
+# 📤 Encoder
+# ========================================
+
+def _packet(first_byte, body):
+    return bytes((first_byte,)) + encode_remaining_length(len(body)) + body
+
+
+def _encode_string(value):
+    data = value.encode('utf-8')
+    return _UINT16.pack(len(data)) + data
+
+
+def encode_connack(return_code=CONNACK_ACCEPTED, session_present=False):
+    """✅ CONNACK"""
+    return bytes((CONNACK << 4, 2, 1 if session_present else 0, return_code))
+
+
+def encode_publish(topic, payload, qos=0, packet_id=None, retain=False, dup=False):
+    """
+    📤 PUBLISH
+
+    Args:
+        topic (str): topic
+        payload (bytes): ข้อมูล
+        qos (int): 0, 1 หรือ 2
+        packet_id (int): ต้องระบุเมื่อ qos > 0
+    """
+    first_byte = (PUBLISH << 4) | (qos << 1)
+    if retain:
+        first_byte |= 0x01
+    if dup:
+        first_byte |= 0x08
+    body = _encode_string(topic)
+    if qos:
+        body += _UINT16.pack(packet_id)
+    return _packet(first_byte, body + payload)
+
+
+def encode_puback(packet_id):
+    """✅ PUBACK"""
+    return bytes((PUBACK << 4, 2)) + _UINT16.pack(packet_id)
+
+
+def encode_pubrec(packet_id):
+    """📥 PUBREC"""
+    return bytes((PUBREC << 4, 2)) + _UINT16.pack(packet_id)
+
+
+def encode_pubcomp(packet_id):
+    """✅ PUBCOMP"""
+    return bytes((PUBCOMP << 4, 2)) + _UINT16.pack(packet_id)
+
+
+def encode_suback(packet_id, return_codes):
+    """✅ SUBACK"""
+    return _packet(SUBACK << 4, _UINT16.pack(packet_id) + bytes(return_codes))
+
+
+def encode_unsuback(packet_id):
+    """✅ UNSUBACK"""
+    return bytes((UNSUBACK << 4, 2)) + _UINT16.pack(packet_id)
+
+
+# ========================================
+# 📥 Decoder
+# ========================================
+
+class _Reader:
+    """📖 อ่าน field ต่างๆ จาก memoryview ของ body ทีละส่วน"""
+
+    __slots__ = ('view', 'offset')
+
+    def __init__(self, view):
+        self.view = view
+        self.offset = 0
+
+    def remaining(self):
+        return len(self.view) - self.offset
+
+    def uint8(self):
+        if self.offset >= len(self.view):
+            raise MQTTProtocolError("packet สั้นเกินไป")
+        value = self.view[self.offset]
+        self.offset += 1
+        return value
+
+    def uint16(self):
+        if self.offset + 2 > len(self.view):
+            raise MQTTProtocolError("packet สั้นเกินไป")
+        value = _UINT16.unpack_from(self.view, self.offset)[0]
+        self.offset += 2
+        return value
+
+    def binary(self):
+        length = self.uint16()
+        if self.offset + length > len(self.view):
+            raise MQTTProtocolError("ความยาว field เกินขนาด packet")
+        data = bytes(self.view[self.offset:self.offset + length])
+        self.offset += length
+        return data
+
+    def string(self):
+        length = self.uint16()
+        if self.offset + length > len(self.view):
+            raise MQTTProtocolError("ความยาว string เกินขนาด packet")
+        try:
+            value = str(self.view[self.offset:self.offset + length], 'utf-8')
+        except UnicodeDecodeError:
+            raise MQTTProtocolError("string ไม่ใช่ UTF-8 ที่ถูกต้อง")
+        self.offset += length
+        return value
+
+    def rest(self):
+        data = bytes(self.view[self.offset:])
+        self.offset = len(self.view)
+        return data
+
+
+def _parse_connect(reader):
+    protocol_name = reader.string()
+    protocol_level = reader.uint8()
+    flags = reader.uint8()
+    keepalive = reader.uint16()
+    client_id = reader.string()
+
+    will = None
+    if flags & 0x04:
+        will = {
+            'topic': reader.string(),
+            'payload': reader.binary(),
+            'qos': (flags >> 3) & 0x03,
+            'retain': bool(flags & 0x20)
+        }
+
+    username = reader.string() if flags & 0x80 else None
+    password = reader.binary() if flags & 0x40 else None
+
+    return {
+        'type': 'connect',
+        'protocol_name': protocol_name,
+        'protocol_level': protocol_level,
+        'clean_session': bool(flags & 0x02),
+        'keepalive': keepalive,
+        'client_id': client_id,
+        'will': will,
+        'username': username,
+        'password': password
+    }
+
+
+def _parse_publish(flags, reader):
+    qos = (flags >> 1) & 0x03
+    if qos == 3:
+        raise MQTTProtocolError("QoS 3 ไม่มีอยู่จริง")
+    topic = reader.string()
+    packet_id = reader.uint16() if qos else None
+    return {
+        'type': 'publish',
+        'topic': topic,
+        'payload': reader.rest(),
+        'qos': qos,
+        'retain': bool(flags & 0x01),
+        'dup': bool(flags & 0x08),
+        'packet_id': packet_id
+    }
+
+
+def _parse_subscribe(reader):
+    packet_id = reader.uint16()
+    topics = []
+    while reader.remaining():
+        topic_filter = reader.string()
+        qos = reader.uint8() & 0x03
+        topics.append((topic_filter, qos))
+    if not topics:
+        raise MQTTProtocolError("SUBSCRIBE ต้องมีอย่างน้อยหนึ่ง topic")
+    return {'type': 'subscribe', 'packet_id': packet_id, 'topics': topics}
+
+
+def _parse_unsubscribe(reader):
+    packet_id = reader.uint16()
+    topics = []
+    while reader.remaining():
+        topics.append(reader.string())
+    if not topics:
+        raise MQTTProtocolError("UNSUBSCRIBE ต้องมีอย่างน้อยหนึ่ง topic")
+    return {'type': 'unsubscribe', 'packet_id': packet_id, 'topics': topics}
+
+
+_ACK_TYPES = {PUBACK: 'puback', PUBREC: 'pubrec', PUBREL: 'pubrel', PUBCOMP: 'pubcomp'}
+
+
+def parse_packet(packet_type, flags, body):
+    """
+    🔍 แปลง packet หนึ่งตัวเป็น dict
+
+    Args:
+        packet_type (int): ประเภท packet
+        flags (int): 4 bit ล่างของ fixed header
+        body (memoryview): ข้อมูลหลัง fixed header
+    """
+    reader = _Reader(body)
+
+    if packet_type == PUBLISH:
+        return _parse_publish(flags, reader)
+    if packet_type == PINGREQ:
+        return {'type': 'ping'}
+    if packet_type in _ACK_TYPES:
+        return {'type': _ACK_TYPES[packet_type], 'packet_id': reader.uint16()}
+    if packet_type == SUBSCRIBE:
+        return _parse_subscribe(reader)
+    if packet_type == UNSUBSCRIBE:
+        return _parse_unsubscribe(reader)
+    if packet_type == CONNECT:
+        return _parse_connect(reader)
+    if packet_type == DISCONNECT:
+        return {'type': 'disconnect'}
+
+    raise MQTTProtocolError(f"client ไม่ควรส่ง packet ประเภท {packet_type}")
+
+
+class MQTTStreamDecoder(ReceiveBuffer):
+    """
+    📥 ถอดรหัส MQTT packet จาก stream ของ TCP
+
+    ใช้ได้สองแบบ:
+    - recv_into(sock) แล้วเรียก decode()
+    - get_buffer() / buffer_updated(n) (ตรงกับ asyncio.BufferedProtocol) แล้วเรียก decode()
+
+    Args:
+        read_size (int): พื้นที่ว่างขั้นต่ำที่เตรียมไว้สำหรับการอ่านแต่ละครั้ง
+        max_packet_size (int): ขนาด packet สูงสุดที่ยอมรับ
+    """
+
+    def __init__(self, read_size=DEFAULT_READ_SIZE, max_packet_size=DEFAULT_MAX_FRAME_SIZE):
+        super().__init__(read_size)
+        self.max_packet_size = max_packet_size
+
+    def decode(self):
+        """
+        🔍 parse packet ที่ได้รับครบแล้วทั้งหมด
+
+        Returns:
+            list: packet ในรูป dict
+        """
+        packets = []
+        view = memoryview(self.buffer)
+        try:
+            start = self.start
+            end = self.end
+            while end - start >= 2:
+                header = view[start]
+                decoded = decode_remaining_length(view, start + 1, end)
+                if decoded is None:
+                    break
+                length, body_start = decoded
+                if length > self.max_packet_size:
+                    raise MQTTProtocolError(f"packet ใหญ่เกิน {self.max_packet_size} byte")
+                body_end = body_start + length
+                if body_end > end:
+                    break
+                packets.append(parse_packet(header >> 4, header & 0x0F, view[body_start:body_end]))
+                start = body_end
+        finally:
+            view.release()
+
+        self._consumed(start)
+        return packets
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+💤 Session ถาวรของ client (Persistent Session)
+============================================
+
+client ที่เชื่อมต่อด้วย client id เดิมและขอ session ถาวร
+(MQTT: CONNECT ที่ clean_session = 0, JSON-line: {"type": "connect", "clean_session": false})
+จะได้ subscription เดิมกลับมาเมื่อเชื่อมต่อใหม่ และได้รับข้อความที่ publish ระหว่างที่หลุดไป
+
+- ระหว่างที่ client ไม่อยู่ subscription ของ session อยู่ใน trie ภายใต้ key ของ session
+  (OFFLINE_PREFIX + client id) ข้อความที่ตรงกันจึงถูกเก็บลง OfflineQueue ของ session
+- OfflineQueue เก็บข้อความชุดแรกในหน่วยความจำ ส่วนที่เกินเขียนต่อท้ายไฟล์ของ session (spill)
+  แล้วอ่านกลับทีละ batch ตอนส่งให้ client จำนวนรวมจำกัดที่ max_messages (เกินแล้วทิ้งข้อความใหม่)
+- session เก็บในหน่วยความจำของ broker: ไฟล์ spill ที่ค้างจากการรันครั้งก่อนถูกลบตอนเริ่ม
+"""
+
+import hashlib
+import os
+import threading
+from collections import deque
+
+from message_log import dump_json, load_json
+
+OFFLINE_PREFIX = 'session:'
+
+
+class OfflineQueue:
+    """
+    📥 คิวข้อความของ session ที่ client ไม่ได้เชื่อมต่อ (ผู้เรียกต้องถือ lock ของ session)
+
+    ข้อความที่อยู่ในไฟล์ใหม่กว่าข้อความในหน่วยความจำเสมอ: เมื่อเริ่ม spill แล้ว
+    ข้อความใหม่ต่อท้ายไฟล์จนกว่าจะอ่านไฟล์หมด ลำดับจึงไม่สลับ
+
+    Args:
+        path (str): ไฟล์สำหรับ spill (None = เก็บในหน่วยความจำอย่างเดียว)
+        memory_messages (int): จำนวนข้อความที่เก็บในหน่วยความจำก่อนเริ่มเขียนลงไฟล์
+        max_messages (int): จำนวนข้อความรวมสูงสุด (0 = ไม่จำกัด)
+    """
+
+    def __init__(self, path=None, memory_messages=1000, max_messages=10000):
+        self.path = path
+        self.memory_messages = memory_messages
+        self.max_messages = max_messages
+        self.memory = deque()
+        self.file = None            # เปิดเมื่อ spill ครั้งแรก
+        self.read_position = 0      # ตำแหน่งในไฟล์ที่อ่านถึงแล้ว
+        self.spilled = 0            # ข้อความในไฟล์ที่ยังไม่ได้อ่าน
+        self.dropped = 0
+
+    def push(self, message):
+        """
+        ➕ เพิ่มข้อความ (dict ที่แปลงเป็น JSON ได้) ต่อท้ายคิว
+
+        Returns:
+            bool: False ถ้าคิวเต็มหรือเขียนไฟล์ไม่ได้ (ข้อความถูกทิ้ง)
+        """
+        if self.max_messages and len(self) >= self.max_messages:
+            self.dropped += 1
+            return False
+        if self.spilled or (self.path and len(self.memory) >= self.memory_messages):
+            try:
+                self._spill(message)
+            except OSError:
+                self.dropped += 1
+                return False
+            return True
+        self.memory.append(message)
+        return True
+
+    def _spill(self, message):
+        """💾 เขียนข้อความต่อท้ายไฟล์ (หนึ่งบรรทัด JSON ต่อข้อความ)"""
+        if self.file is None:
+            self.file = open(self.path, 'w+b')
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(dump_json(message) + b'\n')
+        self.spilled += 1
+
+    def requeue(self, messages):
+        """↩️ ใส่ข้อความที่ส่งไม่สำเร็จกลับไว้หัวคิว (ไม่นับกับ max_messages เพราะรับไว้แล้ว)"""
+        self.memory.extendleft(reversed(messages))
+
+    def pop_batch(self, limit):
+        """
+        📤 เอาข้อความจากหัวคิวออกไม่เกิน limit ข้อความ (หน่วยความจำก่อน แล้วค่อยอ่านไฟล์)
+
+        Returns:
+            list: ข้อความเรียงตามลำดับที่เข้าคิว
+        """
+        batch = []
+        while self.memory and len(batch) < limit:
+            batch.append(self.memory.popleft())
+        if self.spilled and len(batch) < limit:
+            batch.extend(self._read_spilled(limit - len(batch)))
+        return batch
+
+    def _read_spilled(self, limit):
+        """📖 อ่านข้อความถัดไปจากไฟล์ (อ่านหมดแล้วเริ่มไฟล์ใหม่ ไฟล์จึงไม่โตเรื่อยๆ)"""
+        self.file.flush()
+        self.file.seek(self.read_position)
+        batch = []
+        while len(batch) < limit:
+            line = self.file.readline()
+            if not line:
+                break
+            batch.append(load_json(line))
+        self.read_position = self.file.tell()
+        self.spilled -= len(batch)
+        if not self.spilled:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_position = 0
+        return batch
+
+    def close(self):
+        """🗑️ ทิ้งข้อความทั้งหมดและลบไฟล์"""
+        self.memory.clear()
+        self.spilled = 0
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        """📊 จำนวนข้อความที่รออยู่ (รวมในไฟล์)"""
+        return len(self.memory) + self.spilled
+
+
+class Session:
+    """
+    💤 session ถาวรของ client id หนึ่งตัว
+
+    Args:
+        client_id (str): client id ที่ client ส่งมาตอนเชื่อมต่อ
+        queue (OfflineQueue): คิวข้อความระหว่างที่ client ไม่อยู่
+    """
+
+    __slots__ = ('client_id', 'key', 'subscriptions', 'queue', 'connection', 'online', 'lock')
+
+    def __init__(self, client_id, queue):
+        self.client_id = client_id
+        self.key = OFFLINE_PREFIX + client_id   # subscriber id ใน trie ระหว่างที่ client ไม่อยู่
+        self.subscriptions = {}                 # topic filter -> QoS (บันทึกตอน client หลุด)
+        self.queue = queue
+        self.connection = None                  # ID ของ connection ที่ใช้ session อยู่ (None = ไม่อยู่)
+        self.online = False                     # ส่งข้อความที่ค้างครบแล้ว ข้อความใหม่ส่งตรงถึง connection
+        self.lock = threading.Lock()
+
+    def offer(self, message):
+        """
+        📥 เก็บข้อความที่ publish มาระหว่างที่ client ไม่อยู่หรือยังรับข้อความที่ค้างไม่ครบ
+
+        Returns:
+            str: ID ของ connection ถ้า session online แล้ว (ผู้เรียกต้องส่งตรงเอง), None ถ้าเก็บลงคิวแล้ว
+        """
+        with self.lock:
+            if self.online:
+                return self.connection
+            self.queue.push(message)
+            return None
+
+    def attach(self, connection):
+        """🔗 ผูก session กับ connection ใหม่ (ข้อความใหม่ยังเข้าคิวจนกว่าจะส่งของเก่าครบ)"""
+        with self.lock:
+            self.connection = connection
+            self.online = False
+
+    def take(self, connection, limit):
+        """
+        📤 ข้อความที่ค้างชุดถัดไปสำหรับ connection นี้
+
+        ถ้าไม่เหลือข้อความแล้ว session จะ online ทันทีภายใต้ lock เดียวกัน
+        ข้อความที่ offer เข้ามาหลังจากนี้จึงส่งตรง ไม่ค้างอยู่ในคิว
+
+        Returns:
+            list: ข้อความ ([] = ส่งครบแล้ว), None ถ้า connection นี้ไม่ได้ใช้ session แล้ว
+        """
+        with self.lock:
+            if self.connection != connection:
+                return None
+            batch = self.queue.pop_batch(limit)
+            if not batch:
+                self.online = True
+            return batch
+
+    def suspend(self, subscriptions):
+        """
+        💤 client หลุด: จำ subscription ไว้ และเริ่มเก็บข้อความลงคิว
+
+        Args:
+            subscriptions (dict): topic filter -> QoS ของ client ตอนหลุด
+        """
+        with self.lock:
+            self.subscriptions = subscriptions
+            self.connection = None
+            self.online = False
+
+    def requeue(self, messages):
+        """↩️ ใส่ข้อความที่ยังส่งไม่สำเร็จ (เช่น QoS 1 ที่ไม่ได้ PUBACK) กลับไว้หัวคิว"""
+        if messages:
+            with self.lock:
+                self.queue.requeue(messages)
+
+
+class SessionStore:
+    """
+    🗄️ session ถาวรทั้งหมดของ broker
+
+    Args:
+        directory (str): โฟลเดอร์สำหรับไฟล์ spill (None = เก็บในหน่วยความจำอย่างเดียว)
+        memory_messages (int): ข้อความต่อ session ที่เก็บในหน่วยความจำก่อน spill
+        max_messages (int): ข้อความสูงสุดต่อ session (0 = ไม่จำกัด)
+    """
+
+    def __init__(self, directory=None, memory_messages=1000, max_messages=10000):
+        self.directory = directory
+        self.memory_messages = memory_messages
+        self.max_messages = max_messages
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.dropped = 0            # ข้อความที่ทิ้งไปจาก session ที่ถูกลบแล้ว
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for name in os.listdir(directory):
+                if name.endswith('.queue'):
+                    os.remove(os.path.join(directory, name))
+
+    def _queue_path(self, client_id):
+        """📄 ไฟล์ spill ของ client id (ใช้ hash เพราะ client id มีอักขระอะไรก็ได้)"""
+        if not self.directory:
+            return None
+        name = hashlib.sha1(client_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.queue')
+
+    def open(self, client_id):
+        """
+        📂 หา session ของ client id (สร้างใหม่ถ้ายังไม่มี)
+
+        Returns:
+            tuple: (Session, True ถ้ามี session เดิมอยู่แล้ว)
+        """
+        with self.lock:
+            session = self.sessions.get(client_id)
+            if session is not None:
+                return session, True
+            queue = OfflineQueue(self._queue_path(client_id), self.memory_messages, self.max_messages)
+            session = self.sessions[client_id] = Session(client_id, queue)
+            return session, False
+
+    def get(self, client_id):
+        """🔍 session ของ client id (None ถ้าไม่มี)"""
+        return self.sessions.get(client_id)
+
+    def offline(self, key):
+        """🔍 session จาก subscriber id ใน trie (None ถ้า key นี้ไม่ใช่ของ session)"""
+        if not key.startswith(OFFLINE_PREFIX):
+            return None
+        return self.sessions.get(key[len(OFFLINE_PREFIX):])
+
+    def discard(self, session):
+        """🗑️ ลบ session และข้อความที่ค้างทั้งหมด"""
+        with self.lock:
+            if self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+        with session.lock:
+            self.dropped += session.queue.dropped + len(session.queue)
+            session.queue.close()
+
+    def close(self):
+        """🔒 ปิดไฟล์ spill ทั้งหมด (ตอนหยุด broker)"""
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            with session.lock:
+                session.queue.close()
+
+    def __len__(self):
+        """📊 จำนวน session"""
+        return len(self.sessions)
+
+    def stats(self):
+        """📊 จำนวน session, session ที่ client ไม่อยู่, ข้อความที่ค้าง (รวม/ในไฟล์) และที่ทิ้งไป"""
+        sessions = list(self.sessions.values())
+        return {
+            'sessions': len(sessions),
+            'offline': sum(1 for session in sessions if session.connection is None),
+            'queued': sum(len(session.queue) for session in sessions),
+            'spilled': sum(session.queue.spilled for session in sessions),
+            'dropped': self.dropped + sum(session.queue.dropped for session in sessions)
+        }
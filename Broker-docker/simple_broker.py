@@ -5,90 +5,534 @@
 =================================
 
 นี่คือ MQTT Broker ที่ปรับแต่งสำหรับ Docker environment
+เลือก engine ได้ด้วยตัวแปร BROKER_ENGINE (threaded / asyncio)
+และแบ่งเป็นหลาย process ได้ด้วยตัวแปร BROKER_WORKERS
+ส่วน BROKER_PROTOCOL เลือกว่าจะพูด JSON-line, MQTT 3.1.1 (binary) หรือทั้งสองแบบบน port เดียวกัน (auto)
+และ BACKPRESSURE_POLICY เลือกว่าจะทำอย่างไรกับ subscriber ที่รับข้อมูลไม่ทัน
+subscriber ที่ขอ QoS 1 จะได้รับแบบ at-least-once (รอ PUBACK และส่งซ้ำด้วย timer กลาง)
+client ที่เงียบนานเกิน KEEPALIVE_TIMEOUT / CLIENT_TIMEOUT ถูกตัดโดย timing wheel เดียวสำหรับทุก client
+client ที่ขอ session ถาวร (PERSISTENT_SESSIONS) ได้ subscription และข้อความที่พลาดไประหว่างหลุดคืน
+log ถูกเขียนโดย thread แยกผ่านคิว (ไฟล์หมุนตาม LOG_FILE_MAX_SIZE) และ log ต่อข้อความจำกัดด้วย LOG_HOT_PATH_PER_SECOND
+สถิติอ่านได้จาก endpoint /metrics แบบ Prometheus ที่ METRICS_PORT (worker ตัวที่ N ใช้ METRICS_PORT + N)
+latency ของข้อความแต่ละขั้น (LATENCY_TRACKING) เปิด/ปิดระหว่างทำงานได้ด้วย POST /latency ที่ port เดียวกัน
+และ client ที่ subscribe '$SYS/#' ได้รับสถิติของ worker ที่ตัวเองเชื่อมต่ออยู่ทุก SYS_INTERVAL วินาที
+SIGUSR1 / SIGUSR2 หรือคำสั่ง admin (ADMIN_TOKEN) เปิด/ปิด profiler ระหว่างทำงาน ผลเขียนลง PROFILE_DIR
 """
 
 import socket
 import threading
 import time
 import json
+import base64
 import os
+import hmac
+import signal
+import itertools
 from datetime import datetime
-from collections import defaultdict
 import logging
 
+from async_engine import AsyncioEngine
+from cluster import run_cluster
+from topic_trie import is_valid_filter, has_wildcard, topic_matches
+from sharded_state import ShardedMap, ShardedTopicTrie, StatCounter
+from retained_store import RetainedStore
+from message_log import MessageLog
+from frame_decoder import LineFrameDecoder, FrameTooLargeError
+from client_writer import SocketWriter, OutboundLimits, BackpressureStats
+from timer_queue import TimerQueue
+from timing_wheel import TimingWheel
+from inflight import InflightWindow
+from session_store import SessionStore
+from log_pipeline import LogPipeline, RateLimitedLog, file_handler, parse_size
+from metrics import MetricsRegistry, MetricsServer, Histogram, FANOUT_BUCKETS
+from latency import LatencyTracker, QUANTILES, STAGES
+from sys_topics import SysTopics, SYS_PREFIX
+from profiler import ProfilerControl, MODES
+from mqtt_codec import (
+    MQTTStreamDecoder, MQTTProtocolError, PINGRESP_PACKET, SUBACK_FAILURE,
+    CONNACK_ACCEPTED, CONNACK_BAD_PROTOCOL, CONNACK_IDENTIFIER_REJECTED,
+    encode_connack, encode_publish, encode_puback, encode_pubrec, encode_pubcomp,
+    encode_suback, encode_unsuback, detect_protocol
+)
+
+# ⏪ จำนวนข้อความต่อ chunk ของ replay (รอให้คิวขาออกของ client ลดลงก่อนส่ง chunk ถัดไป)
+REPLAY_CHUNK_SIZE = 256
+
+
+def setup_logging(filename='broker.log'):
+    """
+    📝 ตั้งค่าระบบ logging (ใช้ร่วมกันทั้ง broker และ process แม่ของ cluster)
+    
+    log ทุกตัวเข้าคิวแล้วถูกเขียนโดย thread เขียน log ของ process นั้น (worker ที่ fork มาต้องเรียกใหม่)
+    คืนค่า LogPipeline สำหรับดูสถิติและ stop() ตอนจบ
+    """
+    log_level = os.getenv('LOG_LEVEL', 'INFO')
+    
+    formatter = logging.Formatter(
+        '%(asctime)s | %(levelname)s | %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    handlers = [
+        logging.StreamHandler(),
+        file_handler(
+            os.path.join('/app/logs', filename),
+            parse_size(os.getenv('LOG_FILE_MAX_SIZE', '10MB')),
+            int(os.getenv('LOG_FILE_BACKUP_COUNT', '5'))
+        )
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, log_level))
+    return LogPipeline(handlers, int(os.getenv('LOG_QUEUE_SIZE', '10000'))).install(root)
+
+
+def _payload_to_bytes(payload):
+    """🔄 แปลง payload จาก JSON client ให้เป็น bytes สำหรับ MQTT client"""
+    if payload is None:
+        return b''
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+def _payload_to_json(payload):
+    """🔄 แปลง payload (bytes) จาก MQTT client เป็น field ของข้อความ JSON (ไม่ใช่ UTF-8 = ส่งเป็น base64)"""
+    try:
+        return {'payload': payload.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'payload': base64.b64encode(payload).decode('ascii'), 'payload_encoding': 'base64'}
+
+
+def _parse_timestamp(value):
+    """🕒 แปลงเวลาจากคำขอ replay (epoch วินาที หรือ ISO 8601) เป็น epoch วินาที (None = ไม่ได้ระบุ)"""
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+def _parse_qos(value):
+    """🔢 แปลง QoS จากข้อความ JSON (ค่าที่ไม่ถูกต้องถือเป็น 0)"""
+    try:
+        return min(max(int(value or 0), 0), 2)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _subscription_qos(qos_filters, topic):
+    """🔢 QoS สูงสุดของ subscription (topic filter -> QoS ของ client หรือของ session) ที่ตรงกับ topic"""
+    if not qos_filters:
+        return 0
+    qos = qos_filters.get(topic, 0)
+    for topic_filter, filter_qos in qos_filters.items():
+        if filter_qos > qos and topic_matches(topic_filter, topic):
+            qos = filter_qos
+    return qos
+
+
+def _parse_client_policies(value):
+    """🚦 แปลง CLIENT_POLICIES ('dashboard=conflate,logger=pause') เป็น dict"""
+    policies = {}
+    for item in value.split(','):
+        if '=' in item:
+            mqtt_client_id, policy = item.split('=', 1)
+            policies[mqtt_client_id.strip()] = policy.strip().lower()
+    return policies
+
+
 class MQTTBroker:
     """🏠 MQTT Broker หลักสำหรับ Docker"""
     
-    def __init__(self, host='0.0.0.0', port=1883):
-        """🔧 เตรียมตัวแปรสำหรับ Broker"""
+    def __init__(self, host='0.0.0.0', port=1883, reuse_port=False, cluster=None):
+        """
+        🔧 เตรียมตัวแปรสำหรับ Broker
+        
+        Args:
+            host (str): ที่อยู่ IP ที่จะรอรับการเชื่อมต่อ
+            port (int): พอร์ตที่จะใช้
+            reuse_port (bool): bind ด้วย SO_REUSEPORT (ใช้ตอนรันหลาย worker)
+            cluster (ClusterLink): ช่องทางส่ง publish ไปยัง worker อื่น (ถ้ามี)
+        """
         self.host = host
         self.port = port
         self.running = False
+        self.reuse_port = reuse_port
+        self.cluster = cluster
+        
+        # ⚡ engine ที่ใช้: 'threaded' (thread ต่อ client) หรือ 'asyncio' (event loop เดียว)
+        self.engine = os.getenv('BROKER_ENGINE', 'threaded').lower()
+        self.async_engine = None
+        
+        # 📦 protocol ที่ใช้: 'json' (JSON-line แบบง่าย), 'mqtt' (MQTT 3.1.1 binary)
+        #    หรือ 'auto' (ดูจาก byte แรกของแต่ละ connection)
+        self.protocol = os.getenv('BROKER_PROTOCOL', 'auto').lower()
+        
+        # 📥 ขนาด buffer รับข้อมูลต่อ connection (byte)
+        self.read_size = int(os.getenv('READ_BUFFER_SIZE', '65536'))
+        
+        # 🚦 ขีดจำกัดคิวขาออกต่อ client และ policy เมื่อ subscriber ตามไม่ทัน
+        self.outbound_limits = OutboundLimits(
+            policy=os.getenv('BACKPRESSURE_POLICY', 'drop-oldest').lower(),
+            high_bytes=int(os.getenv('OUTBOUND_HIGH_BYTES', str(8 * 1024 * 1024))),
+            low_bytes=int(os.getenv('OUTBOUND_LOW_BYTES', str(4 * 1024 * 1024))),
+            high_messages=int(os.getenv('OUTBOUND_HIGH_MESSAGES', '10000')),
+            low_messages=int(os.getenv('OUTBOUND_LOW_MESSAGES', '5000'))
+        )
+        self.client_limits = {          # MQTT client id -> ขีดจำกัดที่ใช้ policy เฉพาะตัว
+            mqtt_client_id: self.outbound_limits.with_policy(policy)
+            for mqtt_client_id, policy in _parse_client_policies(os.getenv('CLIENT_POLICIES', '')).items()
+        }
+        self.backpressure_stats = BackpressureStats()
         
-        # 📚 Dictionary สำหรับจัดเก็บข้อมูล
-        self.clients = {}              # เก็บข้อมูล client ที่เชื่อมต่อ
-        self.subscriptions = defaultdict(set)  # เก็บการ subscribe
-        self.retained_messages = {}    # เก็บข้อความที่ retain ไว้
+        # 📬 QoS 1 ขาออก: in-flight window ต่อ client และ timer กลางสำหรับส่งซ้ำ
+        #    (MAX_QOS=0 ส่งทุกข้อความแบบ QoS 0, QoS 2 ขาออกลดเหลือ 1)
+        self.max_qos = min(int(os.getenv('MAX_QOS', '1')), 1)
+        self.inflight_window = int(os.getenv('INFLIGHT_WINDOW', '20'))
+        self.max_pending_messages = int(os.getenv('MAX_PENDING_MESSAGES', '1000'))
+        self.qos_retry_interval = float(os.getenv('QOS_RETRY_INTERVAL', '10'))
+        self.timers = TimerQueue('qos-retry')
         
-        # 📊 สถิติการทำงาน
+        # ⏰ client ที่เงียบนานเกินกำหนดถูกตัด (MQTT: 1.5 เท่าของ keepalive, JSON-line: CLIENT_TIMEOUT)
+        #    deadline ของทุก client อยู่ใน timing wheel เดียว ตรวจทุก HEARTBEAT_INTERVAL วินาที
+        self.keepalive_timeout = float(os.getenv('KEEPALIVE_TIMEOUT', '60'))
+        self.client_timeout = float(os.getenv('CLIENT_TIMEOUT', '300'))
+        self.heartbeat_interval = float(os.getenv('HEARTBEAT_INTERVAL', '10'))
+        self.deadlines = TimingWheel(now=time.monotonic())
+        
+        # 📚 ข้อมูลหลักแบ่งเป็น shard แต่ละ shard มี lock ของตัวเอง (ดู sharded_state.py)
+        #    lock ของ shard ใน clients ดูแลข้อมูล session ของ client ใน shard นั้นด้วย
+        shards = int(os.getenv('LOCK_SHARDS', '16'))
+        self.clients = ShardedMap('clients', shards)           # เก็บข้อมูล client ที่เชื่อมต่อ
+        self.subscriptions = ShardedTopicTrie(                   # เก็บการ subscribe (trie รองรับ + และ #)
+            wildcards=os.getenv('WILDCARD_SUBSCRIPTIONS', 'true').lower() == 'true',
+            cache_size=int(os.getenv('MATCH_CACHE_SIZE', '4096')),
+            shard_count=shards
+        )
+        self.connection_ids = itertools.count(1)               # ลำดับการเชื่อมต่อ (ใช้สร้าง client ID)
+        
+        # 📊 สถิติการทำงาน (ตัวนับเพิ่มค่าได้โดยไม่ต้องใช้ lock)
         self.stats = {
-            'total_connections': 0,
-            'current_connections': 0,
-            'total_messages': 0,
+            'total_connections': StatCounter(),
+            'total_messages': StatCounter(),
+            'qos_retransmitted': StatCounter(),     # ข้อความ QoS 1 ที่ส่งซ้ำเพราะไม่ได้ PUBACK
+            'qos_dropped': StatCounter(),           # ข้อความ QoS 1 ที่ทิ้งเพราะคิวของ window เต็ม (client ที่หลุดไปแล้ว)
+            'timed_out': StatCounter(),             # client ที่ถูกตัดเพราะเงียบนานเกินกำหนด
+            'messages_delivered': StatCounter(),    # ข้อความที่ส่งให้ subscriber (นับต่อผู้รับ)
             'start_time': datetime.now(),
             'last_activity': datetime.now()
         }
+        self.fanout = Histogram(FANOUT_BUCKETS)     # จำนวนผู้รับต่อหนึ่ง publish
         
         # 🔧 ตั้งค่า logging
         self.setup_logging()
         
+        # 📌 เก็บข้อความที่ retain ไว้ (None = ปิด)
+        self.retained_messages = self._open_retained_store()
+        
+        # 📒 log ของทุก publish (DURABLE_LOG) เก็บใน DATA_DIR/log (None = ปิด)
+        self.message_log = self._open_message_log()
+        
+        # 💤 session ถาวร (PERSISTENT_SESSIONS) ข้อความที่ค้างเกินหน่วยความจำเก็บใน DATA_DIR/sessions (None = ปิด)
+        self.session_expiry = float(os.getenv('SESSION_EXPIRY', '3600'))
+        self.sessions = self._open_session_store()
+        
+        # ⏱️ latency ของข้อความแต่ละขั้น (LATENCY_TRACKING) วัดหนึ่งใน LATENCY_SAMPLE_EVERY ข้อความ
+        self.latency = LatencyTracker(
+            f'{self.host}:{self.port}',
+            enabled=os.getenv('LATENCY_TRACKING', 'false').lower() == 'true',
+            prefix_levels=int(os.getenv('LATENCY_TOPIC_LEVELS', '0')),
+            max_prefixes=int(os.getenv('LATENCY_MAX_PREFIXES', '64')),
+            sample_every=int(os.getenv('LATENCY_SAMPLE_EVERY', '16'))
+        )
+        
+        # 📈 endpoint /metrics (METRICS_ENABLED) ค่าต่อวินาทีคำนวณใหม่ทุก STATS_INTERVAL วินาที
+        self.stats_interval = float(os.getenv('STATS_INTERVAL', '30'))
+        self.metrics = self._build_metrics()
+        self.metrics_server = None
+        
+        # 📡 สถิติใน topic $SYS/broker/... (SYS_TOPICS_ENABLED) ส่งทุก SYS_INTERVAL วินาทีเมื่อมีคน subscribe
+        self.sys_interval = float(os.getenv('SYS_INTERVAL', '10'))
+        self.sys_topics = self._build_sys_topics()
+        
+        # 🔬 profiler ที่เปิด/ปิดได้ระหว่างทำงาน (SIGUSR1/SIGUSR2 หรือคำสั่ง admin) ผลเขียนลง PROFILE_DIR
+        self.profile_signal_mode = os.getenv('PROFILE_SIGNAL_MODE', 'cpu').lower()
+        self.admin_token = os.getenv('ADMIN_TOKEN', '')
+        self.profiler = ProfilerControl(
+            os.getenv('PROFILE_DIR', '/app/logs'),
+            sample_interval=float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '5')) / 1000,
+            memory_frames=int(os.getenv('PROFILE_MEMORY_FRAMES', '10')),
+            on_cpu_change=self._profile_event_loop
+        )
+        
         # 🌐 ตั้งค่า socket
         self.server_socket = None
         
     def setup_logging(self):
-        """📝 ตั้งค่าระบบ logging"""
-        log_level = os.getenv('LOG_LEVEL', 'INFO')
-        
-        logging.basicConfig(
-            level=getattr(logging, log_level),
-            format='%(asctime)s | %(levelname)s | %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S',
-            handlers=[
-                logging.StreamHandler(),
-                logging.FileHandler('/app/logs/broker.log', encoding='utf-8')
-            ]
-        )
+        """📝 ตั้งค่าระบบ logging (worker ของ cluster เขียนไฟล์ของตัวเอง เพราะหลาย process หมุนไฟล์เดียวกันไม่ได้)"""
+        filename = f'broker-worker-{self.cluster.worker_index}.log' if self.cluster is not None else 'broker.log'
+        self.log_pipeline = setup_logging(filename)
         self.logger = logging.getLogger(__name__)
         
+        # 🚦 log ของเหตุการณ์ที่เกิดถี่ (publish, เชื่อมต่อ, subscribe): format เฉพาะที่ผ่านโควตาต่อวินาที
+        per_second = int(os.getenv('LOG_HOT_PATH_PER_SECOND', '20'))
+        self.publish_log = RateLimitedLog(self.logger, per_second)
+        self.client_log = RateLimitedLog(self.logger, per_second)
+        
+    def _open_retained_store(self):
+        """
+        📌 เปิดที่เก็บ retained message (RETAINED_MESSAGES / DATA_DIR)
+        
+        เก็บลงไฟล์ retained.db ใน DATA_DIR (volume mqtt-data) จึงไม่หายเมื่อ container restart
+        ในโหมด multi-process ทุก worker โหลดจากไฟล์ แต่ worker #0 เป็นผู้เขียนไฟล์เพียงตัวเดียว
+        (retained message จาก worker อื่นส่งผ่าน hub มาถึงทุก worker อยู่แล้ว)
+        """
+        if os.getenv('RETAINED_MESSAGES', 'true').lower() != 'true':
+            return None
+            
+        data_dir = os.getenv('DATA_DIR', '/app/data')
+        path = os.path.join(data_dir, 'retained.db') if data_dir else None
+        writable = self.cluster is None or self.cluster.worker_index == 0
+        try:
+            store = RetainedStore(path, writable=writable)
+        except OSError as e:
+            self.logger.warning(f"⚠️ เปิดไฟล์ retained ไม่ได้ ({e}) เก็บในหน่วยความจำแทน")
+            store = RetainedStore()
+            
+        loaded = store.stats()
+        if loaded['topics']:
+            self.logger.info(
+                f"📌 โหลด retained message {loaded['topics']} topic ใน {loaded['load_ms']:.1f} ms"
+            )
+        return store
+        
+    def _open_session_store(self):
+        """
+        💤 สร้างที่เก็บ session ถาวร (ไฟล์ spill ที่ค้างจากการรันครั้งก่อนถูกลบ)
+        
+        session อยู่ในหน่วยความจำของ worker: ในโหมด multi-process client ต้องกลับมาที่ worker เดิม
+        จึงจะได้ session คืน แต่ละ worker ใช้โฟลเดอร์ DATA_DIR/sessions/worker-N ของตัวเอง
+        """
+        if os.getenv('PERSISTENT_SESSIONS', 'true').lower() != 'true':
+            return None
+            
+        memory_messages = int(os.getenv('SESSION_MEMORY_MESSAGES', '1000'))
+        max_messages = int(os.getenv('SESSION_MAX_MESSAGES', '10000'))
+        data_dir = os.getenv('DATA_DIR', '/app/data')
+        directory = os.path.join(data_dir, 'sessions') if data_dir else None
+        if directory and self.cluster is not None:
+            directory = os.path.join(directory, f'worker-{self.cluster.worker_index}')
+        try:
+            return SessionStore(directory, memory_messages, max_messages)
+        except OSError as e:
+            self.logger.warning(f"⚠️ ใช้โฟลเดอร์ของ session ไม่ได้ ({e}) เก็บข้อความที่ค้างในหน่วยความจำแทน")
+            return SessionStore(None, memory_messages, max_messages)
+        
+    def _open_message_log(self):
+        """
+        📒 เปิด log ของข้อความ (DURABLE_LOG) และซ่อม segment ล่าสุดหลัง crash
+        
+        ข้อความที่ publish ทุกข้อความถูกเขียนต่อท้าย segment ใน DATA_DIR/log (volume mqtt-data)
+        ก่อนส่งให้ subscriber ในโหมด multi-process แต่ละ worker เขียน log ของตัวเอง
+        ใน DATA_DIR/log/worker-N (ไฟล์เดียวกันเขียนจากหลาย process ไม่ได้)
+        """
+        if os.getenv('DURABLE_LOG', 'false').lower() != 'true':
+            return None
+            
+        directory = os.path.join(os.getenv('DATA_DIR', '/app/data') or '/app/data', 'log')
+        if self.cluster is not None:
+            directory = os.path.join(directory, f'worker-{self.cluster.worker_index}')
+        message_log = MessageLog(
+            directory,
+            mode=os.getenv('DURABLE_MODE', 'sync').lower(),
+            fsync_interval_ms=float(os.getenv('FSYNC_INTERVAL_MS', '5')),
+            segment_bytes=int(os.getenv('LOG_SEGMENT_BYTES', str(64 * 1024 * 1024))),
+            retention_bytes=int(os.getenv('LOG_RETENTION_BYTES', str(1024 * 1024 * 1024))),
+            retention_hours=float(os.getenv('LOG_RETENTION_HOURS', '168'))
+        )
+        
+        if message_log.recovered_bytes:
+            self.logger.warning(
+                f"🩺 ตัด record ที่เขียนไม่ครบท้าย log ทิ้ง {message_log.recovered_bytes} bytes"
+            )
+        recovered = message_log.stats()
+        self.logger.info(
+            f"📒 Durable log ({recovered['mode']}): {recovered['segments']} segment "
+            f"offset ถัดไป {recovered['next_offset']}"
+        )
+        return message_log
+        
+    def _build_metrics(self):
+        """📈 ลงทะเบียน metric ทั้งหมด (อ่านจากตัวนับที่ปรับค่าระหว่างทำงาน ไม่เดินดู client หรือ topic)"""
+        registry = MetricsRegistry()
+        stats = self.stats
+        traffic = self.backpressure_stats
+        listener = f'{self.host}:{self.port}'
+        
+        registry.counter('mqtt_connections_total', 'จำนวน connection ที่รับมาทั้งหมด',
+                         lambda: stats['total_connections'].value)
+        registry.gauge('mqtt_connections_active', 'จำนวน connection ที่ต่ออยู่', lambda: len(self.clients))
+        registry.counter('mqtt_clients_timed_out_total', 'client ที่ถูกตัดเพราะเงียบนานเกินกำหนด',
+                         lambda: stats['timed_out'].value)
+        registry.counter('mqtt_messages_published_total', 'ข้อความที่ client ของ worker นี้ publish เข้ามา',
+                         lambda: stats['total_messages'].value)
+        registry.counter('mqtt_messages_delivered_total', 'ข้อความที่ส่งให้ subscriber (นับต่อผู้รับ)',
+                         lambda: stats['messages_delivered'].value)
+        registry.rate('mqtt_messages_published_per_second', 'publish ต่อวินาทีในรอบ STATS_INTERVAL ล่าสุด',
+                      lambda: stats['total_messages'].value)
+        registry.rate('mqtt_messages_delivered_per_second', 'ข้อความที่ส่งต่อวินาทีในรอบ STATS_INTERVAL ล่าสุด',
+                      lambda: stats['messages_delivered'].value)
+        registry.histogram('mqtt_publish_fanout', 'จำนวน subscriber ที่ได้รับต่อหนึ่ง publish', self.fanout)
+        registry.gauge('mqtt_subscriptions', 'จำนวน subscription ใน trie',
+                       lambda: self.subscriptions.subscription_count)
+        registry.gauge('mqtt_topic_filters', 'จำนวน topic filter ที่มี subscriber',
+                       lambda: len(self.subscriptions))
+        registry.counter('mqtt_bytes_received_total', 'byte ที่อ่านจาก client', lambda: traffic.received_bytes.value)
+        registry.counter('mqtt_bytes_sent_total', 'byte ที่ส่งให้ client', lambda: traffic.sent_bytes.value)
+        registry.gauge('mqtt_outbound_queued_bytes', 'byte ที่ค้างในคิวขาออกของทุก client',
+                       lambda: traffic.queued_bytes.value)
+        registry.gauge('mqtt_outbound_queued_frames', 'frame ที่ค้างในคิวขาออกของทุก client',
+                       lambda: traffic.queued_frames.value)
+        registry.counter('mqtt_backpressure_events_total', 'เหตุการณ์ของ backpressure แยกตามชนิด',
+                         lambda: {(('event', name),): count for name, count in traffic.snapshot().items()})
+        registry.counter('mqtt_listener_errors_total', 'connection ที่มีปัญหาแยกตาม listener และสาเหตุ',
+                         lambda: {(('listener', listener), ('reason', reason)): count
+                                  for reason, count in traffic.error_snapshot().items()})
+        registry.counter('mqtt_qos_retransmitted_total', 'ข้อความ QoS 1 ที่ส่งซ้ำเพราะไม่ได้ PUBACK',
+                         lambda: stats['qos_retransmitted'].value)
+        registry.counter('mqtt_qos_dropped_total', 'ข้อความ QoS 1 ที่ทิ้ง (ของ client ที่หลุดไปแล้ว)',
+                         lambda: stats['qos_dropped'].value)
+        registry.gauge('mqtt_keepalive_tracked', 'client ที่ติดตาม keepalive อยู่ใน timing wheel',
+                       lambda: len(self.deadlines))
+        if self.sessions is not None:
+            registry.gauge('mqtt_sessions', 'จำนวน session ถาวร', lambda: len(self.sessions))
+        registry.gauge('mqtt_latency_enabled', 'เปิดการวัด latency อยู่ไหม (1 = เปิด)',
+                       lambda: int(self.latency.enabled))
+        registry.summary('mqtt_message_latency_seconds', 'เวลาตั้งแต่รับข้อมูลจนถึงแต่ละขั้นของข้อความ',
+                         self._latency_summary)
+        registry.counter('mqtt_log_records_dropped_total', 'log ที่ทิ้งเพราะคิวของ thread เขียน log เต็ม',
+                         lambda: self.log_pipeline.stats()['dropped'])
+        registry.gauge('mqtt_uptime_seconds', 'เวลาที่ broker ทำงานมา',
+                       lambda: (datetime.now() - stats['start_time']).total_seconds())
+        return registry
+        
+    def _latency_summary(self):
+        """⏱️ percentile ของ latency แต่ละขั้นในรูปแบบของ summary (หน่วยวินาที, แยก prefix เมื่อตั้ง LATENCY_TOPIC_LEVELS)"""
+        listener = self.latency.listener
+        per_prefix = bool(self.latency.prefix_levels)
+        summary = {}
+        for (prefix, stage), values in self.latency.snapshot(per_prefix).items():
+            labels = (('listener', listener), ('stage', stage))
+            if per_prefix:
+                labels += (('prefix', prefix),)
+            summary[labels] = (
+                [(quantile, value / 1e9) for quantile, value in zip(QUANTILES, values['quantiles'])],
+                values['sum'] / 1e9,
+                values['count']
+            )
+        return summary
+        
+    def _control_latency(self, params):
+        """🎛️ POST /latency?enabled=true|false&reset=true เปิด/ปิด/ล้างค่าการวัด latency ของ worker นี้"""
+        flags = {'true': True, '1': True, 'on': True, 'false': False, '0': False, 'off': False}
+        for key in ('enabled', 'reset'):
+            if key in params and params[key].lower() not in flags:
+                raise ValueError(f"{key} ต้องเป็น true หรือ false")
+        if 'enabled' in params:
+            self.latency.set_enabled(flags[params['enabled'].lower()])
+            self.logger.info(f"⏱️ {'เปิด' if self.latency.enabled else 'ปิด'}การวัด latency")
+        if flags.get(params.get('reset', 'false').lower()):
+            self.latency.reset()
+        return f"latency enabled={str(self.latency.enabled).lower()}\n"
+        
+    def _build_sys_topics(self):
+        """📡 ลงทะเบียนค่าที่ publish ใน $SYS/broker/... (อ่านจากตัวนับชุดเดียวกับ /metrics ของ worker นี้)"""
+        sys_topics = SysTopics(self.subscriptions, self._publish_system)
+        stats = self.stats
+        traffic = self.backpressure_stats
+        
+        sys_topics.value('uptime', lambda: int((datetime.now() - stats['start_time']).total_seconds()))
+        sys_topics.value('clients/connected', lambda: len(self.clients))
+        sys_topics.value('clients/total', lambda: stats['total_connections'].value)
+        sys_topics.value('clients/timed_out', lambda: stats['timed_out'].value)
+        sys_topics.value('messages/received', lambda: stats['total_messages'].value)
+        sys_topics.value('messages/delivered', lambda: stats['messages_delivered'].value)
+        sys_topics.rate('messages/received/per_second', lambda: stats['total_messages'].value)
+        sys_topics.rate('messages/delivered/per_second', lambda: stats['messages_delivered'].value)
+        sys_topics.value('messages/qos_retransmitted', lambda: stats['qos_retransmitted'].value)
+        sys_topics.value('messages/qos_dropped', lambda: stats['qos_dropped'].value)
+        sys_topics.value('subscriptions/count', lambda: self.subscriptions.subscription_count)
+        sys_topics.value('subscriptions/filters', lambda: len(self.subscriptions))
+        if self.retained_messages is not None:
+            sys_topics.value('retained/count', lambda: len(self.retained_messages))
+        if self.sessions is not None:
+            sys_topics.value('sessions/count', lambda: len(self.sessions))
+        sys_topics.value('queue/bytes', lambda: traffic.queued_bytes.value)
+        sys_topics.value('queue/frames', lambda: traffic.queued_frames.value)
+        sys_topics.value('bytes/received', lambda: traffic.received_bytes.value)
+        sys_topics.value('bytes/sent', lambda: traffic.sent_bytes.value)
+        return sys_topics
+        
+    def _start_metrics_server(self):
+        """🌐 เปิด endpoint /metrics ใน thread แยก (worker ตัวที่ N ใช้ METRICS_PORT + N)"""
+        host = os.getenv('METRICS_HOST', '0.0.0.0')
+        port = int(os.getenv('METRICS_PORT', '9883'))
+        if self.cluster is not None:
+            port += self.cluster.worker_index
+        # POST /latency ต้องใช้ ADMIN_TOKEN (ไม่ได้ตั้ง = รับเฉพาะจากใน container เอง)
+        server = MetricsServer(self.metrics, host, port, token=self.admin_token)
+        server.add_action('/latency', self._control_latency)
+        try:
+            port = server.start()
+        except OSError as e:
+            self.logger.warning(f"⚠️ เปิด endpoint metrics ที่ port {port} ไม่ได้: {e}")
+            return
+        self.metrics_server = server
+        self.logger.info(f"📈 Prometheus metrics ที่ http://{host}:{port}/metrics")
+        
     def start(self):
         """🚀 เริ่มต้น MQTT Broker"""
         try:
             print("🚀 เตรียมเริ่ม Simple MQTT Broker")
             print("=" * 50)
             
-            # สร้าง socket server
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(100)
-            
             self.running = True
-            self.logger.info("🚀 MQTT Broker เริ่มทำงานแล้ว!")
-            self.logger.info(f"📍 รอรับการเชื่อมต่อที่ {self.host}:{self.port}")
+            
+            # เปิด endpoint /metrics ก่อนรับ client
+            if os.getenv('METRICS_ENABLED', 'true').lower() == 'true':
+                self._start_metrics_server()
+            
+            # SIGUSR1 / SIGUSR2 เปิด-ปิด profiler
+            self._install_profiling_signals()
+            
+            # รับ publish จาก worker อื่น (โหมด multi-process)
+            if self.cluster:
+                self.cluster.start(self._handle_remote_publish)
             
             # เริ่ม thread สำหรับแสดงสถิติ
             stats_thread = threading.Thread(target=self._show_stats_periodically)
             stats_thread.daemon = True
             stats_thread.start()
             
-            # รอรับการเชื่อมต่อ
-            while self.running:
-                try:
-                    client_socket, client_address = self.server_socket.accept()
-                    self._handle_new_client(client_socket, client_address)
-                except Exception as e:
-                    if self.running:
-                        self.logger.error(f"❌ เกิดข้อผิดพลาดในการรับ connection: {e}")
+            # เริ่ม thread ตัด client ที่เงียบนานเกินกำหนด
+            reaper_thread = threading.Thread(target=self._reap_idle_clients_periodically)
+            reaper_thread.daemon = True
+            reaper_thread.start()
+            
+            # เริ่ม thread publish สถิติใน $SYS
+            if os.getenv('SYS_TOPICS_ENABLED', 'true').lower() == 'true':
+                sys_thread = threading.Thread(target=self._publish_sys_topics_periodically)
+                sys_thread.daemon = True
+                sys_thread.start()
+            
+            if self.engine == 'asyncio':
+                self._serve_asyncio()
+            else:
+                self._serve_threaded()
                         
         except Exception as e:
             self.logger.error(f"💥 ไม่สามารถเริ่ม broker ได้: {e}")
@@ -96,60 +540,532 @@ class MQTTBroker:
             
         return True
         
-    def _handle_new_client(self, client_socket, client_address):
-        """👤 จัดการ client ใหม่"""
-        client_id = f"client_{len(self.clients) + 1}_{int(time.time())}"
+    def _install_profiling_signals(self):
+        """🔬 SIGUSR1 เปิด/ปิด profiler แบบ PROFILE_SIGNAL_MODE และ SIGUSR2 เปิด/ปิด tracemalloc (เฉพาะ main thread)"""
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            return
+        
+        def on_signal(mode):
+            # handler ทำงานกลางคำสั่งใดก็ได้ของ main thread การเขียนไฟล์จึงทำใน thread แยก
+            def handler(signum, frame):
+                worker = threading.Thread(target=self._toggle_profiler, args=(mode, 'signal'))
+                worker.daemon = True
+                worker.start()
+            return handler
+        
+        if self.profile_signal_mode not in MODES:
+            self.logger.warning(f"⚠️ PROFILE_SIGNAL_MODE '{self.profile_signal_mode}' ไม่ถูกต้อง ใช้ 'cpu' แทน")
+            self.profile_signal_mode = 'cpu'
+        signal.signal(signal.SIGUSR1, on_signal(self.profile_signal_mode))
+        signal.signal(signal.SIGUSR2, on_signal('memory'))
+        
+    def _toggle_profiler(self, mode, source):
+        """🔀 เปิด/ปิด profiler แล้วบอกใน log ว่าเริ่มวัดหรือเขียนผลไว้ที่ไหน"""
+        try:
+            files = self.profiler.toggle(mode)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"❌ เปิด/ปิด {mode} profiling ไม่ได้ ({source}): {e}")
+            return
+        if files:
+            self.logger.info(f"🔬 หยุด {mode} profiling ({source}) เขียนผลที่ {', '.join(files)}")
+        else:
+            self.logger.info(f"🔬 เริ่ม {mode} profiling ({source})")
+        
+    def _profile_event_loop(self):
+        """🔬 ให้ event loop ของ engine asyncio เข้าร่วม/ออกจาก cProfile รอบปัจจุบัน (cProfile วัดเฉพาะ thread ที่เปิดมัน)"""
+        engine = self.async_engine
+        if engine is not None and engine.loop is not None and not engine.loop.is_closed():
+            engine.loop.call_soon_threadsafe(self.profiler.follow)
+        
+    def _log_started(self):
+        """📢 แจ้งว่า broker พร้อมรับการเชื่อมต่อแล้ว"""
+        self.logger.info(f"🚀 MQTT Broker เริ่มทำงานแล้ว! (engine: {self.engine}, protocol: {self.protocol})")
+        self.logger.info(f"📍 รอรับการเชื่อมต่อที่ {self.host}:{self.port}")
+        
+    def _serve_threaded(self):
+        """🧵 engine แบบ thread ต่อ client"""
+        # สร้าง socket server
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(100)
+        
+        self._log_started()
+        
+        # รอรับการเชื่อมต่อ
+        while self.running:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+                self._handle_new_client(client_socket, client_address)
+            except Exception as e:
+                if self.running:
+                    self.backpressure_stats.error('accept')
+                    self.logger.error(f"❌ เกิดข้อผิดพลาดในการรับ connection: {e}")
+                    
+    def _serve_asyncio(self):
+        """⚡ engine แบบ asyncio: ทุก connection ใช้ event loop เดียว"""
+        self.async_engine = AsyncioEngine(
+            self.host,
+            self.port,
+            on_connect=self._register_client,
+            on_frames=self._process_frames,
+            on_disconnect=self._disconnect_client,
+            backlog=100,
+            reuse_port=self.reuse_port,
+            protocol=self.protocol,
+            on_packet=self._process_mqtt_packet,
+            read_size=self.read_size,
+            outbound_limits=self.outbound_limits,
+            backpressure_stats=self.backpressure_stats,
+            detect_timeout=self.keepalive_timeout or None,
+            latency=self.latency
+        )
+        self.async_engine.run(on_ready=self._log_started)
+        
+    def _register_client(self, client_socket, client_address, protocol='json'):
+        """📝 ลงทะเบียน client ใหม่และคืนค่า client_id"""
+        client_id = f"client_{next(self.connection_ids)}_{int(time.time())}"
+        # MQTT ใช้ KEEPALIVE_TIMEOUT จนกว่าจะได้ CONNECT (แล้วเปลี่ยนเป็นตาม keepalive ของ client)
+        timeout = self.keepalive_timeout if protocol == 'mqtt' else self.client_timeout
+        now = time.monotonic()
         
         # เก็บข้อมูล client
-        self.clients[client_id] = {
+        self.clients.put(client_id, {
             'socket': client_socket,
             'address': client_address,
             'subscriptions': set(),
             'connected_at': datetime.now(),
-            'last_activity': datetime.now()
-        }
+            'last_activity': now,       # time.monotonic() ของข้อมูลล่าสุดที่ได้รับ
+            'timeout': timeout,         # วินาทีที่เงียบได้ก่อนถูกตัด (0 = ไม่ตัด)
+            'protocol': protocol,
+            'mqtt_client_id': None,     # ได้จาก CONNECT (MQTT binary) หรือ connect (JSON-line)
+            'will': None,               # will message (เฉพาะ MQTT binary)
+            'session': None,            # Session ถาวรที่ใช้อยู่ (None = clean session)
+            'qos_filters': {},          # topic filter -> QoS ที่ได้รับ (เฉพาะ QoS > 0, แทนทั้ง dict เมื่อเปลี่ยน)
+            'inflight': InflightWindow(self.inflight_window, self.max_pending_messages),
+            'retry': lambda: self._retry_inflight(client_id)
+        })
+        if timeout:
+            self.deadlines.schedule(client_id, now + timeout)
         
         # อัพเดทสถิติ
-        self.stats['total_connections'] += 1
-        self.stats['current_connections'] = len(self.clients)
+        self.stats['total_connections'].add()
         self.stats['last_activity'] = datetime.now()
         
-        self.logger.info(f"✅ Client ใหม่เชื่อมต่อ: {client_id} จาก {client_address}")
+        self.client_log.log("✅ Client ใหม่เชื่อมต่อ: %s จาก %s", client_id, client_address)
+        return client_id
         
+    def _handle_new_client(self, client_socket, client_address):
+        """👤 จัดการ client ใหม่"""
         # สร้าง thread สำหรับจัดการ client นี้
         client_thread = threading.Thread(
-            target=self._handle_client_messages,
-            args=(client_id, client_socket)
+            target=self._serve_connection,
+            args=(client_socket, client_address)
         )
         client_thread.daemon = True
         client_thread.start()
         
-    def _handle_client_messages(self, client_id, client_socket):
-        """📨 จัดการข้อความจาก client"""
-        buffer = ""
+    def _serve_connection(self, client_socket, client_address):
+        """🔌 เลือก protocol (รอ byte แรกถ้าเป็น auto) แล้วส่งให้ handler ที่ตรงกัน"""
+        protocol = self.protocol
+        if protocol == 'auto':
+            protocol = self._detect_client_protocol(client_socket)
+            if protocol is None:
+                client_socket.close()
+                return
+                
+        # ข้อมูลขาออกผ่านคิวของ client เอง ผู้ publish จึงไม่ต้องรอ socket ของ subscriber
+        writer = SocketWriter(
+            client_socket,
+            name=f'writer-{client_address[1]}',
+            limits=self.outbound_limits,
+            stats=self.backpressure_stats
+        )
+        client_id = self._register_client(writer, client_address, protocol)
+        if protocol == 'mqtt':
+            self._handle_mqtt_client_messages(client_id, client_socket, writer)
+        else:
+            self._handle_client_messages(client_id, client_socket, writer)
+            
+    def _detect_client_protocol(self, client_socket):
+        """🔎 แอบดู byte แรก (MSG_PEEK) คืนค่า 'json' / 'mqtt' หรือ None ถ้าปิดหรือเงียบเกิน KEEPALIVE_TIMEOUT"""
+        client_socket.settimeout(self.keepalive_timeout or None)
+        try:
+            first = client_socket.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return None
+        finally:
+            client_socket.settimeout(None)
+        if not first:
+            return None
+        return detect_protocol(first[0])
+        
+    def _handle_client_messages(self, client_id, client_socket, writer=None):
+        """📨 จัดการข้อความจาก client (อ่านลง buffer ของ decoder แล้วประมวลผลทุกบรรทัดที่ครบ)"""
+        decoder = LineFrameDecoder(self.read_size)
+        received = self.backpressure_stats.received_bytes
+        latency = self.latency
+        profiler = self.profiler
+        profiling = None
         
         try:
             while self.running and client_id in self.clients:
                 # รับข้อมูล
-                data = client_socket.recv(1024).decode('utf-8')
-                
-                if not data:
+                if writer is not None:
+                    writer.wait_if_paused()
+                nbytes = decoder.recv_into(client_socket)
+                if not nbytes:
                     break
+                received.add(nbytes)
+                latency.received()
+                if profiler.cpu is not profiling:
+                    profiling = profiler.follow()
                     
-                buffer += data
-                self.clients[client_id]['last_activity'] = datetime.now()
-                
                 # ประมวลผลข้อความที่สมบูรณ์
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line.strip():
-                        self._process_message(client_id, line.strip())
+                frames = decoder.decode()
+                if frames:
+                    self._process_frames(client_id, frames)
                         
+        except FrameTooLargeError as e:
+            self.backpressure_stats.error('frame_too_large')
+            self.logger.warning(f"⚠️ {client_id} {e}")
+        except Exception as e:
+            self.backpressure_stats.error('connection')
+            self.logger.error(f"❌ เกิดข้อผิดพลาดกับ client {client_id}: {e}")
+        finally:
+            # will message ไม่ใช้เวลา ingress ของข้อมูลชุดสุดท้าย
+            latency.finished()
+            self._disconnect_client(client_id)
+            
+    def _handle_mqtt_client_messages(self, client_id, client_socket, writer=None):
+        """📦 จัดการ client ที่พูด MQTT binary (recv_into ลง buffer ของ decoder โดยตรง)"""
+        decoder = MQTTStreamDecoder(self.read_size)
+        received = self.backpressure_stats.received_bytes
+        latency = self.latency
+        profiler = self.profiler
+        profiling = None
+        
+        try:
+            while self.running and client_id in self.clients:
+                if writer is not None:
+                    writer.wait_if_paused()
+                nbytes = decoder.recv_into(client_socket)
+                if not nbytes:
+                    break
+                received.add(nbytes)
+                latency.received()
+                if profiler.cpu is not profiling:
+                    profiling = profiler.follow()
+                    
+                # handler คืนค่า False เมื่อต้องปิด connection
+                if not all(self._process_mqtt_packet(client_id, packet) for packet in decoder.decode()):
+                    break
+                    
+        except MQTTProtocolError as e:
+            self.backpressure_stats.error('protocol')
+            self.logger.warning(f"⚠️ {client_id} ส่ง MQTT packet ไม่ถูกต้อง: {e}")
         except Exception as e:
+            self.backpressure_stats.error('connection')
             self.logger.error(f"❌ เกิดข้อผิดพลาดกับ client {client_id}: {e}")
         finally:
+            # will message ไม่ใช้เวลา ingress ของข้อมูลชุดสุดท้าย
+            latency.finished()
             self._disconnect_client(client_id)
             
+    def _process_mqtt_packet(self, client_id, packet):
+        """
+        📦 ประมวลผล MQTT packet หนึ่งตัว (คืนค่า False ถ้าต้องปิด connection)
+        
+        packet ถูกแปลงเป็น dict รูปแบบเดียวกับ JSON protocol
+        แล้วส่งต่อให้ _handle_publish / _handle_subscribe เดิม
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        # เขียนค่าเดียวลง dict ของ client ไม่ต้องใช้ lock (ไม่แตะ timing wheel)
+        client['last_activity'] = time.monotonic()
+            
+        packet_type = packet['type']
+        
+        if packet_type == 'connect':
+            if client['mqtt_client_id'] is not None:
+                self.logger.warning(f"⚠️ {client_id} ส่ง CONNECT ซ้ำ")
+                return False
+            return self._handle_mqtt_connect(client_id, packet)
+            
+        if client['mqtt_client_id'] is None:
+            self.logger.warning(f"⚠️ {client_id} ต้องส่ง CONNECT ก่อน packet อื่น")
+            return False
+            
+        if packet_type == 'publish':
+            if has_wildcard(packet['topic']):
+                self.logger.warning(f"⚠️ {client_id} publish ไปยัง topic ที่มี wildcard")
+                return False
+            # ตอบ PUBACK/PUBREC หลังรับข้อความแล้ว (DURABLE_LOG จะรอให้ลงดิสก์ก่อน)
+            ack = None
+            if packet['qos'] == 1:
+                ack = encode_puback(packet['packet_id'])
+            elif packet['qos'] == 2:
+                ack = encode_pubrec(packet['packet_id'])
+            self._handle_publish(client_id, {
+                'topic': packet['topic'],
+                'payload': packet['payload'],
+                'qos': packet['qos'],
+                'retain': packet['retain']
+            }, on_accepted=(lambda: self._send_raw(client_id, ack)) if ack else None)
+                
+        elif packet_type == 'pubrel':
+            self._send_raw(client_id, encode_pubcomp(packet['packet_id']))
+            
+        elif packet_type == 'puback':
+            self._handle_puback(client_id, packet['packet_id'])
+            
+        elif packet_type == 'subscribe':
+            # ตอบ SUBACK ก่อน แล้วค่อยส่ง retained message (ตามลำดับของมาตรฐาน)
+            # QoS ที่ได้รับคือ QoS ที่ขอแต่ไม่เกิน MAX_QOS
+            wildcards = self.subscriptions.wildcards
+            return_codes = [
+                min(qos, self.max_qos) if not wildcards or is_valid_filter(topic_filter) else SUBACK_FAILURE
+                for topic_filter, qos in packet['topics']
+            ]
+            self._send_raw(client_id, encode_suback(packet['packet_id'], return_codes))
+            for (topic_filter, qos), code in zip(packet['topics'], return_codes):
+                if code != SUBACK_FAILURE:
+                    self._handle_subscribe(client_id, {'topic': topic_filter, 'qos': code})
+                    
+        elif packet_type == 'unsubscribe':
+            for topic_filter in packet['topics']:
+                self._handle_unsubscribe(client_id, {'topic': topic_filter})
+            self._send_raw(client_id, encode_unsuback(packet['packet_id']))
+            
+        elif packet_type == 'ping':
+            self._handle_ping(client_id, packet)
+            
+        elif packet_type == 'disconnect':
+            # ตัดการเชื่อมต่ออย่างปกติ ไม่ต้องส่ง will message
+            with self.clients.lock_for(client_id):
+                client['will'] = None
+            return False
+            
+        return True
+        
+    def _handle_mqtt_connect(self, client_id, packet):
+        """🤝 จัดการ CONNECT และตอบ CONNACK (คืนค่า False ถ้าปฏิเสธ)"""
+        protocol = (packet['protocol_name'], packet['protocol_level'])
+        if protocol not in (('MQTT', 4), ('MQIsdp', 3)):
+            self.logger.warning(f"⚠️ {client_id} ใช้ protocol ที่ไม่รองรับ: {protocol}")
+            self._send_raw(client_id, encode_connack(CONNACK_BAD_PROTOCOL))
+            return False
+            
+        if not packet['client_id'] and not packet['clean_session']:
+            self._send_raw(client_id, encode_connack(CONNACK_IDENTIFIER_REJECTED))
+            return False
+            
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is None:
+                return False
+            client['mqtt_client_id'] = packet['client_id'] or client_id
+            client['will'] = packet['will']
+            client['keepalive'] = packet['keepalive']
+            # มาตรฐาน MQTT: ตัดเมื่อเงียบเกิน 1.5 เท่าของ keepalive (keepalive 0 ใช้ CLIENT_TIMEOUT)
+            client['timeout'] = packet['keepalive'] * 1.5 or self.client_timeout
+        
+        if client['timeout']:
+            self.deadlines.schedule(client_id, client['last_activity'] + client['timeout'])
+        else:
+            self.deadlines.cancel(client_id)
+        
+        # policy เฉพาะ client (เช่น dashboard ที่ต้องการแค่ค่าล่าสุดใช้ conflate)
+        limits = self.client_limits.get(packet['client_id'])
+        if limits:
+            client['socket'].set_limits(limits)
+        
+        session, present = self._resume_session(client_id, client['mqtt_client_id'], packet['clean_session'])
+        self._send_raw(client_id, encode_connack(CONNACK_ACCEPTED, present))
+        self.client_log.log(
+            "🤝 %s CONNECT เป็น '%s' (MQTT%s)",
+            client_id, client['mqtt_client_id'], ', session ถาวร' if session is not None else ''
+        )
+        if session is not None:
+            self._start_session_restore(client_id, session, present)
+        return True
+        
+    def _handle_connect(self, client_id, message):
+        """🤝 connect ของ JSON-line (ต้องเป็นข้อความแรก): ใช้ client id ของ client เองและขอ session ถาวรได้"""
+        session_id = message.get('client_id')
+        clean_session = bool(message.get('clean_session', True))
+        
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is None:
+                return
+            error = None
+            if client['mqtt_client_id'] is not None or client['subscriptions']:
+                error = 'connect ต้องเป็นข้อความแรกของ connection'
+            elif not session_id and not clean_session:
+                error = 'session ถาวรต้องระบุ client_id'
+            else:
+                client['mqtt_client_id'] = session_id or client_id
+                
+        if error:
+            self.logger.warning(f"⚠️ {client_id} ส่ง connect ไม่ถูกต้อง: {error}")
+            self._send_to_client(client_id, {'type': 'connack', 'session_present': False, 'error': error})
+            return
+            
+        limits = self.client_limits.get(session_id)
+        if limits:
+            client['socket'].set_limits(limits)
+            
+        session, present = self._resume_session(client_id, client['mqtt_client_id'], clean_session)
+        self._send_to_client(client_id, {
+            'type': 'connack',
+            'session_present': present,
+            'queued': len(session.queue) if session is not None else 0
+        })
+        self.client_log.log(
+            "🤝 %s connect เป็น '%s' (JSON%s)",
+            client_id, client['mqtt_client_id'], ', session ถาวร' if session is not None else ''
+        )
+        if session is not None:
+            self._start_session_restore(client_id, session, present)
+            
+    def _resume_session(self, client_id, session_id, clean_session):
+        """
+        💤 ผูก connection กับ session ถาวรของ client id คืนค่า (Session หรือ None, มี session เดิมไหม)
+        
+        clean_session ลบ session เดิม (ถ้ามี) และถ้า client id นี้ยังต่ออยู่อีก connection หนึ่ง
+        connection เดิมถูกตัดก่อน (session takeover)
+        """
+        if self.sessions is None:
+            return None, False
+            
+        existing = self.sessions.get(session_id)
+        if existing is not None and existing.connection not in (None, client_id):
+            self.logger.info(f"🔁 '{session_id}' เชื่อมต่อใหม่ ตัด connection เดิม {existing.connection}")
+            self._disconnect_client(existing.connection)
+        if clean_session:
+            if existing is not None:
+                self._discard_session(existing)
+            return None, False
+            
+        session, present = self.sessions.open(session_id)
+        self.deadlines.cancel(session.key)
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is not None:
+                # subscription เดิมยังอยู่ใต้ key ของ session จนกว่า _restore_session จะส่งข้อความที่ค้างครบ
+                session.attach(client_id)
+                client['session'] = session
+                client['subscriptions'] = set(session.subscriptions)
+                client['qos_filters'] = {topic: qos for topic, qos in session.subscriptions.items() if qos}
+        if client is None:
+            # connection หลุดไประหว่างนี้: session กลับไปรอเหมือนเดิม
+            self._suspend_session(session)
+            return None, False
+        return session, present
+        
+    def _start_session_restore(self, client_id, session, present):
+        """🚚 เริ่มส่งข้อความที่ค้างใน session จาก thread แยก (session ใหม่ไม่มีอะไรค้าง ทำต่อได้ทันที)"""
+        if not present:
+            self._restore_session(client_id, session)
+            return
+        restore_thread = threading.Thread(
+            target=self._restore_session,
+            args=(client_id, session),
+            name=f'session-{client_id}'
+        )
+        restore_thread.daemon = True
+        restore_thread.start()
+        
+    def _restore_session(self, client_id, session):
+        """
+        📦 ส่งข้อความที่ค้างใน session ทีละ chunk แล้วย้าย subscription กลับมาที่ connection
+        
+        ระหว่างนี้ subscription ยังอยู่ใต้ key ของ session ข้อความใหม่จึงต่อท้ายคิว (ไม่แซงข้อความเก่า)
+        เมื่อคิวว่าง session จะ online ข้อความที่ตามมาส่งตรงถึง connection
+        """
+        restored = list(session.subscriptions)
+        sent = 0
+        try:
+            while self.running:
+                batch = session.take(client_id, REPLAY_CHUNK_SIZE)
+                if batch is None:
+                    return          # client หลุดไปแล้ว ข้อความที่เหลือยังอยู่ในคิว
+                if not batch:
+                    break
+                if not self._send_session_batch(client_id, batch):
+                    session.requeue(batch)
+                    return
+                sent += len(batch)
+        except Exception as e:
+            self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่างส่งข้อความที่ค้างให้ {client_id}: {e}")
+            return
+            
+        # subscribe ด้วย connection ก่อนแล้วค่อยเอา key ของ session ออก worker จึงไม่เลิกสนใจ filter
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is None:
+                return
+            for topic in restored:
+                if topic in client['subscriptions']:
+                    self._add_subscription(client_id, topic)
+                self._remove_subscription(session.key, topic)
+        if sent:
+            self.logger.info(f"📦 ส่งข้อความที่ค้างใน session '{session.client_id}' ให้ {client_id} ครบ {sent} ข้อความ")
+            
+    def _send_session_batch(self, client_id, batch):
+        """
+        📦 ส่งข้อความที่ค้างหนึ่ง chunk ([[qos, message], ...]) เมื่อคิวขาออกและ in-flight window มีที่ว่าง
+        
+        ส่งแบบไม่มี topic จึงไม่ถูกทิ้งตาม backpressure policy (คืนค่า False ถ้า client หลุดไประหว่างรอ)
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        queue = client['socket']
+        window = client['inflight']
+        # ข้อความ QoS 1 ของ chunk ก่อนหน้ายังรอที่ว่างใน window: รอก่อน ไม่ให้ล้น MAX_PENDING_MESSAGES
+        while window.pending:
+            if window.closed or not self.running:
+                return False
+            time.sleep(0.01)
+        while not queue.wait_for_room(timeout=1.0):
+            if queue.closing or not self.running:
+                return False
+        for qos, message in batch:
+            if qos:
+                self._send_qos1(client_id, client, message)
+            elif not self._send_raw(client_id, self._encode_message(client['protocol'], message)):
+                return False
+        return True
+        
+    def _suspend_session(self, session, subscriptions=None):
+        """💤 client ของ session หลุด: subscription อยู่ใต้ key ของ session ต่อ และเริ่มนับเวลาหมดอายุ"""
+        session.suspend(session.subscriptions if subscriptions is None else subscriptions)
+        for topic in session.subscriptions:
+            self._add_subscription(session.key, topic)
+        if self.session_expiry:
+            self.deadlines.schedule(session.key, time.monotonic() + self.session_expiry)
+            
+    def _discard_session(self, session):
+        """🗑️ ลบ session ถาวร (client ขอ clean session หรือ session หมดอายุ) พร้อมข้อความที่ค้าง"""
+        self.deadlines.cancel(session.key)
+        for topic in session.subscriptions:
+            self._remove_subscription(session.key, topic)
+        self.sessions.discard(session)
+        
+    def _process_frames(self, client_id, frames):
+        """📦 ประมวลผลทุกบรรทัดที่ได้จากการอ่านหนึ่งครั้ง"""
+        client = self.clients.get(client_id)
+        if client is not None:
+            client['last_activity'] = time.monotonic()
+            
+        for frame in frames:
+            self._process_message(client_id, frame)
+            
     def _process_message(self, client_id, message_str):
         """⚙️ ประมวลผลข้อความที่ได้รับ"""
         try:
@@ -161,13 +1077,29 @@ class MQTTBroker:
             elif msg_type == 'unsubscribe':
                 self._handle_unsubscribe(client_id, message)
             elif msg_type == 'publish':
-                self._handle_publish(client_id, message)
+                # QoS 1 ที่มี packet_id: ตอบ puback หลังรับข้อความแล้ว (เหมือน MQTT binary)
+                packet_id = message.get('packet_id')
+                ack = {'type': 'puback', 'packet_id': packet_id}
+                self._handle_publish(
+                    client_id, message,
+                    on_accepted=(lambda: self._send_to_client(client_id, ack))
+                    if message.get('qos') and packet_id is not None else None
+                )
+            elif msg_type == 'puback':
+                self._handle_puback(client_id, message.get('packet_id'))
             elif msg_type == 'ping':
                 self._handle_ping(client_id, message)
+            elif msg_type == 'connect':
+                self._handle_connect(client_id, message)
+            elif msg_type == 'replay':
+                self._handle_replay(client_id, message)
+            elif msg_type == 'admin':
+                self._handle_admin(client_id, message)
             else:
                 self.logger.warning(f"⚠️ ประเภทข้อความไม่รู้จัก: {msg_type}")
                 
         except json.JSONDecodeError:
+            self.backpressure_stats.error('invalid_json')
             self.logger.error(f"❌ ข้อความไม่ใช่ JSON ที่ถูกต้อง: {message_str}")
         except Exception as e:
             self.logger.error(f"💥 เกิดข้อผิดพลาดในการประมวลผล: {e}")
@@ -178,15 +1110,53 @@ class MQTTBroker:
         if not topic:
             return
             
-        # เพิ่มการ subscribe
-        self.subscriptions[topic].add(client_id)
-        self.clients[client_id]['subscriptions'].add(topic)
+        if self.subscriptions.wildcards and not is_valid_filter(topic):
+            self.logger.warning(f"⚠️ topic filter ไม่ถูกต้อง: '{topic}'")
+            return
+            
+        qos = min(_parse_qos(message.get('qos')), self.max_qos)
+            
+        # เพิ่มการ subscribe (ถือ lock ของ client ไว้ _disconnect_client จึงไม่พลาด subscription นี้)
+        # และแจ้ง worker อื่นว่า worker นี้สนใจ filter นี้แล้ว
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is None:
+                return
+            client['subscriptions'].add(topic)
+            # filter ของ session ที่ยังส่งข้อความที่ค้างไม่ครบ: _restore_session ย้ายมาให้เอง
+            # (subscribe ตอนนี้จะได้ข้อความซ้ำกับในคิวและแซงข้อความเก่า)
+            session = client['session']
+            if session is None or session.online or topic not in session.subscriptions:
+                self._add_subscription(client_id, topic)
+            # แทน dict ใหม่ทั้งก้อน _deliver_local จึงอ่าน qos_filters ได้โดยไม่ต้องใช้ lock
+            if qos or topic in client['qos_filters']:
+                qos_filters = dict(client['qos_filters'])
+                if qos:
+                    qos_filters[topic] = qos
+                else:
+                    qos_filters.pop(topic, None)
+                client['qos_filters'] = qos_filters
         
-        self.logger.info(f"📥 {client_id} subscribe topic: '{topic}'")
+        self.client_log.log("📥 %s subscribe topic: '%s' (QoS %s)", client_id, topic, qos)
         
-        # ส่งข้อความที่ retain ไว้ (ถ้ามี)
-        if topic in self.retained_messages:
-            self._send_to_client(client_id, self.retained_messages[topic])
+        # ส่งข้อความที่ retain ไว้ของทุก topic ที่ตรงกับ filter (ถ้ามี)
+        if self.retained_messages is None:
+            return
+        if self.subscriptions.wildcards and has_wildcard(topic):
+            for retained_topic, retained in self.retained_messages.matching(topic):
+                self._send_retained(client_id, client, retained, qos)
+        else:
+            retained = self.retained_messages.get(topic)
+            if retained is not None:
+                self._send_retained(client_id, client, retained, qos)
+                
+    def _send_retained(self, client_id, client, retained, granted_qos):
+        """📌 ส่ง retained message ให้ผู้ subscribe ใหม่ด้วย flag retain และ QoS ต่ำกว่าระหว่างตอน publish กับที่ได้รับ"""
+        message = dict(retained, retain=True)
+        if min(message.pop('qos', 0), granted_qos):
+            self._send_qos1(client_id, client, message)
+        else:
+            self._send_to_client(client_id, message)
             
     def _handle_unsubscribe(self, client_id, message):
         """📤 จัดการการ unsubscribe"""
@@ -195,24 +1165,52 @@ class MQTTBroker:
             return
             
         # ลบการ subscribe
-        self.subscriptions[topic].discard(client_id)
-        self.clients[client_id]['subscriptions'].discard(topic)
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is not None:
+                client['subscriptions'].discard(topic)
+                if topic in client['qos_filters']:
+                    qos_filters = dict(client['qos_filters'])
+                    del qos_filters[topic]
+                    client['qos_filters'] = qos_filters
+            self._remove_subscription(client_id, topic)
+            
+        self.client_log.log("📤 %s unsubscribe topic: '%s'", client_id, topic)
         
-        # ลบ topic ที่ไม่มีคนใช้แล้ว
-        if not self.subscriptions[topic]:
-            del self.subscriptions[topic]
+    def _add_subscription(self, client_id, topic):
+        """➕ เพิ่ม subscription และแจ้ง worker อื่นว่า worker นี้สนใจ filter นี้แล้ว"""
+        self.subscriptions.subscribe(
+            topic, client_id, on_first=self.cluster.add_interest if self.cluster else None
+        )
+        
+    def _remove_subscription(self, client_id, topic):
+        """🧹 ลบ subscription และแจ้ง worker อื่นเมื่อ filter ไม่เหลือ subscriber"""
+        self.subscriptions.unsubscribe(
+            topic, client_id, on_last=self.cluster.remove_interest if self.cluster else None
+        )
             
-        self.logger.info(f"📤 {client_id} unsubscribe topic: '{topic}'")
+    def _handle_publish(self, client_id, message, on_accepted=None):
+        """
+        📤 จัดการการ publish
         
-    def _handle_publish(self, client_id, message):
-        """📤 จัดการการ publish"""
+        ถ้าเปิด DURABLE_LOG ข้อความจะถูกเขียนลง log ก่อนส่งต่อ
+        (DURABLE_MODE=sync ส่งต่อและเรียก on_accepted หลัง fsync ของ batch นั้น)
+        """
         topic = message.get('topic')
         payload = message.get('payload', '')
         retain = message.get('retain', False)
+        qos = _parse_qos(message.get('qos'))
         
         if not topic:
             return
             
+        # topic ใต้ $SYS เป็นของ broker: ไม่ส่งต่อ (แต่ยังตอบ PUBACK client จะได้ไม่ส่งซ้ำ)
+        if topic.partition('/')[0] == SYS_PREFIX:
+            self.logger.warning(f"⚠️ {client_id} publish ไปยัง '{topic}' ไม่ได้ (topic ของ broker)")
+            if on_accepted is not None:
+                on_accepted()
+            return
+            
         # สร้างข้อความที่จะส่งต่อ
         forward_message = {
             'type': 'message',
@@ -222,22 +1220,360 @@ class MQTTBroker:
             'from_client': client_id
         }
         
+        # ⏱️ trace ของ latency (None ถ้าปิดการวัด) ส่งต่อไปถึงตัวเขียน socket ของ subscriber
+        trace = self.latency.begin(topic)
+        if trace is not None:
+            trace.parsed()
+        
+        if self.message_log is not None:
+            try:
+                self.message_log.append(
+                    topic, client_id, payload,
+                    on_durable=lambda offset: self._accept_publish(
+                        client_id, forward_message, retain, on_accepted, offset, qos, trace
+                    )
+                )
+            except (OSError, ValueError) as e:
+                # เขียนดิสก์ไม่ได้: ไม่ถือว่ารับข้อความ (ไม่ส่งต่อและไม่ตอบ PUBACK)
+                self.logger.error(f"💥 เขียนข้อความของ {client_id} ลง log ไม่ได้: {e}")
+                return
+        else:
+            self._accept_publish(client_id, forward_message, retain, on_accepted, qos=qos, trace=trace)
+                    
+        # อัพเดทสถิติ
+        self.stats['total_messages'].add()
+        self.stats['last_activity'] = datetime.now()
+        
+        self.publish_log.log("📤 %s publish ไปยัง '%s': %s", client_id, topic, payload)
+        
+    def _accept_publish(self, client_id, forward_message, retain, on_accepted=None, offset=None, qos=0, trace=None):
+        """
+        📬 เก็บ retained และส่งข้อความที่รับแล้วให้ subscriber ทั้งใน process นี้และ worker อื่น
+        
+        offset (DURABLE_LOG) ถูกใส่ในข้อความ subscriber จึงใช้ขอ replay ต่อจากข้อความล่าสุดที่ได้รับ
+        qos คือ QoS ของ publish (subscriber ได้ QoS 1 เมื่อทั้ง publish และ subscription เป็น QoS 1)
+        trace คือ trace ของ latency (None = ไม่วัด ข้อความจาก worker อื่นไม่ถูกวัด)
+        """
+        topic = forward_message['topic']
+        if offset is not None:
+            forward_message['offset'] = offset
+        
         # เก็บข้อความ retain (ถ้าต้องการ)
         if retain:
-            self.retained_messages[topic] = forward_message
+            self._store_retained(topic, forward_message, qos)
             
         # ส่งข้อความให้ subscriber ทั้งหมด
+        self._deliver_local(topic, forward_message, exclude=client_id, qos=qos, trace=trace)
+        
+        # ส่งต่อให้ worker อื่น (โหมด multi-process)
+        if self.cluster:
+            self.cluster.forward_publish(forward_message, retain, qos)
+            
+        if on_accepted is not None:
+            on_accepted()
+        
+    def _deliver_local(self, topic, forward_message, exclude=None, qos=0, trace=None):
+        """📢 ส่งข้อความให้ subscriber ใน process นี้ (ไม่ส่งกลับไปหาผู้ส่ง, trace บันทึกขั้น route / enqueue / write)"""
         sent_count = 0
-        for subscriber_id in self.subscriptions.get(topic, set()):
-            if subscriber_id != client_id:  # ไม่ส่งกลับไปหาผู้ส่ง
-                if self._send_to_client(subscriber_id, forward_message):
+        frames = {}  # แปลงข้อความ QoS 0 ครั้งเดียวต่อ protocol แล้วใช้ bytes ชุดเดียวกันกับทุกคน
+        congested = []
+        qos = min(qos, self.max_qos)
+        subscribers = self.subscriptions.match(topic)
+        if trace is not None:
+            trace.routed()
+        for subscriber_id in subscribers:
+            client = self.clients.get(subscriber_id)
+            if client is None and self.sessions is not None:
+                subscriber_id, client = self._offer_to_session(
+                    subscriber_id, subscribers, topic, forward_message, qos, exclude
+                )
+            if subscriber_id == exclude or client is None:
+                continue
+            if qos and _subscription_qos(client['qos_filters'], topic):
+                # QoS 1: แต่ละ client มี packet id ของตัวเอง
+                if self._send_qos1(subscriber_id, client, forward_message, trace):
                     sent_count += 1
-                    
-        # อัพเดทสถิติ
-        self.stats['total_messages'] += 1
-        self.stats['last_activity'] = datetime.now()
+            else:
+                protocol = client['protocol']
+                data = frames.get(protocol)
+                if data is None:
+                    data = frames[protocol] = self._encode_message(protocol, forward_message)
+                if self._send_raw(subscriber_id, data, topic, trace):
+                    sent_count += 1
+            queue = client['socket']
+            if queue.congested and queue.limits.policy == 'pause':
+                congested.append(queue)
+        if trace is not None:
+            trace.enqueued()
+                
+        # policy 'pause': หยุดอ่านข้อมูลจากผู้ publish จนกว่า subscriber จะตามทัน
+        # (publish ที่มาจาก worker อื่นไม่มีผู้ส่งใน process นี้ให้หยุด)
+        publisher = self.clients.get(exclude)
+        if congested and publisher is not None:
+            publisher['socket'].pause_until_drained(congested)
+        self.stats['messages_delivered'].add(sent_count)
+        self.fanout.observe(sent_count)
+        return sent_count
+        
+    def _publish_system(self, topic, payload):
+        """
+        📡 ส่งข้อความของ broker เอง ($SYS/broker/...) ให้ client ใน process นี้ที่ subscribe และเชื่อมต่ออยู่
+        
+        เป็น QoS 0 ไม่ส่งต่อให้ worker อื่น ไม่เก็บ retained ไม่เข้าคิวของ session และไม่นับใน messages_delivered
+        """
+        message = {
+            'type': 'message',
+            'topic': topic,
+            'payload': payload,
+            'timestamp': datetime.now().isoformat(),
+            'from_client': SYS_PREFIX
+        }
+        frames = {}
+        for subscriber_id in self.subscriptions.match(topic):
+            client = self.clients.get(subscriber_id)
+            if client is None:
+                continue
+            protocol = client['protocol']
+            data = frames.get(protocol)
+            if data is None:
+                data = frames[protocol] = self._encode_message(protocol, message)
+            self._send_raw(subscriber_id, data, topic)
+            
+    def _offer_to_session(self, key, subscribers, topic, forward_message, qos, exclude):
+        """
+        💤 subscriber ที่ไม่ใช่ connection คือ session ถาวรที่ client ไม่อยู่: เก็บข้อความลงคิวของ session
+        
+        session ที่เพิ่งส่งข้อความที่ค้างครบคืน (connection, client) มาให้ส่งตรง ไม่อย่างนั้นคืน (None, None)
+        """
+        session = self.sessions.offline(key)
+        if session is None or session.connection == exclude:
+            return None, None
+        connection = session.offer([qos and _subscription_qos(session.subscriptions, topic), forward_message])
+        if connection is None or connection in subscribers:
+            return None, None
+        return connection, self.clients.get(connection)
+        
+    def _send_qos1(self, client_id, client, message, trace=None):
+        """📬 ส่งข้อความแบบ QoS 1 ผ่าน in-flight window ของ client (window เต็ม = รอในคิวของ window ไม่วัด latency)"""
+        window = client['inflight']
+        packet_id = window.submit(message)
+        if packet_id is None:
+            return False
+        # ข้อความ QoS 1 ห้ามทิ้งด้วย backpressure policy (ขนาดถูกจำกัดด้วย window อยู่แล้ว)
+        sent = self._send_raw(client_id, self._encode_message(client['protocol'], message, packet_id), trace=trace)
+        window.arm(self.timers, self.qos_retry_interval, client['retry'])
+        return sent
+        
+    def _handle_puback(self, client_id, packet_id):
+        """✅ client ตอบ PUBACK ของข้อความ QoS 1 แล้ว ส่งข้อความที่รอที่ว่างใน window ต่อ"""
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+            
+        window = client['inflight']
+        acked, released = window.ack(packet_id)
+        if not acked:
+            self.logger.debug(f"🔍 {client_id} ตอบ PUBACK ของ packet id ที่ไม่ได้รอ: {packet_id}")
+            return
+            
+        for next_id, message in released:
+            self._send_raw(client_id, self._encode_message(client['protocol'], message, next_id))
+        if released:
+            window.arm(self.timers, self.qos_retry_interval, client['retry'])
+            
+    def _retry_inflight(self, client_id):
+        """🔁 ส่งข้อความ QoS 1 ที่ยังไม่ได้ PUBACK ภายใน QOS_RETRY_INTERVAL ซ้ำ (เรียกจาก timer)"""
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+            
+        window = client['inflight']
+        expired, next_check = window.due(self.qos_retry_interval)
+        for packet_id, message in expired:
+            self._send_raw(client_id, self._encode_message(client['protocol'], message, packet_id, dup=True))
+        if expired:
+            self.stats['qos_retransmitted'].add(len(expired))
+            self.logger.debug(f"🔁 ส่งข้อความ QoS 1 ซ้ำให้ {client_id}: {len(expired)} ข้อความ")
+        if next_check is not None:
+            window.arm(self.timers, next_check, client['retry'])
+        
+    def _handle_remote_publish(self, forward_message, retain, qos=0):
+        """🧩 ได้รับ publish จาก worker อื่น"""
+        topic = forward_message['topic']
+        if retain:
+            self._store_retained(topic, forward_message, qos)
+        self._deliver_local(topic, forward_message, qos=qos)
+        
+    def _store_retained(self, topic, forward_message, qos=0):
+        """📌 เก็บ retained message พร้อม QoS ตอน publish (payload ว่าง = ลบ retained ของ topic นั้น ตามมาตรฐาน MQTT)"""
+        if self.retained_messages is None:
+            return
+        if forward_message['payload'] in ('', b'', None):
+            self.retained_messages.pop(topic)
+        else:
+            self.retained_messages.put(topic, dict(forward_message, qos=qos))
+        
+    def _handle_replay(self, client_id, message):
+        """
+        ⏪ จัดการคำขอ replay: ส่งข้อความที่เก็บใน log ตั้งแต่ from_offset หรือ from_time
+        
+        ส่งจาก thread แยกทีละ chunk จึงไม่ขวางข้อความสด และจบด้วย replay_end
+        ที่บอก offset ถัดไป (โหมดหลาย worker อ่านจาก log ของ worker ที่ client ต่ออยู่)
+        """
+        topic_filter = message.get('topic')
+        if not topic_filter:
+            return
+            
+        # คำขอที่ replay ไม่ได้ก็ตอบ replay_end (count 0 พร้อม error) client จะได้ไม่รอค้าง
+        if self.subscriptions.wildcards and not is_valid_filter(topic_filter):
+            self.logger.warning(f"⚠️ topic filter ไม่ถูกต้อง: '{topic_filter}'")
+            self._send_replay_error(client_id, topic_filter, f"topic filter ไม่ถูกต้อง: '{topic_filter}'")
+            return
+            
+        if self.message_log is None:
+            self._send_replay_error(client_id, topic_filter, 'replay ใช้ได้เมื่อเปิด DURABLE_LOG')
+            return
+            
+        try:
+            from_time = _parse_timestamp(message.get('from_time'))
+            from_offset = int(message.get('from_offset') or 0)
+            limit = int(message.get('limit') or 0)
+        except (TypeError, ValueError) as e:
+            self.logger.warning(f"⚠️ {client_id} ส่ง replay ที่มีค่าไม่ถูกต้อง: {e}")
+            self._send_replay_error(client_id, topic_filter, f"ค่าในคำขอ replay ไม่ถูกต้อง: {e}")
+            return
+            
+        self.logger.info(f"⏪ {client_id} replay '{topic_filter}'")
+        replay_thread = threading.Thread(
+            target=self._stream_replay,
+            args=(client_id, topic_filter, from_offset, from_time, limit),
+            name=f'replay-{client_id}'
+        )
+        replay_thread.daemon = True
+        replay_thread.start()
+        
+    def _send_replay_error(self, client_id, topic_filter, error):
+        """⏹️ ตอบคำขอ replay ที่ทำไม่ได้ด้วย replay_end ที่มี error (ไม่มีข้อความ)"""
+        self._send_to_client(client_id, {
+            'type': 'replay_end',
+            'replay': topic_filter,
+            'count': 0,
+            'error': error
+        })
+        
+    def _stream_replay(self, client_id, topic_filter, from_offset, from_time, limit=0):
+        """📼 อ่านข้อความจาก log แล้วส่งให้ client ทีละ chunk (ทำงานใน thread ของ replay)"""
+        end_offset = self.message_log.next_offset
+        next_offset = from_offset
+        count = 0
+        chunk = []
+        try:
+            for offset, timestamp, topic, publisher, payload in self.message_log.read(
+                from_offset, from_time, topic_filter
+            ):
+                chunk.append(self._encode_message('json', {
+                    'type': 'message',
+                    'topic': topic,
+                    'payload': payload,
+                    'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+                    'from_client': publisher,
+                    'offset': offset,
+                    'replay': topic_filter
+                }))
+                next_offset = offset + 1
+                if len(chunk) >= REPLAY_CHUNK_SIZE or (limit and count + len(chunk) >= limit):
+                    if not self._send_replay_chunk(client_id, chunk):
+                        return
+                    count += len(chunk)
+                    chunk = []
+                    if limit and count >= limit:
+                        break
+            else:
+                next_offset = max(next_offset, end_offset)
+            if chunk:
+                if not self._send_replay_chunk(client_id, chunk):
+                    return
+                count += len(chunk)
+        except Exception as e:
+            self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่าง replay ให้ {client_id}: {e}")
+            
+        self._send_to_client(client_id, {
+            'type': 'replay_end',
+            'replay': topic_filter,
+            'count': count,
+            'next_offset': next_offset
+        })
+        self.logger.info(f"⏪ replay '{topic_filter}' ให้ {client_id} ครบ {count} ข้อความ")
         
-        self.logger.info(f"📤 {client_id} publish ไปยัง '{topic}': {payload}")
+    def _send_replay_chunk(self, client_id, frames):
+        """
+        📦 ส่ง chunk ของ replay เมื่อคิวขาออกของ client ลดลงถึง low watermark
+        
+        frame ของ replay ส่งแบบไม่มี topic จึงไม่ถูกทิ้งตาม backpressure policy
+        (คืนค่า False ถ้า client หลุดไประหว่างรอ)
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        queue = client['socket']
+        while not queue.wait_for_room(timeout=1.0):
+            if queue.closing or not self.running:
+                return False
+        for data in frames:
+            if not self._send_raw(client_id, data):
+                return False
+        return True
+        
+    def _handle_admin(self, client_id, message):
+        """🔐 คำสั่ง admin (token ต้องตรงกับ ADMIN_TOKEN) เช่น {"type": "admin", "command": "profile", "mode": "cpu", "action": "toggle"}"""
+        token = self.admin_token
+        if not token or not hmac.compare_digest(str(message.get('token', '')).encode(), token.encode()):
+            self.logger.warning(f"⚠️ {client_id} ส่งคำสั่ง admin แต่ token ไม่ถูกต้อง (หรือไม่ได้ตั้ง ADMIN_TOKEN)")
+            self._send_to_client(client_id, {'type': 'admin_result', 'ok': False, 'error': 'unauthorized'})
+            return
+            
+        command = message.get('command')
+        if command != 'profile':
+            self._send_to_client(client_id, {'type': 'admin_result', 'command': command, 'ok': False,
+                                             'error': f"ไม่รู้จักคำสั่ง '{command}'"})
+            return
+            
+        # การหยุดวัดเขียนไฟล์ (อาจนานหลายวินาที) จึงทำใน thread แยก ไม่ให้ thread ที่อ่านข้อมูลหรือ event loop ค้าง
+        admin_thread = threading.Thread(
+            target=self._run_profile_command,
+            args=(client_id, message.get('mode', 'cpu'), message.get('action', 'toggle'))
+        )
+        admin_thread.daemon = True
+        admin_thread.start()
+        
+    def _run_profile_command(self, client_id, mode, action):
+        """🔬 ทำคำสั่ง admin 'profile' (start / stop / toggle / status) แล้วตอบผลให้ client"""
+        result = {'type': 'admin_result', 'command': 'profile', 'mode': mode}
+        try:
+            if mode not in MODES:
+                raise ValueError(f"ไม่รู้จัก profiler แบบ '{mode}' (ใช้ได้: {', '.join(MODES)})")
+            if action == 'start':
+                self.profiler.start(mode)
+                files = []
+            elif action == 'stop':
+                files = self.profiler.stop(mode)
+            elif action == 'toggle':
+                files = self.profiler.toggle(mode)
+            elif action == 'status':
+                files = None
+            else:
+                raise ValueError(f"ไม่รู้จัก action '{action}' (ใช้ได้: start, stop, toggle, status)")
+        except (OSError, ValueError) as e:
+            result.update(ok=False, error=str(e), running=mode in MODES and self.profiler.running(mode))
+            self._send_to_client(client_id, result)
+            return
+            
+        if files:
+            self.logger.info(f"🔬 หยุด {mode} profiling (admin {client_id}) เขียนผลที่ {', '.join(files)}")
+        elif files is not None:
+            self.logger.info(f"🔬 เริ่ม {mode} profiling (admin {client_id})")
+        result.update(ok=True, running=self.profiler.running(mode), files=files or [])
+        self._send_to_client(client_id, result)
         
     def _handle_ping(self, client_id, message):
         """🏓 จัดการ ping/pong"""
@@ -248,13 +1584,51 @@ class MQTTBroker:
         self._send_to_client(client_id, pong_message)
         
     def _send_to_client(self, client_id, message):
-        """📬 ส่งข้อความไปยัง client"""
-        if client_id not in self.clients:
+        """📬 ส่งข้อความไปยัง client (แปลงตาม protocol ของ client)"""
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+            
+        data = self._encode_message(client['protocol'], message)
+        if data is None:
+            # ข้อความประเภทนี้ไม่มีใน protocol ของ client
+            return True
+        return self._send_raw(client_id, data)
+        
+    def _encode_message(self, protocol, message, packet_id=None, dup=False):
+        """📦 แปลงข้อความ (dict) เป็น bytes: JSON-line หรือ MQTT packet (packet_id = ส่งแบบ QoS 1)"""
+        if protocol == 'mqtt':
+            msg_type = message.get('type')
+            if msg_type == 'message':
+                payload = _payload_to_bytes(message['payload'])
+                # retain: retained message ที่ส่งเพราะเพิ่ง subscribe [MQTT-3.3.1-8] (ข้อความสดเป็น 0 เสมอ)
+                retain = message.get('retain', False)
+                if packet_id is not None:
+                    return encode_publish(message['topic'], payload, 1, packet_id, retain=retain, dup=dup)
+                return encode_publish(message['topic'], payload, retain=retain)
+            if msg_type == 'pong':
+                return PINGRESP_PACKET
+            return None
+            
+        if isinstance(message.get('payload'), bytes):
+            # payload จาก MQTT client เป็น bytes: แปลงตอนสร้าง frame JSON เท่านั้น
+            message = dict(message, **_payload_to_json(message['payload']))
+        if packet_id is not None:
+            message = dict(message, qos=1, packet_id=packet_id)
+            if dup:
+                message['dup'] = True
+                
+        message_json = json.dumps(message, ensure_ascii=False) + '\n'
+        return message_json.encode('utf-8')
+        
+    def _send_raw(self, client_id, data, topic=None, trace=None):
+        """📤 ใส่ข้อมูลที่แปลงแล้ว (bytes) ลงคิวขาออกของ client (topic=None คือห้ามทิ้ง, trace บันทึกขั้น write)"""
+        client = self.clients.get(client_id)
+        if client is None:
             return False
             
         try:
-            message_json = json.dumps(message, ensure_ascii=False) + '\n'
-            self.clients[client_id]['socket'].send(message_json.encode('utf-8'))
+            client['socket'].send(data, topic, trace)
             return True
         except Exception as e:
             self.logger.error(f"❌ ไม่สามารถส่งข้อความถึง {client_id}: {e}")
@@ -263,57 +1637,221 @@ class MQTTBroker:
             
     def _disconnect_client(self, client_id):
         """🔌 ตัดการเชื่อมต่อ client"""
-        if client_id not in self.clients:
-            return
+        # ลบ client ออกก่อน (subscribe ที่มาพร้อมกันจะเห็นว่า client หายไปแล้ว)
+        shard = self.clients.shard(client_id)
+        with shard.lock:
+            client = shard.data.get(client_id)
+            if client is None:
+                return
+            session = client['session']
+            if session is not None:
+                # session ถาวร: ย้าย subscription ไปไว้ใต้ key ของ session ก่อนเอา client ออก
+                # ข้อความที่ publish ระหว่างนี้จึงไม่หาย (อาจได้ซ้ำ ตามแบบ at-least-once)
+                self._suspend_session(session, {
+                    topic: client['qos_filters'].get(topic, 0) for topic in client['subscriptions']
+                })
+            del shard.data[client_id]
+        self.deadlines.cancel(client_id)
+            
+        # ยกเลิก timer ส่งซ้ำ ข้อความ QoS 1 ที่ค้างเก็บไว้ใน session ถาวร (ไม่มี session ก็ทิ้ง)
+        unacked = client['inflight'].close()
+        self.stats['qos_dropped'].add(client['inflight'].dropped)
+        if session is not None:
+            session.requeue([[1, message] for message in unacked])
             
         try:
             # ปิด socket
-            self.clients[client_id]['socket'].close()
+            client['socket'].close()
         except:
             pass
             
         # ลบการ subscribe ทั้งหมด
-        for topic in self.clients[client_id]['subscriptions']:
-            self.subscriptions[topic].discard(client_id)
-            if not self.subscriptions[topic]:
-                del self.subscriptions[topic]
+        for topic in client['subscriptions']:
+            self._remove_subscription(client_id, topic)
                 
-        # ลบ client
-        del self.clients[client_id]
+        will = client['will']
         
-        # อัพเดทสถิติ
-        self.stats['current_connections'] = len(self.clients)
+        self.client_log.log("👋 Client %s ตัดการเชื่อมต่อ", client_id)
         
-        self.logger.info(f"👋 Client {client_id} ตัดการเชื่อมต่อ")
+        # client MQTT ที่หลุดโดยไม่ส่ง DISCONNECT: ส่ง will message แทน
+        if will:
+            self._handle_publish(client_id, {
+                'topic': will['topic'],
+                'payload': will['payload'],
+                'qos': will['qos'],
+                'retain': will['retain']
+            })
         
     def _show_stats_periodically(self):
-        """📊 แสดงสถิติเป็นระยะ"""
+        """📊 คำนวณค่าต่อวินาทีของ metrics ทุก STATS_INTERVAL วินาที (พิมพ์ลง log ด้วยเมื่อ LOG_STATS=true หรือปิด metrics)"""
+        log_stats = (os.getenv('LOG_STATS', 'false').lower() == 'true'
+                     or os.getenv('METRICS_ENABLED', 'true').lower() != 'true')
         while self.running:
-            time.sleep(30)  # แสดงทุก 30 วินาที
+            time.sleep(self.stats_interval)
             if self.running:
-                self._show_stats()
+                self.metrics.update_rates()
+                if log_stats:
+                    self._show_stats()
                 
+    def _publish_sys_topics_periodically(self):
+        """📡 publish สถิติใน $SYS/broker/... ทุก SYS_INTERVAL วินาที (ไม่มีคน subscribe ก็ไม่ทำอะไร)"""
+        while self.running:
+            time.sleep(self.sys_interval)
+            if not self.running:
+                break
+            try:
+                self.sys_topics.tick()
+            except Exception as e:
+                self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่าง publish สถิติใน $SYS: {e}")
+                
+    def _reap_idle_clients_periodically(self):
+        """⏰ ตัด client ที่เงียบนานเกินกำหนดทุก HEARTBEAT_INTERVAL วินาที"""
+        while self.running:
+            time.sleep(self.heartbeat_interval)
+            if not self.running:
+                break
+            try:
+                self._reap_idle_clients(time.monotonic())
+            except Exception as e:
+                self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่างตรวจ client ที่เงียบ: {e}")
+                
+    def _reap_idle_clients(self, now):
+        """
+        ⏰ หมุน timing wheel ถึง now แล้วตัด client ที่หมดเวลา (ถ้ามีข้อมูลเข้ามาหลัง deadline เดิมก็เลื่อนออกไป)
+        
+        session ถาวรที่ client ไม่กลับมาภายใน SESSION_EXPIRY ก็หมดเวลาใน wheel เดียวกันนี้
+        """
+        idle = []
+        expired = []
+        for client_id, _ in self.deadlines.advance(now):
+            client = self.clients.get(client_id)
+            if client is None and self.sessions is not None:
+                session = self.sessions.offline(client_id)
+                if session is not None and session.connection is None:
+                    expired.append(session)
+                continue
+            if client is None or not client['timeout']:
+                continue
+            deadline = client['last_activity'] + client['timeout']
+            if deadline > now:
+                self.deadlines.schedule(client_id, deadline)
+            else:
+                idle.append((client_id, now - client['last_activity']))
+        
+        # client MQTT ที่หมดเวลาจะส่ง will message ด้วย (เหมือนหลุดโดยไม่ส่ง DISCONNECT)
+        for client_id, silent in idle:
+            self.logger.warning(f"⏰ {client_id} ไม่มีการติดต่อมา {silent:.0f} วินาที ตัดการเชื่อมต่อ")
+            self._disconnect_client(client_id)
+        self.stats['timed_out'].add(len(idle))
+        
+        for session in expired:
+            self.logger.info(
+                f"🗑️ session '{session.client_id}' หมดอายุ ทิ้งข้อความที่ค้าง {len(session.queue)} ข้อความ"
+            )
+            self._discard_session(session)
+        
     def _show_stats(self):
         """📊 แสดงสถิติปัจจุบัน"""
         uptime = datetime.now() - self.stats['start_time']
         
         self.logger.info("📊 ===== สถิติ MQTT Broker =====")
         self.logger.info(f"🕒 เวลาทำงาน: {uptime}")
-        self.logger.info(f"🔗 การเชื่อมต่อทั้งหมด: {self.stats['total_connections']}")
-        self.logger.info(f"🟢 การเชื่อมต่อปัจจุบัน: {self.stats['current_connections']}")
-        self.logger.info(f"📨 ข้อความทั้งหมด: {self.stats['total_messages']}")
-        self.logger.info(f"📥 subscription ทั้งหมด: {sum(len(subs) for subs in self.subscriptions.values())}")
+        self.logger.info(f"🔗 การเชื่อมต่อทั้งหมด: {self.stats['total_connections'].value}")
+        self.logger.info(f"🟢 การเชื่อมต่อปัจจุบัน: {len(self.clients)}")
+        self.logger.info(f"⏰ ตัดเพราะเงียบนานเกินกำหนด: {self.stats['timed_out'].value} (ติดตาม {len(self.deadlines)} client)")
+        if self.sessions is not None:
+            sessions = self.sessions.stats()
+            self.logger.info(
+                f"💤 Session ถาวร: {sessions['sessions']} (client ไม่อยู่ {sessions['offline']}) | "
+                f"ข้อความค้าง {sessions['queued']} (ในไฟล์ {sessions['spilled']}) | ทิ้ง {sessions['dropped']}"
+            )
+        self.logger.info(f"📨 ข้อความทั้งหมด: {self.stats['total_messages'].value}")
+        self.logger.info(
+            f"📬 ส่งให้ subscriber: {self.stats['messages_delivered'].value} | "
+            f"รับ {self.backpressure_stats.received_bytes.value} bytes / ส่ง {self.backpressure_stats.sent_bytes.value} bytes"
+        )
+        self.logger.info(f"📥 subscription ทั้งหมด: {self.subscriptions.subscription_count}")
         self.logger.info(f"📂 Topic ที่มีการใช้งาน: {len(self.subscriptions)}")
-        self.logger.info(f"💾 ข้อความที่เก็บไว้: {len(self.retained_messages)}")
+        if self.retained_messages is not None:
+            retained = self.retained_messages.stats()
+            self.logger.info(
+                f"💾 ข้อความที่เก็บไว้: {retained['topics']} "
+                f"({'ไฟล์' if retained['persistent'] else 'หน่วยความจำ'} "
+                f"ใช้ {retained['live_bytes']} bytes | ถูกทับ {retained['dead_bytes']} bytes "
+                f"| compact {retained['compactions']} ครั้ง)"
+            )
+        if self.message_log is not None:
+            durable = self.message_log.stats()
+            self.logger.info(
+                f"📒 Durable log ({durable['mode']}): {durable['segments']} segment {durable['bytes']} bytes "
+                f"| offset {durable['first_offset']}-{durable['next_offset'] - 1} "
+                f"| fsync {durable['fsyncs']} ครั้ง เฉลี่ย {durable['records_per_fsync']:.1f} ข้อความ/ครั้ง"
+            )
+        if self.max_qos:
+            windows = [client['inflight'] for _, client in self.clients.items()]
+            self.logger.info(
+                f"📬 QoS 1: รอ PUBACK {sum(len(window) for window in windows)} | "
+                f"รอที่ว่างใน window {sum(len(window.pending) for window in windows)} | "
+                f"ส่งซ้ำ {self.stats['qos_retransmitted'].value} | "
+                f"ทิ้ง {self.stats['qos_dropped'].value + sum(window.dropped for window in windows)}"
+            )
+        cache = self.subscriptions.cache_stats()
+        if cache:
+            self.logger.info(
+                f"🎯 Match cache: hit {cache['hits']} / miss {cache['misses']} "
+                f"({cache['hit_rate']:.1%}) | evict {cache['evictions']} "
+                f"| invalidate {cache['invalidations']} | snapshot {cache['snapshots']} "
+                f"| {cache['size']}/{cache['capacity']} topics"
+            )
+        backpressure = self.backpressure_stats.snapshot()
+        self.logger.info(
+            f"🚦 Backpressure ({self.outbound_limits.policy}): "
+            f"เกิน high watermark {backpressure['high_watermark']} | "
+            f"ทิ้งเก่า {backpressure['dropped_oldest']} | ทิ้งใหม่ {backpressure['dropped_newest']} | "
+            f"รวมค่า {backpressure['conflated']} | หยุดผู้ publish {backpressure['paused']} | "
+            f"ตัดการเชื่อมต่อ {backpressure['disconnected']}"
+        )
+        for name, locks in self._lock_stats().items():
+            self.logger.info(
+                f"🔒 Lock {name} ({locks['locks']} shard): ได้ lock {locks['acquired']} ครั้ง | "
+                f"ต้องรอ {locks['contended']} ({locks['contention']:.2%}) เฉลี่ย {locks['wait_us']:.1f} µs | "
+                f"ถือเฉลี่ย {locks['hold_us']:.1f} µs นานสุด {locks['max_hold_us']:.0f} µs"
+            )
+        if self.latency.enabled:
+            latency = self.latency.snapshot()
+            self.logger.info("⏱️ Latency (p50 / p99 / p999): " + " | ".join(
+                f"{stage} " + " / ".join(f"{value / 1000:.0f}" for value in latency[('', stage)]['quantiles'])
+                + f" µs ({latency[('', stage)]['count']})"
+                for stage in STAGES
+            ))
+        logs = self.log_pipeline.stats()
+        self.logger.info(
+            f"📝 Log: รอเขียน {logs['queued']} | ทิ้งเพราะคิวเต็ม {logs['dropped']} | "
+            f"ข้ามตามโควตา publish {self.publish_log.suppressed} client {self.client_log.suppressed}"
+        )
         self.logger.info("================================")
         
+    def _lock_stats(self):
+        """🔒 สถิติ lock ของแต่ละกลุ่ม (จำนวนครั้งที่ต้องรอและเวลาที่ถือ lock)"""
+        locks = {
+            'clients': self.clients.lock_stats(),
+            'subscriptions': self.subscriptions.lock_stats()
+        }
+        if self.retained_messages is not None:
+            locks['retained'] = self.retained_messages.lock_stats()
+        return locks
+        
     def stop(self):
         """⏹️ หยุดการทำงานของ broker"""
         self.logger.info("⏹️ กำลังหยุดการทำงาน...")
         self.running = False
         
+        # หยุด event loop (ถ้าใช้ asyncio engine)
+        if self.async_engine:
+            self.async_engine.stop()
+        
         # ปิดการเชื่อมต่อทั้งหมด
-        for client_id in list(self.clients.keys()):
+        for client_id in self.clients.keys():
             self._disconnect_client(client_id)
             
         # ปิด server socket
@@ -323,7 +1861,30 @@ class MQTTBroker:
             except:
                 pass
                 
+        # หยุด timer ส่งซ้ำของ QoS 1
+        self.timers.stop()
+        
+        # ลบไฟล์ข้อความที่ค้างของ session ถาวร (session อยู่ในหน่วยความจำเท่านั้น)
+        if self.sessions is not None:
+            self.sessions.close()
+        
+        # fsync ข้อความที่ค้างใน log (และส่งข้อความที่รอ fsync อยู่)
+        if self.message_log is not None:
+            self.message_log.close()
+            
+        # เขียน retained message ที่ค้างลงดิสก์
+        if self.retained_messages is not None:
+            self.retained_messages.close()
+                
+        # ปิด endpoint /metrics
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+                
         self.logger.info("✅ หยุดการทำงานเรียบร้อย")
+        
+        # เขียน log ที่ค้างในคิวให้หมดแล้วหยุด thread เขียน log
+        self.log_pipeline.stop()
 
 
 def main():
@@ -331,6 +1892,28 @@ def main():
     # อ่านค่า config จาก environment variables
     host = os.getenv('BROKER_HOST', '0.0.0.0')
     port = int(os.getenv('BROKER_PORT', '1883'))
+    workers = int(os.getenv('BROKER_WORKERS', '1'))
+    
+    # 🧩 โหมด multi-process: process แม่เป็น hub, worker แต่ละตัวเป็น broker
+    if workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            print("💥 ระบบนี้ไม่รองรับ SO_REUSEPORT ใช้ BROKER_WORKERS=1 แทน")
+            exit(1)
+            
+        log_pipeline = setup_logging()
+        
+        def run_worker(link):
+            broker = MQTTBroker(host=host, port=port, reuse_port=True, cluster=link)
+            try:
+                broker.start()
+            finally:
+                broker.stop()
+                
+        try:
+            run_cluster(run_worker, workers)
+        finally:
+            log_pipeline.stop()
+        return
     
     # สร้าง broker instance
     broker = MQTTBroker(host=host, port=port)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⏲️ Timer กลางของ Broker
+=====================
+
+งานที่ต้องทำเมื่อถึงเวลา (เช่นส่งข้อความ QoS 1 ซ้ำเมื่อ client ไม่ตอบ PUBACK)
+ใช้ thread เดียวกับ heap ของเวลาเป้าหมาย แทนการสร้าง threading.Timer หนึ่งตัวต่องาน
+
+- schedule() คืน handle ที่ cancel() ได้: งานที่ยกเลิกยังอยู่ใน heap จนถึงเวลา
+  แล้วถูกข้ามไป (ยกเลิกเป็น O(1) ไม่ต้องค้นหาใน heap)
+- callback ถูกเรียกจาก thread ของ timer นอก lock จึงควรทำงานสั้นๆ และไม่ block
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TimerHandle:
+    """🎫 งานหนึ่งงานใน TimerQueue"""
+
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """🚫 ยกเลิกงาน (ถ้ายังไม่ถูกเรียก)"""
+        self.cancelled = True
+        self.callback = None
+
+
+class TimerQueue:
+    """
+    ⏲️ heap ของงานที่รอเวลา พร้อม thread เดียวที่เรียกงานเมื่อถึงเวลา
+
+    Args:
+        name (str): ชื่อ thread
+    """
+
+    def __init__(self, name='broker-timer'):
+        self.name = name
+        self.heap = []
+        self.sequence = itertools.count()   # ลำดับสำหรับงานที่เวลาเท่ากัน
+        self.condition = threading.Condition(threading.Lock())
+        self.thread = None
+        self.running = True
+        self.fired = 0
+
+    def schedule(self, delay, callback):
+        """
+        ⏰ นัดให้เรียก callback() หลังจากนี้ delay วินาที
+
+        Returns:
+            TimerHandle: ใช้ยกเลิกงาน
+        """
+        handle = TimerHandle(time.monotonic() + delay, callback)
+        with self.condition:
+            if not self.running:
+                return handle
+            heapq.heappush(self.heap, (handle.deadline, next(self.sequence), handle))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.heap[0][2] is handle:
+                # งานใหม่ถึงเวลาก่อนงานที่ thread กำลังรอ
+                self.condition.notify()
+        return handle
+
+    def _run(self):
+        """🔁 รอจนงานแรกใน heap ถึงเวลา แล้วเรียกทุกงานที่ถึงเวลาแล้วพร้อมกัน"""
+        while True:
+            with self.condition:
+                while self.running:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if not self.running:
+                    return
+                now = time.monotonic()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+
+            for handle in due:
+                callback = handle.callback
+                if handle.cancelled or callback is None:
+                    continue
+                handle.callback = None
+                self.fired += 1
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"💥 เกิดข้อผิดพลาดใน timer: {e}")
+
+    def __len__(self):
+        """📊 จำนวนงานใน heap (รวมงานที่ยกเลิกแล้วแต่ยังไม่ถึงเวลา)"""
+        return len(self.heap)
+
+    def stop(self):
+        """🛑 หยุด thread (งานที่ค้างจะไม่ถูกเรียก)"""
+        with self.condition:
+            self.running = False
+            self.heap.clear()
+            self.condition.notify()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🎡 Timing Wheel แบบหลายชั้น (Hierarchical Timing Wheel)
+=====================================================
+
+ติดตามเวลาหมดอายุ (deadline) ของ key จำนวนมาก เช่น keepalive ของทุก client
+- schedule() / cancel() เป็น O(1): แค่ย้าย key ไปไว้ในช่อง (slot) ของเวลานั้น
+- advance() หมุนวงล้อไปถึงเวลาปัจจุบัน แล้วคืน key ที่หมดเวลาทั้งช่องพร้อมกัน
+
+วงล้อชั้นแรกมี slots ช่อง ช่องละ tick วินาที ชั้นถัดไปแต่ละช่องกว้างเป็น slots เท่าของชั้นก่อน
+(ค่าเริ่มต้น 64 ช่อง x 4 ชั้น ที่ tick 1 วินาที ครอบคลุมประมาณ 194 วัน)
+key ที่อยู่ชั้นบนจะถูกเลื่อนลงชั้นล่าง (cascade) เมื่อวงล้อหมุนมาถึงช่องของมัน
+ดังนั้นแต่ละ key ถูกย้ายไม่เกินจำนวนชั้น ไม่ว่าจะมี key ทั้งหมดกี่ตัว
+
+deadline ถูกปัดขึ้นเป็นทีละ tick: key หมดเวลาไม่ก่อน deadline แต่อาจช้ากว่าได้ไม่เกินหนึ่ง tick
+เวลาทั้งหมดเป็น time.monotonic() (ไม่เปลี่ยนตามนาฬิกาของเครื่อง)
+"""
+
+import math
+import threading
+
+
+class TimingWheel:
+    """
+    🎡 วงล้อเวลาหลายชั้น
+
+    Args:
+        tick (float): ความละเอียดของวงล้อ (วินาทีต่อช่อง)
+        slots (int): จำนวนช่องต่อชั้น (ต้องเป็นเลขยกกำลังของ 2)
+        levels (int): จำนวนชั้น
+        now (float): เวลาเริ่มต้น (monotonic)
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4, now=0.0):
+        if slots & (slots - 1):
+            raise ValueError("slots ต้องเป็นเลขยกกำลังของ 2")
+        self.tick = tick
+        self.slots = slots
+        self.bits = slots.bit_length() - 1
+        self.mask = slots - 1
+        self.levels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.span = slots ** levels            # จำนวน tick ที่วงล้อทุกชั้นรวมกันครอบคลุม
+        self.current = int(now // tick)        # tick ล่าสุดที่หมุนผ่านไปแล้ว
+        self.where = {}                        # key -> slot (dict) ที่ key อยู่
+        self.lock = threading.Lock()
+        self.expired = 0
+        self.cascaded = 0
+
+    def _place(self, key, deadline, earliest):
+        """📍 ใส่ key ลงช่องที่ถึงเวลาไม่ก่อน deadline (และไม่ก่อน tick earliest)"""
+        target = max(math.ceil(deadline / self.tick), earliest)
+        delta = target - self.current
+        if delta >= self.span:
+            # ไกลเกินวงล้อ: วางไว้ช่องไกลสุดของชั้นบนสุด แล้วค่อยวางใหม่เมื่อถึง
+            target = self.current + self.span - 1
+            delta = self.span - 1
+        level = 0
+        while delta >= 1 << (self.bits * (level + 1)):
+            level += 1
+        slot = self.levels[level][(target >> (self.bits * level)) & self.mask]
+        slot[key] = deadline
+        self.where[key] = slot
+
+    def schedule(self, key, deadline):
+        """
+        ⏰ ตั้ง (หรือเลื่อน) เวลาหมดอายุของ key
+
+        Args:
+            key: ตัวระบุ (hashable)
+            deadline (float): เวลา monotonic ที่หมดอายุ
+        """
+        with self.lock:
+            slot = self.where.pop(key, None)
+            if slot is not None:
+                del slot[key]
+            # ช่องของ tick ปัจจุบันถูกเก็บไปแล้ว: deadline ที่ผ่านมาแล้วหมดเวลาใน tick ถัดไป
+            self._place(key, deadline, self.current + 1)
+
+    def cancel(self, key):
+        """🚫 เลิกติดตาม key (ไม่มี key นี้ก็ไม่เป็นไร)"""
+        with self.lock:
+            slot = self.where.pop(key, None)
+            if slot is not None:
+                del slot[key]
+
+    def advance(self, now):
+        """
+        🔄 หมุนวงล้อถึงเวลา now
+
+        Args:
+            now (float): เวลา monotonic ปัจจุบัน
+
+        Returns:
+            list: [(key, deadline), ...] ที่หมดเวลา (key ถูกเอาออกจากวงล้อแล้ว)
+        """
+        target = int(now // self.tick)
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                self._cascade()
+                slot = self.levels[0][self.current & self.mask]
+                if slot:
+                    for key, deadline in slot.items():
+                        del self.where[key]
+                        expired.append((key, deadline))
+                    slot.clear()
+            self.expired += len(expired)
+        return expired
+
+    def _cascade(self):
+        """⬇️ เมื่อชั้นล่างหมุนครบรอบ เลื่อน key ในช่องปัจจุบันของชั้นบนลงมา"""
+        for level in range(1, len(self.levels)):
+            if self.current & ((1 << (self.bits * level)) - 1):
+                return
+            index = (self.current >> (self.bits * level)) & self.mask
+            slot = self.levels[level][index]
+            if not slot:
+                continue
+            entries = list(slot.items())
+            slot.clear()
+            self.cascaded += len(entries)
+            for key, deadline in entries:
+                self._place(key, deadline, self.current)
+
+    def __len__(self):
+        """📊 จำนวน key ที่ติดตามอยู่"""
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def stats(self):
+        """📊 จำนวน key, key ที่หมดเวลาแล้วทั้งหมด และจำนวนครั้งที่เลื่อนชั้น"""
+        return {
+            'tracked': len(self.where),
+            'expired': self.expired,
+            'cascaded': self.cascaded
+        }
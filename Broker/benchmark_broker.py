@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🏁 Benchmark สำหรับ Simple MQTT Broker
+=====================================
+
+เปรียบเทียบ engine ของ broker (threaded / asyncio) ในสองด้าน:
+- ความจุการเชื่อมต่อ: เปิด connection พร้อมกันกี่ตัว และทุกตัวยังตอบ ping ได้
+- ปริมาณข้อความ: publisher หลายตัวยิงข้อความ แล้ววัดจำนวนที่ subscriber ได้รับต่อวินาที
+
+Broker จะรันใน process แยก เพื่อให้ตัวสร้างโหลดไม่แย่ง GIL กับ broker
+
+และวัด CPU ต่อการ publish หนึ่งครั้งเทียบกับจำนวน subscriber (fan-out)
+ระหว่างการแปลงข้อความครั้งเดียว (broadcast_to_subscribers) กับการแปลงแยกทีละ subscriber
+
+โหมด --qos เทียบปริมาณข้อความที่ส่งให้ subscriber แบบ QoS 0 กับ QoS 1
+(subscriber ตอบ puback ทุกข้อความ broker ส่งได้ไม่เกิน in-flight window ต่อ client)
+
+โหมด --stress ให้หลาย thread publish / subscribe / unsubscribe / เชื่อมต่อ / ตัดการเชื่อมต่อ
+พร้อมกันกับ broker ใน process เดียวกัน แล้วตรวจว่าข้อมูลยังถูกต้อง พร้อมแสดงสถิติ lock
+
+วิธีใช้:
+    python benchmark_broker.py
+    python benchmark_broker.py --engines asyncio --connections 5000
+    python benchmark_broker.py --fanout 1 10 100 500
+    python benchmark_broker.py --qos --inflight 20 100
+    python benchmark_broker.py --stress 8 --iterations 2000
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows ไม่มี module resource
+    resource = None
+
+BROKER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def raise_fd_limit():
+    """📈 ขยายจำนวนไฟล์ที่เปิดได้ให้เต็ม hard limit (ต้องใช้กับ connection จำนวนมาก)"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def run_broker(port, engine, qos=None):
+    """🏠 รัน broker ใน process ลูก (ปิด log ระดับ INFO เพื่อไม่ให้ disk เป็นคอขวด)"""
+    raise_fd_limit()
+    os.environ['BROKER_ENGINE'] = engine
+    os.chdir(BROKER_DIR)
+
+    from simple_broker import MQTTBroker
+    from config_manager import BrokerConfig
+
+    config = BrokerConfig()
+    if qos:
+        # ค่า qos ที่ต่างจาก config.json (เช่นขนาด in-flight window)
+        config.config.setdefault('qos', {}).update(qos)
+    # เขียน broker.log ลง temp แทนโฟลเดอร์โปรเจค
+    os.chdir(tempfile.gettempdir())
+    broker = MQTTBroker(host='127.0.0.1', port=port, config=config)
+    broker.logger.setLevel(logging.WARNING)
+    broker.start()
+
+
+def free_port():
+    """🚪 หา port ว่าง"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_listening(port, timeout=10.0):
+    """⏳ รอจน broker เปิด port"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def encode(message):
+    """📦 แปลงข้อความเป็น JSON-line"""
+    return (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def read_lines(sock, count, timeout):
+    """
+    📨 อ่านจนได้ครบ count บรรทัดหรือไม่มีข้อมูลเข้ามานาน timeout วินาที
+
+    Returns:
+        tuple: (จำนวนบรรทัดที่อ่านได้, เวลา perf_counter ของข้อมูลชุดสุดท้าย)
+    """
+    sock.settimeout(timeout)
+    received = 0
+    last = time.perf_counter()
+    try:
+        while received < count:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received += data.count(b'\n')
+            last = time.perf_counter()
+    except socket.timeout:
+        pass
+    return received, last
+
+
+def read_and_ack(sock, count, timeout):
+    """
+    📬 อ่านข้อความแบบเดียวกับ read_lines แต่ตอบ puback ทุกข้อความที่มี packet_id (subscriber QoS 1)
+
+    Returns:
+        tuple: (จำนวนข้อความที่อ่านได้, เวลา perf_counter ของข้อมูลชุดสุดท้าย)
+    """
+    sock.settimeout(timeout)
+    received = 0
+    pending = b''
+    last = time.perf_counter()
+    try:
+        while received < count:
+            data = sock.recv(65536)
+            if not data:
+                break
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            received += len(lines)
+            last = time.perf_counter()
+            acks = b''.join(
+                encode({'type': 'puback', 'packet_id': message['packet_id']})
+                for message in map(json.loads, lines) if 'packet_id' in message
+            )
+            if acks:
+                sock.sendall(acks)
+    except socket.timeout:
+        pass
+    return received, last
+
+
+def bench_connections(port, connections):
+    """
+    🔗 เปิด connection จำนวนมากแล้วส่ง ping จากทุกตัว
+
+    Returns:
+        dict: จำนวนที่เชื่อมต่อได้, จำนวนที่ได้ pong, เวลาที่ใช้
+    """
+    sockets = []
+    start = time.perf_counter()
+    for _ in range(connections):
+        try:
+            sockets.append(socket.create_connection(('127.0.0.1', port), timeout=5))
+        except OSError:
+            break
+    connect_time = time.perf_counter() - start
+
+    ping = encode({'type': 'ping'})
+    for sock in sockets:
+        try:
+            sock.sendall(ping)
+        except OSError:
+            pass
+
+    answered = 0
+    for sock in sockets:
+        if read_lines(sock, 1, 5.0)[0]:
+            answered += 1
+    total_time = time.perf_counter() - start
+
+    for sock in sockets:
+        sock.close()
+
+    return {
+        'connected': len(sockets),
+        'answered': answered,
+        'connect_time': connect_time,
+        'total_time': total_time
+    }
+
+
+def bench_throughput(port, publishers, subscribers, messages, qos=0):
+    """
+    📤 publisher หลายตัวยิงข้อความไปยัง topic เดียว แล้วนับที่ subscriber ได้รับ
+
+    qos=1: subscriber subscribe ด้วย QoS 1 และตอบ puback ทุกข้อความ
+    (publisher ไม่ส่ง packet_id จึงไม่ต้องรอ puback ขาเข้า วัดเฉพาะขาส่งให้ subscriber)
+
+    Returns:
+        dict: จำนวนที่คาดหวัง, จำนวนที่ได้รับ, เวลาที่ใช้
+    """
+    topic = 'bench/throughput'
+
+    subs = []
+    for _ in range(subscribers):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        sock.sendall(encode({'type': 'subscribe', 'topic': topic, 'qos': qos}) + encode({'type': 'ping'}))
+        read_lines(sock, 1, 5.0)  # รอ pong = subscribe ถูกประมวลผลแล้ว
+        subs.append(sock)
+
+    pubs = [socket.create_connection(('127.0.0.1', port), timeout=5) for _ in range(publishers)]
+    batch = b''.join(
+        encode({'type': 'publish', 'topic': topic, 'payload': f'{i}', 'qos': qos})
+        for i in range(messages)
+    )
+
+    expected = publishers * messages
+    counts = [0] * subscribers
+    finished = [0.0] * subscribers
+    read = read_and_ack if qos else read_lines
+
+    def consume(index, sock):
+        counts[index], finished[index] = read(sock, expected, 3.0)
+
+    readers = [threading.Thread(target=consume, args=(i, s)) for i, s in enumerate(subs)]
+    for reader in readers:
+        reader.start()
+
+    start = time.perf_counter()
+    senders = [threading.Thread(target=p.sendall, args=(batch,)) for p in pubs]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    for reader in readers:
+        reader.join()
+    elapsed = max(finished) - start
+
+    for sock in subs + pubs:
+        sock.close()
+
+    return {
+        'expected': expected * subscribers,
+        'delivered': sum(counts),
+        'elapsed': elapsed
+    }
+
+
+class NullSocket:
+    """🕳️ คิวขาออกปลอมที่รับข้อมูลทิ้ง (วัดเฉพาะงานของ broker ไม่รวม kernel)"""
+
+    congested = False
+
+    def send(self, data, topic=None, trace=None):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class CountingSocket(NullSocket):
+    """🧮 คิวขาออกปลอมที่นับจำนวน frame ที่ได้รับ (เรียกจากหลาย thread พร้อมกันได้)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0
+
+    def send(self, data, topic=None, trace=None):
+        with self.lock:
+            self.frames += 1
+        return len(data)
+
+
+def bench_fanout(fanout, publishes):
+    """
+    📢 วัดเวลา CPU ต่อ publish ที่มี subscriber fanout ตัว
+
+    Returns:
+        dict: ไมโครวินาทีต่อ publish แบบแปลงครั้งเดียว และแบบแปลงทีละ subscriber
+    """
+    from simple_broker import MQTTBroker
+    from config_manager import BrokerConfig
+
+    config = BrokerConfig(os.path.join(BROKER_DIR, 'config.json'))
+    broker = MQTTBroker(host='127.0.0.1', port=0, config=config)
+    broker.logger.setLevel(logging.WARNING)
+
+    topic = 'bench/fanout'
+    publisher = broker.register_client(NullSocket(), ('127.0.0.1', 0))
+    subscribers = []
+    for _ in range(fanout):
+        client_id = broker.register_client(NullSocket(), ('127.0.0.1', 0))
+        broker.handle_subscribe(client_id, {'topic': topic})
+        subscribers.append(client_id)
+
+    message_data = {
+        'payload': {'temperature': 25.5, 'humidity': 60, 'sensor': 'room-1'},
+        'client_id': publisher,
+        'timestamp': datetime.now().isoformat(),
+        'qos': 0
+    }
+
+    start = time.process_time()
+    for _ in range(publishes):
+        broker.broadcast_to_subscribers(topic, message_data)
+    encode_once = time.process_time() - start
+
+    # แบบเดิม: สร้างข้อความแล้ว send_to_client (แปลง JSON ใหม่) ทีละ subscriber
+    start = time.process_time()
+    for _ in range(publishes):
+        broadcast_message = {
+            'type': 'message',
+            'topic': topic,
+            'payload': message_data['payload'],
+            'timestamp': message_data['timestamp'],
+            'from_client': message_data['client_id']
+        }
+        for client_id in broker.subscriptions.match(topic):
+            broker.send_to_client(client_id, broadcast_message)
+    per_subscriber = time.process_time() - start
+
+    return {
+        'encode_once': encode_once / publishes * 1e6,
+        'per_subscriber': per_subscriber / publishes * 1e6
+    }
+
+
+def run_fanout(args):
+    """📢 แสดงตาราง CPU ต่อ publish ตามจำนวน fan-out"""
+    # broker.log ของ broker ที่สร้างใน process นี้ให้ไปอยู่ใน temp
+    os.chdir(tempfile.gettempdir())
+
+    print("📢 CPU ต่อ publish เทียบกับ fan-out")
+    print("=" * 62)
+    print(f"{'fan-out':>8} {'encode-once µs':>16} {'per-subscriber µs':>19} {'speedup':>9}")
+    print("-" * 62)
+    for fanout in args.fanout:
+        result = bench_fanout(fanout, args.publishes)
+        speedup = result['per_subscriber'] / result['encode_once'] if result['encode_once'] else 0
+        print(f"{fanout:>8} {result['encode_once']:>16.1f} {result['per_subscriber']:>19.1f} "
+              f"{speedup:>8.1f}x")
+    print("=" * 62)
+
+
+def bench_stress(threads, iterations, topics=8):
+    """
+    🧵 ให้หลาย thread ใช้ broker ตัวเดียวกันพร้อมกัน แล้วตรวจความถูกต้อง
+
+    แต่ละ thread publish ผ่าน process_frames และทุก 10 รอบจะสร้าง client ชั่วคราว
+    ที่ subscribe / unsubscribe แล้วตัดการเชื่อมต่อ
+
+    Returns:
+        dict: errors (list ของสิ่งที่ผิด), elapsed, publishes และ lock_stats
+    """
+    from simple_broker import MQTTBroker
+    from config_manager import BrokerConfig
+
+    config = BrokerConfig(os.path.join(BROKER_DIR, 'config.json'))
+    broker = MQTTBroker(host='127.0.0.1', port=0, config=config)
+    broker.logger.setLevel(logging.WARNING)
+
+    # subscriber ที่อยู่ตลอดการทดสอบ: หนึ่งตัวต่อ topic และหนึ่งตัวที่ใช้ wildcard
+    topic_names = [f'stress/{index}/value' for index in range(topics)]
+    exact = []
+    for topic in topic_names:
+        writer = CountingSocket()
+        client_id = broker.register_client(writer, ('127.0.0.1', 0))
+        broker.handle_subscribe(client_id, {'topic': topic})
+        exact.append(writer)
+    wildcard = CountingSocket()
+    broker.handle_subscribe(broker.register_client(wildcard, ('127.0.0.1', 0)), {'topic': 'stress/+/value'})
+
+    churned = [0] * threads
+    failures = []
+
+    def worker(index):
+        try:
+            publisher = broker.register_client(NullSocket(), ('127.0.0.1', 0))
+            for iteration in range(iterations):
+                topic = topic_names[(index + iteration) % topics]
+                broker.process_frames(publisher, [json.dumps({
+                    'type': 'publish', 'topic': topic, 'payload': iteration
+                })])
+                if iteration % 10 == 0:
+                    client_id = broker.register_client(CountingSocket(), ('127.0.0.1', 0))
+                    broker.handle_subscribe(client_id, {'topic': topic})
+                    broker.handle_subscribe(client_id, {'topic': 'stress/#'})
+                    broker.handle_unsubscribe(client_id, {'topic': topic})
+                    broker.disconnect_client(client_id)
+                    churned[index] += 1
+        except Exception as e:
+            failures.append(f'thread {index}: {e!r}')
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # ✅ ตรวจผลลัพธ์
+    publishes = threads * iterations
+    expected = [0] * topics
+    for index in range(threads):
+        for iteration in range(iterations):
+            expected[(index + iteration) % topics] += 1
+
+    errors = list(failures)
+
+    def check(name, actual, wanted):
+        if actual != wanted:
+            errors.append(f'{name}: ได้ {actual} ควรเป็น {wanted}')
+
+    for index, writer in enumerate(exact):
+        check(f'subscriber ของ {topic_names[index]}', writer.frames, expected[index])
+    check('subscriber แบบ wildcard', wildcard.frames, publishes)
+    check('total_messages', broker.stats['total_messages'].value, publishes)
+    check('total_connections', broker.stats['total_connections'].value,
+          topics + 1 + threads + sum(churned))
+    check('active_connections', broker.stats['active_connections'].value, len(broker.clients))
+    check('จำนวน client', len(broker.clients), topics + 1 + threads)
+    check('จำนวน subscription', broker.subscriptions.subscription_count, topics + 1)
+    check('จำนวน filter', len(broker.subscriptions), topics + 1)
+    check('จำนวน topic ที่เก็บข้อความ', len(broker.topics), topics)
+    depth = broker.topics.depth
+    for topic, history in broker.topics.items():
+        if len(history) > depth:
+            errors.append(f'{topic}: เก็บข้อความ {len(history)} รายการ (เกิน {depth})')
+
+    return {
+        'errors': errors,
+        'elapsed': elapsed,
+        'publishes': publishes,
+        'lock_stats': broker.lock_stats()
+    }
+
+
+def run_stress(args):
+    """🧵 รัน stress test และแสดงสถิติ lock (exit code 1 ถ้าข้อมูลไม่ถูกต้อง)"""
+    os.chdir(tempfile.gettempdir())
+
+    result = bench_stress(args.stress, args.iterations)
+    rate = result['publishes'] / result['elapsed'] if result['elapsed'] else 0
+
+    print(f"🧵 Stress test: {args.stress} thread x {args.iterations} รอบ "
+          f"({result['publishes']} publish ใน {result['elapsed']:.2f} วินาที, {rate:.0f} publish/s)")
+    print("=" * 86)
+    print(f"{'lock':<14} {'shards':>7} {'acquired':>10} {'contended':>10} {'ratio':>8} "
+          f"{'wait µs':>9} {'hold µs':>9} {'max hold µs':>12}")
+    print("-" * 86)
+    for name, locks in result['lock_stats'].items():
+        print(f"{name:<14} {locks['locks']:>7} {locks['acquired']:>10} {locks['contended']:>10} "
+              f"{locks['contention']:>8.2%} {locks['wait_us']:>9.1f} {locks['hold_us']:>9.1f} "
+              f"{locks['max_hold_us']:>12.0f}")
+    print("=" * 86)
+
+    if result['errors']:
+        print("❌ พบข้อมูลไม่ถูกต้อง:")
+        for error in result['errors']:
+            print(f"   - {error}")
+        sys.exit(1)
+    print("✅ ข้อมูลถูกต้องทั้งหมด")
+
+
+def run_qos(args):
+    """📬 เทียบ msgs/s ที่ subscriber ได้รับระหว่าง QoS 0 กับ QoS 1 ตามขนาด in-flight window"""
+    raise_fd_limit()
+
+    print(f"📬 QoS 0 เทียบกับ QoS 1 ({args.publishers} publisher x {args.messages} ข้อความ, "
+          f"{args.subscribers} subscriber)")
+    print("=" * 62)
+    print(f"{'engine':<10} {'qos':>4} {'window':>7} {'delivered':>12} {'ratio':>7} {'msgs/s':>12}")
+    print("-" * 62)
+    for engine in args.engines:
+        # QoS 0 ไม่ใช้ window / QoS 1 ไม่จำกัดคิวรอ window (วัดความเร็ว ไม่ให้ข้อความถูกทิ้ง)
+        runs = [(0, None)] + [(1, window) for window in args.inflight]
+        for qos, window in runs:
+            settings = {'inflight_window': window, 'max_pending_messages': 0} if window else None
+            port = free_port()
+            process = multiprocessing.Process(target=run_broker, args=(port, engine, settings), daemon=True)
+            process.start()
+            try:
+                if not wait_until_listening(port):
+                    raise RuntimeError(f"broker ({engine}) ไม่เปิด port {port}")
+                tput = bench_throughput(port, args.publishers, args.subscribers, args.messages, qos)
+            finally:
+                process.terminate()
+                process.join()
+            ratio = tput['delivered'] / tput['expected'] if tput['expected'] else 0
+            rate = tput['delivered'] / tput['elapsed'] if tput['elapsed'] else 0
+            print(f"{engine:<10} {qos:>4} {window or '-':>7} {tput['delivered']:>12} "
+                  f"{ratio:>7.1%} {rate:>12.0f}")
+    print("=" * 62)
+
+
+def run_engine(engine, args):
+    """🏁 รัน benchmark ทั้งหมดกับ engine เดียว"""
+    port = free_port()
+    process = multiprocessing.Process(target=run_broker, args=(port, engine), daemon=True)
+    process.start()
+    try:
+        if not wait_until_listening(port):
+            raise RuntimeError(f"broker ({engine}) ไม่เปิด port {port}")
+        connections = bench_connections(port, args.connections)
+        throughput = bench_throughput(port, args.publishers, args.subscribers, args.messages)
+    finally:
+        process.terminate()
+        process.join()
+    return connections, throughput
+
+
+def main():
+    """🎯 ฟังก์ชันหลัก"""
+    parser = argparse.ArgumentParser(description='Benchmark engine ของ Simple MQTT Broker')
+    parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--publishers', type=int, default=4)
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=5000, help='จำนวนข้อความต่อ publisher')
+    parser.add_argument('--fanout', type=int, nargs='+',
+                        help='วัด CPU ต่อ publish ที่จำนวน subscriber เหล่านี้ (แทนการเทียบ engine)')
+    parser.add_argument('--publishes', type=int, default=2000, help='จำนวน publish ต่อขนาด fan-out')
+    parser.add_argument('--stress', type=int, metavar='THREADS',
+                        help='stress test หลาย thread พร้อมตรวจความถูกต้อง (แทนการเทียบ engine)')
+    parser.add_argument('--iterations', type=int, default=2000, help='จำนวนรอบต่อ thread ของ --stress')
+    parser.add_argument('--qos', action='store_true',
+                        help='เทียบ throughput ของ QoS 0 กับ QoS 1 (แทนการเทียบ engine)')
+    parser.add_argument('--inflight', type=int, nargs='+', default=[20],
+                        help='ขนาด in-flight window ที่ใช้วัด QoS 1 ของ --qos')
+    args = parser.parse_args()
+
+    if args.fanout:
+        run_fanout(args)
+        return
+
+    if args.stress:
+        run_stress(args)
+        return
+
+    if args.qos:
+        run_qos(args)
+        return
+
+    raise_fd_limit()
+
+    print("🏁 Simple MQTT Broker benchmark")
+    print("=" * 78)
+    print(f"{'engine':<10} {'connected':>10} {'pong':>8} {'conn/s':>10} "
+          f"{'delivered':>12} {'ratio':>7} {'msgs/s':>12}")
+    print("-" * 78)
+
+    for engine in args.engines:
+        conn, tput = run_engine(engine, args)
+        conn_rate = conn['connected'] / conn['connect_time'] if conn['connect_time'] else 0
+        ratio = tput['delivered'] / tput['expected'] if tput['expected'] else 0
+        rate = tput['delivered'] / tput['elapsed'] if tput['elapsed'] else 0
+        print(f"{engine:<10} {conn['connected']:>10} {conn['answered']:>8} {conn_rate:>10.0f} "
+              f"{tput['delivered']:>12} {ratio:>7.1%} {rate:>12.0f}")
+
+    print("=" * 78)
+
+
+if __name__ == "__main__":
+    main()
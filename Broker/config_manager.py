@@ -52,7 +52,9 @@ class BrokerConfig:
                 "host": "localhost",
                 "port": 1883,
                 "max_connections": 100,
-                "keepalive_timeout": 60
+                "keepalive_timeout": 60,
+                "engine": "threaded",
+                "protocol": "auto"
             },
             "logging": {
                 "level": "INFO",
@@ -89,6 +91,187 @@ class BrokerConfig:
         """🚪 ดึง port ของ broker"""
         return self.get("broker", "port", 1883)
     
+    def get_broker_engine(self) -> str:
+        """⚡ ดึงชื่อ engine ของ broker ('threaded' หรือ 'asyncio')"""
+        return self.get("broker", "engine", "threaded")
+    
+    def is_wildcard_subscriptions_enabled(self) -> bool:
+        """🌳 ตรวจสอบว่ารองรับ wildcard (+ และ #) ใน subscription ไหม"""
+        return self.get("features", "wildcard_subscriptions", True)
+    
+    def get_match_cache_size(self) -> int:
+        """🎯 ดึงขนาด cache ของผลการหา subscriber ต่อ topic (0 = ปิด)"""
+        return self.get("performance", "match_cache_size", 4096)
+    
+    def get_keepalive_settings(self) -> Dict[str, Any]:
+        """⏰ ดึงเวลาที่ยอมให้ client เงียบได้ก่อนถูกตัด และความถี่ในการตรวจ"""
+        return {
+            "keepalive_timeout": self.get("broker", "keepalive_timeout", 60),
+            "client_timeout": self.get("performance", "client_timeout", 300),
+            "heartbeat_interval": self.get("performance", "heartbeat_interval", 10)
+        }
+    
+    def get_backpressure_settings(self) -> Dict[str, Any]:
+        """🚦 ดึงขีดจำกัดคิวขาออกของแต่ละ client และ policy เมื่อเกิน"""
+        settings = {
+            "policy": "drop-oldest",
+            "high_watermark_bytes": 8 * 1024 * 1024,
+            "low_watermark_bytes": 4 * 1024 * 1024,
+            "high_watermark_messages": 10000,
+            "low_watermark_messages": 5000,
+            "client_policies": {}
+        }
+        settings.update(self.get("backpressure") or {})
+        return settings
+    
+    def get_broker_protocol(self) -> str:
+        """📦 ดึง protocol ของ broker ('auto', 'json' หรือ 'mqtt')"""
+        return self.get("broker", "protocol", "auto")
+    
+    def get_read_buffer_size(self) -> int:
+        """📥 ดึงขนาด buffer รับข้อมูลต่อ connection (byte)"""
+        return self.get("performance", "read_buffer_size", 65536)
+    
+    def get_lock_shards(self) -> int:
+        """🔒 ดึงจำนวน shard ของ lock (client / subscription / ข้อความล่าสุด)"""
+        return self.get("performance", "lock_shards", 16)
+    
+    def get_max_messages_per_topic(self) -> int:
+        """🕘 ดึงจำนวนข้อความที่เก็บไว้ต่อ topic"""
+        return self.get("topics", "max_messages_per_topic", 10)
+    
+    def get_topic_history_max_bytes(self) -> int:
+        """📦 ดึงงบ byte รวมของประวัติข้อความทุก topic (0 = ไม่จำกัด)"""
+        return self.get("topics", "max_total_bytes", 0)
+    
+    def get_max_topics(self) -> int:
+        """📂 ดึงจำนวน topic สูงสุดที่เก็บประวัติ (0 = ไม่จำกัด)"""
+        return self.get("topics", "max_topics", 0)
+    
+    def get_topic_cleanup_settings(self) -> Dict[str, Any]:
+        """🧹 ดึงการตั้งค่าการทิ้งประวัติของ topic ที่ไม่มีการ publish นานเกินไป"""
+        settings = {
+            "auto_cleanup": True,
+            "cleanup_interval": 3600,
+            "max_idle_time": 3600
+        }
+        for key in settings:
+            settings[key] = self.get("topics", key, settings[key])
+        return settings
+    
+    def is_retained_messages_enabled(self) -> bool:
+        """📌 ตรวจสอบว่าเก็บข้อความที่ publish ด้วย retain ไหม"""
+        return self.get("features", "retained_messages", False)
+    
+    def get_data_dir(self) -> str:
+        """💾 ดึงโฟลเดอร์เก็บข้อมูลถาวร เช่น retained message ('' = เก็บในหน่วยความจำเท่านั้น)"""
+        return self.get("storage", "data_dir", "data")
+    
+    def get_max_qos(self) -> int:
+        """📬 QoS สูงสุดที่ส่งให้ subscriber ได้ (จาก features.qos_support ส่งได้ถึง QoS 1)"""
+        levels = self.get("features", "qos_support", [0, 1]) or [0]
+        return min(max(levels), 1)
+    
+    def get_qos_settings(self) -> Dict[str, Any]:
+        """📬 ดึงการตั้งค่าการส่งข้อความ QoS 1 (in-flight window และการส่งซ้ำ)"""
+        settings = {
+            "inflight_window": 20,
+            "retry_interval": 10,
+            "max_pending_messages": 1000
+        }
+        for key in settings:
+            settings[key] = self.get("qos", key, settings[key])
+        return settings
+    
+    def get_metrics_settings(self) -> Dict[str, Any]:
+        """📈 ดึงการตั้งค่า endpoint /metrics แบบ Prometheus (log_stats = ยังพิมพ์สถิติลง log ทุก stats_interval ด้วย)"""
+        settings = {
+            "enabled": True,
+            "host": "localhost",
+            "port": 9883,
+            "log_stats": False
+        }
+        for key in settings:
+            settings[key] = self.get("metrics", key, settings[key])
+        return settings
+    
+    def get_latency_settings(self) -> Dict[str, Any]:
+        """⏱️ ดึงการตั้งค่าการวัด latency ของข้อความ (เปิด/ปิดระหว่างทำงานได้ทาง POST /latency)"""
+        settings = {
+            "enabled": False,
+            "topic_prefix_levels": 0,
+            "max_prefixes": 64,
+            "sample_every": 16
+        }
+        for key in settings:
+            settings[key] = self.get("latency", key, settings[key])
+        return settings
+    
+    def get_sys_topics_settings(self) -> Dict[str, Any]:
+        """📡 ดึงการตั้งค่าการ publish สถิติของ broker ใน topic $SYS/broker/..."""
+        settings = {
+            "enabled": True,
+            "interval": 10
+        }
+        for key in settings:
+            settings[key] = self.get("sys_topics", key, settings[key])
+        return settings
+    
+    def get_profiling_settings(self) -> Dict[str, Any]:
+        """🔬 ดึงการตั้งค่า profiling ระหว่างทำงาน (signal และคำสั่ง admin)"""
+        settings = {
+            "directory": "logs",
+            "signal_mode": "cpu",
+            "sample_interval_ms": 5,
+            "memory_frames": 10,
+            "admin_token": ""
+        }
+        for key in settings:
+            settings[key] = self.get("profiling", key, settings[key])
+        return settings
+    
+    def get_session_settings(self) -> Dict[str, Any]:
+        """💤 ดึงการตั้งค่า session ถาวร (เก็บ subscription และข้อความของ client ที่หลุดไป)"""
+        settings = {
+            "enabled": True,
+            "max_queued_messages": 10000,
+            "memory_messages": 1000,
+            "expiry": 3600
+        }
+        for key in settings:
+            settings[key] = self.get("sessions", key, settings[key])
+        return settings
+    
+    def get_durability_settings(self) -> Dict[str, Any]:
+        """📒 ดึงการตั้งค่า log ของข้อความแบบ durable (เขียนทุก publish ลงดิสก์ก่อนส่งต่อ)"""
+        settings = {
+            "enabled": False,
+            "mode": "sync",
+            "fsync_interval_ms": 5,
+            "segment_bytes": 64 * 1024 * 1024,
+            "retention_bytes": 1024 * 1024 * 1024,
+            "retention_hours": 168
+        }
+        for key in settings:
+            settings[key] = self.get("durability", key, settings[key])
+        return settings
+    
+    def get_logging_settings(self) -> Dict[str, Any]:
+        """📝 ดึงการตั้งค่า logging ทั้งหมด (ไฟล์หมุนเวียน, ขนาดคิว และจำนวน log ของเหตุการณ์ที่เกิดถี่ต่อวินาที)"""
+        settings = {
+            "level": "INFO",
+            "console": True,
+            "file": True,
+            "filename": "broker.log",
+            "max_file_size": "10MB",
+            "backup_count": 5,
+            "queue_size": 10000,
+            "hot_path_per_second": 20
+        }
+        for key in settings:
+            settings[key] = self.get("logging", key, settings[key])
+        return settings
+    
     def get_log_level(self) -> str:
         """📝 ดึง log level"""
         return self.get("logging", "level", "INFO")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📥 Frame Decoder สำหรับฝั่งรับข้อมูลของ Broker
+============================================
+
+TCP ไม่รับประกันว่าการ recv หนึ่งครั้งจะได้ข้อความหนึ่งข้อความพอดี
+บางครั้งหลายข้อความมาติดกัน บางครั้งข้อความเดียวถูกตัดเป็นหลายท่อน
+module นี้จึงเก็บข้อมูลไว้ใน buffer แล้วตัดเป็น frame ที่สมบูรณ์เท่านั้น
+
+- ReceiveBuffer: bytearray ที่ใช้ซ้ำได้ อ่านลงได้โดยตรงด้วย recv_into
+  หรือ get_buffer() / buffer_updated() ของ asyncio.BufferedProtocol
+- LineFrameDecoder: ตัด JSON-line ด้วย '\\n' ทีละ batch
+  (หา newline จากตำแหน่งที่ค้างไว้ ไม่สแกนข้อมูลเดิมซ้ำ และ decode UTF-8 ครั้งเดียวต่อ frame)
+"""
+
+DEFAULT_READ_SIZE = 65536
+DEFAULT_MAX_FRAME_SIZE = 1024 * 1024
+
+
+class FrameTooLargeError(Exception):
+    """❌ frame ใหญ่เกินขนาดที่ยอมรับ"""
+
+
+class ReceiveBuffer:
+    """
+    📦 buffer รับข้อมูลที่ใช้ซ้ำได้
+
+    ข้อมูลที่ยังไม่ได้ใช้อยู่ระหว่าง start ถึง end
+    พื้นที่ว่างหลัง end ใช้รับข้อมูลชุดต่อไป
+
+    Args:
+        read_size (int): พื้นที่ว่างขั้นต่ำที่เตรียมไว้สำหรับการอ่านแต่ละครั้ง
+    """
+
+    def __init__(self, read_size=DEFAULT_READ_SIZE):
+        self.read_size = read_size
+        self.buffer = bytearray(read_size * 2)
+        self.start = 0   # ตำแหน่งเริ่มของข้อมูลที่ยังไม่ได้ parse
+        self.end = 0     # ตำแหน่งสิ้นสุดของข้อมูลที่อ่านมาแล้ว
+
+    def get_buffer(self, sizehint=-1):
+        """📥 คืน memoryview ของพื้นที่ว่างท้าย buffer สำหรับเขียนข้อมูลใหม่"""
+        want = max(self.read_size, sizehint)
+        if len(self.buffer) - self.end < want:
+            self._make_room(want)
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """✍️ แจ้งว่าเขียนข้อมูลลง buffer แล้ว nbytes byte"""
+        self.end += nbytes
+
+    def recv_into(self, sock):
+        """🔌 อ่านจาก socket ลง buffer โดยตรง คืนค่าจำนวน byte (0 = ปิด connection)"""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.end += nbytes
+        return nbytes
+
+    def feed(self, data):
+        """📨 ใส่ข้อมูลที่ได้มาเป็น bytes"""
+        view = self.get_buffer(len(data))
+        view[:len(data)] = data
+        self.end += len(data)
+
+    def _make_room(self, want):
+        pending = self.end - self.start
+        size = len(self.buffer)
+        if pending + want > size:
+            # ขยาย buffer (frame ใหญ่กว่าพื้นที่ที่มี)
+            while pending + want > size:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        else:
+            # ย้ายข้อมูลที่เหลือไปไว้ต้น buffer
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self._shifted(self.start)
+        self.start = 0
+        self.end = pending
+
+    def _shifted(self, offset):
+        """🔁 เรียกเมื่อข้อมูลถูกย้ายไปต้น buffer (ให้ subclass ปรับตำแหน่งที่จำไว้)"""
+
+    def _consumed(self, start):
+        """✅ บันทึกว่าใช้ข้อมูลถึงตำแหน่ง start แล้ว"""
+        if start == self.end:
+            self.start = self.end = 0
+        else:
+            self.start = start
+
+
+class LineFrameDecoder(ReceiveBuffer):
+    """
+    📨 ตัดข้อมูลเป็นบรรทัด (JSON-line)
+
+    ใช้เหมือน MQTTStreamDecoder: อ่านข้อมูลลง buffer แล้วเรียก decode()
+    ซึ่งคืนทุกบรรทัดที่ครบแล้วในครั้งเดียว
+
+    Args:
+        read_size (int): พื้นที่ว่างขั้นต่ำที่เตรียมไว้สำหรับการอ่านแต่ละครั้ง
+        max_frame_size (int): ความยาวสูงสุดของหนึ่งบรรทัด
+    """
+
+    def __init__(self, read_size=DEFAULT_READ_SIZE, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        super().__init__(read_size)
+        self.max_frame_size = max_frame_size
+        self.scanned = 0  # ตำแหน่งที่หา newline ไปแล้ว (ไม่ต้องหาซ้ำเมื่อมีข้อมูลเพิ่ม)
+
+    def _shifted(self, offset):
+        self.scanned -= offset
+
+    def decode(self):
+        """
+        🔍 ตัดบรรทัดที่ครบแล้วทั้งหมด (ข้ามบรรทัดว่าง)
+
+        Returns:
+            list: ข้อความแต่ละบรรทัดเป็น str
+        """
+        buffer = self.buffer
+        start = self.start
+        end = self.end
+        frames = []
+
+        newline = buffer.find(b'\n', max(self.scanned, start), end)
+        if newline >= 0:
+            with memoryview(buffer) as view:
+                while newline >= 0:
+                    if newline > start:
+                        frame = str(view[start:newline], 'utf-8', 'replace')
+                        if not frame.isspace():
+                            frames.append(frame)
+                    start = newline + 1
+                    newline = buffer.find(b'\n', start, end)
+
+        if end - start > self.max_frame_size:
+            raise FrameTooLargeError(f"บรรทัดยาวเกิน {self.max_frame_size} byte")
+
+        self._consumed(start)
+        self.scanned = self.end
+        return frames
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⏱️ Latency ของข้อความภายใน Broker
+=================================
+
+วัดว่าข้อความหนึ่งอยู่ใน broker นานเท่าไรตั้งแต่ recv() ได้ byte ของมันมา (ingress)
+จนถึงแต่ละขั้น บันทึกลง histogram แบบ log-bucket (แบบเดียวกับ HdrHistogram)
+
+ขั้นที่วัด (ทุกขั้นนับจากเวลา ingress เดียวกัน):
+- parse    แยก frame และถอดข้อความเสร็จ
+- route    หา subscriber จาก trie เสร็จ
+- enqueue  ใส่ข้อความลงคิวขาออกของ subscriber ครบทุกคน
+- write    frame ถูกเขียนลง socket ของ subscriber แล้ว (บันทึกต่อผู้รับ)
+
+- ปิดอยู่ (enabled = False) มีต้นทุนแค่ตรวจ flag ต่อการอ่านหนึ่งครั้ง เปิด/ปิดได้ระหว่างทำงาน
+- วัดหนึ่งใน sample_every ข้อความ (การบันทึกครบทุกขั้นใช้เวลาไม่กี่ µs ใน CPython
+  การสุ่มตัวอย่างทำให้ต้นทุนเฉลี่ยต่อข้อความเหลือไม่กี่ร้อย ns โดย percentile ยังไม่เอนเอียง)
+- histogram ไม่ใช้ lock: การนับที่ชนกันระหว่าง thread อาจหายบ้างเล็กน้อย (พอสำหรับสถิติ)
+- แยก histogram ตาม prefix ของ topic ได้ (topic_prefix_levels ระดับแรก จำนวน prefix จำกัดที่ max_prefixes)
+"""
+
+import math
+import threading
+import time
+
+# 📊 ขั้นของข้อความที่วัด (เรียงตามลำดับที่เกิด)
+STAGES = ('parse', 'route', 'enqueue', 'write')
+
+# 🎯 percentile ที่แสดงใน stats และ /metrics
+QUANTILES = (0.5, 0.99, 0.999)
+
+# bucket ละเอียด 1/16 ต่อช่วงเท่าตัว (ผิดพลาดไม่เกิน ~6%) ครอบคลุมถึง ~2^40 ns (~18 นาที)
+_SUB_BITS = 5
+_HALF = 1 << (_SUB_BITS - 1)
+_MAX_MAGNITUDE = 40 - _SUB_BITS
+_BUCKETS = (_MAX_MAGNITUDE + 2) * _HALF
+
+OTHER_PREFIX = '(other)'
+
+perf_counter_ns = time.perf_counter_ns
+
+
+def _bucket_upper(index):
+    """📏 ค่าสูงสุดที่อยู่ใน bucket (ns)"""
+    if index < (1 << _SUB_BITS):
+        return index
+    magnitude = (index >> (_SUB_BITS - 1)) - 1
+    sub = index - (magnitude << (_SUB_BITS - 1))
+    return ((sub + 1) << magnitude) - 1
+
+
+class LatencyHistogram:
+    """📊 histogram ของเวลา (ns) แบบ log-bucket ความละเอียดคงที่ตามสัดส่วนของค่า"""
+
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * _BUCKETS
+        self.total = 0              # ผลรวมของทุกค่า (ns)
+
+    def record(self, value):
+        """➕ บันทึกค่าหนึ่งค่า (ns)"""
+        if value < (1 << _SUB_BITS):
+            index = value if value > 0 else 0
+        else:
+            magnitude = value.bit_length() - _SUB_BITS
+            index = ((magnitude << (_SUB_BITS - 1)) + (value >> magnitude)
+                     if magnitude <= _MAX_MAGNITUDE else _BUCKETS - 1)
+        self.counts[index] += 1
+        self.total += value
+
+    def merge(self, other):
+        """🔗 รวมค่าของ histogram อื่นเข้ามา"""
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.total += other.total
+
+    def count(self):
+        """📊 จำนวนค่าที่บันทึกไว้"""
+        return sum(self.counts)
+
+    def percentiles(self, quantiles=QUANTILES):
+        """
+        🎯 ค่าที่ percentile ต่างๆ (ขอบบนของ bucket หน่วย ns)
+
+        Returns:
+            list: ค่าตามลำดับของ quantiles (0 ถ้ายังไม่มีข้อมูล)
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return [0] * len(quantiles)
+        targets = [max(1, math.ceil(q * total)) for q in quantiles]
+        results = []
+        running = 0
+        index = 0
+        for target in targets:
+            while running + counts[index] < target and index < _BUCKETS - 1:
+                running += counts[index]
+                index += 1
+            results.append(_bucket_upper(index))
+        return results
+
+    def reset(self):
+        """🗑️ ล้างค่า"""
+        self.counts = [0] * _BUCKETS
+        self.total = 0
+
+
+class LatencyGroup:
+    """📦 histogram ของทุกขั้น สำหรับ prefix ของ topic หนึ่งค่า"""
+
+    __slots__ = ('prefix',) + STAGES
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        for stage in STAGES:
+            setattr(self, stage, LatencyHistogram())
+
+
+class LatencyTrace:
+    """
+    🧾 เวลา ingress ของ publish หนึ่งข้อความ ส่งต่อไปตามขั้นต่างๆ จนถึงตัวเขียน socket
+
+    Args:
+        start (int): เวลา ingress (perf_counter_ns)
+        group (LatencyGroup): histogram ที่ใช้บันทึก
+    """
+
+    __slots__ = ('start', 'group')
+
+    def __init__(self, start, group):
+        self.start = start
+        self.group = group
+
+    def parsed(self):
+        self.group.parse.record(perf_counter_ns() - self.start)
+
+    def routed(self):
+        self.group.route.record(perf_counter_ns() - self.start)
+
+    def enqueued(self):
+        self.group.enqueue.record(perf_counter_ns() - self.start)
+
+    def written(self, now):
+        """✍️ เขียนลง socket แล้ว (now = perf_counter_ns() หลังเขียน batch เสร็จ)"""
+        self.group.write.record(now - self.start)
+
+
+class LatencyTracker:
+    """
+    ⏱️ ตัววัด latency ของ listener หนึ่งตัว
+
+    ตัวอ่านข้อมูลเรียก received() หลัง recv() ได้ข้อมูล และ finished() หลังประมวลผลเสร็จ
+    (เวลา ingress เก็บต่อ thread) ตัวจัดการ publish เรียก begin() เพื่อเริ่ม trace ของข้อความ
+
+    Args:
+        listener (str): ชื่อ listener (host:port) ใช้เป็น label
+        enabled (bool): เริ่มวัดทันที
+        prefix_levels (int): แยก histogram ตาม topic กี่ระดับแรก (0 = ไม่แยก)
+        max_prefixes (int): จำนวน prefix สูงสุด (เกินแล้วรวมเป็น '(other)')
+        sample_every (int): วัดหนึ่งใน N ข้อความ (1 = ทุกข้อความ)
+    """
+
+    def __init__(self, listener, enabled=False, prefix_levels=0, max_prefixes=64, sample_every=1):
+        self.listener = listener
+        self.enabled = enabled
+        self.sample_every = max(1, sample_every)
+        self.countdown = 1          # ไม่ใช้ lock: นับชนกันระหว่าง thread แค่ทำให้ระยะห่างของตัวอย่างคลาดไปเล็กน้อย
+        self.prefix_levels = prefix_levels
+        self.max_prefixes = max_prefixes
+        self.groups = {'': LatencyGroup('')}
+        self.default = self.groups['']
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def set_enabled(self, enabled):
+        """🔀 เปิด/ปิดการวัดระหว่างทำงาน (trace ที่เริ่มไปแล้วยังบันทึกจนจบ)"""
+        self.enabled = enabled
+
+    def received(self):
+        """📥 จำเวลา ingress ของข้อมูลที่เพิ่งอ่านได้ (thread นี้)"""
+        self._local.start = perf_counter_ns() if self.enabled else 0
+
+    def finished(self):
+        """🧹 ประมวลผลข้อมูลชุดนี้เสร็จ (publish ที่เกิดทีหลัง เช่น will ไม่ใช้เวลาเดิม)"""
+        self._local.start = 0
+
+    def begin(self, topic):
+        """
+        🧾 เริ่ม trace ของ publish ที่กำลังประมวลผล
+
+        Returns:
+            LatencyTrace: None ถ้าปิดอยู่ ไม่ใช่ตัวอย่างที่สุ่มได้ หรือ publish นี้ไม่ได้มาจากการอ่านของ thread นี้
+        """
+        if not self.enabled:
+            return None
+        countdown = self.countdown - 1
+        if countdown > 0:
+            self.countdown = countdown
+            return None
+        self.countdown = self.sample_every
+        start = getattr(self._local, 'start', 0)
+        if not start:
+            return None
+        if not self.prefix_levels:
+            return LatencyTrace(start, self.default)
+        prefix = '/'.join(topic.split('/', self.prefix_levels)[:self.prefix_levels])
+        group = self.groups.get(prefix)
+        if group is None:
+            group = self._add_group(prefix)
+        return LatencyTrace(start, group)
+
+    def _add_group(self, prefix):
+        """➕ สร้าง histogram ของ prefix ใหม่ (เกิน max_prefixes แล้วใช้ '(other)')"""
+        with self.lock:
+            group = self.groups.get(prefix)
+            if group is None:
+                if len(self.groups) > self.max_prefixes:
+                    prefix = OTHER_PREFIX
+                    group = self.groups.get(prefix)
+                if group is None:
+                    # เขียน dict ใหม่ทั้งก้อน ผู้อ่านที่ไม่ถือ lock จึงไม่เห็น dict ที่กำลังเปลี่ยน
+                    groups = dict(self.groups)
+                    group = groups[prefix] = LatencyGroup(prefix)
+                    self.groups = groups
+            return group
+
+    def reset(self):
+        """🗑️ ล้างค่าทั้งหมด"""
+        with self.lock:
+            for group in self.groups.values():
+                for stage in STAGES:
+                    getattr(group, stage).reset()
+
+    def snapshot(self, per_prefix=False):
+        """
+        📸 percentile ของแต่ละขั้น
+
+        Args:
+            per_prefix (bool): แยกตาม prefix (False = รวมทุก prefix)
+
+        Returns:
+            dict: (prefix, stage) -> {'quantiles': [ns ...], 'sum': ns, 'count': จำนวนตัวอย่าง}
+        """
+        groups = list(self.groups.values())
+        result = {}
+        for stage in STAGES:
+            if per_prefix:
+                histograms = [(group.prefix, getattr(group, stage)) for group in groups]
+            else:
+                merged = LatencyHistogram()
+                for group in groups:
+                    merged.merge(getattr(group, stage))
+                histograms = [('', merged)]
+            for prefix, histogram in histograms:
+                count = histogram.count()
+                if per_prefix and not count:
+                    continue
+                result[(prefix, stage)] = {
+                    'quantiles': histogram.percentiles(),
+                    'sum': histogram.total,
+                    'count': count
+                }
+        return result
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📝 ระบบ Log แบบไม่ block (Queue-based Logging)
+=============================================
+
+thread ที่รับส่งข้อความของ broker ไม่เขียน log ลง console หรือไฟล์เอง
+แค่ใส่ LogRecord ลงคิวแล้วทำงานต่อ thread เขียน log (QueueListener) หนึ่งตัวเป็นคนเขียนจริง
+ความเร็วของ broker จึงไม่ขึ้นกับความเร็วของดิสก์หรือ terminal
+
+- คิวมีขนาดจำกัด: ถ้า thread เขียน log ตามไม่ทัน record ใหม่ถูกทิ้ง (นับไว้ใน dropped) แทนการรอ
+- ข้อความ log ถูก format (รวม args แบบ %s) ใน thread เขียน log ไม่ใช่ใน thread ที่เรียก
+- ไฟล์ log หมุนเวียนตามขนาด (RotatingFileHandler) เก็บไฟล์เก่าไว้ backup_count ไฟล์
+- RateLimitedLog จำกัดจำนวน log ต่อวินาทีของเหตุการณ์ที่เกิดถี่ (เช่น publish ทุกข้อความ)
+"""
+
+import logging
+import logging.handlers
+import queue
+import re
+import time
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+def parse_size(value):
+    """
+    📏 แปลงขนาดไฟล์ ('10MB', '512KB', 1048576) เป็นจำนวน byte
+
+    Returns:
+        int: จำนวน byte (0 = ไม่จำกัด)
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*', str(value).upper())
+    if not match:
+        raise ValueError(f"ขนาดไม่ถูกต้อง: {value!r}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def file_handler(path, max_bytes=0, backup_count=0):
+    """💾 handler เขียนไฟล์ log (max_bytes > 0 = หมุนไฟล์เมื่อเกินขนาด เก็บไฟล์เก่า backup_count ไฟล์)"""
+    return logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """📥 QueueHandler ที่ไม่ block และไม่ format ใน thread ที่เรียก (คิวเต็มแล้วทิ้ง record)"""
+
+    def __init__(self, log_queue, max_size):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0            # นับแบบประมาณ (ไม่ใช้ lock) พอสำหรับสถิติ
+
+    def prepare(self, record):
+        # record อยู่ใน process เดียวกัน ไม่ต้อง format หรือตัด exc_info แบบ QueueHandler ปกติ
+        return record
+
+    def enqueue(self, record):
+        if self.max_size and self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class LogPipeline:
+    """
+    🧵 ต่อ logger เข้ากับคิวและ thread เขียน log
+
+    Args:
+        handlers (list): handler ที่เขียนจริง (console / ไฟล์) ใช้ formatter และ level ของแต่ละตัว
+        queue_size (int): จำนวน record สูงสุดที่รอเขียน (0 = ไม่จำกัด)
+    """
+
+    def __init__(self, handlers, queue_size=10000):
+        self.handlers = handlers
+        # SimpleQueue ไม่มี lock ฝั่ง put จึงยังใช้ได้ใน process ที่ fork มาระหว่างที่ thread เขียน log รออยู่
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = BoundedQueueHandler(self.queue, queue_size)
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *handlers, respect_handler_level=True
+        )
+        self.logger = None
+
+    def install(self, logger):
+        """
+        🔌 แทน handler เดิมของ logger ด้วยคิว แล้วเริ่ม thread เขียน log
+
+        Args:
+            logger (logging.Logger): logger ที่จะส่ง record เข้าคิว
+        """
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(self.queue_handler)
+        self.logger = logger
+        self.listener.start()
+        return self
+
+    def stop(self):
+        """🛑 เขียน record ที่ค้างในคิวให้หมด หยุด thread และปิดไฟล์"""
+        if self.logger is None:
+            return
+        self.logger.removeHandler(self.queue_handler)
+        self.logger = None
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+    def stats(self):
+        """📊 record ที่รอเขียนและที่ทิ้งไปเพราะคิวเต็ม"""
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': self.queue_handler.dropped
+        }
+
+
+class RateLimitedLog:
+    """
+    🚦 log ของเหตุการณ์ที่เกิดถี่ จำกัดไม่เกิน per_second ครั้งต่อวินาที
+
+    ถ้า level ของ logger ปิดอยู่จะไม่มีการ format เลย ส่วนที่ถูกข้ามนับไว้
+    และบอกจำนวนต่อท้าย log ถัดไปที่ผ่าน เช่น "... (ข้าม 1234 รายการ)"
+
+    Args:
+        logger (logging.Logger): logger ที่ใช้เขียน
+        per_second (int): จำนวน log สูงสุดต่อวินาที (0 = ไม่จำกัด)
+        level (int): level ของ log
+    """
+
+    def __init__(self, logger, per_second, level=logging.INFO):
+        self.logger = logger
+        self.per_second = per_second
+        self.level = level
+        self.window_end = 0.0
+        self.count = 0
+        self.pending = 0            # ที่ถูกข้ามตั้งแต่ log ล่าสุดที่ผ่าน
+        self.suppressed = 0         # ที่ถูกข้ามทั้งหมด (นับแบบประมาณ ไม่ใช้ lock)
+
+    def log(self, msg, *args):
+        """
+        📝 เขียน log ถ้ายังไม่เกินโควตาของวินาทีนี้
+
+        Args:
+            msg (str): ข้อความแบบ %-format (format ใน thread เขียน log เมื่อผ่านเท่านั้น)
+            *args: ค่าที่ใส่ใน msg
+        """
+        if not self.logger.isEnabledFor(self.level):
+            return
+        if self.per_second:
+            now = time.monotonic()
+            if now >= self.window_end:
+                self.window_end = now + 1.0
+                self.count = 0
+            if self.count >= self.per_second:
+                self.pending += 1
+                self.suppressed += 1
+                return
+            self.count += 1
+            if self.pending:
+                skipped, self.pending = self.pending, 0
+                self.logger.log(self.level, msg + " (ข้าม %d รายการ)", *args, skipped)
+                return
+        self.logger.log(self.level, msg, *args)
@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📒 Log ของข้อความแบบ Append-only (Durable Publish)
+===============================================
+
+ทุก publish ที่ broker รับจะถูกเขียนต่อท้าย log ก่อนส่งให้ subscriber
+เมื่อ broker ตายกลางทาง ข้อความที่รับไปแล้วจึงยังอยู่ในดิสก์
+
+- log แบ่งเป็น segment ชื่อ '<offset แรก 20 หลัก>.log' เมื่อ segment เต็มจะเปิดไฟล์ใหม่
+- แต่ละ record มี crc32 ตอนเริ่มจะตรวจ segment ล่าสุดแล้วตัด record ที่เขียนไม่ครบทิ้ง
+- offset ของข้อความเพิ่มทีละหนึ่งต่อเนื่องข้าม segment
+- group commit: thread เดียวเรียก fsync ครั้งเดียวต่อ batch ของข้อความที่เขียนระหว่างนั้น
+  * mode 'sync'  - ส่งข้อความให้ subscriber (callback on_durable) หลัง fsync แล้วเท่านั้น
+  * mode 'async' - ส่งทันที แล้ว fsync ตามรอบ (อาจเสียข้อความไม่เกิน fsync_interval_ms ล่าสุด)
+  fsync_interval_ms คือเวลารอรวม batch: มาก = fsync น้อยครั้ง แต่ข้อความรอนานขึ้น
+- segment เก่าถูกลบเมื่อขนาดรวมเกิน retention_bytes หรืออายุเกิน retention_hours
+- index แบบ sparse (offset, ตำแหน่งในไฟล์, เวลา) ทุกประมาณ 4 KB ของแต่ละ segment
+  ใช้หาตำแหน่งเริ่มอ่านจาก offset หรือเวลาได้โดยไม่ต้องอ่านทั้ง segment
+  และชุดของ topic ใน segment: อ่านตาม topic filter จะข้าม segment ที่ไม่มี topic ที่ตรงทั้งไฟล์
+
+รูปแบบ record:
+    ความยาวทั้ง record (u32) | crc32 ของส่วนที่เหลือ (u32) | offset (u64) | เวลา (f64)
+    | ความยาว topic (u16) | ความยาว client id (u16) | topic | client id | payload (JSON)
+    payload แบบ bytes (MQTT) เก็บเป็น byte 0x00 ตามด้วยข้อมูลดิบ (JSON ไม่มีทางขึ้นต้นด้วย 0x00)
+"""
+
+import base64
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+
+from topic_trie import topic_matches
+
+logger = logging.getLogger(__name__)
+
+_RECORD = struct.Struct('<IIQdHH')
+_CRC_START = 8                      # crc ครอบคลุมตั้งแต่ field offset เป็นต้นไป
+_SUFFIX = '.log'
+_INDEX_INTERVAL = 4096
+_RETENTION_CHECK_INTERVAL = 60
+_RAW_PAYLOAD = b'\x00'
+_BYTES_KEY = '$bytes'
+
+MODES = ('sync', 'async')
+
+
+class LogCorruptionError(Exception):
+    """❌ record ในไฟล์ log เสีย (เขียนไม่ครบหรือข้อมูลไม่ตรงกับ crc)"""
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {_BYTES_KEY: base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"แปลง {type(value).__name__} เป็น JSON ไม่ได้")
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and _BYTES_KEY in obj:
+        return base64.b64decode(obj[_BYTES_KEY])
+    return obj
+
+
+def dump_json(value):
+    """📦 แปลงข้อมูลเป็น JSON (bytes) โดย bytes ข้างในเก็บเป็น {"$bytes": base64} จึงอ่านกลับได้ครบ"""
+    return json.dumps(value, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+
+def load_json(data):
+    """📖 อ่าน JSON ที่เขียนด้วย dump_json() (ได้ bytes กลับมาตามเดิม)"""
+    return json.loads(data, object_hook=_json_object_hook)
+
+
+def encode_body(topic, client_id, payload):
+    """📦 แปลง topic, client id และ payload เป็น bytes (ทำนอก lock ได้)"""
+    if isinstance(payload, (bytes, bytearray)):
+        payload_bytes = _RAW_PAYLOAD + payload
+    else:
+        payload_bytes = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return topic.encode('utf-8'), (client_id or '').encode('utf-8'), payload_bytes
+
+
+def encode_record(offset, timestamp, topic, client_id, payload, body=None):
+    """📦 แปลงข้อความเป็น record หนึ่งตัว (bytes) body = ผลของ encode_body() ถ้าแปลงไว้แล้ว"""
+    topic_bytes, client_bytes, payload_bytes = body or encode_body(topic, client_id, payload)
+    length = _RECORD.size + len(topic_bytes) + len(client_bytes) + len(payload_bytes)
+    header = _RECORD.pack(length, 0, offset, timestamp, len(topic_bytes), len(client_bytes))
+    body = header[_CRC_START:] + topic_bytes + client_bytes + payload_bytes
+    return struct.pack('<II', length, zlib.crc32(body)) + body
+
+
+def decode_record(data, position=0):
+    """
+    📖 อ่าน record หนึ่งตัวจาก data
+
+    Returns:
+        tuple: (offset, timestamp, topic, client_id, payload, ความยาว record)
+
+    Raises:
+        LogCorruptionError: ถ้าข้อมูลไม่ครบหรือ crc ไม่ตรง
+    """
+    if position + _RECORD.size > len(data):
+        raise LogCorruptionError("header ไม่ครบ")
+    length, crc, offset, timestamp, topic_length, client_length = _RECORD.unpack_from(data, position)
+    end = position + length
+    if length < _RECORD.size + topic_length + client_length or end > len(data):
+        raise LogCorruptionError("ความยาว record ไม่ถูกต้อง")
+    if zlib.crc32(memoryview(data)[position + _CRC_START:end]) != crc:
+        raise LogCorruptionError("crc ไม่ตรง")
+    start = position + _RECORD.size
+    topic = bytes(data[start:start + topic_length]).decode('utf-8')
+    start += topic_length
+    client_id = bytes(data[start:start + client_length]).decode('utf-8')
+    start += client_length
+    if data[start:start + 1] == _RAW_PAYLOAD:
+        payload = bytes(data[start + 1:end])
+    else:
+        payload = json.loads(bytes(data[start:end]))
+    return offset, timestamp, topic, client_id, payload, length
+
+
+class _Segment:
+    """📄 หนึ่งไฟล์ของ log พร้อม sparse index"""
+
+    __slots__ = ('base', 'path', 'size', 'next_offset', 'offsets', 'positions', 'times',
+                 'topics', 'first_time', 'indexed', 'last_indexed')
+
+    def __init__(self, base, path):
+        self.base = base
+        self.path = path
+        self.size = 0
+        self.next_offset = base
+        self.offsets = array('Q')
+        self.positions = array('Q')
+        self.times = array('d')
+        self.topics = set()
+        self.first_time = None      # เวลาของ record แรก (None = ยังว่าง)
+        self.indexed = False        # segment ที่ปิดแล้วจะสร้าง index ตอนอ่านครั้งแรก
+        self.last_indexed = -_INDEX_INTERVAL
+
+    def add_index(self, offset, position, timestamp):
+        if position - self.last_indexed >= _INDEX_INTERVAL:
+            self.offsets.append(offset)
+            self.positions.append(position)
+            self.times.append(timestamp)
+            self.last_indexed = position
+
+    def position_for_offset(self, offset):
+        """📍 ตำแหน่งเริ่มอ่านที่ไม่เกิน offset นี้"""
+        index = bisect_right(self.offsets, offset) - 1
+        return self.positions[index] if index >= 0 else 0
+
+    def position_for_time(self, timestamp):
+        """📍 ตำแหน่งเริ่มอ่านก่อนเวลานี้ (เวลาในหนึ่ง segment เรียงตามลำดับการเขียน)"""
+        index = bisect_right(self.times, timestamp) - 1
+        return self.positions[index] if index >= 0 else 0
+
+    def may_contain(self, topic_filter):
+        """🔎 segment นี้อาจมี topic ที่ตรงกับ filter ไหม (ยังไม่มี index = อาจมี)"""
+        if not self.indexed:
+            return True
+        return any(topic_matches(topic_filter, topic) for topic in self.topics)
+
+
+class MessageLog:
+    """
+    📒 log ของข้อความแบบ append-only แบ่ง segment
+
+    Args:
+        directory (str): โฟลเดอร์เก็บ segment
+        mode (str): 'sync' (ส่งต่อหลัง fsync) หรือ 'async' (ส่งทันที fsync ตามรอบ)
+        fsync_interval_ms (float): เวลารอรวม batch ก่อน fsync แต่ละครั้ง
+        segment_bytes (int): ขนาดสูงสุดของแต่ละ segment
+        retention_bytes (int): ขนาดรวมสูงสุดของทุก segment (0 = ไม่จำกัด)
+        retention_hours (float): อายุสูงสุดของ segment ที่ปิดแล้ว (0 = ไม่จำกัด)
+    """
+
+    def __init__(self, directory, mode='sync', fsync_interval_ms=5, segment_bytes=64 * 1024 * 1024,
+                 retention_bytes=0, retention_hours=0):
+        if mode not in MODES:
+            raise ValueError(f"durability mode ต้องเป็นหนึ่งใน {MODES}")
+        self.directory = directory
+        self.mode = mode
+        self.fsync_interval = fsync_interval_ms / 1000.0
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_hours * 3600
+
+        self.condition = threading.Condition()
+        self.segments = []
+        self.file = None
+        self.waiting = []           # callback ที่รอ fsync (mode sync)
+        self.unsynced = False
+        self.closed = False
+        self.synced_offset = -1     # offset สุดท้ายที่ fsync แล้ว
+
+        # 📊 สถิติ
+        self.appended = 0
+        self.fsyncs = 0
+        self.synced_records = 0
+        self.deleted_segments = 0
+        self.recovered_bytes = 0    # ขนาดข้อมูลที่ตัดทิ้งตอนกู้คืน
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self.enforce_retention()
+
+        self.flusher = threading.Thread(target=self._flush_loop, name='message-log-fsync')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    # ========================================
+    # 🩺 กู้คืนตอนเริ่ม
+    # ========================================
+
+    def _segment_path(self, base):
+        return os.path.join(self.directory, f'{base:020d}{_SUFFIX}')
+
+    def _recover(self):
+        """🩺 โหลดรายการ segment ตรวจ segment ล่าสุด และตัด record ที่เสียทิ้ง"""
+        bases = sorted(
+            int(name[:-len(_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit()
+        )
+        for previous, base in zip(bases, bases[1:] + [None]):
+            segment = _Segment(previous, self._segment_path(previous))
+            segment.size = os.path.getsize(segment.path)
+            segment.next_offset = base if base is not None else previous
+            segment.first_time = self._read_first_time(segment.path)
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(_Segment(0, self._segment_path(0)))
+            open(self.segments[0].path, 'ab').close()
+
+        active = self.segments[-1]
+        self._index_segment(active, repair=True)
+        self.file = open(active.path, 'ab')
+        self.synced_offset = active.next_offset - 1
+
+    @staticmethod
+    def _read_first_time(path):
+        """🕒 เวลาของ record แรกใน segment (ใช้หา segment เริ่มต้นจากเวลาโดยไม่ต้องสร้าง index)"""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(_RECORD.size)
+        except OSError:
+            return None
+        if len(header) < _RECORD.size:
+            return None
+        return _RECORD.unpack(header)[3]
+
+    def _index_segment(self, segment, repair=False):
+        """
+        🗂️ อ่านทั้ง segment เพื่อสร้าง sparse index
+
+        Args:
+            repair (bool): ตัด record ที่เสียท้ายไฟล์ทิ้ง (ใช้กับ segment ล่าสุดตอนเริ่มเท่านั้น)
+        """
+        with open(segment.path, 'rb') as f:
+            data = f.read()
+        # สร้าง index ใหม่แยกไว้ก่อน (reader หลายตัวอาจสร้าง index ของ segment เดียวกันพร้อมกัน)
+        index = _Segment(segment.base, segment.path)
+        position = 0
+        expected = segment.base
+        while position < len(data):
+            try:
+                offset, timestamp, topic, _, _, length = decode_record(data, position)
+            except (LogCorruptionError, ValueError, UnicodeDecodeError):
+                offset = None
+            if offset != expected:
+                if repair:
+                    self.recovered_bytes += len(data) - position
+                    logger.warning(
+                        f"⚠️ log {os.path.basename(segment.path)} เสียที่ตำแหน่ง {position} "
+                        f"ตัดข้อมูลท้ายไฟล์ {len(data) - position} bytes"
+                    )
+                    with open(segment.path, 'r+b') as f:
+                        f.truncate(position)
+                        os.fsync(f.fileno())
+                break
+            index.add_index(offset, position, timestamp)
+            index.topics.add(topic)
+            position += length
+            expected += 1
+        segment.offsets, segment.positions, segment.times = index.offsets, index.positions, index.times
+        segment.last_indexed = index.last_indexed
+        segment.topics = index.topics
+        segment.first_time = index.times[0] if index.times else None
+        segment.size = position
+        segment.next_offset = expected
+        segment.indexed = True
+
+    # ========================================
+    # ✍️ เขียน
+    # ========================================
+
+    @property
+    def next_offset(self):
+        return self.segments[-1].next_offset
+
+    def append(self, topic, client_id, payload, timestamp=None, on_durable=None):
+        """
+        ➕ เขียนข้อความต่อท้าย log
+
+        Args:
+            topic (str): topic
+            client_id (str): ผู้ publish
+            payload: ข้อมูล (ต้องแปลงเป็น JSON ได้)
+            timestamp (float): เวลา (epoch วินาที) ไม่ระบุ = ตอนนี้
+            on_durable (Callable): on_durable(offset) เรียกเมื่อข้อความพร้อมส่งต่อ
+                (mode sync: หลัง fsync จาก thread ของ log, mode async: ทันที)
+
+        Returns:
+            int: offset ของข้อความ
+        """
+        body = encode_body(topic, client_id, payload)
+        with self.condition:
+            if self.closed:
+                raise ValueError("log ถูกปิดแล้ว")
+            # เวลาอ่านขณะถือ lock: เวลาใน log จึงเรียงตาม offset (ใช้ค้นหาจากเวลา)
+            timestamp = time.time() if timestamp is None else timestamp
+            segment = self.segments[-1]
+            if segment.size >= self.segment_bytes:
+                segment = self._roll()
+            offset = segment.next_offset
+            record = encode_record(offset, timestamp, topic, client_id, payload, body)
+            self.file.write(record)
+            if segment.first_time is None:
+                segment.first_time = timestamp
+            segment.add_index(offset, segment.size, timestamp)
+            segment.topics.add(topic)
+            segment.size += len(record)
+            segment.next_offset = offset + 1
+            self.appended += 1
+            if not self.unsynced:
+                self.unsynced = True
+                self.condition.notify()
+            if on_durable is not None and self.mode == 'sync':
+                self.waiting.append((on_durable, offset))
+                on_durable = None
+
+        if on_durable is not None:
+            on_durable(offset)
+        return offset
+
+    def _roll(self):
+        """📄 ปิด segment ปัจจุบัน (fsync) แล้วเปิด segment ใหม่ (เรียกขณะถือ lock)"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        base = self.segments[-1].next_offset
+        segment = _Segment(base, self._segment_path(base))
+        segment.indexed = True
+        self.segments.append(segment)
+        self.file = open(segment.path, 'ab')
+        # ทุกอย่างก่อน segment ใหม่ fsync แล้ว (callback ที่รออยู่ให้ flusher เรียกตามลำดับ)
+        self.synced_records += base - 1 - self.synced_offset
+        self.synced_offset = base - 1
+        self.fsyncs += 1
+        self._fsync_directory()
+        threading.Thread(target=self.enforce_retention, daemon=True).start()
+        return segment
+
+    def _fsync_directory(self):
+        """📁 fsync โฟลเดอร์เพื่อให้ไฟล์ segment ใหม่ไม่หายหลังเครื่องดับ (ไม่มีผลบน Windows)"""
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _flush_loop(self):
+        """🔁 group commit: รอให้มีข้อมูลใหม่ รอรวม batch แล้ว fsync ครั้งเดียว (และตรวจ retention เป็นระยะ)"""
+        next_retention = time.monotonic() + _RETENTION_CHECK_INTERVAL
+        while True:
+            with self.condition:
+                if not self.unsynced and not self.closed:
+                    self.condition.wait(timeout=max(0.0, next_retention - time.monotonic()))
+                if self.closed:
+                    return
+                pending = self.unsynced
+            if time.monotonic() >= next_retention:
+                # segment อาจหมดอายุโดยไม่มี segment ใหม่ถูกสร้าง (ข้อความน้อย)
+                self.enforce_retention()
+                next_retention = time.monotonic() + _RETENTION_CHECK_INTERVAL
+            if not pending:
+                continue
+            if self.fsync_interval:
+                time.sleep(self.fsync_interval)
+            self.sync()
+
+    def sync(self):
+        """💾 fsync ข้อมูลที่ค้างทั้งหมด แล้วเรียก callback ของข้อความเหล่านั้นตามลำดับ"""
+        with self.condition:
+            file = self.file
+            file.flush()
+            target = self.next_offset - 1
+            callbacks, self.waiting = self.waiting, []
+            self.unsynced = False
+        try:
+            os.fsync(file.fileno())
+        except (OSError, ValueError):
+            # segment ถูกปิดระหว่างนั้น (_roll fsync ให้แล้ว)
+            pass
+        with self.condition:
+            if target > self.synced_offset:
+                self.synced_records += target - self.synced_offset
+                self.synced_offset = target
+            self.fsyncs += 1
+
+        for callback, offset in callbacks:
+            try:
+                callback(offset)
+            except Exception as e:
+                logger.error(f"💥 เกิดข้อผิดพลาดหลังบันทึกข้อความลง log: {e}")
+
+    # ========================================
+    # 📖 อ่าน
+    # ========================================
+
+    def read(self, start_offset=0, start_time=None, topic_filter=None, block_size=1024 * 1024):
+        """
+        📖 อ่านข้อความตั้งแต่ offset (หรือเวลา) ที่กำหนดไปจนถึงข้อความล่าสุด ณ ตอนอ่านแต่ละ segment
+
+        ใช้ sparse index หาตำแหน่งเริ่มในไฟล์ ข้าม segment ที่ไม่มี topic ที่ตรงกับ filter
+        และอ่านทีละ block ไม่โหลดทั้ง segment (ถือ lock เฉพาะตอนดูรายการ segment)
+
+        Args:
+            start_offset (int): offset แรกที่ต้องการ (ถ้าถูกลบไปแล้วเริ่มจากข้อความเก่าสุดที่เหลือ)
+            start_time (float): เริ่มจากข้อความแรกที่เวลาไม่ก่อนนี้ (epoch วินาที) แทน start_offset
+            topic_filter (str): เอาเฉพาะ topic ที่ตรงกับ filter (รองรับ + และ #)
+
+        Yields:
+            tuple: (offset, timestamp, topic, client_id, payload)
+        """
+        offset = start_offset
+        if start_time is not None:
+            offset = self.offset_for_time(start_time)
+        while True:
+            with self.condition:
+                if offset >= self.next_offset:
+                    return
+                segment = self._segment_for(offset)
+                active = segment is self.segments[-1]
+                if active:
+                    self.file.flush()
+                end = segment.size
+            if not segment.indexed:
+                self._index_segment(segment)
+            if topic_filter is None or segment.may_contain(topic_filter):
+                position = segment.position_for_offset(offset)
+                for record in self._read_segment(segment, position, end, topic_filter, block_size):
+                    if record[0] >= offset:
+                        yield record
+            if active:
+                return
+            offset = max(offset, segment.next_offset)
+
+    def offset_for_time(self, timestamp):
+        """
+        🕒 offset ของข้อความแรกที่เวลาไม่ก่อน timestamp
+
+        Returns:
+            int: offset (next_offset ถ้าไม่มีข้อความหลังเวลานั้น)
+        """
+        with self.condition:
+            segments = [segment for segment in self.segments if segment.first_time is not None]
+            next_offset = self.next_offset
+        if not segments:
+            return next_offset
+        # segment สุดท้ายที่ record แรกไม่หลังเวลาที่ต้องการ (เวลาเรียงตาม offset)
+        index = max(bisect_right([segment.first_time for segment in segments], timestamp) - 1, 0)
+        for segment in segments[index:]:
+            with self.condition:
+                if segment is self.segments[-1]:
+                    self.file.flush()
+                end = segment.size
+            if not segment.indexed:
+                self._index_segment(segment)
+            position = segment.position_for_time(timestamp)
+            for record in self._read_segment(segment, position, end, None, 1024 * 1024):
+                if record[1] >= timestamp:
+                    return record[0]
+        return next_offset
+
+    def tail(self, count):
+        """📜 อ่าน count ข้อความล่าสุด (เท่าที่ยังเหลือหลัง retention)"""
+        return self.read(max(0, self.next_offset - count))
+
+    def _segment_for(self, offset):
+        """🔎 segment ที่มี offset นี้ (ถ้า offset ถูกลบไปแล้วใช้ segment เก่าสุดที่เหลือ)"""
+        bases = [segment.base for segment in self.segments]
+        index = bisect_right(bases, offset) - 1
+        return self.segments[max(index, 0)] if self.segments else None
+
+    @staticmethod
+    def _read_segment(segment, position, end, topic_filter, block_size):
+        """📖 อ่าน record ใน segment ตั้งแต่ position ถึง end ทีละ block (แปลง payload เฉพาะที่ตรง filter)"""
+        try:
+            f = open(segment.path, 'rb')
+        except FileNotFoundError:
+            return          # ถูกลบโดย retention ระหว่างอ่าน
+        with f:
+            f.seek(position)
+            buffer = b''
+            while position < end:
+                chunk = f.read(min(block_size, end - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                data = buffer + chunk
+                start = 0
+                while start + _RECORD.size <= len(data):
+                    length, _, _, _, topic_length, _ = _RECORD.unpack_from(data, start)
+                    if start + length > len(data):
+                        break
+                    if topic_filter is not None:
+                        topic_start = start + _RECORD.size
+                        topic = data[topic_start:topic_start + topic_length].decode('utf-8', errors='replace')
+                        if not topic_matches(topic_filter, topic):
+                            start += length
+                            continue
+                    offset, timestamp, topic, client_id, payload, length = decode_record(data, start)
+                    yield offset, timestamp, topic, client_id, payload
+                    start += length
+                buffer = data[start:]
+
+    # ========================================
+    # 🧹 Retention
+    # ========================================
+
+    def enforce_retention(self):
+        """🧹 ลบ segment เก่าที่ทำให้ขนาดรวมเกิน retention_bytes หรืออายุเกิน retention_hours"""
+        if not self.retention_bytes and not self.retention_seconds:
+            return
+        cutoff = time.time() - self.retention_seconds
+        with self.condition:
+            while len(self.segments) > 1:
+                oldest = self.segments[0]
+                total = sum(segment.size for segment in self.segments)
+                too_big = self.retention_bytes and total > self.retention_bytes
+                try:
+                    too_old = self.retention_seconds and os.path.getmtime(oldest.path) < cutoff
+                except OSError:
+                    too_old = True
+                if not (too_big or too_old):
+                    break
+                self.segments.pop(0)
+                try:
+                    os.remove(oldest.path)
+                except OSError as e:
+                    logger.warning(f"⚠️ ลบ segment {oldest.path} ไม่สำเร็จ: {e}")
+                self.deleted_segments += 1
+
+    # ========================================
+    # 📊 สถานะ
+    # ========================================
+
+    def stats(self):
+        """📊 จำนวน segment ขนาด offset และจำนวนข้อความต่อ fsync"""
+        with self.condition:
+            segments = len(self.segments)
+            size = sum(segment.size for segment in self.segments)
+            first = self.segments[0].base
+            next_offset = self.next_offset
+        return {
+            'mode': self.mode,
+            'segments': segments,
+            'bytes': size,
+            'first_offset': first,
+            'next_offset': next_offset,
+            'synced_offset': self.synced_offset,
+            'appended': self.appended,
+            'fsyncs': self.fsyncs,
+            'records_per_fsync': self.synced_records / self.fsyncs if self.fsyncs else 0.0,
+            'deleted_segments': self.deleted_segments
+        }
+
+    def close(self):
+        """🔒 fsync ข้อมูลที่ค้าง เรียก callback ที่รออยู่ แล้วปิดไฟล์"""
+        with self.condition:
+            if self.closed:
+                return
+        self.sync()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            self.file.close()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📈 Metrics แบบ Prometheus
+========================
+
+broker เปิด HTTP endpoint /metrics (text format 0.0.4) ให้ Prometheus มา scrape
+แทนการพิมพ์สถิติลง log เป็นระยะ
+
+- ทุก metric อ่านจากตัวนับที่ broker ปรับค่าอยู่แล้วระหว่างทำงาน (StatCounter, ตัวนับของแต่ละ shard)
+  การ scrape จึงไม่เดินดู client, topic หรือ subscription ทีละตัว และไม่แย่ง lock กับ hot path
+- Histogram แยก cell ต่อ thread เหมือน StatCounter: observe() ไม่ต้องใช้ lock
+- RateGauge คำนวณค่าต่อวินาทีจาก counter ทุกรอบ stats_interval (ดูได้โดยไม่ต้องใช้ rate() ของ Prometheus)
+- POST ไปยัง path ที่ลงทะเบียนด้วย add_action() ใช้สั่งงาน broker ระหว่างทำงาน (เช่น เปิด/ปิดการวัด latency)
+  ต้องส่ง 'Authorization: Bearer <token>' ที่ตรงกับ token หรือถ้าไม่ได้ตั้ง token รับเฉพาะจาก localhost
+"""
+
+import bisect
+import hmac
+import ipaddress
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 📊 bucket ของจำนวน subscriber ที่ได้รับต่อหนึ่ง publish
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def _format_value(value):
+    """🔢 ตัวเลขในรูปแบบของ Prometheus"""
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value))
+
+
+def _format_labels(labels):
+    """🏷️ {key="value",...} (escape \\, " และขึ้นบรรทัดใหม่ตามมาตรฐาน)"""
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class Histogram:
+    """
+    📊 histogram แบบ bucket คงที่ observe() ได้โดยไม่ต้องใช้ lock
+
+    แต่ละ thread มี cell ของตัวเอง ([จำนวนต่อ bucket ..., จำนวนที่เกิน bucket สุดท้าย, ผลรวม])
+    ค่ารวมคำนวณตอนอ่าน เหมือน StatCounter
+
+    Args:
+        buckets (tuple): ขอบบนของแต่ละ bucket เรียงจากน้อยไปมาก
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._local = threading.local()
+        self._cells = []            # (thread, cell)
+        self._retired = [0] * (len(self.buckets) + 1) + [0]
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """➕ บันทึกค่าหนึ่งค่า"""
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * (len(self.buckets) + 1) + [0]
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        """
+        📸 ค่าปัจจุบัน
+
+        Returns:
+            tuple: (จำนวนสะสมต่อ bucket รวม +Inf, ผลรวม, จำนวนทั้งหมด)
+        """
+        with self._lock:
+            total = list(self._retired)
+            alive = []
+            for thread, cell in self._cells:
+                for index, count in enumerate(cell):
+                    total[index] += count
+                if thread.is_alive():
+                    alive.append((thread, cell))
+                else:
+                    for index, count in enumerate(cell):
+                        self._retired[index] += count
+            self._cells = alive
+        cumulative = []
+        running = 0
+        for count in total[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, total[-1], running
+
+
+class RateGauge:
+    """
+    ⏱️ ค่าต่อวินาทีของ counter คำนวณจากผลต่างระหว่างการเรียก update() สองครั้ง
+
+    Args:
+        read (Callable): ฟังก์ชันที่คืนค่าปัจจุบันของ counter
+    """
+
+    def __init__(self, read):
+        self.read = read
+        self.last_value = read()
+        self.last_time = time.monotonic()
+        self.rate = 0.0
+
+    def update(self):
+        """🔄 คำนวณค่าต่อวินาทีตั้งแต่ครั้งก่อน (เรียกทุกรอบ stats_interval)"""
+        now = time.monotonic()
+        value = self.read()
+        elapsed = now - self.last_time
+        if elapsed > 0:
+            self.rate = (value - self.last_value) / elapsed
+        self.last_value = value
+        self.last_time = now
+
+
+class MetricsRegistry:
+    """
+    🗂️ รายการ metric ทั้งหมดของ broker
+
+    แต่ละ metric เก็บเป็นฟังก์ชันที่อ่านค่าตอน scrape คืนค่าเป็นตัวเลข
+    หรือ dict ของ (label, value) -> ค่า สำหรับ metric ที่มี label
+    """
+
+    def __init__(self):
+        self.metrics = []           # (name, type, help, read)
+        self.rates = []
+
+    def counter(self, name, help_text, read):
+        """🔢 ตัวนับที่เพิ่มขึ้นอย่างเดียว (ชื่อควรลงท้ายด้วย _total)"""
+        self.metrics.append((name, 'counter', help_text, read))
+
+    def gauge(self, name, help_text, read):
+        """📏 ค่าที่ขึ้นลงได้"""
+        self.metrics.append((name, 'gauge', help_text, read))
+
+    def histogram(self, name, help_text, histogram):
+        """📊 histogram (Histogram)"""
+        self.metrics.append((name, 'histogram', help_text, histogram))
+
+    def summary(self, name, help_text, read):
+        """
+        🎯 summary (percentile ที่คำนวณฝั่ง broker)
+
+        read คืน dict ของ (label, value) -> ([(quantile, ค่า), ...], ผลรวม, จำนวน)
+        """
+        self.metrics.append((name, 'summary', help_text, read))
+
+    def rate(self, name, help_text, read):
+        """⏱️ gauge ค่าต่อวินาทีของ counter (อัปเดตเมื่อเรียก update_rates())"""
+        rate = RateGauge(read)
+        self.rates.append(rate)
+        self.gauge(name, help_text, lambda: rate.rate)
+
+    def update_rates(self):
+        """🔄 คำนวณค่าต่อวินาทีของทุก RateGauge"""
+        for rate in self.rates:
+            rate.update()
+
+    def render(self):
+        """
+        📝 ค่าของทุก metric ใน Prometheus text format
+
+        Returns:
+            str: ข้อความสำหรับตอบ /metrics
+        """
+        lines = []
+        for name, kind, help_text, read in self.metrics:
+            try:
+                samples = self._samples(name, kind, read)
+            except Exception as e:
+                # metric หนึ่งตัวพังไม่ควรทำให้ทั้ง endpoint ใช้ไม่ได้
+                logger.warning(f"⚠️ อ่านค่า metric {name} ไม่ได้: {e}")
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def _samples(self, name, kind, read):
+        """📋 บรรทัดค่าของ metric หนึ่งตัว"""
+        if kind == 'histogram':
+            cumulative, total, count = read.snapshot()
+            samples = [
+                f'{name}_bucket{_format_labels({"le": _format_value(bound)})} {count_le}'
+                for bound, count_le in zip(read.buckets, cumulative)
+            ]
+            samples.append(f'{name}_bucket{{le="+Inf"}} {cumulative[-1]}')
+            samples.append(f'{name}_sum {_format_value(total)}')
+            samples.append(f'{name}_count {count}')
+            return samples
+
+        value = read()
+        if kind == 'summary':
+            samples = []
+            for labels, (quantiles, total, count) in value.items():
+                labels = dict(labels)
+                for quantile, sample in quantiles:
+                    quantile_labels = dict(labels, quantile=_format_value(float(quantile)))
+                    samples.append(f'{name}{_format_labels(quantile_labels)} {_format_value(sample)}')
+                samples.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                samples.append(f'{name}_count{_format_labels(labels)} {count}')
+            return samples
+        if isinstance(value, dict):
+            return [
+                f'{name}{_format_labels(dict(labels))} {_format_value(sample)}'
+                for labels, sample in value.items()
+            ]
+        return [f'{name} {_format_value(value)}']
+
+
+class MetricsServer:
+    """
+    🌐 HTTP server ของ endpoint /metrics (thread แยก ไม่เกี่ยวกับ engine ของ broker)
+
+    Args:
+        registry (MetricsRegistry): metric ที่จะตอบ
+        host (str): ที่อยู่ที่รอรับ
+        port (int): port (0 = ให้ระบบเลือก)
+        token (str): token ของคำสั่ง POST ('' = รับเฉพาะจาก localhost, None = ไม่ตรวจ)
+    """
+
+    def __init__(self, registry, host, port, token=None):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.token = token
+        self.server = None
+        self.thread = None
+        self.scrapes = 0
+        self.actions = {}           # path -> callback(params) ที่เรียกด้วย POST
+        self.lock = threading.Lock()
+
+    def add_action(self, path, callback):
+        """
+        🎛️ ลงทะเบียนคำสั่งที่เรียกด้วย POST (เช่น POST /latency?enabled=true)
+
+        Args:
+            path (str): path ของคำสั่ง
+            callback (Callable): รับ dict ของ query string คืนข้อความตอบกลับ (ValueError = 400)
+        """
+        self.actions[path] = callback
+
+    def authorized(self, client_host, authorization):
+        """
+        🔐 ผู้ส่ง POST นี้สั่งงานได้ไหม
+
+        Args:
+            client_host (str): ที่อยู่ของผู้ส่ง
+            authorization (str): ค่าของ header Authorization (None ถ้าไม่ได้ส่ง)
+        """
+        if self.token is None:
+            return True
+        if not self.token:
+            try:
+                return ipaddress.ip_address(client_host).is_loopback
+            except ValueError:
+                return False
+        scheme, _, supplied = (authorization or '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(supplied.strip().encode(), self.token.encode())
+
+    def start(self):
+        """
+        🚀 bind port แล้วเริ่มตอบ request ใน thread แยก
+
+        Returns:
+            int: port ที่ใช้จริง
+        """
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                metrics_server.scrapes += 1
+                body = metrics_server.registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                action = metrics_server.actions.get(url.path)
+                if action is None:
+                    self.send_error(404)
+                    return
+                if not metrics_server.authorized(self.client_address[0], self.headers.get('Authorization')):
+                    reason = 'token ไม่ถูกต้อง' if metrics_server.token else 'รับเฉพาะจาก localhost'
+                    logger.warning(f"⚠️ ปฏิเสธคำสั่ง POST {url.path} จาก {self.client_address[0]} ({reason})")
+                    self.send_error(401 if metrics_server.token else 403)
+                    return
+                try:
+                    status, body = 200, action(dict(parse_qsl(url.query)))
+                except ValueError as e:
+                    status, body = 400, f'{e}\n'
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"📈 metrics {self.address_string()} {format % args}")
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        """🛑 หยุดรับ request และปิด socket (เรียกซ้ำหรือเรียกพร้อมกันจากหลาย thread ได้)"""
+        # สลับออกใต้ lock ก่อนใช้: ผู้เรียกพร้อมกันคนอื่นจะได้ None และไม่ปิดซ้ำ
+        with self.lock:
+            server, self.server = self.server, None
+        if server is None:
+            return
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🔬 Profiling ระหว่างทำงาน (On-demand Profiling)
+=============================================
+
+เปิด/ปิด profiler ได้ขณะที่ broker ทำงานจริงโดยไม่ต้อง restart หรือต่อ debugger
+(ผ่าน signal หรือคำสั่ง admin ของ JSON-line) แล้วเขียนผลเป็นไฟล์ในโฟลเดอร์ที่กำหนด
+
+มี 3 แบบ:
+- cpu       cProfile ของ thread ที่ทำงานของ broker -> .pstats (เปิดด้วย pstats / snakeviz) และ .txt
+- sampling  ดู stack ของทุก thread ทุก sample_interval วินาที (wall-clock รวมเวลาที่รอ I/O)
+            -> .txt แบบ folded stack ใช้กับ flamegraph.pl หรือ speedscope ได้
+- memory    tracemalloc: หน่วยความจำที่จองหลังเริ่มวัดและยังไม่คืน แยกตามบรรทัด -> .txt
+
+ตอนปิดอยู่ไม่มี profiler, hook หรือ thread ใดทำงานเลย
+cProfile ของ Python 3.11 วัดได้เฉพาะ thread ที่เปิดมันเอง thread ที่อ่านข้อมูลจาก client
+จึงเทียบ reference ของรอบที่กำลังวัดหนึ่งครั้งต่อการอ่าน แล้วเรียก follow() เมื่อรอบเปลี่ยน
+"""
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+MODES = ('cpu', 'sampling', 'memory')
+
+
+class _StatsSnapshot:
+    """📸 ค่าของ Profile ที่อ่านแล้ว (pstats.Stats จะเรียก create_stats() ซึ่งปิด profiler ของ thread ที่อ่าน)"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class CpuSession:
+    """📊 cProfile หนึ่งรอบ (แต่ละ thread มี Profile ของตัวเอง รวมกันตอนเขียนไฟล์)"""
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def join(self):
+        """➕ เริ่ม cProfile ใน thread ที่เรียก"""
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def stats(self):
+        """📊 ผลรวมของทุก thread (อ่านอย่างเดียว ไม่ไปปิด profiler ของ thread อื่น)"""
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats()
+        for profile in profiles:
+            profile.snapshot_stats()
+            if profile.stats:
+                stats.add(_StatsSnapshot(profile.stats))
+        return stats
+
+
+class StackSampler:
+    """
+    🎯 sampling profiler: อ่าน stack ของทุก thread เป็นระยะจาก thread แยก
+
+    thread ที่ถูกวัดไม่ต้องทำอะไรเพิ่ม ต้นทุนอยู่ที่ thread ของ sampler (แย่ง GIL ทุกรอบที่อ่าน)
+
+    Args:
+        interval (float): วินาทีระหว่างการอ่านแต่ละครั้ง
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()     # "thread;func (file:line);..." -> จำนวนครั้งที่เห็น
+        self.samples = 0
+        self.started = time.monotonic()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='profiler-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.running:
+            time.sleep(self.interval)
+            # thread ของ client มีเลขต่อท้ายชื่อ แทนด้วย N เพื่อรวม stack ของ thread ชนิดเดียวกัน
+            names = {thread.ident: re.sub(r'\d+', 'N', thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        """🛑 หยุด thread ของ sampler (รอรอบที่กำลังอ่านให้จบ)"""
+        self.running = False
+        self.thread.join()
+
+
+class ProfilerControl:
+    """
+    🎛️ เปิด/ปิด profiler แต่ละแบบและเขียนผลลงไฟล์ (เรียกจากหลาย thread พร้อมกันได้)
+
+    Args:
+        directory (str): โฟลเดอร์ที่เขียนไฟล์ผล
+        sample_interval (float): วินาทีระหว่างการอ่าน stack ของ sampling profiler
+        memory_frames (int): จำนวน frame ที่ tracemalloc เก็บต่อการจองหน่วยความจำ
+        on_cpu_change (Callable): เรียกหลัง cProfile เริ่ม/จบรอบ (เช่น ให้ event loop เรียก follow())
+    """
+
+    def __init__(self, directory, sample_interval=0.005, memory_frames=10, on_cpu_change=None):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.memory_frames = memory_frames
+        self.on_cpu_change = on_cpu_change
+        self.cpu = None             # CpuSession ที่กำลังวัด (None = ปิด) thread ของ client อ่านค่านี้ทุกการอ่าน
+        self.sampler = None
+        self.memory = False
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def follow(self):
+        """
+        🧵 ให้ thread ที่เรียกเข้าร่วม cProfile รอบปัจจุบัน (หรือหยุดวัดถ้ารอบจบแล้ว)
+
+        thread ที่ทำงานของ broker เรียกเมื่อ cpu ไม่ใช่รอบที่ตัวเองอยู่:
+            if profiler.cpu is not profiling:
+                profiling = profiler.follow()
+
+        Returns:
+            CpuSession: รอบที่ thread นี้อยู่ตอนนี้ (None = ไม่ได้วัด)
+        """
+        session = self.cpu
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.disable()
+        self._local.profile = session.join() if session is not None else None
+        return session
+
+    def running(self, mode):
+        """❓ profiler แบบนี้กำลังทำงานอยู่ไหม"""
+        if mode == 'cpu':
+            return self.cpu is not None
+        if mode == 'sampling':
+            return self.sampler is not None
+        return self.memory
+
+    def toggle(self, mode):
+        """
+        🔀 เริ่มถ้ายังไม่ได้วัด หยุดและเขียนผลถ้ากำลังวัดอยู่
+
+        Returns:
+            list: ไฟล์ที่เขียน ([] = เพิ่งเริ่มวัด)
+        """
+        with self.lock:
+            if self.running(mode):
+                return self._stop(mode)
+            self._start(mode)
+            return []
+
+    def start(self, mode):
+        """▶️ เริ่มวัด (ValueError ถ้าไม่รู้จักแบบนี้หรือกำลังวัดอยู่แล้ว)"""
+        with self.lock:
+            if self.running(mode):
+                raise ValueError(f"{mode} profiling ทำงานอยู่แล้ว")
+            self._start(mode)
+
+    def stop(self, mode):
+        """
+        ⏹️ หยุดวัดและเขียนผล (ValueError ถ้าไม่ได้วัดอยู่)
+
+        Returns:
+            list: ไฟล์ที่เขียน
+        """
+        with self.lock:
+            if not self.running(mode):
+                raise ValueError(f"{mode} profiling ไม่ได้ทำงานอยู่")
+            return self._stop(mode)
+
+    def _start(self, mode):
+        if mode == 'cpu':
+            self.cpu = CpuSession()
+            if self.on_cpu_change is not None:
+                self.on_cpu_change()
+        elif mode == 'sampling':
+            self.sampler = StackSampler(self.sample_interval)
+        elif mode == 'memory':
+            tracemalloc.start(self.memory_frames)
+            self.memory = True
+        else:
+            raise ValueError(f"ไม่รู้จัก profiler แบบ '{mode}' (ใช้ได้: {', '.join(MODES)})")
+
+    def _stop(self, mode):
+        if mode == 'cpu':
+            session, self.cpu = self.cpu, None
+            if self.on_cpu_change is not None:
+                self.on_cpu_change()
+            return self._write_cpu(session.stats())
+        if mode == 'sampling':
+            sampler, self.sampler = self.sampler, None
+            sampler.stop()
+            return self._write_sampling(sampler)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        self.memory = False
+        return self._write_memory(snapshot)
+
+    def _path(self, mode):
+        """📄 ชื่อไฟล์ผลไม่รวมนามสกุล (มี pid เพราะแต่ละ worker เขียนไฟล์ของตัวเองในโฟลเดอร์เดียวกัน)"""
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.directory, f'profile-{mode}-{stamp}-{os.getpid()}')
+
+    def _write_cpu(self, stats):
+        """💾 cProfile: .pstats สำหรับเครื่องมืออื่น และ .txt เรียงตามเวลาสะสม"""
+        base = self._path('cpu')
+        dump_path = base + '.pstats'
+        stats.dump_stats(dump_path)
+        text_path = base + '.txt'
+        with open(text_path, 'w', encoding='utf-8') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(60)
+        return [dump_path, text_path]
+
+    def _write_sampling(self, sampler):
+        """💾 sampling: สรุป function ที่อยู่บนสุดของ stack บ่อยที่สุด ตามด้วย folded stack ทั้งหมด"""
+        leaves = collections.Counter()
+        for stack, count in sampler.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(sampler.stacks.values()) or 1
+        path = self._path('sampling') + '.txt'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"# {sampler.samples} รอบใน {time.monotonic() - sampler.started:.1f} วินาที "
+                    f"(ทุก {sampler.interval * 1000:.1f} ms, wall-clock รวม thread ที่รอ I/O)\n")
+            f.write("# function ที่อยู่บนสุดของ stack บ่อยที่สุด\n")
+            for leaf, count in leaves.most_common(30):
+                f.write(f"#   {count / total:6.1%}  {leaf}\n")
+            f.write("# folded stack (thread;caller;...;callee จำนวนครั้ง)\n")
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return [path]
+
+    def _write_memory(self, snapshot):
+        """💾 tracemalloc: หน่วยความจำที่ยังจองอยู่แยกตามบรรทัด และ traceback ของก้อนที่ใหญ่ที่สุด"""
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        by_line = snapshot.statistics('lineno')
+        out = io.StringIO()
+        out.write(f"# หน่วยความจำที่จองหลังเริ่มวัดและยังไม่คืน: "
+                  f"{sum(stat.size for stat in by_line) / 1024:.1f} KiB ใน {sum(stat.count for stat in by_line)} ก้อน\n")
+        for stat in by_line[:50]:
+            out.write(f"{stat}\n")
+        out.write("\n# traceback ของ 10 อันดับแรก\n")
+        for stat in snapshot.statistics('traceback')[:10]:
+            out.write(f"\n{stat.size / 1024:.1f} KiB ใน {stat.count} ก้อน\n")
+            out.write('\n'.join(stat.traceback.format()) + '\n')
+        path = self._path('memory') + '.txt'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(out.getvalue())
+        return [path]
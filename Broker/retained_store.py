@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📌 ที่เก็บ Retained Message แบบเก็บลงไฟล์ (mmap)
+============================================
+
+ข้อความที่ publish ด้วย retain จะถูกเขียนต่อท้ายไฟล์เป็น record ทีละข้อความ
+(ไม่เขียนไฟล์ใหม่ทั้งไฟล์) ผ่าน memory-mapped file: การเขียนเป็นแค่การ copy ลงหน่วยความจำ
+แล้ว OS จะเขียนลงดิสก์เอง ข้อมูลจึงอยู่รอดแม้ process ถูก kill (เช่น container restart)
+
+รูปแบบไฟล์:
+    header  : magic 'RTND' | version (u16) | ว่าง (u16) | ตำแหน่งสิ้นสุดของข้อมูลที่สมบูรณ์ (u64)
+              | generation (u64)
+    record  : flags (u8) | ความยาว topic (u16) | ความยาวข้อมูล (u32) | crc32 (u32) | topic | ข้อมูล JSON
+
+- record ที่ใหม่กว่าของ topic เดียวกันทับของเก่า record ที่ไม่มี flag LIVE คือการลบ
+- ตำแหน่งสิ้นสุดใน header ถูกอัพเดทหลังเขียน record เสร็จ และ crc ตรวจ record ที่เขียนไม่ครบ
+- index (topic -> ตำแหน่งในไฟล์) ถูกบันทึกเป็น snapshot ในไฟล์ '<ไฟล์>.idx' เป็นระยะ
+  (ตอนปิด, หลัง compact และเมื่อมี record ใหม่มากพอ) ตอนเริ่มจึงโหลด snapshot ทีเดียว
+  แล้วอ่านเฉพาะ record ที่เขียนหลัง snapshot เริ่มได้ในระดับมิลลิวินาทีแม้มีหลายแสน topic
+- ข้อมูล JSON ถูก decode ตอนส่งให้ subscriber เท่านั้น
+- เมื่อ record ที่ถูกทับ/ลบแล้วมีขนาดเกินข้อมูลที่ยังใช้อยู่ จะ compact ไฟล์ใหม่ครั้งหนึ่ง
+
+ถ้าไม่ระบุไฟล์ จะใช้ mmap ในหน่วยความจำ (anonymous) ด้วยรูปแบบเดียวกันแต่ไม่เก็บลงดิสก์
+"""
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+
+from message_log import dump_json, load_json
+from sharded_state import InstrumentedLock, lock_stats
+from topic_trie import topic_matches
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'RTND'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHHQQ')
+_END = struct.Struct('<Q')
+_END_OFFSET = 8
+_RECORD = struct.Struct('<BHII')
+
+# snapshot ของ index: magic | generation | ตำแหน่งสิ้นสุดตอน snapshot | live | dead | จำนวน topic | crc32
+_INDEX_MAGIC = b'RTNX'
+_INDEX_HEADER = struct.Struct('<4sQQQQQI')
+
+FLAG_LIVE = 0x01
+
+_INITIAL_SIZE = 1024 * 1024
+_COMPACT_MIN_DEAD = 1024 * 1024
+_SNAPSHOT_MIN_RECORDS = 10000
+
+
+class RetainedStore:
+    """
+    📌 retained message ของทุก topic (topic -> ข้อความล่าสุดที่ retain)
+
+    อ่าน index ได้โดยไม่ต้องใช้ lock การแก้ไขและการ decode ข้อความถือ lock ของไฟล์
+    (retained message เปลี่ยนไม่บ่อยเมื่อเทียบกับ publish ทั่วไป)
+
+    Args:
+        path (str): ไฟล์ที่ใช้เก็บ (None = เก็บในหน่วยความจำเท่านั้น)
+        writable (bool): False = โหลดจากไฟล์แล้วทำงานในหน่วยความจำ ไม่เขียนกลับ
+            (ใช้กับ worker ที่ไม่ใช่ผู้เขียนไฟล์ในโหมด multi-process)
+    """
+
+    def __init__(self, path=None, writable=True):
+        self.path = path if writable else None
+        self.lock = InstrumentedLock('retained')
+        self.index = {}         # topic -> ตำแหน่งของ record ในไฟล์
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        self.compactions = 0
+        self.generation = 0
+        self.unindexed = 0      # จำนวน record ที่เขียนหลัง snapshot ของ index ล่าสุด
+        self.file = None
+        self.mm = None
+
+        started = time.perf_counter()
+        if self.path:
+            self._open_file()
+            self._maybe_compact()
+        else:
+            self._open_memory(path)
+        self.load_ms = (time.perf_counter() - started) * 1000
+
+    # ========================================
+    # 📂 เปิด / โหลดไฟล์
+    # ========================================
+
+    def _open_file(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, 'a+b')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < _HEADER.size:
+            size = _INITIAL_SIZE
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self._load()
+
+    def _open_memory(self, source=None):
+        """🧠 mmap ในหน่วยความจำ (ถ้ามีไฟล์ source จะ map แบบ copy-on-write ไม่เขียนกลับไฟล์)"""
+        if source and os.path.exists(source) and os.path.getsize(source) >= _HEADER.size:
+            with open(source, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            self.mm = mmap.mmap(-1, _INITIAL_SIZE)
+        self._load(source)
+
+    def _load(self, source=None):
+        """📖 โหลด snapshot ของ index (ถ้ามี) แล้วอ่าน record ที่เขียนหลังจากนั้น"""
+        mm = self.mm
+        magic, version, _, end, generation = _HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC or version != _VERSION:
+            if magic.strip(b'\x00'):
+                logger.warning("⚠️ ไฟล์ retained ไม่ใช่รูปแบบที่รองรับ เริ่มใหม่ด้วยไฟล์ว่าง")
+            self.generation = time.time_ns()
+            self._write_header(_HEADER.size)
+            return
+
+        self.generation = generation
+        end = min(end, len(mm))
+        offset = _HEADER.size
+        live = dead = 0
+        snapshot = self._read_snapshot(source or self.path, end)
+        if snapshot is not None:
+            self.index, offset, live, dead = snapshot
+
+        index = self.index
+        view = memoryview(mm)
+        unpack = _RECORD.unpack_from
+        record_size = _RECORD.size
+        try:
+            while offset + record_size <= end:
+                flags, topic_length, value_length, crc = unpack(mm, offset)
+                start = offset + record_size
+                record_end = start + topic_length + value_length
+                if record_end > end or zlib.crc32(view[start:record_end]) != crc:
+                    logger.warning(f"⚠️ record ของ retained เสียที่ตำแหน่ง {offset} ตัดข้อมูลที่เหลือทิ้ง")
+                    break
+                topic = str(view[start:start + topic_length], 'utf-8')
+                previous = index.get(topic)
+                if previous is not None:
+                    previous_size = self._record_size(previous)
+                    live -= previous_size
+                    dead += previous_size
+                if flags & FLAG_LIVE:
+                    index[topic] = offset
+                    live += record_end - offset
+                else:
+                    index.pop(topic, None)
+                    dead += record_end - offset
+                offset = record_end
+                self.unindexed += 1
+        finally:
+            view.release()
+
+        self.live_bytes = live
+        self.dead_bytes = dead
+        if offset != end:
+            self._write_header(offset)
+
+    def _write_header(self, end):
+        _HEADER.pack_into(self.mm, 0, _MAGIC, _VERSION, 0, end, self.generation)
+
+    def _read_snapshot(self, path, end):
+        """
+        📖 อ่าน snapshot ของ index
+
+        Returns:
+            tuple: (index, ตำแหน่งที่ต้องอ่าน record ต่อ, live_bytes, dead_bytes)
+                หรือ None ถ้าไม่มี snapshot หรือ snapshot ไม่ตรงกับไฟล์ข้อมูล
+        """
+        if not path:
+            return None
+        try:
+            with open(path + '.idx', 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < _INDEX_HEADER.size:
+            return None
+
+        magic, generation, indexed_end, live, dead, count, crc = _INDEX_HEADER.unpack_from(data, 0)
+        body = memoryview(data)[_INDEX_HEADER.size:]
+        if (magic != _INDEX_MAGIC or generation != self.generation or indexed_end > end
+                or zlib.crc32(body) != crc):
+            return None
+
+        offsets = array('Q')
+        offsets.frombytes(body[:count * 8])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        topics = str(body[count * 8:], 'utf-8').split('\0') if count else []
+        if len(topics) != count:
+            return None
+        return dict(zip(topics, offsets)), indexed_end, live, dead
+
+    def _write_snapshot(self):
+        """💾 บันทึก snapshot ของ index (เขียนไฟล์ใหม่แล้วสลับ เรียกขณะถือ lock)"""
+        if self.file is None:
+            return
+        offsets = array('Q', self.index.values())
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        body = offsets.tobytes() + '\0'.join(self.index).encode('utf-8')
+        header = _INDEX_HEADER.pack(
+            _INDEX_MAGIC, self.generation, self.end, self.live_bytes, self.dead_bytes,
+            len(self.index), zlib.crc32(body)
+        )
+        temp_path = self.path + '.idx.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(header)
+                f.write(body)
+            os.replace(temp_path, self.path + '.idx')
+            self.unindexed = 0
+        except OSError as e:
+            logger.warning(f"⚠️ บันทึก index ของ retained ไม่สำเร็จ: {e}")
+
+    @property
+    def end(self):
+        return _END.unpack_from(self.mm, _END_OFFSET)[0]
+
+    def _record_size(self, offset):
+        _, topic_length, value_length, _ = _RECORD.unpack_from(self.mm, offset)
+        return _RECORD.size + topic_length + value_length
+
+    # ========================================
+    # ✍️ เขียน record
+    # ========================================
+
+    def _ensure_capacity(self, needed):
+        """📏 ขยาย mmap (เพิ่มเท่าตัว) ถ้าพื้นที่ไม่พอ"""
+        size = len(self.mm)
+        if needed <= size:
+            return
+        while size < needed:
+            size *= 2
+        self._remap(size)
+
+    def _remap(self, size, data=None):
+        """🔁 สร้าง mmap ใหม่ขนาด size (ไฟล์ขยายได้เลย ส่วนในหน่วยความจำต้อง copy ข้อมูลเดิม)"""
+        if self.file is not None and data is None:
+            self.mm.close()
+            self.file.truncate(size)
+            self.mm = mmap.mmap(self.file.fileno(), size)
+            return
+        if data is None:
+            data = self.mm[:self.end]
+        self.mm.close()
+        self.mm = mmap.mmap(-1, size)
+        self.mm[:len(data)] = data
+
+    def _append(self, topic_bytes, value, flags):
+        """➕ เขียน record ต่อท้าย แล้วเลื่อนตำแหน่งสิ้นสุดใน header (เรียกขณะถือ lock)"""
+        body = topic_bytes + value
+        offset = self.end
+        record_end = offset + _RECORD.size + len(body)
+        self._ensure_capacity(record_end)
+        _RECORD.pack_into(self.mm, offset, flags, len(topic_bytes), len(value), zlib.crc32(body))
+        self.mm[offset + _RECORD.size:record_end] = body
+        _END.pack_into(self.mm, _END_OFFSET, record_end)
+        self.unindexed += 1
+        return offset
+
+    def put(self, topic, message):
+        """📌 เก็บ retained message ของ topic (ทับของเดิม)"""
+        topic_bytes = topic.encode('utf-8')
+        value = dump_json(message)
+        with self.lock:
+            if self.mm is None:
+                return
+            previous = self.index.get(topic)
+            offset = self._append(topic_bytes, value, FLAG_LIVE)
+            self.index[topic] = offset
+            self.live_bytes += self._record_size(offset)
+            if previous is not None:
+                self._mark_dead(previous)
+            self._maybe_compact()
+
+    def pop(self, topic):
+        """🗑️ ลบ retained message ของ topic (เขียน record ลบต่อท้าย)"""
+        with self.lock:
+            if self.mm is None:
+                return False
+            previous = self.index.pop(topic, None)
+            if previous is None:
+                return False
+            offset = self._append(topic.encode('utf-8'), b'', 0)
+            self._mark_dead(previous)
+            self.dead_bytes += self._record_size(offset)
+            self._maybe_compact()
+            return True
+
+    def _mark_dead(self, offset):
+        size = self._record_size(offset)
+        self.live_bytes -= size
+        self.dead_bytes += size
+
+    def _maybe_compact(self):
+        if self.dead_bytes > max(self.live_bytes, _COMPACT_MIN_DEAD):
+            self.compact()
+        elif self.unindexed > max(_SNAPSHOT_MIN_RECORDS, len(self.index)):
+            # snapshot ใช้เวลาตามจำนวน topic จึงทำเมื่อ record ใหม่มีจำนวนพอๆ กัน (เฉลี่ยแล้ว O(1))
+            self._write_snapshot()
+
+    def compact(self):
+        """
+        🗜️ เขียนเฉพาะ record ที่ยังใช้อยู่ลงไฟล์ใหม่ แล้วสลับแทนไฟล์เดิม
+
+        เรียกขณะถือ lock (หรือก่อนเริ่มใช้งาน)
+        """
+        mm = self.mm
+        parts = [b'']
+        index = {}
+        position = _HEADER.size
+        for topic, offset in self.index.items():
+            record_end = offset + self._record_size(offset)
+            parts.append(mm[offset:record_end])
+            index[topic] = position
+            position += record_end - offset
+        self.generation = time.time_ns()
+        parts[0] = _HEADER.pack(_MAGIC, _VERSION, 0, position, self.generation)
+        data = b''.join(parts)
+        size = max(_INITIAL_SIZE, len(data) * 2)
+
+        if self.file is not None:
+            # เขียนไฟล์ใหม่ให้เสร็จก่อนแล้วค่อยสลับ ไฟล์จึงไม่เสียแม้หยุดกลางทาง
+            temp_path = self.path + '.compact'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+                f.truncate(size)
+                f.flush()
+                os.fsync(f.fileno())
+            mm.close()
+            self.file.close()
+            os.replace(temp_path, self.path)
+            self.file = open(self.path, 'r+b')
+            self.mm = mmap.mmap(self.file.fileno(), size)
+        else:
+            self._remap(size, data)
+
+        self.index = index
+        self.live_bytes = position - _HEADER.size
+        self.dead_bytes = 0
+        self.compactions += 1
+        self._write_snapshot()
+
+    # ========================================
+    # 📖 อ่าน
+    # ========================================
+
+    def _decode(self, offset):
+        _, topic_length, value_length, _ = _RECORD.unpack_from(self.mm, offset)
+        start = offset + _RECORD.size + topic_length
+        return load_json(self.mm[start:start + value_length])
+
+    def get(self, topic):
+        """📖 retained message ของ topic (None ถ้าไม่มี)"""
+        if topic not in self.index:
+            return None
+        with self.lock:
+            offset = self.index.get(topic)
+            if offset is None or self.mm is None:
+                return None
+            return self._decode(offset)
+
+    def matching(self, topic_filter):
+        """
+        🔎 retained message ของทุก topic ที่ตรงกับ filter
+
+        Returns:
+            list: [(topic, message), ...]
+        """
+        topics = [topic for topic in list(self.index) if topic_matches(topic_filter, topic)]
+        if not topics:
+            return []
+        matched = []
+        with self.lock:
+            if self.mm is None:
+                return []
+            for topic in topics:
+                offset = self.index.get(topic)
+                if offset is not None:
+                    matched.append((topic, self._decode(offset)))
+        return matched
+
+    def __contains__(self, topic):
+        return topic in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def stats(self):
+        """📊 จำนวน topic, ขนาดข้อมูลที่ใช้อยู่/ถูกทับ และเวลาที่ใช้โหลดตอนเริ่ม"""
+        return {
+            'topics': len(self.index),
+            'live_bytes': self.live_bytes,
+            'dead_bytes': self.dead_bytes,
+            'compactions': self.compactions,
+            'load_ms': self.load_ms,
+            'persistent': self.file is not None
+        }
+
+    def lock_stats(self):
+        return lock_stats([self.lock])
+
+    def flush(self):
+        """💾 สั่งให้ OS เขียนข้อมูลที่ค้างใน mmap ลงดิสก์"""
+        with self.lock:
+            if self.file is not None and self.mm is not None:
+                self.mm.flush()
+
+    def close(self):
+        """🔒 flush แล้วปิดไฟล์"""
+        with self.lock:
+            if self.mm is None:
+                return
+            if self.file is not None:
+                self.mm.flush()
+                if self.unindexed:
+                    self._write_snapshot()
+            self.mm.close()
+            self.mm = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🔒 State แบบแบ่ง shard สำหรับ Broker
+===================================
+
+แทน lock ตัวเดียวที่ครอบทุกอย่าง (client, subscription, ข้อความล่าสุด, สถิติ)
+ด้วย lock หลายตัวที่แบ่งตาม key: งานที่แตะ key คนละ shard ทำพร้อมกันได้
+
+- InstrumentedLock: lock ที่นับจำนวนครั้งที่ต้องรอ (contention) และเวลาที่ถือ lock
+- ShardedMap: dict ที่แบ่งเป็นหลาย shard ตาม hash ของ key แต่ละ shard มี lock ของตัวเอง
+  (การอ่านค่าเดียวด้วย get() ไม่ต้องใช้ lock เพราะเป็น operation เดียวของ dict)
+- ShardedTopicTrie: TopicTrie แยกตาม shard ของระดับแรกของ topic
+  filter ที่ขึ้นต้นด้วย wildcard ('+' / '#') อยู่ใน shard แยกที่ทุก publish ต้องดูด้วย
+- StatCounter: ตัวนับที่แต่ละ thread เพิ่มค่าใน cell ของตัวเอง ไม่ต้องใช้ lock
+  (รวมค่าตอนอ่านเท่านั้น)
+
+ลำดับการถือ lock ที่อนุญาต (กัน deadlock):
+    lock ของ client  ->  lock ของ subscription  ->  lock ใน callback on_first / on_last
+lock ของ shard อื่นๆ (เช่นข้อความล่าสุดของ topic) ห้ามถือซ้อนกับ lock ใด
+"""
+
+import threading
+from time import perf_counter_ns
+
+from topic_trie import TopicTrie
+
+DEFAULT_SHARDS = 16
+
+
+class InstrumentedLock:
+    """
+    📏 threading.Lock ที่วัดการใช้งานของตัวเอง
+
+    ใช้กับ with เท่านั้น ตัวนับทั้งหมดถูกแก้ขณะถือ lock จึงไม่ต้องมี lock เพิ่ม
+
+    Args:
+        name (str): ชื่อที่ใช้แสดงในสถิติ
+    """
+
+    __slots__ = ('name', '_lock', '_since', 'acquired', 'contended',
+                 'wait_ns', 'hold_ns', 'max_hold_ns')
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._since = 0
+        self.acquired = 0       # จำนวนครั้งที่ได้ lock
+        self.contended = 0      # จำนวนครั้งที่ต้องรอ thread อื่นปล่อย lock
+        self.wait_ns = 0        # เวลารอรวม
+        self.hold_ns = 0        # เวลาถือ lock รวม
+        self.max_hold_ns = 0    # เวลาถือ lock นานสุดครั้งเดียว
+
+    def __enter__(self):
+        lock = self._lock
+        if not lock.acquire(False):
+            start = perf_counter_ns()
+            lock.acquire()
+            self.contended += 1
+            self.wait_ns += perf_counter_ns() - start
+        self.acquired += 1
+        self._since = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        held = perf_counter_ns() - self._since
+        self.hold_ns += held
+        if held > self.max_hold_ns:
+            self.max_hold_ns = held
+        self._lock.release()
+
+
+def lock_stats(locks):
+    """
+    📊 รวมสถิติของ lock หลายตัว (เช่นทุก shard ของ ShardedMap)
+
+    Returns:
+        dict: acquired, contended, contention (สัดส่วน), wait_us / hold_us (เฉลี่ยต่อครั้ง)
+              และ max_hold_us
+    """
+    acquired = sum(lock.acquired for lock in locks)
+    contended = sum(lock.contended for lock in locks)
+    wait_ns = sum(lock.wait_ns for lock in locks)
+    hold_ns = sum(lock.hold_ns for lock in locks)
+    return {
+        'locks': len(locks),
+        'acquired': acquired,
+        'contended': contended,
+        'contention': contended / acquired if acquired else 0.0,
+        'wait_us': wait_ns / contended / 1000 if contended else 0.0,
+        'hold_us': hold_ns / acquired / 1000 if acquired else 0.0,
+        'max_hold_us': max((lock.max_hold_ns for lock in locks), default=0) / 1000
+    }
+
+
+class _Shard:
+    """🧩 หนึ่ง shard: lock และข้อมูลที่ lock นั้นดูแล"""
+
+    __slots__ = ('lock', 'data')
+
+    def __init__(self, lock, data):
+        self.lock = lock
+        self.data = data
+
+
+class ShardedMap:
+    """
+    🗂️ dict ที่แบ่งเป็นหลาย shard ตาม hash ของ key
+
+    - get() / in: อ่านค่าเดียวโดยไม่ใช้ lock
+    - put() / pop(): ถือ lock ของ shard นั้นเท่านั้น
+    - งานที่ต้องแก้หลายค่าพร้อมกันของ key เดียว ใช้ shard(key) แล้วถือ lock เอง
+
+    Args:
+        name (str): ชื่อที่ใช้แสดงในสถิติ lock
+        shard_count (int): จำนวน shard
+        factory (Callable): สร้าง dict ของแต่ละ shard (subclass ของ dict ที่มีข้อมูลต่อ shard เพิ่มได้)
+    """
+
+    def __init__(self, name, shard_count=DEFAULT_SHARDS, factory=dict):
+        self.name = name
+        self.shards = [
+            _Shard(InstrumentedLock(f'{name}[{index}]'), factory())
+            for index in range(max(1, shard_count))
+        ]
+
+    def shard(self, key):
+        """🧩 shard ที่ดูแล key นี้"""
+        return self.shards[hash(key) % len(self.shards)]
+
+    def lock_for(self, key):
+        """🔒 lock ของ shard ที่ดูแล key นี้"""
+        return self.shard(key).lock
+
+    def get(self, key, default=None):
+        return self.shard(key).data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.shard(key).data
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self.shards)
+
+    def put(self, key, value):
+        shard = self.shard(key)
+        with shard.lock:
+            shard.data[key] = value
+
+    def pop(self, key, default=None):
+        shard = self.shard(key)
+        with shard.lock:
+            return shard.data.pop(key, default)
+
+    def keys(self):
+        """📋 key ทั้งหมด (ถือ lock ทีละ shard จึงไม่ใช่ snapshot ของทุก shard พร้อมกัน)"""
+        keys = []
+        for shard in self.shards:
+            with shard.lock:
+                keys.extend(shard.data)
+        return keys
+
+    def items(self):
+        """📋 (key, value) ทั้งหมด ถือ lock ทีละ shard"""
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend(shard.data.items())
+        return items
+
+    def lock_stats(self):
+        return lock_stats([shard.lock for shard in self.shards])
+
+
+class ShardedTopicTrie:
+    """
+    🌳 ดัชนี subscription แบบ trie ที่แบ่ง shard ตามระดับแรกของ topic
+
+    subscribe ไปยัง 'sensor/...' กับ 'home/...' ใช้คนละ lock จึงไม่แย่งกัน
+    filter ที่ระดับแรกเป็น wildcard (เช่น '+/status' หรือ '#') ตรงได้กับทุก topic
+    จึงเก็บแยกไว้ใน shard เดียว และ match() รวมผลของ shard นี้เข้าไปด้วยเสมอ
+
+    match() ไม่ใช้ lock เลย: แต่ละ shard เป็น TopicTrie แบบ copy-on-write
+    lock ของ shard มีไว้เรียงคิวผู้แก้ไข (subscribe / unsubscribe) เท่านั้น
+
+    ใช้แทน TopicTrie ได้โดยตรง (subscribe / unsubscribe / match / subscribers / len)
+
+    Args:
+        wildcards (bool): เปิดใช้ '+' และ '#'
+        cache_size (int): จำนวน topic ที่ cache ผลการ match ไว้ต่อ shard (0 = ไม่ใช้ cache)
+        shard_count (int): จำนวน shard ของ topic ปกติ
+    """
+
+    def __init__(self, wildcards=True, cache_size=0, shard_count=DEFAULT_SHARDS):
+        self.wildcards = wildcards
+        self.shards = [
+            _Shard(InstrumentedLock(f'subscriptions[{index}]'), TopicTrie(wildcards, cache_size))
+            for index in range(max(1, shard_count))
+        ]
+        self.wildcard_shard = _Shard(
+            InstrumentedLock('subscriptions[+/#]'), TopicTrie(wildcards)
+        )
+
+    def _topic_shard(self, topic):
+        return self.shards[hash(topic.partition('/')[0]) % len(self.shards)]
+
+    def _filter_shard(self, topic_filter):
+        first = topic_filter.partition('/')[0]
+        if self.wildcards and first in ('+', '#'):
+            return self.wildcard_shard
+        return self.shards[hash(first) % len(self.shards)]
+
+    def _all_shards(self):
+        return self.shards + [self.wildcard_shard]
+
+    def subscribe(self, topic_filter, subscriber, on_first=None):
+        """
+        ➕ เพิ่ม subscriber ให้ filter
+
+        Args:
+            on_first (Callable): เรียก on_first(topic_filter) ขณะยังถือ lock ของ shard
+                เมื่อ filter นี้เพิ่งมี subscriber ตัวแรก (ลำดับจึงตรงกับ on_last ของ unsubscribe)
+
+        Returns:
+            bool: True ถ้า filter นี้เพิ่งมี subscriber ตัวแรก
+        """
+        shard = self._filter_shard(topic_filter)
+        with shard.lock:
+            first = shard.data.subscribe(topic_filter, subscriber)
+            if shard is self.wildcard_shard:
+                self._invalidate_topic_shards(topic_filter)
+            if first and on_first:
+                on_first(topic_filter)
+            return first
+
+    def unsubscribe(self, topic_filter, subscriber, on_last=None):
+        """
+        ➖ ลบ subscriber ออกจาก filter
+
+        Args:
+            on_last (Callable): เรียก on_last(topic_filter) ขณะยังถือ lock ของ shard
+                เมื่อ filter นี้ไม่เหลือ subscriber แล้ว
+
+        Returns:
+            bool: True ถ้า filter นี้ไม่เหลือ subscriber แล้ว
+        """
+        shard = self._filter_shard(topic_filter)
+        with shard.lock:
+            last = shard.data.unsubscribe(topic_filter, subscriber)
+            if shard is self.wildcard_shard:
+                self._invalidate_topic_shards(topic_filter)
+            if last and on_last:
+                on_last(topic_filter)
+            return last
+
+    def _invalidate_topic_shards(self, topic_filter):
+        """
+        🧹 ตัดผลที่ filter นี้ครอบคลุมออกจาก cache ของทุก shard หลัง wildcard shard เปลี่ยน
+        (เรียกขณะถือ lock ของ wildcard shard)
+
+        cache ของแต่ละ shard เก็บผลรวมกับ wildcard shard ไว้ด้วย ผลของ topic อื่นยังใช้ต่อได้
+        ลำดับ lock: wildcard shard -> shard ปกติ (ไม่มีที่ไหนถือกลับทาง)
+        """
+        for shard in self.shards:
+            with shard.lock:
+                shard.data.invalidate(topic_filter)
+
+    def subscribers(self, topic_filter):
+        """👥 subscriber ของ filter นี้ (ตรงตัว ไม่ใช้ wildcard)"""
+        return self._filter_shard(topic_filter).data.subscribers(topic_filter)
+
+    def branch(self, level):
+        """🌿 node ของระดับแรกใน shard ของระดับนั้น (None = ไม่มี filter ใต้ระดับนี้, ดู TopicTrie.branch)"""
+        return self._filter_shard(level).data.branch(level)
+
+    def match(self, topic):
+        """
+        🎯 หา subscriber ทั้งหมดที่ filter ตรงกับ topic ที่ publish (ไม่ใช้ lock)
+
+        Returns:
+            frozenset: subscriber ที่ตรงกัน
+        """
+        return self._topic_shard(topic).data.match(topic, self.wildcard_shard.data)
+
+    @property
+    def subscription_count(self):
+        return sum(shard.data.subscription_count for shard in self._all_shards())
+
+    def __contains__(self, topic_filter):
+        return topic_filter in self._filter_shard(topic_filter).data
+
+    def __len__(self):
+        """📊 จำนวน filter ที่มี subscriber อยู่"""
+        return sum(shard.data.filter_count for shard in self._all_shards())
+
+    def cache_stats(self):
+        """🎯 สถิติ match cache รวมทุก shard (None ถ้าไม่ได้เปิด cache)"""
+        caches = [shard.data.cache_stats() for shard in self.shards if shard.data.cache_size]
+        if not caches:
+            return None
+        total = {
+            key: sum(cache[key] for cache in caches)
+            for key in ('size', 'capacity', 'hits', 'misses', 'evictions', 'invalidations', 'snapshots')
+        }
+        lookups = total['hits'] + total['misses']
+        total['hit_rate'] = total['hits'] / lookups if lookups else 0.0
+        return total
+
+    def lock_stats(self):
+        return lock_stats([shard.lock for shard in self._all_shards()])
+
+
+class StatCounter:
+    """
+    🔢 ตัวนับสถิติที่เพิ่มค่าได้โดยไม่ต้องใช้ lock
+
+    แต่ละ thread มี cell ของตัวเอง (มีผู้เขียนคนเดียว) ค่ารวมคำนวณตอนอ่าน
+    cell ของ thread ที่จบไปแล้วจะถูกรวมเข้า base ตอนอ่านครั้งถัดไป
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = []            # (thread, cell)
+        self._retired = 0           # ค่าจาก thread ที่จบไปแล้ว
+        self._lock = threading.Lock()   # ใช้ตอนลงทะเบียน thread ใหม่และตอนอ่านเท่านั้น
+
+    def add(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            cell = self._local.cell = [amount]
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+
+    @property
+    def value(self):
+        with self._lock:
+            total = self._retired
+            alive = []
+            for thread, cell in self._cells:
+                total += cell[0]
+                if thread.is_alive():
+                    alive.append((thread, cell))
+                else:
+                    self._retired += cell[0]
+            self._cells = alive
+        return total
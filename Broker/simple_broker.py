@@ -11,21 +11,66 @@
 - รับ-ส่งข้อความ MQTT
 - จัดการ Topic ต่างๆ
 - แสดงสถิติการทำงาน
-- บันทึกกิจกรรมทั้งหมด
+- บันทึกกิจกรรมทั้งหมด (ผ่านคิวและ thread เขียน log แยก ไฟล์ log หมุนเวียนตามขนาด)
+- endpoint /metrics แบบ Prometheus อ่านจากตัวนับที่ปรับค่าระหว่างทำงาน (ไม่เดินดู state ของ broker)
+- วัด latency ของข้อความแต่ละขั้น (parse / route / enqueue / write) เปิดปิดได้ระหว่างทำงาน
+- publish สถิติของ broker เองใน topic $SYS/broker/... (เฉพาะเมื่อมีคน subscribe)
+- เปิด/ปิด profiler (cProfile, sampling, tracemalloc) ระหว่างทำงานด้วย SIGUSR1/SIGUSR2 หรือคำสั่ง admin
+- เลือก engine ได้ระหว่าง thread ต่อ client หรือ asyncio event loop เดียว
+- Subscribe ด้วย wildcard (+ และ #) ตามมาตรฐาน MQTT
+- พูด MQTT 3.1.1 จริง (binary) ได้ ใช้กับ client อย่าง paho-mqtt ได้
+- client JSON-line และ MQTT binary ใช้ port เดียวกันและส่งข้อความถึงกันได้
+- จำกัดคิวขาออกของ subscriber ที่ช้า (backpressure) ไม่ให้ใช้หน่วยความจำไม่จำกัด
+- แบ่ง state เป็น shard แต่ละ shard มี lock ของตัวเอง (client ต่างกันไม่ต้องแย่ง lock เดียวกัน)
+- ส่งข้อความ QoS 1 แบบ at-least-once (รอ PUBACK และส่งซ้ำด้วย timer กลาง)
+- ตัด client ที่เงียบนานเกิน keepalive / client_timeout (timing wheel เดียวสำหรับทุก client)
+- session ถาวร: client ที่ใช้ client id เดิมได้ subscription และข้อความที่พลาดไประหว่างหลุดคืน
 """
 
 import socket
 import threading
 import time
 import json
+import base64
+import os
+import hmac
+import signal
+import itertools
 from datetime import datetime
-from collections import defaultdict
 import logging
 
+from config_manager import BrokerConfig
+from async_engine import AsyncioEngine
+from topic_trie import is_valid_filter, has_wildcard, topic_matches
+from sharded_state import ShardedMap, ShardedTopicTrie, StatCounter
+from topic_history import TopicHistory
+from retained_store import RetainedStore
+from message_log import MessageLog
+from frame_decoder import LineFrameDecoder, FrameTooLargeError
+from client_writer import SocketWriter, OutboundLimits, BackpressureStats
+from timer_queue import TimerQueue
+from timing_wheel import TimingWheel
+from inflight import InflightWindow
+from session_store import SessionStore
+from log_pipeline import LogPipeline, RateLimitedLog, file_handler, parse_size
+from metrics import MetricsRegistry, MetricsServer, Histogram, FANOUT_BUCKETS
+from latency import LatencyTracker, QUANTILES, STAGES
+from sys_topics import SysTopics, SYS_PREFIX
+from profiler import ProfilerControl, MODES
+from mqtt_codec import (
+    MQTTStreamDecoder, MQTTProtocolError, PINGRESP_PACKET, SUBACK_FAILURE,
+    CONNACK_ACCEPTED, CONNACK_BAD_PROTOCOL, CONNACK_IDENTIFIER_REJECTED,
+    encode_connack, encode_publish, encode_puback, encode_pubrec, encode_pubcomp,
+    encode_suback, encode_unsuback, detect_protocol
+)
+
 # ========================================
 # 📋 ตั้งค่าพื้นฐาน
 # ========================================
 
+# ⏪ จำนวนข้อความต่อ chunk ของ replay (รอให้คิวขาออกของ client ลดลงก่อนส่ง chunk ถัดไป)
+REPLAY_CHUNK_SIZE = 256
+
 class MQTTBroker:
     """
     🏠 MQTT Broker หลัก
@@ -36,169 +81,1142 @@ class MQTTBroker:
     - ตัวส่งข้อความไปยัง Subscriber
     """
     
-    def __init__(self, host='localhost', port=1883):
+    def __init__(self, host='localhost', port=1883, config=None):
         """
         🔧 เตรียมตัวแปรสำหรับ Broker
         
         Args:
             host (str): ที่อยู่ IP ที่จะรอรับการเชื่อมต่อ
             port (int): พอร์ตที่จะใช้ (1883 เป็นมาตรฐาน MQTT)
+            config (BrokerConfig): การตั้งค่า (ถ้าไม่ระบุจะอ่านจาก config.json)
         """
         self.host = host
         self.port = port
         self.running = False
         
-        # 📚 Dictionary สำหรับจัดเก็บข้อมูล
-        self.clients = {}               # เก็บข้อมูล Client ที่เชื่อมต่อ
-        self.subscriptions = defaultdict(set)  # เก็บ Topic ที่แต่ละ Client Subscribe
-        self.topics = defaultdict(list) # เก็บข้อความล่าสุดของแต่ละ Topic
+        # ⚙️ การตั้งค่า
+        self.config = config or BrokerConfig()
+        
+        # ⚡ engine ที่ใช้: 'threaded' (thread ต่อ client) หรือ 'asyncio' (event loop เดียว)
+        # ตัวแปร BROKER_ENGINE จะ override ค่าใน config.json
+        self.engine = os.getenv('BROKER_ENGINE', self.config.get_broker_engine()).lower()
+        self.async_engine = None
+        
+        # 📦 protocol ที่ใช้: 'json' (JSON-line แบบง่าย), 'mqtt' (MQTT 3.1.1 binary)
+        #    หรือ 'auto' (ดูจาก byte แรกของแต่ละ connection)
+        self.protocol = os.getenv('BROKER_PROTOCOL', self.config.get_broker_protocol()).lower()
+        
+        # 📥 ขนาด buffer รับข้อมูลต่อ connection (byte)
+        self.read_size = self.config.get_read_buffer_size()
+        
+        # 🚦 ขีดจำกัดคิวขาออกต่อ client และ policy เมื่อ subscriber ตามไม่ทัน
+        backpressure = self.config.get_backpressure_settings()
+        self.outbound_limits = OutboundLimits(
+            policy=os.getenv('BACKPRESSURE_POLICY', backpressure['policy']).lower(),
+            high_bytes=backpressure['high_watermark_bytes'],
+            low_bytes=backpressure['low_watermark_bytes'],
+            high_messages=backpressure['high_watermark_messages'],
+            low_messages=backpressure['low_watermark_messages']
+        )
+        self.client_limits = {          # MQTT client id -> ขีดจำกัดที่ใช้ policy เฉพาะตัว
+            mqtt_client_id: self.outbound_limits.with_policy(policy)
+            for mqtt_client_id, policy in backpressure['client_policies'].items()
+        }
+        self.backpressure_stats = BackpressureStats()
+        
+        # 📬 QoS 1 ขาออก: in-flight window ต่อ client และ timer กลางสำหรับส่งซ้ำ (qos)
+        self.max_qos = self.config.get_max_qos()
+        self.qos = self.config.get_qos_settings()
+        self.timers = TimerQueue('qos-retry')
+        
+        # ⏰ client ที่เงียบนานเกินกำหนดถูกตัด (MQTT: 1.5 เท่าของ keepalive, JSON-line: client_timeout)
+        #    deadline ของทุก client อยู่ใน timing wheel เดียว ตรวจทุก heartbeat_interval วินาที
+        self.keepalive = self.config.get_keepalive_settings()
+        self.deadlines = TimingWheel(now=time.monotonic())
         
-        # 📊 ตัวแปรสำหรับสถิติ
+        # 📚 ข้อมูลหลักแบ่งเป็น shard แต่ละ shard มี lock ของตัวเอง (ดู sharded_state.py)
+        #    lock ของ shard ใน clients ดูแลข้อมูล session ของ client ใน shard นั้นด้วย
+        #    (subscribed_topics, will, mqtt_client_id)
+        shards = self.config.get_lock_shards()
+        self.clients = ShardedMap('clients', shards)        # เก็บข้อมูล Client ที่เชื่อมต่อ
+        self.subscriptions = ShardedTopicTrie(                # เก็บ Topic filter -> Client ที่ Subscribe
+            wildcards=self.config.is_wildcard_subscriptions_enabled(),
+            cache_size=self.config.get_match_cache_size(),
+            shard_count=shards
+        )
+        self.topics = TopicHistory(                           # เก็บข้อความล่าสุดของแต่ละ Topic (ring buffer)
+            depth=self.config.get_max_messages_per_topic(),
+            max_bytes=self.config.get_topic_history_max_bytes(),
+            max_topics=self.config.get_max_topics(),
+            shard_count=shards
+        )
+        
+        # 🧹 ทิ้งประวัติของ topic ที่ไม่มีการ publish นานเกินไป (topics.auto_cleanup)
+        self.topic_cleanup = self.config.get_topic_cleanup_settings()
+        self.connection_ids = itertools.count(1)            # ลำดับการเชื่อมต่อ (ใช้สร้าง client ID)
+        
+        # 📊 ตัวแปรสำหรับสถิติ (ตัวนับเพิ่มค่าได้โดยไม่ต้องใช้ lock)
         self.stats = {
-            'total_connections': 0,
-            'active_connections': 0,
-            'total_messages': 0,
-            'total_subscriptions': 0,
+            'total_connections': StatCounter(),
+            'active_connections': StatCounter(),
+            'total_messages': StatCounter(),
+            'total_subscriptions': StatCounter(),
+            'qos_retransmitted': StatCounter(),     # ข้อความ QoS 1 ที่ส่งซ้ำเพราะไม่ได้ PUBACK
+            'qos_dropped': StatCounter(),           # ข้อความ QoS 1 ที่ทิ้งเพราะคิวของ window เต็ม (client ที่หลุดไปแล้ว)
+            'timed_out': StatCounter(),             # client ที่ถูกตัดเพราะเงียบนานเกินกำหนด
+            'messages_delivered': StatCounter(),    # ข้อความที่ส่งให้ subscriber (นับต่อผู้รับ)
             'start_time': None
         }
+        self.fanout = Histogram(FANOUT_BUCKETS)     # จำนวนผู้รับต่อหนึ่ง publish
         
         # 🌐 Socket หลักสำหรับรอรับการเชื่อมต่อ
         self.server_socket = None
         
-        # 🔒 Lock สำหรับ Thread Safety
-        self.lock = threading.Lock()
-        
         # ตั้งค่า Logging
         self.setup_logging()
         
+        # 📌 ข้อความที่ publish ด้วย retain (features.retained_messages) เก็บลงไฟล์ใน storage.data_dir
+        self.retained = self.open_retained_store() if self.config.is_retained_messages_enabled() else None
+        
+        # 📒 log ของทุก publish สำหรับ durable mode (durability.enabled) เก็บใน storage.data_dir/log
+        self.durability = self.config.get_durability_settings()
+        self.message_log = self.open_message_log() if self.durability['enabled'] else None
+        
+        # 💤 session ถาวรของ client ที่ขอ clean_session = 0 (sessions.enabled)
+        #    ข้อความที่ค้างเกินหน่วยความจำเก็บใน storage.data_dir/sessions
+        self.session_settings = self.config.get_session_settings()
+        self.sessions = self.open_session_store() if self.session_settings['enabled'] else None
+        
+        # ⏱️ latency ของข้อความแต่ละขั้น (latency.enabled) เปิด/ปิดระหว่างทำงานได้ทาง POST /latency
+        latency = self.config.get_latency_settings()
+        self.latency = LatencyTracker(
+            f'{self.host}:{self.port}',
+            enabled=latency['enabled'],
+            prefix_levels=latency['topic_prefix_levels'],
+            max_prefixes=latency['max_prefixes'],
+            sample_every=latency['sample_every']
+        )
+        
+        # 📈 endpoint /metrics (metrics.enabled) ค่าต่อวินาทีคำนวณใหม่ทุก performance.stats_interval
+        self.metrics_settings = self.config.get_metrics_settings()
+        self.stats_interval = self.config.get_stats_interval()
+        self.metrics = self.build_metrics()
+        self.metrics_server = None
+        
+        # 📡 สถิติใน topic $SYS/broker/... (sys_topics.enabled) ส่งทุก sys_topics.interval วินาที
+        #    เฉพาะเมื่อมี client subscribe ใต้ $SYS อยู่
+        self.sys_settings = self.config.get_sys_topics_settings()
+        self.sys_topics = self.build_sys_topics()
+        
+        # 🔬 profiler ที่เปิด/ปิดได้ระหว่างทำงาน ผลเขียนลง profiling.directory
+        #    ปิดอยู่ไม่มี hook ใดทำงาน (thread ที่อ่านข้อมูลแค่เทียบ reference หนึ่งครั้งต่อการอ่าน)
+        self.profiling = self.config.get_profiling_settings()
+        self.profiler = ProfilerControl(
+            self.profiling['directory'],
+            sample_interval=self.profiling['sample_interval_ms'] / 1000,
+            memory_frames=self.profiling['memory_frames'],
+            on_cpu_change=self.profile_event_loop
+        )
+        
     def setup_logging(self):
         """
         📝 ตั้งค่าระบบ Logging
         
-        จะสร้างไฟล์ log เพื่อบันทึกกิจกรรมทั้งหมด
+        จะสร้างไฟล์ log เพื่อบันทึกกิจกรรมทั้งหมด (หมุนไฟล์ตาม logging.max_file_size / backup_count)
+        thread ของ broker แค่ใส่ log ลงคิว การเขียน console และไฟล์จริงทำใน thread เขียน log แยก
+        log ของเหตุการณ์ที่เกิดถี่ (publish, เชื่อมต่อ, subscribe) จำกัดตาม logging.hot_path_per_second
         """
+        settings = self.config.get_logging_settings()
+        
         # สร้าง formatter สำหรับจัดรูปแบบ log
         formatter = logging.Formatter(
             '%(asctime)s | %(levelname)s | %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S'
         )
         
+        handlers = []
+        
         # ตั้งค่า console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
+        if settings['console']:
+            handlers.append(logging.StreamHandler())
+        
+        # ตั้งค่า file handler (หมุนไฟล์เมื่อเกินขนาด)
+        if settings['file']:
+            handlers.append(file_handler(
+                settings['filename'], parse_size(settings['max_file_size']), settings['backup_count']
+            ))
         
-        # ตั้งค่า file handler
-        file_handler = logging.FileHandler('broker.log', encoding='utf-8')
-        file_handler.setFormatter(formatter)
+        for handler in handlers:
+            handler.setFormatter(formatter)
         
-        # ตั้งค่า main logger
+        # ตั้งค่า main logger: ส่ง log เข้าคิวของ thread เขียน log
         self.logger = logging.getLogger('MQTTBroker')
-        self.logger.setLevel(logging.INFO)
-        self.logger.addHandler(console_handler)
-        self.logger.addHandler(file_handler)
+        self.logger.setLevel(getattr(logging, str(settings['level']).upper(), logging.INFO))
+        self.log_pipeline = LogPipeline(handlers, settings['queue_size']).install(self.logger)
+        
+        # 🚦 log ของเหตุการณ์ที่เกิดถี่: format เฉพาะที่ผ่านโควตาต่อวินาที
+        self.publish_log = RateLimitedLog(self.logger, settings['hot_path_per_second'])
+        self.client_log = RateLimitedLog(self.logger, settings['hot_path_per_second'])
+        
+    def open_retained_store(self):
+        """
+        📌 เปิดที่เก็บ retained message (โหลดของเดิมจากไฟล์ถ้ามี)
+        
+        Returns:
+            RetainedStore: ที่เก็บ (ถ้าเปิดไฟล์ไม่ได้จะเก็บในหน่วยความจำแทน)
+        """
+        data_dir = self.config.get_data_dir()
+        path = os.path.join(data_dir, 'retained.db') if data_dir else None
+        try:
+            store = RetainedStore(path)
+        except OSError as e:
+            self.logger.warning(f"⚠️ เปิดไฟล์ retained ไม่ได้ ({e}) เก็บในหน่วยความจำแทน")
+            store = RetainedStore()
+        
+        loaded = store.stats()
+        if loaded['topics']:
+            self.logger.info(f"📌 โหลด retained message {loaded['topics']} topic ใน {loaded['load_ms']:.1f} ms")
+        return store
+        
+    def open_session_store(self):
+        """
+        💤 สร้างที่เก็บ session ถาวร (ไฟล์ spill ที่ค้างจากการรันครั้งก่อนถูกลบ)
+        
+        Returns:
+            SessionStore: ที่เก็บ (ถ้าใช้โฟลเดอร์ไม่ได้จะเก็บในหน่วยความจำแทน)
+        """
+        settings = self.session_settings
+        data_dir = self.config.get_data_dir()
+        directory = os.path.join(data_dir, 'sessions') if data_dir else None
+        try:
+            return SessionStore(directory, settings['memory_messages'], settings['max_queued_messages'])
+        except OSError as e:
+            self.logger.warning(f"⚠️ ใช้โฟลเดอร์ของ session ไม่ได้ ({e}) เก็บข้อความที่ค้างในหน่วยความจำแทน")
+            return SessionStore(None, settings['memory_messages'], settings['max_queued_messages'])
+        
+    def open_message_log(self):
+        """
+        📒 เปิด log ของข้อความ ตรวจ/ซ่อม segment ล่าสุดหลัง crash
+        และโหลดข้อความท้าย log กลับเข้าประวัติของ topic
+        
+        Returns:
+            MessageLog: log ที่พร้อมเขียนต่อ
+        """
+        settings = self.durability
+        directory = os.path.join(self.config.get_data_dir() or 'data', 'log')
+        message_log = MessageLog(
+            directory,
+            mode=settings['mode'],
+            fsync_interval_ms=settings['fsync_interval_ms'],
+            segment_bytes=settings['segment_bytes'],
+            retention_bytes=settings['retention_bytes'],
+            retention_hours=settings['retention_hours']
+        )
+        
+        recovered = message_log.stats()
+        if message_log.recovered_bytes:
+            self.logger.warning(
+                f"🩺 ตัด record ที่เขียนไม่ครบท้าย log ทิ้ง {message_log.recovered_bytes} bytes"
+            )
+        restored = 0
+        for offset, timestamp, topic, client_id, payload in message_log.tail(self.topics.depth * 1000):
+            self.topics.append(
+                topic, payload, client_id, datetime.fromtimestamp(timestamp).isoformat()
+            )
+            restored += 1
+        self.logger.info(
+            f"📒 Durable log ({settings['mode']}): {recovered['segments']} segment "
+            f"offset ถัดไป {recovered['next_offset']} | โหลดกลับเข้าประวัติ {restored} ข้อความ"
+        )
+        return message_log
         
     def start(self):
         """
         🚀 เริ่มต้น MQTT Broker
         
-        สร้าง socket และเริ่มรอรับการเชื่อมต่อ
+        สร้าง socket และเริ่มรอรับการเชื่อมต่อด้วย engine ที่เลือกไว้
         """
         try:
-            # สร้าง socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            
-            # bind กับ host และ port
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)  # รอรับการเชื่อมต่อได้สูงสุด 5 คิว
-            
             self.running = True
             self.stats['start_time'] = datetime.now()
             
-            self.logger.info(f"🚀 MQTT Broker เริ่มทำงานแล้ว!")
-            self.logger.info(f"📍 รอรับการเชื่อมต่อที่ {self.host}:{self.port}")
+            # เปิด endpoint /metrics ก่อนรับ client
+            if self.metrics_settings['enabled']:
+                self.start_metrics_server()
+            
+            # SIGUSR1 / SIGUSR2 เปิด-ปิด profiler
+            self.install_profiling_signals()
             
             # เริ่ม thread สำหรับแสดงสถิติ
             stats_thread = threading.Thread(target=self.show_stats_periodically)
             stats_thread.daemon = True
             stats_thread.start()
             
-            # รอรับการเชื่อมต่อ
-            while self.running:
-                try:
-                    client_socket, client_address = self.server_socket.accept()
-                    
-                    # สร้างข้อมูล client ใหม่
-                    client_id = f"client_{len(self.clients) + 1}_{int(time.time())}"
-                    
-                    with self.lock:
-                        self.clients[client_id] = {
-                            'socket': client_socket,
-                            'address': client_address,
-                            'connected_at': datetime.now(),
-                            'subscribed_topics': set(),
-                            'last_activity': datetime.now()
-                        }
-                        self.stats['total_connections'] += 1
-                        self.stats['active_connections'] += 1
-                    
-                    self.logger.info(f"✅ Client ใหม่เชื่อมต่อ: {client_id} จาก {client_address}")
-                    
-                    # สร้าง thread สำหรับจัดการ client นี้
-                    client_thread = threading.Thread(
-                        target=self.handle_client, 
-                        args=(client_id, client_socket)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                    
-                except socket.error as e:
-                    if self.running:
-                        self.logger.error(f"❌ เกิดข้อผิดพลาดในการรอรับการเชื่อมต่อ: {e}")
+            # เริ่ม thread ตัด client ที่เงียบนานเกินกำหนด
+            reaper_thread = threading.Thread(target=self.reap_idle_clients_periodically)
+            reaper_thread.daemon = True
+            reaper_thread.start()
+            
+            # เริ่ม thread publish สถิติใน $SYS
+            if self.sys_settings['enabled']:
+                sys_thread = threading.Thread(target=self.publish_sys_topics_periodically)
+                sys_thread.daemon = True
+                sys_thread.start()
+            
+            # เริ่ม thread ทำความสะอาดประวัติของ topic ที่เงียบไปแล้ว
+            if self.topic_cleanup['auto_cleanup']:
+                cleanup_thread = threading.Thread(target=self.cleanup_topics_periodically)
+                cleanup_thread.daemon = True
+                cleanup_thread.start()
+            
+            if self.engine == 'asyncio':
+                self.serve_asyncio()
+            else:
+                self.serve_threaded()
                     
         except Exception as e:
             self.logger.error(f"💥 เกิดข้อผิดพลาดร้ายแรง: {e}")
         finally:
             self.stop()
             
-    def handle_client(self, client_id, client_socket):
+    def build_metrics(self):
+        """
+        📈 ลงทะเบียน metric ทั้งหมดของ broker
+        
+        ทุกตัวอ่านจากตัวนับที่ปรับค่าอยู่แล้วระหว่างทำงาน (StatCounter หรือตัวนับของแต่ละ shard)
+        การ scrape จึงไม่เดินดู client หรือ topic ทีละตัว
+        
+        Returns:
+            MetricsRegistry: metric ทั้งหมด
+        """
+        registry = MetricsRegistry()
+        stats = self.stats
+        traffic = self.backpressure_stats
+        listener = f'{self.host}:{self.port}'
+        
+        registry.counter('mqtt_connections_total', 'จำนวน connection ที่รับมาทั้งหมด',
+                         lambda: stats['total_connections'].value)
+        registry.gauge('mqtt_connections_active', 'จำนวน connection ที่ต่ออยู่',
+                       lambda: stats['active_connections'].value)
+        registry.counter('mqtt_clients_timed_out_total', 'client ที่ถูกตัดเพราะเงียบนานเกินกำหนด',
+                         lambda: stats['timed_out'].value)
+        registry.counter('mqtt_messages_published_total', 'ข้อความที่ client publish เข้ามา',
+                         lambda: stats['total_messages'].value)
+        registry.counter('mqtt_messages_delivered_total', 'ข้อความที่ส่งให้ subscriber (นับต่อผู้รับ)',
+                         lambda: stats['messages_delivered'].value)
+        registry.rate('mqtt_messages_published_per_second', 'publish ต่อวินาทีในรอบ stats_interval ล่าสุด',
+                      lambda: stats['total_messages'].value)
+        registry.rate('mqtt_messages_delivered_per_second', 'ข้อความที่ส่งต่อวินาทีในรอบ stats_interval ล่าสุด',
+                      lambda: stats['messages_delivered'].value)
+        registry.histogram('mqtt_publish_fanout', 'จำนวน subscriber ที่ได้รับต่อหนึ่ง publish', self.fanout)
+        registry.counter('mqtt_subscribe_requests_total', 'คำขอ subscribe ที่สำเร็จ',
+                         lambda: stats['total_subscriptions'].value)
+        registry.gauge('mqtt_subscriptions', 'จำนวน subscription ใน trie',
+                       lambda: self.subscriptions.subscription_count)
+        registry.gauge('mqtt_topic_filters', 'จำนวน topic filter ที่มี subscriber',
+                       lambda: len(self.subscriptions))
+        registry.gauge('mqtt_history_messages', 'ข้อความที่เก็บในประวัติของ topic',
+                       lambda: self.topics.stats()['messages'])
+        registry.counter('mqtt_bytes_received_total', 'byte ที่อ่านจาก client', lambda: traffic.received_bytes.value)
+        registry.counter('mqtt_bytes_sent_total', 'byte ที่ส่งให้ client', lambda: traffic.sent_bytes.value)
+        registry.gauge('mqtt_outbound_queued_bytes', 'byte ที่ค้างในคิวขาออกของทุก client',
+                       lambda: traffic.queued_bytes.value)
+        registry.gauge('mqtt_outbound_queued_frames', 'frame ที่ค้างในคิวขาออกของทุก client',
+                       lambda: traffic.queued_frames.value)
+        registry.counter('mqtt_backpressure_events_total', 'เหตุการณ์ของ backpressure แยกตามชนิด',
+                         lambda: {(('event', name),): count for name, count in traffic.snapshot().items()})
+        registry.counter('mqtt_listener_errors_total', 'connection ที่มีปัญหาแยกตาม listener และสาเหตุ',
+                         lambda: {(('listener', listener), ('reason', reason)): count
+                                  for reason, count in traffic.error_snapshot().items()})
+        registry.counter('mqtt_qos_retransmitted_total', 'ข้อความ QoS 1 ที่ส่งซ้ำเพราะไม่ได้ PUBACK',
+                         lambda: stats['qos_retransmitted'].value)
+        registry.counter('mqtt_qos_dropped_total', 'ข้อความ QoS 1 ที่ทิ้ง (ของ client ที่หลุดไปแล้ว)',
+                         lambda: stats['qos_dropped'].value)
+        registry.gauge('mqtt_keepalive_tracked', 'client ที่ติดตาม keepalive อยู่ใน timing wheel',
+                       lambda: len(self.deadlines))
+        if self.sessions is not None:
+            registry.gauge('mqtt_sessions', 'จำนวน session ถาวร', lambda: len(self.sessions))
+        registry.gauge('mqtt_latency_enabled', 'เปิดการวัด latency อยู่ไหม (1 = เปิด)',
+                       lambda: int(self.latency.enabled))
+        registry.summary('mqtt_message_latency_seconds', 'เวลาตั้งแต่รับข้อมูลจนถึงแต่ละขั้นของข้อความ',
+                         self.latency_summary)
+        registry.counter('mqtt_log_records_dropped_total', 'log ที่ทิ้งเพราะคิวของ thread เขียน log เต็ม',
+                         lambda: self.log_pipeline.stats()['dropped'])
+        registry.gauge('mqtt_uptime_seconds', 'เวลาที่ broker ทำงานมา',
+                       lambda: (datetime.now() - stats['start_time']).total_seconds() if stats['start_time'] else 0.0)
+        return registry
+        
+    def latency_summary(self):
+        """
+        ⏱️ percentile ของ latency แต่ละขั้นในรูปแบบของ summary (หน่วยวินาที)
+        
+        Returns:
+            dict: labels -> ([(quantile, วินาที), ...], ผลรวมวินาที, จำนวน)
+        """
+        listener = self.latency.listener
+        per_prefix = bool(self.latency.prefix_levels)
+        summary = {}
+        for (prefix, stage), values in self.latency.snapshot(per_prefix).items():
+            labels = (('listener', listener), ('stage', stage))
+            if per_prefix:
+                labels += (('prefix', prefix),)
+            summary[labels] = (
+                [(quantile, value / 1e9) for quantile, value in zip(QUANTILES, values['quantiles'])],
+                values['sum'] / 1e9,
+                values['count']
+            )
+        return summary
+        
+    def control_latency(self, params):
+        """
+        🎛️ เปิด/ปิด/ล้างค่าการวัด latency ระหว่างทำงาน (POST /latency?enabled=true|false&reset=true)
+        
+        Args:
+            params (dict): query string ของคำขอ
+            
+        Returns:
+            str: สถานะหลังเปลี่ยน
+        """
+        flags = {'true': True, '1': True, 'on': True, 'false': False, '0': False, 'off': False}
+        for key in ('enabled', 'reset'):
+            if key in params and params[key].lower() not in flags:
+                raise ValueError(f"{key} ต้องเป็น true หรือ false")
+        if 'enabled' in params:
+            self.latency.set_enabled(flags[params['enabled'].lower()])
+            self.logger.info(f"⏱️ {'เปิด' if self.latency.enabled else 'ปิด'}การวัด latency")
+        if flags.get(params.get('reset', 'false').lower()):
+            self.latency.reset()
+        return f"latency enabled={str(self.latency.enabled).lower()}\n"
+        
+    def start_metrics_server(self):
+        """
+        🌐 เปิด endpoint /metrics ใน thread แยก (เปิดไม่ได้ก็ยังทำงานต่อโดยไม่มี metrics)
+        """
+        settings = self.metrics_settings
+        # POST /latency ต้องใช้ profiling.admin_token (ไม่ได้ตั้ง = รับเฉพาะจาก localhost)
+        server = MetricsServer(self.metrics, settings['host'], settings['port'],
+                               token=self.profiling['admin_token'])
+        server.add_action('/latency', self.control_latency)
+        try:
+            port = server.start()
+        except OSError as e:
+            self.logger.warning(f"⚠️ เปิด endpoint metrics ที่ port {settings['port']} ไม่ได้: {e}")
+            return
+        self.metrics_server = server
+        self.logger.info(f"📈 Prometheus metrics ที่ http://{settings['host']}:{port}/metrics")
+        
+    def build_sys_topics(self):
+        """
+        📡 ลงทะเบียนค่าที่ publish ใน $SYS/broker/... (อ่านจากตัวนับชุดเดียวกับ /metrics)
+        
+        Returns:
+            SysTopics: ตัว publish ที่ไม่ทำอะไรเลยถ้าไม่มีใคร subscribe ใต้ $SYS
+        """
+        sys_topics = SysTopics(self.subscriptions, self.publish_system)
+        stats = self.stats
+        traffic = self.backpressure_stats
+        
+        sys_topics.value('uptime',
+                         lambda: int((datetime.now() - stats['start_time']).total_seconds()) if stats['start_time'] else 0)
+        sys_topics.value('clients/connected', lambda: stats['active_connections'].value)
+        sys_topics.value('clients/total', lambda: stats['total_connections'].value)
+        sys_topics.value('clients/timed_out', lambda: stats['timed_out'].value)
+        sys_topics.value('messages/received', lambda: stats['total_messages'].value)
+        sys_topics.value('messages/delivered', lambda: stats['messages_delivered'].value)
+        sys_topics.rate('messages/received/per_second', lambda: stats['total_messages'].value)
+        sys_topics.rate('messages/delivered/per_second', lambda: stats['messages_delivered'].value)
+        sys_topics.value('messages/qos_retransmitted', lambda: stats['qos_retransmitted'].value)
+        sys_topics.value('messages/qos_dropped', lambda: stats['qos_dropped'].value)
+        sys_topics.value('subscriptions/count', lambda: self.subscriptions.subscription_count)
+        sys_topics.value('subscriptions/filters', lambda: len(self.subscriptions))
+        sys_topics.value('subscriptions/total', lambda: stats['total_subscriptions'].value)
+        sys_topics.value('topics/count', lambda: len(self.topics))
+        if self.retained is not None:
+            sys_topics.value('retained/count', lambda: len(self.retained))
+        if self.sessions is not None:
+            sys_topics.value('sessions/count', lambda: len(self.sessions))
+        sys_topics.value('queue/bytes', lambda: traffic.queued_bytes.value)
+        sys_topics.value('queue/frames', lambda: traffic.queued_frames.value)
+        sys_topics.value('bytes/received', lambda: traffic.received_bytes.value)
+        sys_topics.value('bytes/sent', lambda: traffic.sent_bytes.value)
+        return sys_topics
+        
+    def install_profiling_signals(self):
+        """
+        🔬 ให้ SIGUSR1 เปิด/ปิด profiler แบบ profiling.signal_mode และ SIGUSR2 เปิด/ปิด tracemalloc
+        
+        ข้ามไปถ้าระบบไม่มี signal เหล่านี้ (Windows) หรือไม่ได้เรียกจาก main thread
+        """
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            return
+        
+        def on_signal(mode):
+            # handler ทำงานใน main thread ระหว่างคำสั่งใดก็ได้ (เช่น กลาง accept หรือตอนถือ lock)
+            # การเขียนไฟล์จึงทำใน thread แยก
+            def handler(signum, frame):
+                worker = threading.Thread(target=self.toggle_profiler, args=(mode, 'signal'))
+                worker.daemon = True
+                worker.start()
+            return handler
+        
+        signal_mode = self.profiling['signal_mode']
+        if signal_mode not in MODES:
+            self.logger.warning(f"⚠️ profiling.signal_mode '{signal_mode}' ไม่ถูกต้อง ใช้ 'cpu' แทน")
+            signal_mode = 'cpu'
+        signal.signal(signal.SIGUSR1, on_signal(signal_mode))
+        signal.signal(signal.SIGUSR2, on_signal('memory'))
+        self.logger.info(f"🔬 kill -USR1 {os.getpid()} เปิด/ปิด {signal_mode} profiling, "
+                         f"kill -USR2 เปิด/ปิด tracemalloc (ผลอยู่ใน {self.profiling['directory']})")
+        
+    def toggle_profiler(self, mode, source):
+        """
+        🔀 เปิด/ปิด profiler แล้วบอกใน log ว่าเริ่มวัดหรือเขียนผลไว้ที่ไหน
+        
+        Args:
+            mode (str): 'cpu', 'sampling' หรือ 'memory'
+            source (str): ที่มาของคำสั่ง (ใช้ใน log)
+            
+        Returns:
+            list: ไฟล์ที่เขียน ([] = เพิ่งเริ่มวัด, None = เกิดข้อผิดพลาด)
+        """
+        try:
+            files = self.profiler.toggle(mode)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"❌ เปิด/ปิด {mode} profiling ไม่ได้ ({source}): {e}")
+            return None
+        if files:
+            self.logger.info(f"🔬 หยุด {mode} profiling ({source}) เขียนผลที่ {', '.join(files)}")
+        else:
+            self.logger.info(f"🔬 เริ่ม {mode} profiling ({source})")
+        return files
+        
+    def profile_event_loop(self):
+        """
+        🔬 ให้ event loop ของ engine asyncio เข้าร่วม/ออกจาก cProfile รอบปัจจุบัน
+        
+        cProfile วัดเฉพาะ thread ที่เปิดมัน จึงต้องให้ thread ของ loop เรียก follow() เอง
+        (thread ของ engine threaded เรียกเองตอนอ่านข้อมูลรอบถัดไป)
+        """
+        engine = self.async_engine
+        if engine is not None and engine.loop is not None and not engine.loop.is_closed():
+            engine.loop.call_soon_threadsafe(self.profiler.follow)
+        
+    def log_started(self):
+        """
+        📢 แจ้งว่า Broker พร้อมรับการเชื่อมต่อแล้ว
+        """
+        self.logger.info(f"🚀 MQTT Broker เริ่มทำงานแล้ว! (engine: {self.engine}, protocol: {self.protocol})")
+        self.logger.info(f"📍 รอรับการเชื่อมต่อที่ {self.host}:{self.port}")
+        
+    def serve_threaded(self):
+        """
+        🧵 Engine แบบเดิม: สร้าง thread หนึ่งตัวต่อ client หนึ่งตัว
+        """
+        # สร้าง socket
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        
+        # bind กับ host และ port
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.config.get('broker', 'max_connections', 100))  # ขนาดคิวรอ accept
+        
+        self.log_started()
+        
+        # รอรับการเชื่อมต่อ
+        while self.running:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+                
+                # สร้าง thread สำหรับจัดการ client นี้
+                client_thread = threading.Thread(
+                    target=self.serve_connection, 
+                    args=(client_socket, client_address)
+                )
+                client_thread.daemon = True
+                client_thread.start()
+                
+            except socket.error as e:
+                if self.running:
+                    self.backpressure_stats.error('accept')
+                    self.logger.error(f"❌ เกิดข้อผิดพลาดในการรอรับการเชื่อมต่อ: {e}")
+                    
+    def serve_asyncio(self):
+        """
+        ⚡ Engine แบบ asyncio: ทุก connection ใช้ event loop เดียวกัน
+        
+        ใช้ handler เดิมทั้งหมด ทั้ง JSON-line และ MQTT binary
+        """
+        self.async_engine = AsyncioEngine(
+            self.host,
+            self.port,
+            on_connect=self.register_client,
+            on_frames=self.process_frames,
+            on_disconnect=self.disconnect_client,
+            backlog=self.config.get('broker', 'max_connections', 100),
+            protocol=self.protocol,
+            on_packet=self.process_mqtt_packet,
+            read_size=self.read_size,
+            outbound_limits=self.outbound_limits,
+            backpressure_stats=self.backpressure_stats,
+            detect_timeout=self.keepalive['keepalive_timeout'] or None,
+            latency=self.latency
+        )
+        self.async_engine.run(on_ready=self.log_started)
+        
+    def serve_connection(self, client_socket, client_address):
+        """
+        🔌 ดูแล connection หนึ่งตัวตั้งแต่ต้นจนจบ (engine แบบ threaded)
+        
+        ถ้าตั้ง protocol เป็น 'auto' จะรอ byte แรกก่อนเพื่อเลือก handler
+        
+        Args:
+            client_socket (socket): socket ของ client
+            client_address (tuple): ที่อยู่ของ client
+        """
+        protocol = self.protocol
+        if protocol == 'auto':
+            protocol = self.detect_client_protocol(client_socket)
+            if protocol is None:
+                client_socket.close()
+                return
+        
+        # ข้อมูลขาออกผ่านคิวของ client เอง ผู้ publish จึงไม่ต้องรอ socket ของ subscriber
+        writer = SocketWriter(
+            client_socket,
+            name=f'writer-{client_address[1]}',
+            limits=self.outbound_limits,
+            stats=self.backpressure_stats
+        )
+        client_id = self.register_client(writer, client_address, protocol)
+        if protocol == 'mqtt':
+            self.handle_mqtt_client(client_id, client_socket, writer)
+        else:
+            self.handle_client(client_id, client_socket, writer)
+            
+    def detect_client_protocol(self, client_socket):
+        """
+        🔎 แอบดู byte แรกของ connection (MSG_PEEK ไม่ดึงข้อมูลออกจาก socket)
+        
+        Args:
+            client_socket (socket): socket ของ client
+            
+        Returns:
+            str: 'json' หรือ 'mqtt' (None ถ้า connection ปิดหรือไม่ส่งอะไรมาภายใน keepalive_timeout)
+        """
+        client_socket.settimeout(self.keepalive['keepalive_timeout'] or None)
+        try:
+            first = client_socket.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return None
+        if not first:
+            return None
+        return detect_protocol(first[0])
+        
+    def register_client(self, client_socket, client_address, protocol='json'):
+        """
+        👤 ลงทะเบียน client ใหม่
+        
+        Args:
+            client_socket: socket (หรือ object ที่มี send/close) ของ client
+            client_address (tuple): ที่อยู่ของ client
+            protocol (str): 'json' หรือ 'mqtt'
+            
+        Returns:
+            str: ID ของ client
+        """
+        # สร้างข้อมูล client ใหม่ (ใช้ลำดับการเชื่อมต่อเพื่อไม่ให้ ID ซ้ำ)
+        client_id = f"client_{next(self.connection_ids)}_{int(time.time())}"
+        # MQTT ใช้ keepalive_timeout จนกว่าจะได้ CONNECT (แล้วเปลี่ยนเป็นตาม keepalive ของ client)
+        timeout = self.keepalive['keepalive_timeout' if protocol == 'mqtt' else 'client_timeout']
+        now = time.monotonic()
+        self.clients.put(client_id, {
+            'socket': client_socket,
+            'address': client_address,
+            'connected_at': datetime.now(),
+            'subscribed_topics': set(),
+            'last_activity': now,       # time.monotonic() ของข้อมูลล่าสุดที่ได้รับ
+            'timeout': timeout,         # วินาทีที่เงียบได้ก่อนถูกตัด (0 = ไม่ตัด)
+            'protocol': protocol,
+            'mqtt_client_id': None,     # ได้จาก CONNECT (MQTT binary) หรือ connect (JSON-line)
+            'will': None,               # will message (เฉพาะ MQTT binary)
+            'session': None,            # Session ถาวรที่ใช้อยู่ (None = clean session)
+            'qos_filters': {},          # topic filter -> QoS ที่ได้รับ (เฉพาะ QoS > 0, แทนทั้ง dict เมื่อเปลี่ยน)
+            'inflight': InflightWindow(self.qos['inflight_window'], self.qos['max_pending_messages']),
+            'retry': lambda: self.retry_inflight(client_id)
+        })
+        if timeout:
+            self.deadlines.schedule(client_id, now + timeout)
+        self.stats['total_connections'].add()
+        self.stats['active_connections'].add()
+        
+        self.client_log.log("✅ Client ใหม่เชื่อมต่อ: %s จาก %s", client_id, client_address)
+        return client_id
+            
+    def handle_client(self, client_id, client_socket, writer=None):
         """
         🤝 จัดการ Client แต่ละตัว
         
         Args:
             client_id (str): ID ของ client
             client_socket (socket): socket ของ client
+            writer (SocketWriter): คิวขาออกของ client นี้ (รอก่อนอ่านเมื่อ policy 'pause' ขอจาก thread อื่น)
         """
+        # ข้อมูลหนึ่งชุดอาจมีหลายข้อความ หรือข้อความเดียวอาจมาไม่ครบ
+        # decoder จะเก็บไว้จนได้บรรทัดที่สมบูรณ์
+        decoder = LineFrameDecoder(self.read_size)
+        received = self.backpressure_stats.received_bytes
+        latency = self.latency
+        profiler = self.profiler
+        profiling = None
+        
+        # รอรับข้อมูลแบบ block: client ที่เงียบเกินกำหนดถูกตัดโดย reap_idle_clients
+        # และการปิด socket (รวมถึงตอนหยุด broker) ทำให้ recv คืนค่าเอง
+        client_socket.settimeout(None)
         try:
             while self.running:
                 try:
-                    # รอรับข้อมูลจาก client (timeout 1 วินาที)
-                    client_socket.settimeout(1.0)
-                    data = client_socket.recv(1024)
-                    
-                    if not data:
+                    if writer is not None:
+                        writer.wait_if_paused()
+                    nbytes = decoder.recv_into(client_socket)
+                    if not nbytes:
                         break
+                    received.add(nbytes)
+                    latency.received()
+                    if profiler.cpu is not profiling:
+                        profiling = profiler.follow()
+                    
+                    # ประมวลผลทุกบรรทัดที่ครบแล้ว
+                    frames = decoder.decode()
+                    if frames:
+                        self.process_frames(client_id, frames)
                     
-                    # อัพเดทเวลาการใช้งานล่าสุด
-                    with self.lock:
-                        if client_id in self.clients:
-                            self.clients[client_id]['last_activity'] = datetime.now()
+                except socket.error:
+                    break
                     
-                    # ประมวลผลข้อมูลที่รับมา
-                    self.process_message(client_id, data)
+        except FrameTooLargeError as e:
+            self.backpressure_stats.error('frame_too_large')
+            self.logger.warning(f"⚠️ {client_id} {e}")
+        except Exception as e:
+            self.backpressure_stats.error('connection')
+            self.logger.error(f"❌ เกิดข้อผิดพลาดกับ client {client_id}: {e}")
+        finally:
+            # ปิดการเชื่อมต่อและลบข้อมูล client (will message ไม่ใช้เวลา ingress ของข้อมูลชุดสุดท้าย)
+            latency.finished()
+            self.disconnect_client(client_id)
+            
+    def handle_mqtt_client(self, client_id, client_socket, writer=None):
+        """
+        📦 จัดการ Client ที่พูด MQTT 3.1.1 (binary)
+        
+        อ่านข้อมูลลง buffer ของ decoder โดยตรง (recv_into) แล้วแยกเป็น packet
+        
+        Args:
+            client_id (str): ID ของ client
+            client_socket (socket): socket ของ client
+            writer (SocketWriter): คิวขาออกของ client นี้ (รอก่อนอ่านเมื่อ policy 'pause' ขอจาก thread อื่น)
+        """
+        decoder = MQTTStreamDecoder(self.read_size)
+        received = self.backpressure_stats.received_bytes
+        latency = self.latency
+        profiler = self.profiler
+        profiling = None
+        client_socket.settimeout(None)
+        try:
+            while self.running:
+                try:
+                    if writer is not None:
+                        writer.wait_if_paused()
+                    nbytes = decoder.recv_into(client_socket)
+                    if not nbytes:
+                        break
+                    received.add(nbytes)
+                    latency.received()
+                    if profiler.cpu is not profiling:
+                        profiling = profiler.follow()
                     
-                except socket.timeout:
-                    # Timeout ปกติ ไม่ต้องทำอะไร
-                    continue
+                    # handler คืนค่า False เมื่อต้องปิด connection
+                    if not all(self.process_mqtt_packet(client_id, packet) for packet in decoder.decode()):
+                        break
+                        
                 except socket.error:
                     break
                     
+        except MQTTProtocolError as e:
+            self.backpressure_stats.error('protocol')
+            self.logger.warning(f"⚠️ {client_id} ส่ง MQTT packet ไม่ถูกต้อง: {e}")
         except Exception as e:
+            self.backpressure_stats.error('connection')
             self.logger.error(f"❌ เกิดข้อผิดพลาดกับ client {client_id}: {e}")
         finally:
-            # ปิดการเชื่อมต่อและลบข้อมูล client
+            latency.finished()
             self.disconnect_client(client_id)
             
+    def process_mqtt_packet(self, client_id, packet):
+        """
+        📦 ประมวลผล MQTT packet หนึ่งตัว
+        
+        packet ถูกแปลงเป็น dict รูปแบบเดียวกับ JSON protocol แล้ว
+        จึงส่งต่อให้ handle_publish / handle_subscribe เดิมได้เลย
+        
+        Args:
+            client_id (str): ID ของ client
+            packet (dict): packet ที่ถอดรหัสแล้ว
+            
+        Returns:
+            bool: False ถ้าต้องปิด connection
+        """
+        self.stats['total_messages'].add()
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        # เขียนค่าเดียวลง dict ของ client ไม่ต้องใช้ lock (ไม่แตะ timing wheel)
+        client['last_activity'] = time.monotonic()
+        connected = client['mqtt_client_id'] is not None
+        
+        packet_type = packet['type']
+        
+        if packet_type == 'connect':
+            if connected:
+                self.logger.warning(f"⚠️ {client_id} ส่ง CONNECT ซ้ำ")
+                return False
+            return self.handle_mqtt_connect(client_id, packet)
+        
+        if not connected:
+            self.logger.warning(f"⚠️ {client_id} ต้องส่ง CONNECT ก่อน packet อื่น")
+            return False
+        
+        if packet_type == 'publish':
+            if has_wildcard(packet['topic']):
+                self.logger.warning(f"⚠️ {client_id} publish ไปยัง topic ที่มี wildcard")
+                return False
+            # ตอบ PUBACK/PUBREC หลังรับข้อความแล้ว (ถ้าเปิด durability จะรอให้ลงดิสก์ก่อน)
+            ack = None
+            if packet['qos'] == 1:
+                ack = encode_puback(packet['packet_id'])
+            elif packet['qos'] == 2:
+                ack = encode_pubrec(packet['packet_id'])
+            self.handle_publish(client_id, {
+                'topic': packet['topic'],
+                'payload': packet['payload'],
+                'qos': packet['qos'],
+                'retain': packet['retain']
+            }, on_accepted=(lambda: self.send_raw(client_id, ack)) if ack else None)
+                
+        elif packet_type == 'pubrel':
+            self.send_raw(client_id, encode_pubcomp(packet['packet_id']))
+            
+        elif packet_type == 'puback':
+            self.handle_puback(client_id, packet['packet_id'])
+            
+        elif packet_type == 'subscribe':
+            # ตอบ SUBACK ก่อน แล้วค่อยส่งข้อความล่าสุดของ topic (ตามลำดับของมาตรฐาน)
+            # QoS ที่ได้รับคือ QoS ที่ขอแต่ไม่เกิน max_qos (QoS 2 ขาออกลดเหลือ 1)
+            wildcards = self.subscriptions.wildcards
+            return_codes = [
+                min(qos, self.max_qos) if not wildcards or is_valid_filter(topic_filter) else SUBACK_FAILURE
+                for topic_filter, qos in packet['topics']
+            ]
+            self.send_raw(client_id, encode_suback(packet['packet_id'], return_codes))
+            for (topic_filter, qos), code in zip(packet['topics'], return_codes):
+                if code != SUBACK_FAILURE:
+                    self.handle_subscribe(client_id, {'topic': topic_filter, 'qos': code})
+                    
+        elif packet_type == 'unsubscribe':
+            for topic_filter in packet['topics']:
+                self.handle_unsubscribe(client_id, {'topic': topic_filter})
+            self.send_raw(client_id, encode_unsuback(packet['packet_id']))
+            
+        elif packet_type == 'ping':
+            self.handle_ping(client_id)
+            
+        elif packet_type == 'disconnect':
+            # ตัดการเชื่อมต่ออย่างปกติ ไม่ต้องส่ง will message
+            with self.clients.lock_for(client_id):
+                client['will'] = None
+            return False
+        
+        return True
+        
+    def handle_mqtt_connect(self, client_id, packet):
+        """
+        🤝 จัดการ CONNECT และตอบ CONNACK
+        
+        Args:
+            client_id (str): ID ของ connection
+            packet (dict): CONNECT packet
+            
+        Returns:
+            bool: False ถ้าปฏิเสธการเชื่อมต่อ
+        """
+        protocol = (packet['protocol_name'], packet['protocol_level'])
+        if protocol not in (('MQTT', 4), ('MQIsdp', 3)):
+            self.logger.warning(f"⚠️ {client_id} ใช้ protocol ที่ไม่รองรับ: {protocol}")
+            self.send_raw(client_id, encode_connack(CONNACK_BAD_PROTOCOL))
+            return False
+        
+        if not packet['client_id'] and not packet['clean_session']:
+            self.send_raw(client_id, encode_connack(CONNACK_IDENTIFIER_REJECTED))
+            return False
+        
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is None:
+                return False
+            client['mqtt_client_id'] = packet['client_id'] or client_id
+            client['will'] = packet['will']
+            client['keepalive'] = packet['keepalive']
+            # มาตรฐาน MQTT: ตัดเมื่อเงียบเกิน 1.5 เท่าของ keepalive (keepalive 0 ใช้ client_timeout)
+            client['timeout'] = packet['keepalive'] * 1.5 or self.keepalive['client_timeout']
+            connection = client['socket']
+        
+        if client['timeout']:
+            self.deadlines.schedule(client_id, client['last_activity'] + client['timeout'])
+        else:
+            self.deadlines.cancel(client_id)
+        
+        # policy เฉพาะ client (เช่น dashboard ที่ต้องการแค่ค่าล่าสุดใช้ conflate)
+        limits = self.client_limits.get(packet['client_id'])
+        if limits:
+            connection.set_limits(limits)
+        
+        session, present = self.resume_session(client_id, client['mqtt_client_id'], packet['clean_session'])
+        self.send_raw(client_id, encode_connack(CONNACK_ACCEPTED, present))
+        self.client_log.log(
+            "🤝 %s CONNECT เป็น '%s' (MQTT%s)",
+            client_id, client['mqtt_client_id'], ', session ถาวร' if session is not None else ''
+        )
+        if session is not None:
+            self.start_session_restore(client_id, session, present)
+        return True
+        
+    def handle_connect(self, client_id, message):
+        """
+        🤝 connect ของ JSON-line: ใช้ client id ของ client เองและขอ session ถาวรได้
+        
+        ต้องเป็นข้อความแรกของ connection ตอบกลับด้วย
+        {"type": "connack", "session_present": bool, "queued": จำนวนข้อความที่ค้าง}
+        
+        Args:
+            client_id (str): ID ของ connection
+            message (dict): {"type": "connect", "client_id": "...", "clean_session": false}
+        """
+        session_id = message.get('client_id')
+        clean_session = bool(message.get('clean_session', True))
+        
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is None:
+                return
+            error = None
+            if client['mqtt_client_id'] is not None or client['subscribed_topics']:
+                error = 'connect ต้องเป็นข้อความแรกของ connection'
+            elif not session_id and not clean_session:
+                error = 'session ถาวรต้องระบุ client_id'
+            else:
+                client['mqtt_client_id'] = session_id or client_id
+            connection = client['socket']
+        
+        if error:
+            self.logger.warning(f"⚠️ {client_id} ส่ง connect ไม่ถูกต้อง: {error}")
+            self.send_to_client(client_id, {'type': 'connack', 'session_present': False, 'error': error})
+            return
+        
+        limits = self.client_limits.get(session_id)
+        if limits:
+            connection.set_limits(limits)
+        
+        session, present = self.resume_session(client_id, client['mqtt_client_id'], clean_session)
+        self.send_to_client(client_id, {
+            'type': 'connack',
+            'session_present': present,
+            'queued': len(session.queue) if session is not None else 0
+        })
+        self.client_log.log(
+            "🤝 %s connect เป็น '%s' (JSON%s)",
+            client_id, client['mqtt_client_id'], ', session ถาวร' if session is not None else ''
+        )
+        if session is not None:
+            self.start_session_restore(client_id, session, present)
+            
+    def resume_session(self, client_id, session_id, clean_session):
+        """
+        💤 ผูก connection กับ session ถาวรของ client id
+        
+        clean_session ลบ session เดิม (ถ้ามี) connection จึงเริ่มใหม่หมดและไม่มี session ถาวร
+        ถ้า client id นี้ยังเชื่อมต่ออยู่ทางอีก connection หนึ่ง connection เดิมถูกตัดก่อน (session takeover)
+        
+        Args:
+            client_id (str): ID ของ connection
+            session_id (str): client id ที่ client ส่งมา
+            clean_session (bool): ไม่ต้องการ session ถาวร
+            
+        Returns:
+            tuple: (Session หรือ None, True ถ้ามี session เดิมอยู่แล้ว)
+        """
+        if self.sessions is None:
+            return None, False
+        
+        existing = self.sessions.get(session_id)
+        if existing is not None and existing.connection not in (None, client_id):
+            self.logger.info(f"🔁 '{session_id}' เชื่อมต่อใหม่ ตัด connection เดิม {existing.connection}")
+            self.disconnect_client(existing.connection)
+        if clean_session:
+            if existing is not None:
+                self.discard_session(existing)
+            return None, False
+        
+        session, present = self.sessions.open(session_id)
+        self.deadlines.cancel(session.key)
+        with self.clients.lock_for(client_id):
+            client = self.clients.get(client_id)
+            if client is not None:
+                # subscription เดิมยังอยู่ใต้ key ของ session จนกว่า restore_session จะส่งข้อความที่ค้างครบ
+                session.attach(client_id)
+                client['session'] = session
+                client['subscribed_topics'] = set(session.subscriptions)
+                client['qos_filters'] = {topic: qos for topic, qos in session.subscriptions.items() if qos}
+        if client is None:
+            # connection หลุดไประหว่างนี้: session กลับไปรอเหมือนเดิม
+            self.suspend_session(session)
+            return None, False
+        return session, present
+        
+    def start_session_restore(self, client_id, session, present):
+        """
+        🚚 เริ่มส่งข้อความที่ค้างใน session (session ใหม่ไม่มีอะไรค้าง จึงทำต่อได้ทันที)
+        
+        Args:
+            client_id (str): ID ของ connection
+            session (Session): session ที่ผูกแล้ว
+            present (bool): เป็น session เดิม
+        """
+        if not present:
+            self.restore_session(client_id, session)
+            return
+        restore_thread = threading.Thread(
+            target=self.restore_session,
+            args=(client_id, session),
+            name=f'session-{client_id}'
+        )
+        restore_thread.daemon = True
+        restore_thread.start()
+        
+    def restore_session(self, client_id, session):
+        """
+        📦 ส่งข้อความที่ค้างใน session ให้ client ทีละ chunk แล้วย้าย subscription กลับมาที่ connection
+        
+        ระหว่างนี้ subscription ยังอยู่ใต้ key ของ session ข้อความใหม่จึงต่อท้ายคิว (ไม่แซงข้อความเก่า)
+        เมื่อคิวว่าง session จะ online ข้อความที่ตามมาส่งตรงถึง connection
+        
+        Args:
+            client_id (str): ID ของ connection
+            session (Session): session ที่ผูกกับ connection นี้
+        """
+        restored = list(session.subscriptions)
+        sent = 0
+        try:
+            while self.running:
+                batch = session.take(client_id, REPLAY_CHUNK_SIZE)
+                if batch is None:
+                    return          # client หลุดไปแล้ว ข้อความที่เหลือยังอยู่ในคิว
+                if not batch:
+                    break
+                if not self.send_session_batch(client_id, batch):
+                    session.requeue(batch)
+                    return
+                sent += len(batch)
+        except Exception as e:
+            self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่างส่งข้อความที่ค้างให้ {client_id}: {e}")
+            return
+        
+        with self.clients.lock_for(client_id):
+            if client_id not in self.clients:
+                return
+            subscribed_topics = self.clients.get(client_id)['subscribed_topics']
+            for topic in restored:
+                if topic in subscribed_topics:
+                    self.subscriptions.subscribe(topic, client_id)
+                self.subscriptions.unsubscribe(topic, session.key)
+        if sent:
+            self.logger.info(f"📦 ส่งข้อความที่ค้างใน session '{session.client_id}' ให้ {client_id} ครบ {sent} ข้อความ")
+            
+    def send_session_batch(self, client_id, batch):
+        """
+        📦 ส่งข้อความที่ค้างหนึ่ง chunk เมื่อคิวขาออกและ in-flight window ของ client มีที่ว่าง
+        
+        ข้อความส่งแบบไม่มี topic จึงไม่ถูกทิ้งตาม backpressure policy (การรอก่อนส่งคุมขนาดไว้แล้ว)
+        
+        Args:
+            client_id (str): ID ของ connection
+            batch (list): [[qos, message], ...] จาก OfflineQueue
+            
+        Returns:
+            bool: False ถ้า client หลุดไประหว่างรอ
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        queue = client['socket']
+        window = client['inflight']
+        # ข้อความ QoS 1 ของ chunk ก่อนหน้ายังรอที่ว่างใน window: รอก่อน ไม่ให้ล้น max_pending_messages
+        while window.pending:
+            if window.closed or not self.running:
+                return False
+            time.sleep(0.01)
+        while not queue.wait_for_room(timeout=1.0):
+            if queue.closing or not self.running:
+                return False
+        for qos, message in batch:
+            if qos:
+                self.send_qos1(client_id, client, message)
+            elif not self.send_frame(client_id, queue, self.encode_message(client['protocol'], message)):
+                return False
+        return True
+        
+    def suspend_session(self, session, subscriptions=None):
+        """
+        💤 client ของ session หลุด: subscription อยู่ใต้ key ของ session ต่อ และเริ่มนับเวลาหมดอายุ
+        
+        Args:
+            session (Session): session
+            subscriptions (dict): topic filter -> QoS ของ client ตอนหลุด (None = ใช้ของเดิม)
+        """
+        session.suspend(session.subscriptions if subscriptions is None else subscriptions)
+        for topic in session.subscriptions:
+            self.subscriptions.subscribe(topic, session.key)
+        if self.session_settings['expiry']:
+            self.deadlines.schedule(session.key, time.monotonic() + self.session_settings['expiry'])
+            
+    def discard_session(self, session):
+        """
+        🗑️ ลบ session ถาวร (client ขอ clean session หรือ session หมดอายุ) พร้อมข้อความที่ค้าง
+        
+        Args:
+            session (Session): session ที่จะลบ
+        """
+        self.deadlines.cancel(session.key)
+        for topic in session.subscriptions:
+            self.subscriptions.unsubscribe(topic, session.key)
+        self.sessions.discard(session)
+        
+    def process_frames(self, client_id, frames):
+        """
+        📦 ประมวลผลข้อความ JSON-line ที่ได้จากการอ่านหนึ่งครั้ง
+        
+        อัพเดทเวลาใช้งานและสถิติครั้งเดียวต่อ batch แล้วค่อยประมวลผลทีละข้อความ
+        
+        Args:
+            client_id (str): ID ของ client ที่ส่งมา
+            frames (list): ข้อความแต่ละบรรทัด (str)
+        """
+        self.stats['total_messages'].add(len(frames))
+        client = self.clients.get(client_id)
+        if client is not None:
+            client['last_activity'] = time.monotonic()
+        
+        for frame in frames:
+            self.process_message(client_id, frame)
+            
     def process_message(self, client_id, data):
         """
         📨 ประมวลผลข้อความที่รับมา
@@ -208,43 +1226,58 @@ class MQTTBroker:
         
         Args:
             client_id (str): ID ของ client ที่ส่งมา
-            data (bytes): ข้อมูลที่ได้รับ
+            data (str): ข้อความหนึ่งบรรทัด
         """
         try:
-            # แปลงข้อมูลเป็น string และ parse JSON
-            message_str = data.decode('utf-8').strip()
-            message = json.loads(message_str)
-            
-            # เพิ่มจำนวนข้อความทั้งหมด
-            with self.lock:
-                self.stats['total_messages'] += 1
+            # parse JSON
+            message = json.loads(data)
             
             # ตรวจสอบประเภทของข้อความ
             msg_type = message.get('type')
             
             if msg_type == 'publish':
-                self.handle_publish(client_id, message)
+                # QoS 1 ที่มี packet_id: ตอบ puback หลังรับข้อความแล้ว (เหมือน MQTT binary)
+                packet_id = message.get('packet_id')
+                ack = {'type': 'puback', 'packet_id': packet_id}
+                self.handle_publish(
+                    client_id, message,
+                    on_accepted=(lambda: self.send_to_client(client_id, ack))
+                    if message.get('qos') and packet_id is not None else None
+                )
+            elif msg_type == 'puback':
+                self.handle_puback(client_id, message.get('packet_id'))
             elif msg_type == 'subscribe':
                 self.handle_subscribe(client_id, message)
             elif msg_type == 'unsubscribe':
                 self.handle_unsubscribe(client_id, message)
             elif msg_type == 'ping':
                 self.handle_ping(client_id)
+            elif msg_type == 'connect':
+                self.handle_connect(client_id, message)
+            elif msg_type == 'replay':
+                self.handle_replay(client_id, message)
+            elif msg_type == 'admin':
+                self.handle_admin(client_id, message)
             else:
                 self.logger.warning(f"⚠️ ได้รับข้อความประเภทไม่รู้จาก {client_id}: {msg_type}")
                 
         except json.JSONDecodeError as e:
+            self.backpressure_stats.error('invalid_json')
             self.logger.error(f"❌ ข้อมูลจาก {client_id} ไม่ใช่ JSON ที่ถูกต้อง: {e}")
         except Exception as e:
             self.logger.error(f"💥 เกิดข้อผิดพลาดในการประมวลผลข้อความจาก {client_id}: {e}")
             
-    def handle_publish(self, client_id, message):
+    def handle_publish(self, client_id, message, on_accepted=None):
         """
         📤 จัดการข้อความประเภท Publish
         
+        ถ้าเปิด durability ข้อความจะถูกเขียนลง log ก่อน แล้วจึงเก็บประวัติและส่งต่อ
+        (mode sync ทำหลัง fsync ของ batch นั้นจาก thread ของ log)
+        
         Args:
             client_id (str): ID ของ client ที่ส่ง
             message (dict): ข้อความที่ได้รับ
+            on_accepted (Callable): เรียกหลังส่งต่อแล้ว เช่น ตอบ PUBACK
         """
         try:
             topic = message.get('topic')
@@ -254,28 +1287,74 @@ class MQTTBroker:
                 self.logger.warning(f"⚠️ {client_id} ส่ง publish แต่ไม่มี topic")
                 return
             
-            # เก็บข้อความใน topic (เก็บ 10 ข้อความล่าสุด)
+            # topic ใต้ $SYS เป็นของ broker: ไม่ส่งต่อ (แต่ยังตอบ PUBACK client จะได้ไม่ส่งซ้ำ)
+            if topic.partition('/')[0] == SYS_PREFIX:
+                self.logger.warning(f"⚠️ {client_id} publish ไปยัง '{topic}' ไม่ได้ (topic ของ broker)")
+                if on_accepted is not None:
+                    on_accepted()
+                return
+            
             message_data = {
                 'payload': payload,
                 'client_id': client_id,
                 'timestamp': datetime.now().isoformat(),
-                'qos': message.get('qos', 0)
+                'qos': self.parse_qos(message.get('qos'))
             }
             
-            with self.lock:
-                self.topics[topic].append(message_data)
-                # เก็บเฉพาะ 10 ข้อความล่าสุด
-                if len(self.topics[topic]) > 10:
-                    self.topics[topic] = self.topics[topic][-10:]
+            # ⏱️ trace ของ latency (None ถ้าปิดการวัด) ส่งต่อไปถึงตัวเขียน socket ของ subscriber
+            trace = self.latency.begin(topic)
+            if trace is not None:
+                trace.parsed()
             
-            self.logger.info(f"📤 {client_id} publish ไปยัง '{topic}': {payload}")
+            self.publish_log.log("📤 %s publish ไปยัง '%s': %s", client_id, topic, payload)
             
-            # ส่งข้อความไปยัง subscriber ทั้งหมด
-            self.broadcast_to_subscribers(topic, message_data)
+            if self.message_log is not None:
+                self.message_log.append(
+                    topic, client_id, payload,
+                    on_durable=lambda offset: self.deliver_publish(
+                        topic, message_data, message.get('retain'), on_accepted, offset, trace
+                    )
+                )
+            else:
+                self.deliver_publish(topic, message_data, message.get('retain'), on_accepted, trace=trace)
             
         except Exception as e:
             self.logger.error(f"💥 เกิดข้อผิดพลาดใน handle_publish: {e}")
             
+    def deliver_publish(self, topic, message_data, retain=False, on_accepted=None, offset=None, trace=None):
+        """
+        📬 เก็บข้อความที่รับแล้วลงประวัติ/retained แล้วส่งให้ subscriber
+        
+        Args:
+            topic (str): topic
+            message_data (dict): ข้อความ (payload, client_id, timestamp, qos)
+            retain (bool): เก็บเป็น retained message ด้วย
+            on_accepted (Callable): เรียกหลังส่งต่อแล้ว
+            offset (int): offset ใน log (durable mode) ส่งให้ subscriber ใช้ขอ replay ต่อ
+            trace (LatencyTrace): trace ของ latency (None = ไม่วัด)
+        """
+        payload = message_data['payload']
+        if offset is not None:
+            message_data['offset'] = offset
+        
+        # เก็บข้อความใน ring buffer ของ topic (จำนวนตาม topics.max_messages_per_topic)
+        self.topics.append(
+            topic, payload, message_data['client_id'], message_data['timestamp'], message_data['qos']
+        )
+        
+        # retain: เก็บเป็นข้อความที่ส่งให้ผู้ subscribe ใหม่ (payload ว่าง = ลบ ตามมาตรฐาน MQTT)
+        if retain and self.retained is not None:
+            if payload in ('', b'', None):
+                self.retained.pop(topic)
+            else:
+                self.retained.put(topic, message_data)
+        
+        # ส่งข้อความไปยัง subscriber ทั้งหมด
+        self.broadcast_to_subscribers(topic, message_data, trace)
+        
+        if on_accepted is not None:
+            on_accepted()
+            
     def handle_subscribe(self, client_id, message):
         """
         📥 จัดการข้อความประเภท Subscribe
@@ -289,31 +1368,76 @@ class MQTTBroker:
             
             if not topic:
                 self.logger.warning(f"⚠️ {client_id} ส่ง subscribe แต่ไม่มี topic")
-                return
+                return False
             
-            with self.lock:
-                # เพิ่ม topic ให้กับ client
-                if client_id in self.clients:
-                    self.clients[client_id]['subscribed_topics'].add(topic)
-                
-                # เพิ่ม client ใน subscription list
-                self.subscriptions[topic].add(client_id)
-                self.stats['total_subscriptions'] += 1
+            if self.subscriptions.wildcards and not is_valid_filter(topic):
+                self.logger.warning(f"⚠️ {client_id} ส่ง topic filter ไม่ถูกต้อง: '{topic}'")
+                return False
             
-            self.logger.info(f"📥 {client_id} subscribe topic: '{topic}'")
+            qos = min(self.parse_qos(message.get('qos')), self.max_qos)
             
-            # ส่งข้อความล่าสุดใน topic นี้ให้ client (ถ้ามี)
-            if topic in self.topics and self.topics[topic]:
-                latest_message = self.topics[topic][-1]
-                self.send_to_client(client_id, {
-                    'type': 'message',
-                    'topic': topic,
-                    'payload': latest_message['payload'],
-                    'timestamp': latest_message['timestamp']
-                })
+            # ถือ lock ของ client ไว้ระหว่างเพิ่มลง trie
+            # disconnect_client จึงไม่พลาด subscription ที่เพิ่มเข้ามาพร้อมกัน
+            with self.clients.lock_for(client_id):
+                client = self.clients.get(client_id)
+                if client is None:
+                    return False
+                client['subscribed_topics'].add(topic)
+                # filter ของ session ที่ยังส่งข้อความที่ค้างไม่ครบ: restore_session ย้ายมาให้เอง
+                # (subscribe ตอนนี้จะได้ข้อความซ้ำกับในคิวและแซงข้อความเก่า)
+                session = client['session']
+                if session is None or session.online or topic not in session.subscriptions:
+                    self.subscriptions.subscribe(topic, client_id)
+                # แทน dict ใหม่ทั้งก้อน broadcast จึงอ่าน qos_filters ได้โดยไม่ต้องใช้ lock
+                if qos or topic in client['qos_filters']:
+                    qos_filters = dict(client['qos_filters'])
+                    if qos:
+                        qos_filters[topic] = qos
+                    else:
+                        qos_filters.pop(topic, None)
+                    client['qos_filters'] = qos_filters
+            self.stats['total_subscriptions'].add()
+            
+            # หา topic ที่มีข้อความเก็บไว้และตรงกับ filter นี้
+            latest_messages = self.latest_messages(topic)
+            
+            self.client_log.log("📥 %s subscribe topic: '%s' (QoS %s)", client_id, topic, qos)
+            
+            # ส่งข้อความล่าสุดของแต่ละ topic ที่ตรงกับ filter ให้ client (ถ้ามี) ในฐานะ retained message
+            for matched_topic, latest_message in latest_messages:
+                self.send_retained(client_id, client, matched_topic, latest_message, qos)
+            
+            return True
                 
         except Exception as e:
             self.logger.error(f"💥 เกิดข้อผิดพลาดใน handle_subscribe: {e}")
+            return False
+            
+    def send_retained(self, client_id, client, topic, message_data, granted_qos):
+        """
+        📌 ส่ง retained message ให้ client ที่เพิ่ง subscribe
+        
+        ข้อความมี flag retain [MQTT-3.3.1-8] และส่งด้วย QoS ที่ต่ำกว่าระหว่าง QoS ตอน publish
+        กับ QoS ที่ client ได้รับ (QoS 1 ผ่าน in-flight window เหมือนข้อความสด)
+        
+        Args:
+            client_id (str): ID ของ client
+            client (dict): ข้อมูล client
+            topic (str): topic ของข้อความ
+            message_data (dict): ข้อความที่เก็บไว้ (payload, timestamp, qos)
+            granted_qos (int): QoS ที่ client ได้รับจากการ subscribe
+        """
+        message = {
+            'type': 'message',
+            'topic': topic,
+            'payload': message_data['payload'],
+            'timestamp': message_data['timestamp'],
+            'retain': True
+        }
+        if min(message_data.get('qos', 0), granted_qos):
+            self.send_qos1(client_id, client, message)
+        else:
+            self.send_to_client(client_id, message)
             
     def handle_unsubscribe(self, client_id, message):
         """
@@ -330,23 +1454,282 @@ class MQTTBroker:
                 self.logger.warning(f"⚠️ {client_id} ส่ง unsubscribe แต่ไม่มี topic")
                 return
             
-            with self.lock:
+            with self.clients.lock_for(client_id):
                 # ลบ topic จาก client
-                if client_id in self.clients:
-                    self.clients[client_id]['subscribed_topics'].discard(topic)
-                
-                # ลบ client จาก subscription list
-                self.subscriptions[topic].discard(client_id)
+                client = self.clients.get(client_id)
+                if client is not None:
+                    client['subscribed_topics'].discard(topic)
+                    if topic in client['qos_filters']:
+                        qos_filters = dict(client['qos_filters'])
+                        del qos_filters[topic]
+                        client['qos_filters'] = qos_filters
                 
-                # ถ้าไม่มี subscriber แล้ว ลบ topic ออก
-                if not self.subscriptions[topic]:
-                    del self.subscriptions[topic]
+                # ลบ client จาก subscription trie (node ที่ว่างจะถูกลบเอง)
+                self.subscriptions.unsubscribe(topic, client_id)
             
-            self.logger.info(f"📤 {client_id} unsubscribe topic: '{topic}'")
+            self.client_log.log("📤 %s unsubscribe topic: '%s'", client_id, topic)
             
         except Exception as e:
             self.logger.error(f"💥 เกิดข้อผิดพลาดใน handle_unsubscribe: {e}")
             
+    @staticmethod
+    def parse_qos(value):
+        """
+        🔢 แปลง QoS จากข้อความ JSON (ค่าที่ไม่ถูกต้องถือเป็น 0)
+        
+        Args:
+            value: QoS ที่ client ส่งมา
+        """
+        try:
+            return min(max(int(value or 0), 0), 2)
+        except (TypeError, ValueError):
+            return 0
+        
+    def latest_messages(self, topic_filter):
+        """
+        🕘 ข้อความล่าสุดของทุก topic ที่ตรงกับ filter
+        
+        ถ้าเปิด features.retained_messages จะใช้เฉพาะข้อความที่ publish ด้วย retain
+        ไม่เช่นนั้นใช้ข้อความล่าสุดในประวัติของ topic
+        filter ที่มี wildcard ต้องดูทุก shard (ถือ lock ทีละ shard)
+        
+        Args:
+            topic_filter (str): topic หรือ filter ที่ subscribe
+            
+        Returns:
+            list: [(topic, message_data), ...]
+        """
+        wildcard = self.subscriptions.wildcards and has_wildcard(topic_filter)
+        if self.retained is not None:
+            if wildcard:
+                return self.retained.matching(topic_filter)
+            latest = self.retained.get(topic_filter)
+        elif wildcard:
+            return self.topics.latest_matching(topic_filter)
+        else:
+            latest = self.topics.latest(topic_filter)
+        return [(topic_filter, latest)] if latest else []
+        
+    def handle_replay(self, client_id, message):
+        """
+        ⏪ จัดการคำขอ replay: ส่งข้อความที่เก็บใน log ตั้งแต่ offset หรือเวลาที่ขอ
+        
+        ส่งจาก thread แยกทีละ chunk จึงไม่ขวางการรับ-ส่งข้อความสด
+        จบด้วยข้อความ replay_end ที่บอก offset ถัดไปสำหรับขอต่อครั้งหน้า
+        
+        Args:
+            client_id (str): ID ของ client
+            message (dict): {"topic": filter, "from_offset": int หรือ "from_time": epoch/ISO, "limit": int}
+        """
+        topic_filter = message.get('topic')
+        if not topic_filter:
+            self.logger.warning(f"⚠️ {client_id} ส่ง replay แต่ไม่มี topic")
+            return
+        
+        # คำขอที่ replay ไม่ได้ก็ตอบ replay_end (count 0 พร้อม error) client จะได้ไม่รอค้าง
+        if self.subscriptions.wildcards and not is_valid_filter(topic_filter):
+            self.logger.warning(f"⚠️ {client_id} ส่ง topic filter ไม่ถูกต้อง: '{topic_filter}'")
+            self.send_replay_error(client_id, topic_filter, f"topic filter ไม่ถูกต้อง: '{topic_filter}'")
+            return
+        
+        if self.message_log is None:
+            self.send_replay_error(client_id, topic_filter, 'replay ใช้ได้เมื่อเปิด durability.enabled')
+            return
+        
+        try:
+            from_time = self.parse_timestamp(message.get('from_time'))
+            from_offset = int(message.get('from_offset') or 0)
+            limit = int(message.get('limit') or 0)
+        except (TypeError, ValueError) as e:
+            self.logger.warning(f"⚠️ {client_id} ส่ง replay ที่มีค่าไม่ถูกต้อง: {e}")
+            self.send_replay_error(client_id, topic_filter, f"ค่าในคำขอ replay ไม่ถูกต้อง: {e}")
+            return
+        
+        self.logger.info(f"⏪ {client_id} replay '{topic_filter}' ตั้งแต่ "
+                         f"{message.get('from_time') or f'offset {from_offset}'}")
+        replay_thread = threading.Thread(
+            target=self.stream_replay,
+            args=(client_id, topic_filter, from_offset, from_time, limit),
+            name=f'replay-{client_id}'
+        )
+        replay_thread.daemon = True
+        replay_thread.start()
+        
+    def send_replay_error(self, client_id, topic_filter, error):
+        """
+        ⏹️ ตอบคำขอ replay ที่ทำไม่ได้ด้วย replay_end ที่มี error (ไม่มีข้อความ)
+        
+        Args:
+            client_id (str): ID ของ client
+            topic_filter (str): topic หรือ filter ที่ขอ
+            error (str): สาเหตุ
+        """
+        self.send_to_client(client_id, {
+            'type': 'replay_end',
+            'replay': topic_filter,
+            'count': 0,
+            'error': error
+        })
+        
+    @staticmethod
+    def parse_timestamp(value):
+        """
+        🕒 แปลงเวลาจากคำขอ (epoch วินาที หรือ ISO 8601) เป็น epoch วินาที
+        
+        Returns:
+            float: เวลา (None ถ้าไม่ได้ระบุ)
+        """
+        if value in (None, ''):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        return datetime.fromisoformat(value).timestamp()
+        
+    def stream_replay(self, client_id, topic_filter, from_offset, from_time, limit=0):
+        """
+        📼 อ่านข้อความจาก log แล้วส่งให้ client ทีละ chunk (ทำงานใน thread ของ replay)
+        
+        ก่อนส่งแต่ละ chunk จะรอให้คิวขาออกของ client ลดลงถึง low watermark
+        replay จึงไม่ทำให้คิวล้นจนข้อความสดถูกทิ้ง และไม่กินหน่วยความจำเกินหนึ่ง chunk
+        
+        Args:
+            client_id (str): ID ของ client
+            topic_filter (str): topic หรือ filter ที่ต้องการ
+            from_offset (int): offset แรก
+            from_time (float): เริ่มจากเวลานี้แทน from_offset (None = ใช้ offset)
+            limit (int): จำนวนข้อความสูงสุด (0 = ไม่จำกัด)
+        """
+        end_offset = self.message_log.next_offset
+        next_offset = from_offset
+        count = 0
+        chunk = []
+        try:
+            for offset, timestamp, topic, publisher, payload in self.message_log.read(
+                from_offset, from_time, topic_filter
+            ):
+                chunk.append(self.encode_message('json', {
+                    'type': 'message',
+                    'topic': topic,
+                    'payload': payload,
+                    'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+                    'from_client': publisher,
+                    'offset': offset,
+                    'replay': topic_filter
+                }))
+                next_offset = offset + 1
+                if len(chunk) >= REPLAY_CHUNK_SIZE or (limit and count + len(chunk) >= limit):
+                    if not self.send_replay_chunk(client_id, chunk):
+                        return
+                    count += len(chunk)
+                    chunk = []
+                    if limit and count >= limit:
+                        break
+            else:
+                next_offset = max(next_offset, end_offset)
+            if chunk:
+                if not self.send_replay_chunk(client_id, chunk):
+                    return
+                count += len(chunk)
+        except Exception as e:
+            self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่าง replay ให้ {client_id}: {e}")
+            
+        self.send_to_client(client_id, {
+            'type': 'replay_end',
+            'replay': topic_filter,
+            'count': count,
+            'next_offset': next_offset
+        })
+        self.logger.info(f"⏪ replay '{topic_filter}' ให้ {client_id} ครบ {count} ข้อความ")
+        
+    def send_replay_chunk(self, client_id, frames):
+        """
+        📦 ส่ง chunk ของ replay เมื่อคิวขาออกของ client มีที่ว่าง
+        
+        frame ของ replay ส่งแบบไม่มี topic จึงไม่ถูกทิ้งหรือรวมตาม backpressure policy
+        (การรอคิวก่อนส่งแต่ละ chunk คุมขนาดไว้แล้ว)
+        
+        Returns:
+            bool: False ถ้า client หลุดไประหว่างรอ
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        queue = client['socket']
+        while not queue.wait_for_room(timeout=1.0):
+            if queue.closing or not self.running:
+                return False
+        for data in frames:
+            if not self.send_frame(client_id, queue, data):
+                return False
+        return True
+        
+    def handle_admin(self, client_id, message):
+        """
+        🔐 คำสั่ง admin ผ่าน JSON-line (ต้องมี token ตรงกับ profiling.admin_token)
+        
+        {"type": "admin", "token": "...", "command": "profile", "mode": "cpu", "action": "toggle"}
+        action: start, stop, toggle หรือ status ผลตอบกลับเป็นข้อความ type 'admin_result'
+        
+        Args:
+            client_id (str): ID ของ client
+            message (dict): คำสั่ง
+        """
+        token = self.profiling['admin_token']
+        if not token or not hmac.compare_digest(str(message.get('token', '')).encode(), str(token).encode()):
+            self.logger.warning(f"⚠️ {client_id} ส่งคำสั่ง admin แต่ token ไม่ถูกต้อง (หรือไม่ได้ตั้ง admin_token)")
+            self.send_to_client(client_id, {'type': 'admin_result', 'ok': False, 'error': 'unauthorized'})
+            return
+        
+        command = message.get('command')
+        if command != 'profile':
+            self.send_to_client(client_id, {'type': 'admin_result', 'command': command, 'ok': False,
+                                            'error': f"ไม่รู้จักคำสั่ง '{command}'"})
+            return
+        
+        # การหยุดวัดเขียนไฟล์ (อาจนานหลายวินาที) จึงทำใน thread แยก ไม่ให้ thread ที่อ่านข้อมูลหรือ event loop ค้าง
+        admin_thread = threading.Thread(
+            target=self.run_profile_command,
+            args=(client_id, message.get('mode', 'cpu'), message.get('action', 'toggle'))
+        )
+        admin_thread.daemon = True
+        admin_thread.start()
+        
+    def run_profile_command(self, client_id, mode, action):
+        """
+        🔬 ทำคำสั่ง admin 'profile' แล้วตอบผลให้ client
+        
+        Args:
+            client_id (str): ID ของ client ที่สั่ง
+            mode (str): 'cpu', 'sampling' หรือ 'memory'
+            action (str): start, stop, toggle หรือ status
+        """
+        result = {'type': 'admin_result', 'command': 'profile', 'mode': mode}
+        try:
+            if mode not in MODES:
+                raise ValueError(f"ไม่รู้จัก profiler แบบ '{mode}' (ใช้ได้: {', '.join(MODES)})")
+            if action == 'start':
+                self.profiler.start(mode)
+                files = []
+            elif action == 'stop':
+                files = self.profiler.stop(mode)
+            elif action == 'toggle':
+                files = self.profiler.toggle(mode)
+            elif action == 'status':
+                files = None
+            else:
+                raise ValueError(f"ไม่รู้จัก action '{action}' (ใช้ได้: start, stop, toggle, status)")
+        except (OSError, ValueError) as e:
+            result.update(ok=False, error=str(e), running=mode in MODES and self.profiler.running(mode))
+            self.send_to_client(client_id, result)
+            return
+        
+        if files:
+            self.logger.info(f"🔬 หยุด {mode} profiling (admin {client_id}) เขียนผลที่ {', '.join(files)}")
+        elif files is not None:
+            self.logger.info(f"🔬 เริ่ม {mode} profiling (admin {client_id})")
+        result.update(ok=True, running=self.profiler.running(mode), files=files or [])
+        self.send_to_client(client_id, result)
+        
     def handle_ping(self, client_id):
         """
         🏓 ตอบกลับ Ping
@@ -357,15 +1740,37 @@ class MQTTBroker:
         response = {'type': 'pong', 'timestamp': datetime.now().isoformat()}
         self.send_to_client(client_id, response)
         
-    def broadcast_to_subscribers(self, topic, message_data):
+    def broadcast_to_subscribers(self, topic, message_data, trace=None):
         """
         📢 ส่งข้อความไปยัง subscriber ทั้งหมดใน topic
         
         Args:
             topic (str): topic ที่จะส่ง
             message_data (dict): ข้อมูลข้อความ
+            trace (LatencyTrace): บันทึก latency ขั้น route / enqueue / write (None = ไม่วัด)
         """
-        if topic not in self.subscriptions:
+        sender_id = message_data['client_id']
+        
+        # หา subscriber จาก snapshot ของ trie (รวม filter ที่เป็น wildcard)
+        # (snapshot ไม่เปลี่ยนหลังเผยแพร่ จึงอ่านได้โดยไม่ต้องใช้ lock และไม่ต้อง copy)
+        recipients = []
+        offline = []
+        subscribers = self.subscriptions.match(topic)
+        for subscriber_id in subscribers:
+            client = self.clients.get(subscriber_id)
+            if client is not None:
+                if subscriber_id != sender_id:  # ไม่ส่งกลับให้ผู้ส่ง
+                    recipients.append((subscriber_id, client))
+            elif self.sessions is not None:
+                # subscriber ที่ไม่ใช่ connection คือ session ถาวรที่ client ไม่อยู่
+                session = self.sessions.offline(subscriber_id)
+                if session is not None and session.connection != sender_id:
+                    offline.append(session)
+        if trace is not None:
+            trace.routed()
+        
+        if not recipients and not offline:
+            self.fanout.observe(0)
             return
         
         # สร้างข้อความที่จะส่ง
@@ -376,32 +1781,293 @@ class MQTTBroker:
             'timestamp': message_data['timestamp'],
             'from_client': message_data['client_id']
         }
+        if 'offset' in message_data:
+            broadcast_message['offset'] = message_data['offset']
         
-        # ส่งให้ subscriber ทั้งหมด
-        subscribers = self.subscriptions[topic].copy()  # copy เพื่อ thread safety
+        # แปลงข้อความ QoS 0 ครั้งเดียวต่อ protocol แล้วส่ง bytes (immutable) ชุดเดียวกันให้ทุกคน
+        # QoS 1 (QoS ของ publish และของ subscription เป็น 1 ทั้งคู่) แต่ละ client มี packet id ของตัวเอง
+        qos = min(message_data['qos'], self.max_qos)
         
-        for subscriber_id in subscribers:
-            if subscriber_id != message_data['client_id']:  # ไม่ส่งกลับให้ผู้ส่ง
-                self.send_to_client(subscriber_id, broadcast_message)
+        # เก็บลงคิวของ session ที่ client ไม่อยู่ (session ที่เพิ่งส่งของค้างครบจะคืน connection มาให้ส่งตรง)
+        for session in offline:
+            session_qos = qos and self.subscription_qos(session.subscriptions, topic)
+            connection = session.offer([session_qos, broadcast_message])
+            if connection is not None and connection not in subscribers:
+                client = self.clients.get(connection)
+                if client is not None:
+                    recipients.append((connection, client))
+        
+        frames = {}
+        congested = []
+        for subscriber_id, client in recipients:
+            protocol = client['protocol']
+            client_socket = client['socket']
+            if qos and self.subscription_qos(client['qos_filters'], topic):
+                self.send_qos1(subscriber_id, client, broadcast_message, trace)
+            else:
+                data = frames.get(protocol)
+                if data is None:
+                    data = frames[protocol] = self.encode_message(protocol, broadcast_message)
+                self.send_frame(subscriber_id, client_socket, data, topic, trace)
+            if client_socket.congested and client_socket.limits.policy == 'pause':
+                congested.append(client_socket)
+        if trace is not None:
+            trace.enqueued()
+        self.stats['messages_delivered'].add(len(recipients))
+        self.fanout.observe(len(recipients))
+        
+        # policy 'pause': หยุดอ่านข้อมูลจากผู้ publish จนกว่า subscriber จะตามทัน
+        if congested:
+            self.pause_publisher(sender_id, congested)
+            
+    def publish_system(self, topic, payload):
+        """
+        📡 ส่งข้อความของ broker เอง (เช่น $SYS/broker/...) ให้ client ที่ subscribe และเชื่อมต่ออยู่
+        
+        เป็น QoS 0 ไม่เก็บประวัติหรือ retained ไม่เข้าคิวของ session ที่ client ไม่อยู่
+        และไม่นับใน messages_delivered (ค่าในสถิติจึงไม่เปลี่ยนเพราะการส่งสถิติเอง)
+        
+        Args:
+            topic (str): topic ที่จะส่ง
+            payload (str): ข้อความ
+        """
+        message = {
+            'type': 'message',
+            'topic': topic,
+            'payload': payload,
+            'timestamp': datetime.now().isoformat(),
+            'from_client': SYS_PREFIX
+        }
+        frames = {}
+        for subscriber_id in self.subscriptions.match(topic):
+            client = self.clients.get(subscriber_id)
+            if client is None:
+                continue
+            protocol = client['protocol']
+            data = frames.get(protocol)
+            if data is None:
+                data = frames[protocol] = self.encode_message(protocol, message)
+            self.send_frame(subscriber_id, client['socket'], data, topic)
+            
+    @staticmethod
+    def subscription_qos(qos_filters, topic):
+        """
+        🔢 QoS สูงสุดของ subscription ที่ตรงกับ topic
+        
+        Args:
+            qos_filters (dict): topic filter -> QoS ของ client (หรือของ session ถาวร)
+            topic (str): topic ของข้อความ
+        """
+        if not qos_filters:
+            return 0
+        qos = qos_filters.get(topic, 0)
+        for topic_filter, filter_qos in qos_filters.items():
+            if filter_qos > qos and topic_matches(topic_filter, topic):
+                qos = filter_qos
+        return qos
+        
+    def send_qos1(self, client_id, client, message, trace=None):
+        """
+        📬 ส่งข้อความแบบ QoS 1 ผ่าน in-flight window ของ client
+        
+        ถ้า window เต็ม ข้อความจะรอในคิวของ window และถูกส่งเมื่อได้ PUBACK
+        
+        Args:
+            client_id (str): ID ของ client
+            client (dict): ข้อมูล client
+            message (dict): ข้อความที่จะส่ง
+            trace (LatencyTrace): trace ของ latency (ข้อความที่รอที่ว่างใน window ไม่ถูกวัด)
+        """
+        window = client['inflight']
+        packet_id = window.submit(message)
+        if packet_id is None:
+            return
+        # ข้อความ QoS 1 ห้ามทิ้งด้วย backpressure policy (ขนาดถูกจำกัดด้วย window อยู่แล้ว)
+        self.send_frame(
+            client_id, client['socket'], self.encode_message(client['protocol'], message, packet_id), trace=trace
+        )
+        window.arm(self.timers, self.qos['retry_interval'], client['retry'])
+        
+    def handle_puback(self, client_id, packet_id):
+        """
+        ✅ client ตอบ PUBACK ของข้อความ QoS 1 แล้ว ส่งข้อความที่รอที่ว่างใน window ต่อ
+        
+        Args:
+            client_id (str): ID ของ client
+            packet_id (int): packet id ของข้อความ
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        
+        window = client['inflight']
+        acked, released = window.ack(packet_id)
+        if not acked:
+            self.logger.debug(f"🔍 {client_id} ตอบ PUBACK ของ packet id ที่ไม่ได้รอ: {packet_id}")
+            return
+        
+        for next_id, message in released:
+            self.send_frame(client_id, client['socket'], self.encode_message(client['protocol'], message, next_id))
+        if released:
+            window.arm(self.timers, self.qos['retry_interval'], client['retry'])
+            
+    def retry_inflight(self, client_id):
+        """
+        🔁 ส่งข้อความ QoS 1 ที่ยังไม่ได้ PUBACK ภายใน qos.retry_interval ซ้ำ (เรียกจาก timer)
+        
+        Args:
+            client_id (str): ID ของ client
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        
+        window = client['inflight']
+        expired, next_check = window.due(self.qos['retry_interval'])
+        for packet_id, message in expired:
+            self.send_frame(
+                client_id, client['socket'],
+                self.encode_message(client['protocol'], message, packet_id, dup=True)
+            )
+        if expired:
+            self.stats['qos_retransmitted'].add(len(expired))
+            self.logger.debug(f"🔁 ส่งข้อความ QoS 1 ซ้ำให้ {client_id}: {len(expired)} ข้อความ")
+        if next_check is not None:
+            window.arm(self.timers, next_check, client['retry'])
+            
+    def pause_publisher(self, publisher_id, queues):
+        """
+        ⏸️ หยุดอ่านข้อมูลจากผู้ publish จนกว่าคิวของ subscriber จะลดลงถึง low watermark
+        
+        Args:
+            publisher_id (str): ID ของผู้ publish
+            queues (list): คิวขาออกของ subscriber ที่เกิน high watermark
+        """
+        client = self.clients.get(publisher_id)
+        if client is None:
+            return
+        
+        client['socket'].pause_until_drained(queues)
                 
     def send_to_client(self, client_id, message):
         """
         📨 ส่งข้อความไปยัง client ที่ระบุ
         
+        ข้อความจะถูกแปลงตาม protocol ของ client:
+        JSON-line สำหรับ client แบบ JSON และ MQTT packet สำหรับ client แบบ binary
+        
         Args:
             client_id (str): ID ของ client
             message (dict): ข้อความที่จะส่ง
         """
-        try:
-            with self.lock:
-                if client_id not in self.clients:
-                    return False
-                
-                client_socket = self.clients[client_id]['socket']
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        
+        data = self.encode_message(client['protocol'], message)
+        if data is None:
+            # ข้อความประเภทนี้ไม่มีใน protocol ของ client
+            return True
+        return self.send_raw(client_id, data)
+        
+    def encode_message(self, protocol, message, packet_id=None, dup=False):
+        """
+        📦 แปลงข้อความ (dict) เป็น bytes ตาม protocol
+        
+        Args:
+            protocol (str): 'json' หรือ 'mqtt'
+            message (dict): ข้อความที่จะส่ง
+            packet_id (int): packet id ของข้อความ QoS 1 (None = QoS 0)
+            dup (bool): เป็นการส่งซ้ำ
+            
+        Returns:
+            bytes: ข้อมูลที่พร้อมส่ง (None ถ้า protocol นี้ไม่มีข้อความประเภทนี้)
+        """
+        if protocol == 'mqtt':
+            msg_type = message.get('type')
+            if msg_type == 'message':
+                payload = self.payload_to_bytes(message['payload'])
+                # retain: retained message ที่ส่งเพราะเพิ่ง subscribe [MQTT-3.3.1-8] (ข้อความสดเป็น 0 เสมอ)
+                retain = message.get('retain', False)
+                if packet_id is not None:
+                    return encode_publish(message['topic'], payload, 1, packet_id, retain=retain, dup=dup)
+                return encode_publish(message['topic'], payload, retain=retain)
+            if msg_type == 'pong':
+                return PINGRESP_PACKET
+            return None
+        
+        if isinstance(message.get('payload'), bytes):
+            # payload จาก MQTT client เป็น bytes: แปลงตอนสร้าง frame JSON เท่านั้น
+            message = dict(message, **self.payload_to_json(message['payload']))
+        if packet_id is not None:
+            message = dict(message, qos=1, packet_id=packet_id)
+            if dup:
+                message['dup'] = True
+        
+        # แปลงข้อความเป็น JSON
+        message_json = json.dumps(message, ensure_ascii=False) + '\n'
+        return message_json.encode('utf-8')
+        
+    @staticmethod
+    def payload_to_bytes(payload):
+        """
+        🔄 แปลง payload จาก JSON client ให้เป็น bytes สำหรับ MQTT client
+        
+        Args:
+            payload: ข้อความ (str), bytes หรือข้อมูล JSON อื่นๆ
+        """
+        if payload is None:
+            return b''
+        if isinstance(payload, bytes):
+            return payload
+        if isinstance(payload, str):
+            return payload.encode('utf-8')
+        return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        
+    @staticmethod
+    def payload_to_json(payload):
+        """
+        🔄 แปลง payload (bytes) จาก MQTT client เป็น field ของข้อความ JSON สำหรับ JSON client
+        
+        Args:
+            payload (bytes): ข้อมูลดิบ
             
-            # แปลงข้อความเป็น JSON และส่ง
-            message_json = json.dumps(message, ensure_ascii=False) + '\n'
-            client_socket.send(message_json.encode('utf-8'))
+        Returns:
+            dict: {'payload': string} ถ้าเป็น UTF-8 ไม่เช่นนั้น
+                  {'payload': base64, 'payload_encoding': 'base64'} (ข้อมูลไม่เสียไป)
+        """
+        try:
+            return {'payload': payload.decode('utf-8')}
+        except UnicodeDecodeError:
+            return {'payload': base64.b64encode(payload).decode('ascii'), 'payload_encoding': 'base64'}
+        
+    def send_raw(self, client_id, data):
+        """
+        📤 ส่งข้อมูลที่แปลงแล้ว (bytes) ไปยัง client
+        
+        Args:
+            client_id (str): ID ของ client
+            data (bytes): ข้อมูลที่จะส่ง
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        
+        return self.send_frame(client_id, client['socket'], data)
+        
+    def send_frame(self, client_id, client_socket, data, topic=None, trace=None):
+        """
+        📤 ใส่ข้อมูลลงคิวขาออกของ client ที่หาไว้แล้ว
+        
+        Args:
+            client_id (str): ID ของ client
+            client_socket: คิวขาออก (SocketWriter หรือ TransportConnection) ของ client
+            data (bytes): ข้อมูลที่จะส่ง (ใช้ object เดียวกันกับหลาย client ได้)
+            topic (str): topic ของข้อความ (ใช้กับ backpressure policy, None = ห้ามทิ้ง)
+            trace (LatencyTrace): บันทึก latency ขั้น write เมื่อเขียน frame ลง socket แล้ว
+        """
+        try:
+            client_socket.send(data, topic, trace)
             
             return True
             
@@ -418,49 +2084,172 @@ class MQTTBroker:
             client_id (str): ID ของ client
         """
         try:
-            with self.lock:
-                if client_id not in self.clients:
+            # เอา client ออกจาก registry ก่อน subscribe ที่มาพร้อมกันจะเห็นว่า client หายไปแล้ว
+            shard = self.clients.shard(client_id)
+            with shard.lock:
+                client = shard.data.get(client_id)
+                if client is None:
                     return
-                
-                # ปิด socket
-                try:
-                    self.clients[client_id]['socket'].close()
-                except:
-                    pass
-                
-                # ลบ subscription ทั้งหมดของ client นี้
-                subscribed_topics = self.clients[client_id]['subscribed_topics'].copy()
-                for topic in subscribed_topics:
-                    self.subscriptions[topic].discard(client_id)
-                    if not self.subscriptions[topic]:
-                        del self.subscriptions[topic]
-                
-                # ลบข้อมูล client
-                del self.clients[client_id]
-                self.stats['active_connections'] -= 1
+                subscribed_topics = client['subscribed_topics'].copy()
+                will = client['will']
+                session = client['session']
+                if session is not None:
+                    # session ถาวร: ย้าย subscription ไปไว้ใต้ key ของ session ก่อนเอา client ออก
+                    # ข้อความที่ publish ระหว่างนี้จึงไม่หาย (อาจได้ซ้ำ ตามแบบ at-least-once)
+                    self.suspend_session(session, {
+                        topic: client['qos_filters'].get(topic, 0) for topic in subscribed_topics
+                    })
+                del shard.data[client_id]
+            self.stats['active_connections'].add(-1)
+            self.deadlines.cancel(client_id)
+            
+            # ยกเลิก timer ส่งซ้ำ ข้อความ QoS 1 ที่ค้างเก็บไว้ใน session ถาวร (ไม่มี session ก็ทิ้ง)
+            unacked = client['inflight'].close()
+            self.stats['qos_dropped'].add(client['inflight'].dropped)
+            if session is not None:
+                session.requeue([[1, message] for message in unacked])
+            
+            # ปิด socket
+            try:
+                client['socket'].close()
+            except:
+                pass
+            
+            # ลบ subscription ทั้งหมดของ client นี้
+            for topic in subscribed_topics:
+                self.subscriptions.unsubscribe(topic, client_id)
             
-            self.logger.info(f"🔌 {client_id} ตัดการเชื่อมต่อแล้ว")
+            self.client_log.log("🔌 %s ตัดการเชื่อมต่อแล้ว", client_id)
+            
+            # client MQTT ที่หลุดโดยไม่ส่ง DISCONNECT: ส่ง will message แทน
+            if will:
+                self.handle_publish(client_id, {
+                    'topic': will['topic'],
+                    'payload': will['payload'],
+                    'qos': will['qos'],
+                    'retain': will['retain']
+                })
             
         except Exception as e:
             self.logger.error(f"💥 เกิดข้อผิดพลาดในการตัดการเชื่อมต่อ {client_id}: {e}")
             
     def show_stats_periodically(self):
         """
-        📊 แสดงสถิติทุกๆ 30 วินาที
+        📊 คำนวณค่าต่อวินาทีของ metrics ทุก performance.stats_interval วินาที
+        
+        พิมพ์สถิติลง log ด้วยเมื่อปิด endpoint /metrics หรือตั้ง metrics.log_stats ไว้
         """
+        log_stats = self.metrics_settings['log_stats'] or not self.metrics_settings['enabled']
         while self.running:
-            time.sleep(30)
+            time.sleep(self.stats_interval)
             if self.running:
-                self.show_stats()
+                self.metrics.update_rates()
+                if log_stats:
+                    self.show_stats()
+                
+    def publish_sys_topics_periodically(self):
+        """
+        📡 publish สถิติใน $SYS/broker/... ทุก sys_topics.interval วินาที (ไม่มีคน subscribe ก็ไม่ทำอะไร)
+        """
+        interval = self.sys_settings['interval']
+        while self.running:
+            time.sleep(interval)
+            if not self.running:
+                break
+            try:
+                self.sys_topics.tick()
+            except Exception as e:
+                self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่าง publish สถิติใน $SYS: {e}")
+                
+    def reap_idle_clients_periodically(self):
+        """
+        ⏰ ตัด client ที่เงียบนานเกินกำหนดทุก heartbeat_interval วินาที
+        """
+        interval = self.keepalive['heartbeat_interval']
+        while self.running:
+            time.sleep(interval)
+            if not self.running:
+                break
+            try:
+                self.reap_idle_clients(time.monotonic())
+            except Exception as e:
+                self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่างตรวจ client ที่เงียบ: {e}")
+                
+    def reap_idle_clients(self, now):
+        """
+        ⏰ หมุน timing wheel ถึงเวลา now แล้วตัด client ที่หมดเวลาทั้ง batch
+        
+        การรับข้อมูลแค่บันทึก last_activity ไม่ได้เลื่อน deadline ใน wheel
+        เมื่อ deadline เดิมครบจึงค่อยดู last_activity: ถ้ามีข้อมูลเข้ามาหลังจากนั้นก็เลื่อน deadline ออกไป
+        session ถาวรที่ client ไม่กลับมาภายใน sessions.expiry ก็หมดเวลาใน wheel เดียวกันนี้
+        
+        Args:
+            now (float): เวลา time.monotonic() ปัจจุบัน
+            
+        Returns:
+            int: จำนวน client ที่ถูกตัด
+        """
+        idle = []
+        expired = []
+        for client_id, _ in self.deadlines.advance(now):
+            client = self.clients.get(client_id)
+            if client is None and self.sessions is not None:
+                session = self.sessions.offline(client_id)
+                if session is not None and session.connection is None:
+                    expired.append(session)
+                continue
+            if client is None or not client['timeout']:
+                continue
+            deadline = client['last_activity'] + client['timeout']
+            if deadline > now:
+                self.deadlines.schedule(client_id, deadline)
+            else:
+                idle.append((client_id, now - client['last_activity']))
+        
+        # client MQTT ที่หมดเวลาจะส่ง will message ด้วย (เหมือนหลุดโดยไม่ส่ง DISCONNECT)
+        for client_id, silent in idle:
+            self.logger.warning(f"⏰ {client_id} ไม่มีการติดต่อมา {silent:.0f} วินาที ตัดการเชื่อมต่อ")
+            self.disconnect_client(client_id)
+        self.stats['timed_out'].add(len(idle))
+        
+        for session in expired:
+            self.logger.info(
+                f"🗑️ session '{session.client_id}' หมดอายุ ทิ้งข้อความที่ค้าง {len(session.queue)} ข้อความ"
+            )
+            self.discard_session(session)
+        return len(idle)
+        
+    def cleanup_topics_periodically(self):
+        """
+        🧹 ทิ้งประวัติของ topic ที่ไม่มีการ publish นานเกิน max_idle_time ทุก cleanup_interval วินาที
+        
+        ดูเฉพาะ topic ที่เงียบนานที่สุดของแต่ละ shard และถือ lock ทีละ batch
+        การ publish จึงไม่ต้องรอการสแกนทั้งหมด
+        """
+        interval = self.topic_cleanup['cleanup_interval']
+        max_idle = self.topic_cleanup['max_idle_time']
+        while self.running:
+            time.sleep(interval)
+            if not self.running:
+                break
+            try:
+                evicted = self.topics.sweep_idle(max_idle)
+                if evicted:
+                    self.logger.info(f"🧹 ทิ้งประวัติของ {evicted} topic ที่เงียบเกิน {max_idle} วินาที")
+            except Exception as e:
+                self.logger.error(f"💥 เกิดข้อผิดพลาดระหว่างทำความสะอาด topic: {e}")
                 
     def show_stats(self):
         """
         📊 แสดงสถิติปัจจุบัน
         """
-        with self.lock:
-            stats = self.stats.copy()
-            active_topics = len(self.subscriptions)
-            total_messages_in_topics = sum(len(messages) for messages in self.topics.values())
+        stats = {
+            name: value.value if isinstance(value, StatCounter) else value
+            for name, value in self.stats.items()
+        }
+        active_topics = len(self.subscriptions)
+        history = self.topics.stats()
+        cache = self.subscriptions.cache_stats()
         
         uptime = datetime.now() - stats['start_time'] if stats['start_time'] else 0
         
@@ -468,12 +2257,102 @@ class MQTTBroker:
         self.logger.info(f"🕒 เวลาทำงาน: {uptime}")
         self.logger.info(f"🔗 การเชื่อมต่อทั้งหมด: {stats['total_connections']}")
         self.logger.info(f"🟢 การเชื่อมต่อปัจจุบัน: {stats['active_connections']}")
+        self.logger.info(f"⏰ ตัดเพราะเงียบนานเกินกำหนด: {stats['timed_out']} (ติดตาม {len(self.deadlines)} client)")
+        if self.sessions is not None:
+            sessions = self.sessions.stats()
+            self.logger.info(
+                f"💤 Session ถาวร: {sessions['sessions']} (client ไม่อยู่ {sessions['offline']}) | "
+                f"ข้อความค้าง {sessions['queued']} (ในไฟล์ {sessions['spilled']}) | ทิ้ง {sessions['dropped']}"
+            )
         self.logger.info(f"📨 ข้อความทั้งหมด: {stats['total_messages']}")
+        self.logger.info(
+            f"📬 ส่งให้ subscriber: {stats['messages_delivered']} | "
+            f"รับ {self.backpressure_stats.received_bytes.value} bytes / ส่ง {self.backpressure_stats.sent_bytes.value} bytes"
+        )
         self.logger.info(f"📥 subscription ทั้งหมด: {stats['total_subscriptions']}")
         self.logger.info(f"📂 Topic ที่มีการใช้งาน: {active_topics}")
-        self.logger.info(f"💾 ข้อความที่เก็บไว้: {total_messages_in_topics}")
+        self.logger.info(f"💾 ข้อความที่เก็บไว้: {history['messages']} ({history['topics']} topics)")
+        if history['evicted']:
+            self.logger.info(f"🧹 topic ที่ถูกทิ้งประวัติ: {history['evicted']}")
+        if self.retained is not None:
+            retained = self.retained.stats()
+            self.logger.info(
+                f"📌 Retained: {retained['topics']} topics "
+                f"({'ไฟล์' if retained['persistent'] else 'หน่วยความจำ'} "
+                f"ใช้ {retained['live_bytes']} bytes | ถูกทับ {retained['dead_bytes']} bytes "
+                f"| compact {retained['compactions']} ครั้ง)"
+            )
+        if self.message_log is not None:
+            durable = self.message_log.stats()
+            self.logger.info(
+                f"📒 Durable log ({durable['mode']}): {durable['segments']} segment {durable['bytes']} bytes "
+                f"| offset {durable['first_offset']}-{durable['next_offset'] - 1} "
+                f"| fsync {durable['fsyncs']} ครั้ง เฉลี่ย {durable['records_per_fsync']:.1f} ข้อความ/ครั้ง"
+            )
+        if self.topics.max_bytes:
+            self.logger.info(
+                f"📦 ประวัติใช้ {history['bytes']}/{self.topics.max_bytes} bytes "
+                f"| ทิ้งเพราะเกินงบ {history['trimmed']}"
+            )
+        if cache:
+            self.logger.info(
+                f"🎯 Match cache: hit {cache['hits']} / miss {cache['misses']} "
+                f"({cache['hit_rate']:.1%}) | evict {cache['evictions']} "
+                f"| invalidate {cache['invalidations']} | snapshot {cache['snapshots']} "
+                f"| {cache['size']}/{cache['capacity']} topics"
+            )
+        if self.max_qos:
+            windows = [client['inflight'] for _, client in self.clients.items()]
+            self.logger.info(
+                f"📬 QoS 1: รอ PUBACK {sum(len(window) for window in windows)} | "
+                f"รอที่ว่างใน window {sum(len(window.pending) for window in windows)} | "
+                f"ส่งซ้ำ {stats['qos_retransmitted']} | "
+                f"ทิ้ง {stats['qos_dropped'] + sum(window.dropped for window in windows)}"
+            )
+        backpressure = self.backpressure_stats.snapshot()
+        self.logger.info(
+            f"🚦 Backpressure ({self.outbound_limits.policy}): "
+            f"เกิน high watermark {backpressure['high_watermark']} | "
+            f"ทิ้งเก่า {backpressure['dropped_oldest']} | ทิ้งใหม่ {backpressure['dropped_newest']} | "
+            f"รวมค่า {backpressure['conflated']} | หยุดผู้ publish {backpressure['paused']} | "
+            f"ตัดการเชื่อมต่อ {backpressure['disconnected']}"
+        )
+        for name, locks in self.lock_stats().items():
+            self.logger.info(
+                f"🔒 Lock {name} ({locks['locks']} shard): ได้ lock {locks['acquired']} ครั้ง | "
+                f"ต้องรอ {locks['contended']} ({locks['contention']:.2%}) เฉลี่ย {locks['wait_us']:.1f} µs | "
+                f"ถือเฉลี่ย {locks['hold_us']:.1f} µs นานสุด {locks['max_hold_us']:.0f} µs"
+            )
+        if self.latency.enabled:
+            latency = self.latency.snapshot()
+            self.logger.info("⏱️ Latency (p50 / p99 / p999): " + " | ".join(
+                f"{stage} " + " / ".join(f"{value / 1000:.0f}" for value in latency[('', stage)]['quantiles'])
+                + f" µs ({latency[('', stage)]['count']})"
+                for stage in STAGES
+            ))
+        logs = self.log_pipeline.stats()
+        self.logger.info(
+            f"📝 Log: รอเขียน {logs['queued']} | ทิ้งเพราะคิวเต็ม {logs['dropped']} | "
+            f"ข้ามตามโควตา publish {self.publish_log.suppressed} client {self.client_log.suppressed}"
+        )
         self.logger.info("================================")
         
+    def lock_stats(self):
+        """
+        🔒 สถิติ lock ของแต่ละกลุ่ม (จำนวนครั้งที่ต้องรอและเวลาที่ถือ lock)
+        
+        Returns:
+            dict: ชื่อกลุ่ม -> สถิติรวมของทุก shard ในกลุ่ม
+        """
+        locks = {
+            'clients': self.clients.lock_stats(),
+            'subscriptions': self.subscriptions.lock_stats(),
+            'topics': self.topics.lock_stats()
+        }
+        if self.retained is not None:
+            locks['retained'] = self.retained.lock_stats()
+        return locks
+        
     def stop(self):
         """
         🛑 หยุดการทำงานของ Broker
@@ -482,11 +2361,12 @@ class MQTTBroker:
         
         self.running = False
         
-        # ปิดการเชื่อมต่อของ client ทั้งหมด
-        with self.lock:
-            client_ids = list(self.clients.keys())
+        # หยุด event loop (ถ้าใช้ asyncio engine)
+        if self.async_engine:
+            self.async_engine.stop()
         
-        for client_id in client_ids:
+        # ปิดการเชื่อมต่อของ client ทั้งหมด
+        for client_id in self.clients.keys():
             self.disconnect_client(client_id)
         
         # ปิด server socket
@@ -496,7 +2376,30 @@ class MQTTBroker:
             except:
                 pass
         
+        # หยุด timer ส่งซ้ำของ QoS 1
+        self.timers.stop()
+        
+        # ลบไฟล์ข้อความที่ค้างของ session ถาวร (session อยู่ในหน่วยความจำเท่านั้น)
+        if self.sessions is not None:
+            self.sessions.close()
+        
+        # fsync ข้อความที่ค้างใน log (และส่งข้อความที่รอ fsync อยู่)
+        if self.message_log is not None:
+            self.message_log.close()
+        
+        # เขียน retained message ที่ค้างลงดิสก์
+        if self.retained is not None:
+            self.retained.close()
+        
         self.logger.info("✅ MQTT Broker หยุดทำงานแล้ว")
+        
+        # ปิด endpoint /metrics
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        
+        # เขียน log ที่ค้างในคิวให้หมดแล้วหยุด thread เขียน log
+        self.log_pipeline.stop()
 
 
 # ========================================
@@ -510,8 +2413,15 @@ def main():
     print("🚀 เตรียมเริ่ม Simple MQTT Broker")
     print("=" * 50)
     
+    # อ่านการตั้งค่าจาก config.json
+    config = BrokerConfig()
+    
     # สร้าง broker instance
-    broker = MQTTBroker(host='localhost', port=1883)
+    broker = MQTTBroker(
+        host=config.get_broker_host(),
+        port=config.get_broker_port(),
+        config=config
+    )
     
     try:
         # เริ่มทำงาน
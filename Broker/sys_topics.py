@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📡 สถิติของ Broker ใน topic $SYS
+===============================
+
+broker publish สถิติของตัวเองเป็นข้อความปกติใน topic $SYS/broker/... ทุก interval วินาที
+dashboard ที่ใช้ MQTTSubscriber อยู่แล้วจึงดูสถิติได้ด้วยการ subscribe '$SYS/#'
+
+- ไม่มีใคร subscribe อะไรใต้ $SYS เลย: แต่ละรอบแค่ดูว่า trie มีกิ่ง $SYS ไหม และอ่านตัวนับของค่าต่อวินาที
+  (ค่าแรกหลังมีคน subscribe จึงเป็นค่าของรอบล่าสุด ไม่ใช่ค่าเฉลี่ยตลอดช่วงที่ไม่มีผู้รับ)
+  ไม่แปลงค่าเป็นข้อความ และไม่ส่งอะไร
+- ค่าอ่านจากตัวนับที่ broker ปรับอยู่แล้วระหว่างทำงาน (StatCounter ฯลฯ) ไม่เดินดู client หรือ topic
+- ส่งเฉพาะค่าที่เปลี่ยนจากรอบก่อน แต่เมื่อ subscription ใต้ $SYS เปลี่ยน (เช่น มีคน subscribe ใหม่)
+  จะส่งครบทุกค่าอีกครั้ง ผู้ที่เพิ่ง subscribe จึงได้ค่าครบในรอบถัดไป
+- wildcard ระดับแรก ('#', '+/...') ไม่ตรงกับ $SYS ตามมาตรฐาน MQTT ต้อง subscribe '$SYS/...' ตรงๆ
+"""
+
+from metrics import RateGauge
+
+SYS_PREFIX = '$SYS'
+
+
+def _format_value(value):
+    """🔢 ค่าเป็นข้อความ (float ใช้ทศนิยมสองตำแหน่ง)"""
+    if isinstance(value, float):
+        return f'{value:.2f}'
+    return str(value)
+
+
+class SysTopics:
+    """
+    📡 ค่าทั้งหมดใน $SYS/broker/... และการ publish เป็นรอบ
+
+    Args:
+        subscriptions (ShardedTopicTrie): subscription ของ broker (ใช้ดูว่ามีใครรอรับ $SYS อยู่ไหม)
+        publish (Callable): publish(topic, payload) ส่งข้อความให้ subscriber ที่เชื่อมต่ออยู่
+    """
+
+    def __init__(self, subscriptions, publish):
+        self.subscriptions = subscriptions
+        self.publish = publish
+        self.entries = []           # [topic, read, payload ที่ส่งล่าสุด]
+        self.rates = []
+        self.branch = None          # กิ่ง $SYS ของ trie ตอนส่งรอบก่อน (None = ไม่มีใคร subscribe)
+        self.published = 0
+
+    def value(self, name, read):
+        """
+        ➕ ค่าหนึ่งตัวที่ $SYS/broker/<name>
+
+        Args:
+            name (str): ชื่อที่ต่อท้าย $SYS/broker/ เช่น 'clients/connected'
+            read (Callable): ฟังก์ชันที่คืนค่าปัจจุบัน (เรียกเฉพาะรอบที่มีผู้รับ)
+        """
+        self.entries.append([f'{SYS_PREFIX}/broker/{name}', read, None])
+
+    def rate(self, name, read):
+        """⏱️ ค่าต่อวินาทีของ counter ระหว่างสองรอบที่ส่ง"""
+        rate = RateGauge(read)
+        self.rates.append(rate)
+        self.value(name, lambda: rate.rate)
+
+    def tick(self):
+        """
+        🔄 ส่งค่าที่เปลี่ยนให้ subscriber ของ $SYS (ไม่มีผู้รับ = ไม่ทำอะไร)
+
+        Returns:
+            int: จำนวนข้อความที่ส่ง
+        """
+        # ค่าต่อวินาทีคำนวณทุกรอบแม้ไม่มีผู้รับ (แค่อ่านตัวนับ) ค่าที่ส่งจึงเป็นของรอบล่าสุดเสมอ
+        for rate in self.rates:
+            rate.update()
+        # node ของ trie ไม่เปลี่ยนหลังเผยแพร่: กิ่งเป็น object ใหม่เมื่อ subscription ใต้ $SYS เปลี่ยนเท่านั้น
+        branch = self.subscriptions.branch(SYS_PREFIX)
+        if branch is None:
+            self.branch = None
+            return 0
+        resend = branch is not self.branch
+        self.branch = branch
+        sent = 0
+        for entry in self.entries:
+            payload = _format_value(entry[1]())
+            if resend or payload != entry[2]:
+                entry[2] = payload
+                self.publish(entry[0], payload)
+                sent += 1
+        self.published += sent
+        return sent
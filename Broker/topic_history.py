@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🕘 ประวัติข้อความของแต่ละ Topic
+==============================
+
+เก็บข้อความล่าสุด N ข้อความของแต่ละ topic (N = topics.max_messages_per_topic)
+ใน ring buffer ขนาดคงที่: ข้อมูลแต่ละช่องอยู่ใน list คู่ขนานที่จองไว้ตั้งแต่สร้าง
+การเพิ่มข้อความจึงเป็น O(1) ไม่สร้าง list ใหม่และไม่ต้องเลื่อนข้อมูล
+(ข้อความใหม่เขียนทับช่องของข้อความเก่าสุดเมื่อเต็ม)
+
+ถ้ากำหนดงบ byte รวม (topics.max_total_bytes) งบจะแบ่งเท่าๆ กันให้แต่ละ shard
+เมื่อ shard ใช้เกินงบ topic ที่เพิ่ง publish จะทิ้งข้อความเก่าของตัวเองก่อน
+ข้อความล่าสุดของทุก topic เก็บไว้เสมอ (ใช้ส่งให้ client ที่เพิ่ง subscribe)
+
+topic ในแต่ละ shard เรียงตามเวลาที่ publish ล่าสุด (LRU) จึงทิ้ง topic ได้โดยไม่ต้องสแกนทั้งหมด:
+- max_topics: เมื่อมี topic ใหม่และ shard เต็ม topic ที่เงียบนานที่สุดใน shard จะถูกทิ้ง
+- sweep_idle(): ทิ้ง topic ที่ไม่มีการ publish นานเกินกำหนด ดูเฉพาะหัวแถวของแต่ละ shard
+  และปล่อย lock ทุก batch (เรียกเป็นระยะจาก thread ทำความสะอาดของ broker)
+"""
+
+import time
+from collections import OrderedDict
+
+from sharded_state import ShardedMap, DEFAULT_SHARDS
+from topic_trie import topic_matches
+
+
+def payload_size(payload):
+    """
+    📏 ประมาณขนาดของ payload (byte) สำหรับงบ byte ของประวัติ
+
+    bytes ใช้ความยาวจริง ข้อความใช้จำนวนตัวอักษร ค่าอื่นใช้ความยาวของ str()
+    """
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray, str)):
+        return len(payload)
+    return len(str(payload))
+
+
+class TopicRing:
+    """
+    🔁 ring buffer ขนาดคงที่ของ topic หนึ่ง
+
+    Args:
+        capacity (int): จำนวนข้อความสูงสุดที่เก็บ
+    """
+
+    __slots__ = ('capacity', 'payloads', 'client_ids', 'timestamps', 'qos', 'sizes',
+                 'head', 'count', 'bytes', 'last_active')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.payloads = [None] * capacity
+        self.client_ids = [None] * capacity
+        self.timestamps = [None] * capacity
+        self.qos = [0] * capacity
+        self.sizes = [0] * capacity
+        self.head = 0       # ช่องที่จะเขียนข้อความถัดไป
+        self.count = 0
+        self.bytes = 0
+        self.last_active = 0.0  # time.monotonic() ของการ publish ครั้งล่าสุด
+
+    def append(self, payload, client_id, timestamp, qos=0, size=0):
+        """
+        ➕ เพิ่มข้อความ (เขียนทับข้อความเก่าสุดถ้าเต็ม)
+
+        Returns:
+            int: จำนวน byte ที่คืนจากข้อความที่ถูกเขียนทับ
+        """
+        index = self.head
+        freed = self.sizes[index] if self.count == self.capacity else 0
+
+        self.payloads[index] = payload
+        self.client_ids[index] = client_id
+        self.timestamps[index] = timestamp
+        self.qos[index] = qos
+        self.sizes[index] = size
+
+        self.head = (index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        self.bytes += size - freed
+        return freed
+
+    def drop_oldest(self):
+        """
+        🗑️ ทิ้งข้อความเก่าสุด
+
+        Returns:
+            int: จำนวน byte ที่คืน
+        """
+        if not self.count:
+            return 0
+        index = (self.head - self.count) % self.capacity
+        freed = self.sizes[index]
+        self.payloads[index] = None
+        self.client_ids[index] = None
+        self.timestamps[index] = None
+        self.sizes[index] = 0
+        self.count -= 1
+        self.bytes -= freed
+        return freed
+
+    def _record(self, index):
+        return {
+            'payload': self.payloads[index],
+            'client_id': self.client_ids[index],
+            'timestamp': self.timestamps[index],
+            'qos': self.qos[index]
+        }
+
+    def latest(self):
+        """🆕 ข้อความล่าสุดในรูป dict (None ถ้ายังไม่มี)"""
+        if not self.count:
+            return None
+        return self._record((self.head - 1) % self.capacity)
+
+    def messages(self):
+        """📜 ทุกข้อความเรียงจากเก่าไปใหม่"""
+        start = self.head - self.count
+        return [self._record((start + offset) % self.capacity) for offset in range(self.count)]
+
+    def __len__(self):
+        return self.count
+
+
+class _TopicTable(OrderedDict):
+    """📂 topic -> TopicRing ของหนึ่ง shard เรียงจาก topic ที่เงียบนานที่สุด พร้อมตัวนับของ shard"""
+
+    __slots__ = ('bytes', 'messages', 'trimmed', 'evicted')
+
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+        self.messages = 0   # จำนวนข้อความที่เก็บอยู่ (ปรับทุกครั้งที่เพิ่ม/ทิ้ง stats() จึงไม่ต้องนับใหม่)
+        self.trimmed = 0    # จำนวนข้อความที่ทิ้งเพราะเกินงบ byte
+        self.evicted = 0    # จำนวน topic ที่ถูกทิ้ง (เงียบนานเกินไป หรือ shard เต็ม)
+
+    def evict_oldest(self):
+        """🗑️ ทิ้ง topic ที่เงียบนานที่สุด"""
+        _, ring = self.popitem(last=False)
+        self.bytes -= ring.bytes
+        self.messages -= ring.count
+        self.evicted += 1
+
+
+class TopicHistory:
+    """
+    🕘 ประวัติข้อความของทุก topic แบ่ง shard ตามชื่อ topic (ดู ShardedMap)
+
+    Args:
+        depth (int): จำนวนข้อความที่เก็บต่อ topic (อย่างน้อย 1)
+        max_bytes (int): งบ byte รวมของทุก topic (0 = ไม่จำกัด)
+        max_topics (int): จำนวน topic สูงสุดที่เก็บประวัติ (0 = ไม่จำกัด) แบ่งเท่าๆ กันต่อ shard
+        shard_count (int): จำนวน shard
+    """
+
+    def __init__(self, depth=10, max_bytes=0, max_topics=0, shard_count=DEFAULT_SHARDS):
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.max_topics = max_topics
+        self.rings = ShardedMap('topics', shard_count, factory=_TopicTable)
+        shards = len(self.rings.shards)
+        self.shard_budget = max_bytes // shards if max_bytes else 0
+        self.shard_topic_limit = -(-max_topics // shards) if max_topics else 0
+
+    def append(self, topic, payload, client_id, timestamp, qos=0):
+        """➕ เก็บข้อความใหม่ของ topic"""
+        budget = self.shard_budget
+        size = payload_size(payload) if budget else 0
+
+        shard = self.rings.shard(topic)
+        with shard.lock:
+            table = shard.data
+            ring = table.get(topic)
+            if ring is None:
+                if self.shard_topic_limit and len(table) >= self.shard_topic_limit:
+                    table.evict_oldest()
+                ring = table[topic] = TopicRing(self.depth)
+            else:
+                table.move_to_end(topic)
+            ring.last_active = time.monotonic()
+            count = ring.count
+            table.bytes += size - ring.append(payload, client_id, timestamp, qos, size)
+            table.messages += ring.count - count
+
+            # เกินงบ: ทิ้งข้อความเก่าของ topic นี้ (เก็บข้อความล่าสุดไว้เสมอ)
+            while budget and table.bytes > budget and ring.count > 1:
+                table.bytes -= ring.drop_oldest()
+                table.messages -= 1
+                table.trimmed += 1
+
+    def latest(self, topic):
+        """🆕 ข้อความล่าสุดของ topic (None ถ้าไม่มี)"""
+        shard = self.rings.shard(topic)
+        with shard.lock:
+            ring = shard.data.get(topic)
+            return ring.latest() if ring is not None else None
+
+    def latest_matching(self, topic_filter):
+        """
+        🔎 ข้อความล่าสุดของทุก topic ที่ตรงกับ filter (ถือ lock ทีละ shard)
+
+        Returns:
+            list: [(topic, message), ...]
+        """
+        latest = []
+        for shard in self.rings.shards:
+            with shard.lock:
+                latest.extend(
+                    (topic, ring.latest()) for topic, ring in shard.data.items()
+                    if ring.count and topic_matches(topic_filter, topic)
+                )
+        return latest
+
+    def messages(self, topic):
+        """📜 ประวัติของ topic เรียงจากเก่าไปใหม่"""
+        shard = self.rings.shard(topic)
+        with shard.lock:
+            ring = shard.data.get(topic)
+            return ring.messages() if ring is not None else []
+
+    def sweep_idle(self, max_idle, batch=256):
+        """
+        🧹 ทิ้งประวัติของ topic ที่ไม่มีการ publish นานเกิน max_idle วินาที
+
+        ดูจากหัวแถว LRU ของแต่ละ shard จึงแตะเฉพาะ topic ที่หมดอายุ
+        และถือ lock ครั้งละไม่เกิน batch topic
+
+        Returns:
+            int: จำนวน topic ที่ถูกทิ้ง
+        """
+        cutoff = time.monotonic() - max_idle
+        evicted = 0
+        for shard in self.rings.shards:
+            while True:
+                with shard.lock:
+                    table = shard.data
+                    count = 0
+                    while table and count < batch:
+                        ring = next(iter(table.values()))
+                        if ring.last_active > cutoff:
+                            break
+                        table.evict_oldest()
+                        count += 1
+                evicted += count
+                if count < batch:
+                    break
+        return evicted
+
+    def items(self):
+        """📋 (topic, TopicRing) ทั้งหมด"""
+        return self.rings.items()
+
+    def stats(self):
+        """📊 จำนวน topic, ข้อความ, byte, ข้อความที่ทิ้งเพราะเกินงบ และ topic ที่ถูกทิ้ง (อ่านตัวนับของแต่ละ shard)"""
+        topics = messages = used = trimmed = evicted = 0
+        for shard in self.rings.shards:
+            with shard.lock:
+                table = shard.data
+                topics += len(table)
+                messages += table.messages
+                used += table.bytes
+                trimmed += table.trimmed
+                evicted += table.evicted
+        return {
+            'topics': topics,
+            'messages': messages,
+            'bytes': used,
+            'trimmed': trimmed,
+            'evicted': evicted
+        }
+
+    def lock_stats(self):
+        return self.rings.lock_stats()
+
+    def __len__(self):
+        """📊 จำนวน topic ที่มีประวัติ"""
+        return len(self.rings)
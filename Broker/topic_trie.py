@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🌳 Topic Trie สำหรับจัดเก็บ Subscription
+=======================================
+
+เก็บ topic filter แยกตามระดับ (level) ที่คั่นด้วย '/'
+เช่น 'home/+/status' จะเก็บเป็น home -> + -> status
+
+รองรับ wildcard ตามมาตรฐาน MQTT:
+- '+' แทนหนึ่งระดับพอดี     เช่น home/+/status ตรงกับ home/kitchen/status
+- '#' แทนทุกระดับที่เหลือ    เช่น sensor/# ตรงกับ sensor, sensor/a, sensor/a/b
+- filter ที่ขึ้นต้นด้วย wildcard จะไม่ตรงกับ topic ที่ขึ้นต้นด้วย '$' (เช่น $SYS/...)
+
+การหา subscriber ของ topic ที่ publish ใช้เวลาตามความลึกของ topic
+ไม่ขึ้นกับจำนวน subscription ทั้งหมด
+
+trie เป็นแบบ copy-on-write (RCU): node ที่เผยแพร่แล้วจะไม่ถูกแก้อีก
+subscribe / unsubscribe สร้าง node ใหม่เฉพาะตามเส้นทางของ filter นั้น
+แล้วสลับ snapshot ใหม่เข้าไปด้วยการกำหนด reference ครั้งเดียว
+ฝั่ง publish จึงอ่าน snapshot ที่สมบูรณ์ได้โดยไม่ต้องใช้ lock และไม่ต้อง copy อะไร
+(ผู้แก้ไขต้องเรียงคิวกันเอง เช่นถือ lock ของ shard ระหว่าง subscribe)
+
+ถ้าเปิด cache ผลการหาของ topic ที่ถูก publish บ่อยจะเก็บเป็น frozenset ไว้ใน snapshot (LRU)
+snapshot ใหม่ยกผลเดิมมาด้วย ตัดออกเฉพาะ topic ที่ filter ที่เปลี่ยนครอบคลุม
+ผลที่คำนวณจาก snapshot เก่าหลังจากนั้นถูกเก็บใน cache ของ snapshot เก่าซึ่งไม่มีใครอ่านแล้ว
+"""
+
+from collections import OrderedDict
+
+
+def is_valid_filter(topic_filter):
+    """
+    ✅ ตรวจสอบว่า topic filter ถูกต้องตามกฎ MQTT
+
+    - ห้ามว่าง
+    - '+' ต้องอยู่คนเดียวในระดับนั้น
+    - '#' ต้องอยู่คนเดียวและเป็นระดับสุดท้าย
+    """
+    if not topic_filter:
+        return False
+
+    levels = topic_filter.split('/')
+    for index, level in enumerate(levels):
+        if '#' in level:
+            if level != '#' or index != len(levels) - 1:
+                return False
+        elif '+' in level and level != '+':
+            return False
+    return True
+
+
+def has_wildcard(topic_filter):
+    """🔍 filter นี้มี wildcard หรือไม่"""
+    return '+' in topic_filter or '#' in topic_filter
+
+
+def topic_matches(topic_filter, topic):
+    """
+    🎯 ตรวจว่า topic ตรงกับ filter หรือไม่ (ใช้เมื่อต้องเทียบทีละคู่)
+
+    Args:
+        topic_filter (str): filter ที่อาจมี wildcard
+        topic (str): ชื่อ topic จริง
+    """
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+
+    if topic.startswith('$') and filter_levels[0] in ('+', '#'):
+        return False
+
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class MatchCache:
+    """
+    🎯 LRU cache: topic ที่ publish -> frozenset ของ subscriber (หนึ่งตัวต่อ snapshot)
+
+    ฝั่ง publish อ่าน เพิ่ม และเลื่อนลำดับได้โดยไม่ใช้ lock
+    ผู้แก้ trie ไม่แก้ cache ที่เผยแพร่แล้ว แต่สร้าง cache ของ snapshot ใหม่ด้วย without()
+
+    Args:
+        capacity (int): จำนวน topic สูงสุดที่เก็บไว้
+        entries (OrderedDict): ผลที่ยกมาจาก cache เดิม
+    """
+
+    __slots__ = ('capacity', 'entries')
+
+    def __init__(self, capacity, entries=None):
+        self.capacity = capacity
+        self.entries = OrderedDict() if entries is None else entries
+
+    def get(self, topic):
+        """🔍 ดึงผลที่เคยคำนวณไว้ (None ถ้าไม่มี)"""
+        subscribers = self.entries.get(topic)
+        if subscribers is not None:
+            try:
+                self.entries.move_to_end(topic)
+            except KeyError:
+                # ถูกดันออกจาก thread อื่นระหว่างนี้
+                pass
+        return subscribers
+
+    def put(self, topic, subscribers):
+        """
+        💾 เก็บผล และดันตัวที่ไม่ได้ใช้นานที่สุดออกเมื่อเกิน capacity
+
+        Returns:
+            int: จำนวนที่ดันออก
+        """
+        entries = self.entries
+        entries[topic] = subscribers
+        if len(entries) <= self.capacity:
+            return 0
+        try:
+            entries.popitem(last=False)
+        except KeyError:
+            # thread อื่นดันออกไปก่อนแล้ว
+            return 0
+        return 1
+
+    def without(self, topic_filter, wildcards):
+        """
+        🧹 cache ใหม่ที่มีผลเดิมทั้งหมด ยกเว้น topic ที่ filter นี้ครอบคลุม
+
+        Returns:
+            tuple: (MatchCache, จำนวนที่ตัดออก)
+        """
+        while True:
+            try:
+                entries = self.entries.copy()
+                break
+            except RuntimeError:
+                # ฝั่ง publish เลื่อนลำดับระหว่าง copy
+                continue
+        if wildcards and has_wildcard(topic_filter):
+            stale = [topic for topic in entries if topic_matches(topic_filter, topic)]
+        else:
+            stale = [topic_filter] if topic_filter in entries else []
+        for topic in stale:
+            del entries[topic]
+        return MatchCache(self.capacity, entries), len(stale)
+
+
+class _Node:
+    """🌿 หนึ่งระดับใน trie (ห้ามแก้หลังจากเผยแพร่ใน snapshot แล้ว)"""
+
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self, children=None, subscribers=frozenset()):
+        self.children = {} if children is None else children
+        self.subscribers = subscribers
+
+
+class _Snapshot:
+    """📸 subscription ทั้งหมด ณ เวลาหนึ่ง พร้อม cache ผลการ match ของ snapshot นี้"""
+
+    __slots__ = ('root', 'cache')
+
+    def __init__(self, root, cache=None):
+        self.root = root
+        self.cache = cache      # MatchCache (None = ไม่ใช้ cache)
+
+
+class TopicTrie:
+    """
+    🌳 ดัชนี subscription แบบ trie (อ่านพร้อมกันได้ไม่ต้องใช้ lock)
+
+    Args:
+        wildcards (bool): เปิดใช้ '+' และ '#' (ถ้าปิด จะถือเป็นตัวอักษรธรรมดา)
+        cache_size (int): ขนาด LRU cache ของผลการ match (0 = ไม่ใช้ cache)
+    """
+
+    def __init__(self, wildcards=True, cache_size=0):
+        self.wildcards = wildcards
+        self.cache_size = cache_size
+        self.snapshot = _Snapshot(_Node(), MatchCache(cache_size) if cache_size > 0 else None)
+        self.filter_count = 0
+        self.subscription_count = 0
+
+        # 📊 สถิติ (ฝั่งอ่านเพิ่มค่าโดยไม่ใช้ lock จึงอาจคลาดเคลื่อนเล็กน้อย)
+        self.snapshots = 0      # จำนวน snapshot ที่สร้างใหม่
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _publish(self, root, topic_filter):
+        """📸 เผยแพร่ root ใหม่ พร้อม cache ที่ตัด topic ที่ filter ที่เปลี่ยนครอบคลุมออกแล้ว"""
+        cache = self.snapshot.cache
+        if cache is not None:
+            cache, stale = cache.without(topic_filter, self.wildcards)
+            self.invalidations += stale
+        self.snapshot = _Snapshot(root, cache)
+        self.snapshots += 1
+
+    def invalidate(self, topic_filter):
+        """🧹 ตัดผลใน cache ที่ filter นี้ครอบคลุม (ใช้เมื่อ trie อื่นที่ถูกรวมผลด้วยเปลี่ยน)"""
+        if self.snapshot.cache is not None:
+            self._publish(self.snapshot.root, topic_filter)
+
+    def _path(self, levels):
+        """🚶 node ตามเส้นทางของ filter (None สำหรับระดับที่ยังไม่มี)"""
+        path = [self.snapshot.root]
+        node = path[0]
+        for level in levels:
+            node = node.children.get(level) if node is not None else None
+            path.append(node)
+        return path
+
+    @staticmethod
+    def _rebuild(path, levels, node):
+        """🔁 สร้าง node ใหม่จากล่างขึ้นบน แทนที่ node ท้ายเส้นทางด้วย node (None = ลบทิ้ง)"""
+        for depth in range(len(levels) - 1, -1, -1):
+            parent = path[depth]
+            children = dict(parent.children) if parent is not None else {}
+            if node is None:
+                children.pop(levels[depth], None)
+            else:
+                children[levels[depth]] = node
+            subscribers = parent.subscribers if parent is not None else frozenset()
+            if depth and not children and not subscribers:
+                node = None     # ตัดกิ่งที่ว่าง (ยกเว้น root)
+            else:
+                node = _Node(children, subscribers)
+        return node
+
+    def subscribe(self, topic_filter, subscriber):
+        """
+        ➕ เพิ่ม subscriber ให้ filter
+
+        Returns:
+            bool: True ถ้า filter นี้เพิ่งมี subscriber ตัวแรก
+        """
+        levels = topic_filter.split('/')
+        path = self._path(levels)
+        leaf = path[-1]
+        if leaf is not None and subscriber in leaf.subscribers:
+            return False
+
+        first = leaf is None or not leaf.subscribers
+        if leaf is None:
+            leaf = _Node(subscribers=frozenset((subscriber,)))
+        else:
+            leaf = _Node(leaf.children, leaf.subscribers | {subscriber})
+        self._publish(self._rebuild(path, levels, leaf), topic_filter)
+
+        self.subscription_count += 1
+        if first:
+            self.filter_count += 1
+        return first
+
+    def unsubscribe(self, topic_filter, subscriber):
+        """
+        ➖ ลบ subscriber ออกจาก filter (และลบ node ที่ไม่มีใครใช้แล้ว)
+
+        Returns:
+            bool: True ถ้า filter นี้ไม่เหลือ subscriber แล้ว
+        """
+        levels = topic_filter.split('/')
+        path = self._path(levels)
+        leaf = path[-1]
+        if leaf is None or subscriber not in leaf.subscribers:
+            return False
+
+        subscribers = leaf.subscribers - {subscriber}
+        if subscribers or leaf.children:
+            leaf = _Node(leaf.children, subscribers)
+        else:
+            leaf = None
+        self._publish(self._rebuild(path, levels, leaf), topic_filter)
+
+        self.subscription_count -= 1
+        if subscribers:
+            return False
+        self.filter_count -= 1
+        return True
+
+    def subscribers(self, topic_filter):
+        """👥 subscriber ของ filter นี้ (ตรงตัว ไม่ใช้ wildcard)"""
+        node = self._path(topic_filter.split('/'))[-1]
+        return node.subscribers if node is not None else frozenset()
+
+    def branch(self, level):
+        """
+        🌿 node ของระดับแรก (เช่น '$SYS') ใช้ดูว่ามี filter ใต้ระดับนี้ไหมโดยไม่ใช้ lock
+
+        กิ่งที่ว่างถูกตัดเสมอ จึงได้ None เมื่อไม่มี subscriber ใต้ระดับนี้เลย
+        และได้ object ใหม่ทุกครั้งที่ subscription ใต้ระดับนี้เปลี่ยน
+        """
+        return self.snapshot.root.children.get(level)
+
+    def match(self, topic, also=None):
+        """
+        🎯 หา subscriber ทั้งหมดที่ filter ตรงกับ topic ที่ publish (ผ่าน cache ถ้าเปิดไว้)
+
+        Args:
+            topic (str): ชื่อ topic (ไม่มี wildcard)
+            also (TopicTrie): trie อื่นที่ต้องรวมผลด้วย ผู้เรียกต้อง invalidate(filter) trie นี้
+                ทุกครั้งที่ also เปลี่ยน เพื่อไม่ให้ผลรวมใน cache ค้าง
+
+        Returns:
+            frozenset: subscriber ที่ตรงกัน
+        """
+        # อ่าน snapshot ของตัวเองก่อน also เสมอ (ผลรวมจะถูกเก็บใน snapshot ที่อ่านมาเท่านั้น)
+        snapshot = self.snapshot
+        cache = snapshot.cache
+        if cache is not None:
+            subscribers = cache.get(topic)
+            if subscribers is not None:
+                self.hits += 1
+                return subscribers
+
+        result = self._walk(snapshot.root, topic)
+        if also is not None:
+            result |= also._walk(also.snapshot.root, topic)
+        subscribers = frozenset(result)
+
+        if cache is not None:
+            self.misses += 1
+            self.evictions += cache.put(topic, subscribers)
+        return subscribers
+
+    def _walk(self, root, topic):
+        """🚶 เดินใน trie ทีละระดับเพื่อหา subscriber ที่ตรงกับ topic"""
+        result = set()
+        wildcards = self.wildcards
+        # topic ที่ขึ้นต้นด้วย $ ไม่ให้ wildcard ระดับแรกจับได้
+        system_topic = topic.startswith('$')
+        nodes = [root]
+
+        for depth, level in enumerate(topic.split('/')):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if wildcards and not (depth == 0 and system_topic):
+                    multi = children.get('#')
+                    if multi is not None:
+                        result |= multi.subscribers
+                    single = children.get('+')
+                    if single is not None:
+                        next_nodes.append(single)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return result
+
+        for node in nodes:
+            result |= node.subscribers
+            if wildcards:
+                # 'a/#' ตรงกับ 'a' ด้วย
+                multi = node.children.get('#')
+                if multi is not None:
+                    result |= multi.subscribers
+        return result
+
+    def cache_stats(self):
+        """📊 สถิติของ cache (None ถ้าไม่ได้เปิด cache)"""
+        if not self.cache_size:
+            return None
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.snapshot.cache.entries),
+            'capacity': self.cache_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'snapshots': self.snapshots,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def __contains__(self, topic_filter):
+        node = self._path(topic_filter.split('/'))[-1]
+        return node is not None and bool(node.subscribers)
+
+    def __len__(self):
+        """📊 จำนวน filter ที่มี subscriber อยู่"""
+        return self.filter_count
@@ -13,6 +13,7 @@ Subscriber นี้จะ:
 
 import socket
 import json
+import base64
 import threading
 import time
 import logging
@@ -31,18 +32,22 @@ class MQTTSubscriber:
     รับผิดชอบการเชื่อมต่อกับ Broker และรับข้อมูล
     """
     
-    def __init__(self, broker_host='localhost', broker_port=1883, client_id=None):
+    def __init__(self, broker_host='localhost', broker_port=1883, client_id=None, clean_session=True):
         """
         🔧 เตรียมตัวแปรสำหรับ Subscriber
         
         Args:
             broker_host (str): ที่อยู่ของ MQTT Broker
             broker_port (int): พอร์ตของ Broker
-            client_id (str): ID ของ Client นี้
+            client_id (str): ID ของ Client นี้ (ใช้ค่าเดิมทุกครั้งที่เชื่อมต่อถ้าต้องการ session เดิม)
+            clean_session (bool): False = ขอ session ถาวร broker จะจำ subscription
+                                  และเก็บข้อความระหว่างที่หลุดไว้ส่งให้ตอนเชื่อมต่อใหม่
         """
         self.broker_host = broker_host
         self.broker_port = broker_port
         self.client_id = client_id or f"subscriber_{int(time.time())}"
+        self.clean_session = clean_session
+        self.session_present = False   # broker มี session เดิมของ client id นี้ (ได้จาก connack)
         
         # การเชื่อมต่อ
         self.socket = None
@@ -53,6 +58,8 @@ class MQTTSubscriber:
         self.subscribed_topics = set()
         self.message_handlers = {}
         self.default_handler = None
+        self.replay_requests = {}      # topic filter -> handler และ callback ของ replay ที่รออยู่
+        self.last_offset = None        # offset ล่าสุดที่ได้รับ (ใช้ขอ replay ต่อหลังเริ่มใหม่)
         
         # สถิติ
         self.stats = {
@@ -141,6 +148,13 @@ class MQTTSubscriber:
             
             self.logger.info(f"✅ เชื่อมต่อสำเร็จ! Client ID: {self.client_id}")
             
+            # แจ้ง client id (และขอ session ถาวรถ้า clean_session=False) ก่อนข้อความอื่น
+            self._send_message({
+                'type': 'connect',
+                'client_id': self.client_id,
+                'clean_session': self.clean_session
+            })
+            
             # เริ่ม thread สำหรับรับข้อความ
             self.receive_thread = threading.Thread(target=self._receive_messages)
             self.receive_thread.daemon = True
@@ -158,13 +172,14 @@ class MQTTSubscriber:
             self.stats['errors'] += 1
             return False
             
-    def subscribe(self, topic: str, handler: Callable = None):
+    def subscribe(self, topic: str, handler: Callable = None, qos: int = 0):
         """
         📥 Subscribe Topic
         
         Args:
             topic (str): Topic ที่ต้องการ subscribe
             handler (Callable): Function สำหรับจัดการข้อความ (optional)
+            qos (int): 1 = ให้ broker ส่งซ้ำจนกว่าจะตอบ puback (ตอบให้อัตโนมัติหลัง handler ทำงานเสร็จ)
         """
         if not self.connected:
             self.logger.error("❌ ไม่ได้เชื่อมต่อกับ Broker")
@@ -175,6 +190,7 @@ class MQTTSubscriber:
             message = {
                 'type': 'subscribe',
                 'topic': topic,
+                'qos': qos,
                 'client_id': self.client_id
             }
             
@@ -187,7 +203,7 @@ class MQTTSubscriber:
             
             self.stats['topics_count'] = len(self.subscribed_topics)
             
-            self.logger.info(f"📥 Subscribe topic: '{topic}' เรียบร้อย")
+            self.logger.info(f"📥 Subscribe topic: '{topic}' (QoS {qos}) เรียบร้อย")
             return True
             
         except Exception as e:
@@ -231,6 +247,50 @@ class MQTTSubscriber:
             self.stats['errors'] += 1
             return False
             
+    def replay(self, topic: str, from_offset: int = None, from_time=None, handler: Callable = None,
+               on_complete: Callable = None, limit: int = None):
+        """
+        ⏪ ขอข้อความที่ Broker เก็บไว้ (ต้องเปิด durable log ที่ Broker)
+        
+        Broker ส่งข้อความกลับมาทีละ chunk ตามปกติ (type 'message' ที่มี 'offset' และ 'replay')
+        แล้วปิดท้ายด้วย replay_end ที่บอก offset ถัดไปสำหรับขอต่อครั้งหน้า
+        
+        Args:
+            topic (str): Topic หรือ filter (รองรับ + และ #)
+            from_offset (int): เริ่มจาก offset นี้ (เช่น self.last_offset + 1)
+            from_time (datetime | float): เริ่มจากเวลานี้แทน offset
+            handler (Callable): Function สำหรับข้อความที่ replay (ไม่ระบุ = ใช้ handler ปกติ)
+            on_complete (Callable): เรียก on_complete(next_offset, count) เมื่อ replay ครบ
+            limit (int): จำนวนข้อความสูงสุด
+        """
+        if not self.connected:
+            self.logger.error("❌ ไม่ได้เชื่อมต่อกับ Broker")
+            return False
+        
+        try:
+            message = {
+                'type': 'replay',
+                'topic': topic,
+                'client_id': self.client_id
+            }
+            if from_offset is not None:
+                message['from_offset'] = from_offset
+            if from_time is not None:
+                message['from_time'] = from_time.isoformat() if isinstance(from_time, datetime) else from_time
+            if limit:
+                message['limit'] = limit
+            
+            self.replay_requests[topic] = {'handler': handler, 'on_complete': on_complete}
+            self._send_message(message)
+            
+            self.logger.info(f"⏪ ขอ replay topic: '{topic}'")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ ไม่สามารถขอ replay '{topic}': {e}")
+            self.stats['errors'] += 1
+            return False
+            
     def set_default_handler(self, handler: Callable):
         """
         🎯 ตั้งค่า Handler เริ่มต้นสำหรับข้อความที่ไม่มี Handler เฉพาะ
@@ -305,6 +365,10 @@ class MQTTSubscriber:
                 self._handle_data_message(message)
             elif msg_type == 'pong':
                 self._handle_pong(message)
+            elif msg_type == 'replay_end':
+                self._handle_replay_end(message)
+            elif msg_type == 'connack':
+                self._handle_connack(message)
             else:
                 self.logger.debug(f"📬 ได้รับข้อความประเภท: {msg_type}")
                 
@@ -380,12 +444,17 @@ class MQTTSubscriber:
         """
         topic = message.get('topic', 'unknown')
         payload = message.get('payload', '')
+        if message.get('payload_encoding') == 'base64':
+            # payload ที่ไม่ใช่ UTF-8 จาก MQTT client มาเป็น base64
+            payload = base64.b64decode(payload)
         timestamp = message.get('timestamp', datetime.now().isoformat())
         from_client = message.get('from_client', 'unknown')
         
         # อัพเดทสถิติ
         self.stats['messages_received'] += 1
         self.stats['last_message_time'] = datetime.now()
+        if message.get('offset') is not None:
+            self.last_offset = max(self.last_offset or 0, message['offset'])
         
         # สร้างข้อความ log แบบสวยงาม
         log_msg = f"MSG | Topic: {Fore.CYAN}{topic}{Style.RESET_ALL} | "
@@ -394,8 +463,15 @@ class MQTTSubscriber:
         
         self.logger.info(log_msg)
         
+        # ข้อความจาก replay ใช้ handler ที่ให้ไว้ตอนขอ replay (ถ้ามี)
+        replay = self.replay_requests.get(message.get('replay'))
+        if replay and replay['handler']:
+            try:
+                replay['handler'](topic, payload, message)
+            except Exception as e:
+                self.logger.error(f"❌ Error in replay handler for '{topic}': {e}")
         # เรียก handler ถ้ามี
-        if topic in self.message_handlers:
+        elif topic in self.message_handlers:
             try:
                 self.message_handlers[topic](topic, payload, message)
             except Exception as e:
@@ -405,7 +481,45 @@ class MQTTSubscriber:
                 self.default_handler(topic, payload, message)
             except Exception as e:
                 self.logger.error(f"❌ Error in default handler: {e}")
+        
+        # ข้อความ QoS 1: ตอบ puback หลังจัดการเสร็จ (ถ้าไม่ตอบ broker จะส่งซ้ำ)
+        if message.get('packet_id') is not None:
+            self._send_message({'type': 'puback', 'packet_id': message['packet_id']})
                 
+    def _handle_replay_end(self, message: dict):
+        """
+        ⏹️ Broker ส่ง replay ครบแล้ว
+        """
+        topic = message.get('replay')
+        replay = self.replay_requests.pop(topic, None)
+        if message.get('error'):
+            self.logger.error(f"❌ replay '{topic}' ไม่สำเร็จ: {message['error']}")
+            return
+        
+        self.logger.info(
+            f"⏪ replay '{topic}' ครบ {message.get('count', 0)} ข้อความ "
+            f"(offset ถัดไป {message.get('next_offset')})"
+        )
+        if replay and replay['on_complete']:
+            try:
+                replay['on_complete'](message.get('next_offset'), message.get('count', 0))
+            except Exception as e:
+                self.logger.error(f"❌ Error in replay callback for '{topic}': {e}")
+        
+    def _handle_connack(self, message: dict):
+        """
+        🤝 Broker ตอบ connect (บอกว่ามี session เดิมและข้อความที่ค้างอยู่กี่ข้อความ)
+        """
+        if message.get('error'):
+            self.logger.error(f"❌ Broker ไม่รับ connect: {message['error']}")
+            return
+        
+        self.session_present = message.get('session_present', False)
+        if self.session_present:
+            self.logger.info(
+                f"💤 ได้ session เดิมกลับมา (subscription เดิม และข้อความที่ค้าง {message.get('queued', 0)} ข้อความ)"
+            )
+        
     def _handle_pong(self, message: dict):
         """
         🏓 จัดการข้อความ pong